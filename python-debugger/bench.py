@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Recorder overhead benchmarks
+Run each workload untraced and traced and report what cdebugger costs
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TESTING_FILES = os.path.join(HERE, "..", "TestingFiles")
+
+# name, script, stdin, runs of the script per process. Scripts that read
+# stdin run once, since a second run would find it empty.
+WORKLOADS = [
+    ("tight_loop", os.path.join(HERE, "benchmarks", "tight_loop.py"), "", 1),
+    ("recursion", os.path.join(HERE, "benchmarks", "recursion.py"), "", 1),
+    ("containers", os.path.join(HERE, "benchmarks", "containers.py"), "", 1),
+    ("many_globals", os.path.join(HERE, "benchmarks", "many_globals.py"), "", 1),
+    # Answers "n" to the interactive input tests
+    ("Test.py", os.path.join(TESTING_FILES, "Test.py"), "n\n", 1),
+    # Raises KeyError by design; the run still counts
+    ("bank_sim.py", os.path.join(TESTING_FILES, "bank_sim.py"), "", 50),
+]
+
+# untraced: no recorder. hooks: the recorder runs but every file is
+# excluded, so only event dispatch is paid. traced: full recording.
+MODES = ("untraced", "hooks", "traced")
+
+# Metrics printed by the table and compared across runs, with their format
+COLUMNS = [
+    ("slowdown", "slowdown", "{:.1f}x"),
+    ("ns_per_event", "ns/event", "{:.0f}"),
+    ("hook_ns_per_event", "hook ns", "{:.0f}"),
+    ("record_ns_per_event", "record ns", "{:.0f}"),
+    ("bytes_per_event", "bytes/event", "{:.2f}"),
+    ("peak_rss_kb", "peak RSS KB", "{:.0f}"),
+]
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KB"""
+    import resource
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KB
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run_child(script, runs, mode, trace_file, options):
+    """Run a workload in this process and return its measurements"""
+    with open(script, "r") as f:
+        code = compile(f.read(), script, "exec")
+    sys.argv = [script]
+    sys.path.insert(0, os.path.dirname(script))
+    sys.stdout = open(os.devnull, "w")
+
+    if mode != "untraced":
+        import cdebugger
+
+        if mode == "hooks":
+            options = dict(options, include=None, exclude=["*"])
+        cdebugger.start_trace(trace_file, **options)
+        backend = cdebugger.get_backend()
+
+    raised = None
+    start = time.perf_counter()
+    for _ in range(runs):
+        globals_dict = {"__name__": "__main__", "__file__": script}
+        try:
+            exec(code, globals_dict)
+        except Exception as e:
+            raised = type(e).__name__
+
+    result = {"raised": raised}
+    if mode != "untraced":
+        # Flushing the last blocks is part of the recorder's cost
+        cdebugger.stop_trace()
+        result["backend"] = backend
+        result["stats"] = cdebugger.get_stats()
+    result["seconds"] = time.perf_counter() - start
+    result["peak_rss_kb"] = peak_rss_kb()
+    return result
+
+
+def run_workload(script, stdin, runs, mode, options):
+    """Run a workload in a fresh interpreter and return its measurements"""
+    workdir = tempfile.mkdtemp(prefix="cdebugger-bench-")
+    try:
+        request = {
+            "script": os.path.abspath(script),
+            "runs": runs,
+            "mode": mode,
+            "trace_file": os.path.join(workdir, "trace.log"),
+            "options": options,
+        }
+        result_file = os.path.join(workdir, "result.json")
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [HERE, env.get("PYTHONPATH")]))
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", json.dumps(request), result_file],
+            input=stdin.encode(),
+            cwd=os.path.dirname(request["script"]),
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        with open(result_file, "r") as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure(script, stdin, runs, options, repeat):
+    """Benchmark one workload: the fastest of repeat runs in each mode"""
+    best = {}
+    for mode in MODES:
+        results = [run_workload(script, stdin, runs, mode, options) for _ in range(repeat)]
+        fastest = min(results, key=lambda result: result["seconds"])
+        best[mode] = dict(fastest, peak_rss_kb=max(result["peak_rss_kb"] for result in results))
+
+    untraced = best["untraced"]["seconds"]
+    hooks = best["hooks"]["seconds"]
+    traced = best["traced"]["seconds"]
+    stats = best["traced"]["stats"]
+    events = max(stats["events"], 1)
+    return {
+        "backend": best["traced"]["backend"],
+        "raised": best["traced"]["raised"],
+        "untraced_s": untraced,
+        "hooks_s": hooks,
+        "traced_s": traced,
+        "slowdown": traced / untraced if untraced > 0 else 0.0,
+        "events": stats["events"],
+        "ns_per_event": (traced - untraced) * 1e9 / events,
+        "hook_ns_per_event": (hooks - untraced) * 1e9 / events,
+        "record_ns_per_event": (traced - hooks) * 1e9 / events,
+        "bytes_written": stats["bytes_written"],
+        "bytes_per_event": stats["bytes_written"] / events,
+        "raw_bytes_per_event": stats["raw_bytes"] / events,
+        "repr_cache_hit_rate": stats["repr_cache_hit_rate"],
+        "untraced_peak_rss_kb": best["untraced"]["peak_rss_kb"],
+        "peak_rss_kb": best["traced"]["peak_rss_kb"],
+    }
+
+
+def git_commit():
+    """Short hash of the checked out commit, or None outside a git tree"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    commit = result.stdout.strip()
+    dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=HERE).returncode != 0
+    return commit + "-dirty" if dirty else commit
+
+
+def parse_option(text):
+    """Parse a start_trace option given as key=value, value as a Python literal"""
+    import ast
+
+    key, sep, value = text.partition("=")
+    if not sep or not key.isidentifier():
+        raise argparse.ArgumentTypeError(f"expected key=value, got '{text}'")
+    try:
+        return key, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return key, value
+
+
+def print_table(report, baseline=None):
+    """Print the results, with the change from baseline when given"""
+    print(f"\033[1;36mRecorder overhead\033[0m  commit {report['commit'] or '?'}, "
+          f"Python {report['python']}, backend {report['backend']}")
+    header = f"{'workload':<14}{'events':>10}" + "".join(f"{title:>14}" for _, title, _ in COLUMNS)
+    print(f"\033[1m{header}\033[0m")
+    for name, result in report["workloads"].items():
+        row = f"{name:<14}{result['events']:>10}"
+        for key, _, fmt in COLUMNS:
+            row += f"{fmt.format(result[key]):>14}"
+        print(row)
+        old = (baseline or {}).get("workloads", {}).get(name)
+        if old:
+            row = f"{'  vs baseline':<24}"
+            for key, _, _ in COLUMNS:
+                if old.get(key):
+                    change = (result[key] - old[key]) * 100 / old[key]
+                    color = "\033[1;31m" if change > 10 else "\033[1;32m" if change < -10 else ""
+                    row += f"{color}{change:>+13.1f}%\033[0m"
+                else:
+                    row += f"{'-':>14}"
+            print(row)
+
+
+def main():
+    """Main entry point"""
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        request, result_file = json.loads(sys.argv[2]), sys.argv[3]
+        result = run_child(request["script"], request["runs"], request["mode"],
+                           request["trace_file"], request["options"])
+        with open(result_file, "w") as f:
+            json.dump(result, f)
+        return
+
+    names = [name for name, _, _, _ in WORKLOADS]
+    parser = argparse.ArgumentParser(description="Measure what cdebugger costs on representative workloads.")
+    parser.add_argument("workloads", nargs="*", metavar="workload",
+                        help=f"workloads to run (default: all of {', '.join(names)})")
+    parser.add_argument("-o", "--output", default=os.path.join(HERE, "build", "bench.json"),
+                        help="JSON file to write the results to (default: build/bench.json)")
+    parser.add_argument("-c", "--compare", metavar="JSON",
+                        help="earlier results to compare against")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="runs of each workload per mode; the fastest counts (default: 3)")
+    parser.add_argument("-b", "--backend", default="auto",
+                        help="recording backend: auto, settrace or monitoring")
+    parser.add_argument("--option", type=parse_option, action="append", default=[],
+                        metavar="KEY=VALUE", help="extra start_trace option, e.g. --option globals_refresh=100")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.workloads if name not in names]
+    if unknown:
+        parser.error(f"unknown workload(s): {', '.join(unknown)}")
+    if args.repeat < 1:
+        parser.error("--repeat must be >= 1")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    options = dict(args.option, backend=args.backend)
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "repeat": args.repeat,
+        "options": options,
+        "workloads": {},
+    }
+    for name, script, stdin, runs in WORKLOADS:
+        if args.workloads and name not in args.workloads:
+            continue
+        print(f"Running {name}...", file=sys.stderr)
+        report["workloads"][name] = measure(script, stdin, runs, options, args.repeat)
+    backends = {result["backend"] for result in report["workloads"].values()}
+    if len(backends) == 1:
+        report["backend"] = backends.pop()
+
+    print_table(report, baseline)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"\nResults saved to: \033[1m{args.output}\033[0m")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""Large containers: locals whose repr is expensive and changes every line."""
+
+
+def build(n):
+    items = []
+    index = {}
+    for i in range(n):
+        items.append(i * 3)
+        index[i] = str(i)
+    return items, index
+
+
+def scan(items, index):
+    hits = 0
+    for value in items:
+        if value % 7 == 0:
+            hits += len(index[value // 3])
+    return hits
+
+
+items, index = build(1000)
+matches = scan(items, index)
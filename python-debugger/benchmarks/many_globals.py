@@ -0,0 +1,13 @@
+"""Many globals: every module-level line snapshots a large globals dict."""
+
+for _i in range(300):
+    globals()["SETTING_%d" % _i] = _i * 3
+TABLE = {"key%d" % i: i for i in range(100)}
+NAMES = tuple("name%d" % i for i in range(100))
+LOG = []
+
+total = 0
+for step in range(3000):
+    total += SETTING_7 + TABLE["key%d" % (step % 100)]
+    if step % 500 == 0:
+        LOG.append(total)
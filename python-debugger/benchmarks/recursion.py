@@ -0,0 +1,24 @@
+"""Deep recursion: calls and returns dominate, each frame has a few locals."""
+
+import sys
+
+sys.setrecursionlimit(5000)
+
+
+def depth(n):
+    if n == 0:
+        return 0
+    below = depth(n - 1)
+    return below + 1
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+total = 0
+for _ in range(20):
+    total += depth(2000)
+total += fib(18)
@@ -0,0 +1,11 @@
+"""Tight loop: many cheap lines with few, small locals."""
+
+
+def count(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+result = count(200000)
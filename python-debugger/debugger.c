@@ -1,8 +1,38 @@
 #include <Python.h>
 #include <frameobject.h>
+#include <marshal.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <stdint.h>
+#include <stdatomic.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <fnmatch.h>
+#include <limits.h>
+#include <pthread.h>
+#include <signal.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
+#include <sys/wait.h>
+#include <poll.h>
+#include <stddef.h>
+
+#include <zlib.h>
+
+#include "traceformat.h"
+
+// Fast locals are read from the frame's own array up to Python 3.10. In 3.11
+// the array moved into the interpreter's internal frame; from 3.12 they are
+// read by name with PyFrame_GetVar(), and 3.11 reads the locals dict.
+#if PY_VERSION_HEX >= 0x030B0000 && PY_VERSION_HEX < 0x030C0000
+#define COMPAT_FAST_LOCALS 0
+#else
+#define COMPAT_FAST_LOCALS 1
+#endif
 
 // Compatibility for Python 3.9-3.10 vs 3.11+
 #if PY_VERSION_HEX < 0x030B0000
@@ -11,12 +41,30 @@
 #define COMPAT_PyFrame_GetLocals(frame) ((frame)->f_locals)
 #define COMPAT_Py_XDECREF_Code(code) ((void)0)  // No-op for old API
 #define COMPAT_PyFrame_GetGlobals(frame) ((frame)->f_globals)
+#define COMPAT_Code_GetQualname(code) ((code)->co_name)
 #else
 // Python 3.11+: Use accessor functions
 #define COMPAT_PyFrame_GetCode(frame) PyFrame_GetCode(frame)
 #define COMPAT_PyFrame_GetLocals(frame) PyFrame_GetLocals(frame)
 #define COMPAT_Py_XDECREF_Code(code) Py_XDECREF(code)
 #define COMPAT_PyFrame_GetGlobals(frame) PyFrame_GetGlobals(frame)
+#define COMPAT_Code_GetQualname(code) ((code)->co_qualname)
+#endif
+
+// Code object extra slots became PyUnstable_* in Python 3.12
+#if PY_VERSION_HEX < 0x030C0000
+#define COMPAT_RequestCodeExtraIndex(free) _PyEval_RequestCodeExtraIndex(free)
+#define COMPAT_Code_GetExtra(code, index, extra) _PyCode_GetExtra(code, index, extra)
+#define COMPAT_Code_SetExtra(code, index, extra) _PyCode_SetExtra(code, index, extra)
+#else
+#define COMPAT_RequestCodeExtraIndex(free) PyUnstable_Eval_RequestCodeExtraIndex(free)
+#define COMPAT_Code_GetExtra(code, index, extra) PyUnstable_Code_GetExtra(code, index, extra)
+#define COMPAT_Code_SetExtra(code, index, extra) PyUnstable_Code_SetExtra(code, index, extra)
+#endif
+
+// sys.monitoring (PEP 669) is available from Python 3.12
+#if PY_VERSION_HEX >= 0x030C0000
+#define HAVE_SYS_MONITORING 1
 #endif
 
 // Breakpoint structure
@@ -25,19 +73,30 @@ typedef struct Breakpoint {
     int lineno;
     int enabled;
     int hit_count;
+    long skip;              // Hits left before the breakpoint may stop (hits=N)
+    char *condition_text;   // NULL for an unconditional breakpoint
+    PyObject *condition;    // condition_text compiled for eval
     struct Breakpoint *next;
 } Breakpoint;
 
-// Trace file handle
-static FILE *trace_file = NULL;
 static long execution_counter = 0;
 static int is_tracing = 0;
 static int is_paused = 0;  // For breakpoint pausing
 static int step_mode = 0;   // 0=continue, 1=step_next, 2=step_into
+static unsigned long step_thread = 0;  // Thread that is stepping
+
+// Recording backends
+typedef enum {
+    BACKEND_SETTRACE,
+    BACKEND_MONITORING
+} TraceBackend;
+
+static TraceBackend trace_backend = BACKEND_SETTRACE;
 
 // Configuration
 static char *trace_filename = NULL;
 static Breakpoint *breakpoints = NULL;
+static unsigned long breakpoint_generation = 1;  // Bumped when breakpoints change
 
 #define MAX_REPR_CHARS 500
 
@@ -57,10 +116,13 @@ is_runtime_name(const char *var_name)
            strcmp(var_name, "__qualname__") == 0;
 }
 
+static PyTypeObject RecordedType;  // Functions decorated with @cdebugger.recorded
+
 static int
 is_import_or_definition_value(PyObject *value)
 {
-    return PyModule_Check(value) || PyFunction_Check(value) || PyType_Check(value);
+    return PyModule_Check(value) || PyFunction_Check(value) || PyType_Check(value) ||
+           Py_IS_TYPE(value, &RecordedType);
 }
 
 static int
@@ -87,501 +149,4924 @@ should_skip_local_variable(const char *var_name, PyObject *value, int locals_are
     return 0;
 }
 
-static void
-write_trace_text(FILE *fp, const char *text, Py_ssize_t max_chars)
-{
-    Py_ssize_t i;
+// Binary trace output (format described in traceformat.h)
+typedef struct ByteBuffer {
+    unsigned char *data;
+    size_t length;
+    size_t capacity;
+} ByteBuffer;
 
-    if (text == NULL) {
-        fputs("<unrepr>", fp);
-        return;
-    }
+static ByteBuffer record_buffer;    // Payload of the record being built
 
-    for (i = 0; text[i] != '\0' && i < max_chars; i++) {
-        switch (text[i]) {
-        case '\n':
-            fputs("\\n", fp);
-            break;
-        case '\r':
-            fputs("\\r", fp);
-            break;
-        case ';':
-            fputs("\\x3b", fp);
-            break;
-        case '|':
-            fputs("\\x7c", fp);
-            break;
-        default:
-            fputc(text[i], fp);
-            break;
-        }
+static int
+buffer_reserve(ByteBuffer *buffer, size_t extra)
+{
+    if (buffer->length + extra <= buffer->capacity) {
+        return 1;
     }
 
-    if (text[i] != '\0') {
-        fputs("...<truncated>", fp);
+    size_t capacity = buffer->capacity ? buffer->capacity : 4096;
+    while (capacity < buffer->length + extra) {
+        capacity *= 2;
     }
+    unsigned char *data = (unsigned char *)realloc(buffer->data, capacity);
+    if (data == NULL) {
+        return 0;
+    }
+    buffer->data = data;
+    buffer->capacity = capacity;
+    return 1;
 }
 
 static void
-write_repr(FILE *fp, PyObject *value)
+buffer_put_varint(ByteBuffer *buffer, uint64_t value)
 {
-    PyObject *repr = PyObject_Repr(value);
-    if (repr == NULL) {
-        PyErr_Clear();
-        fputs("<unrepr>", fp);
-        return;
-    }
-
-    const char *utf8 = PyUnicode_AsUTF8(repr);
-    if (utf8 == NULL) {
-        PyErr_Clear();
-        fputs("<unrepr>", fp);
-    } else {
-        write_trace_text(fp, utf8, MAX_REPR_CHARS);
+    if (buffer_reserve(buffer, TRACE_VARINT_MAX)) {
+        buffer->length += trace_put_varint(buffer->data + buffer->length, value);
     }
-
-    Py_XDECREF(repr);
 }
 
 static void
-append_buffer(char *buffer, size_t buffer_size, const char *text)
+buffer_put_bytes(ByteBuffer *buffer, const void *bytes, size_t length)
 {
-    size_t used = strlen(buffer);
-    if (used >= buffer_size - 1) {
-        return;
+    if (buffer_reserve(buffer, length)) {
+        memcpy(buffer->data + buffer->length, bytes, length);
+        buffer->length += length;
     }
-    strncat(buffer, text, buffer_size - used - 1);
 }
 
 static void
-append_trace_text(char *buffer, size_t buffer_size, const char *text, Py_ssize_t max_chars)
+buffer_free(ByteBuffer *buffer)
 {
-    Py_ssize_t i;
+    free(buffer->data);
+    buffer->data = NULL;
+    buffer->length = 0;
+    buffer->capacity = 0;
+}
 
-    if (text == NULL) {
-        append_buffer(buffer, buffer_size, "<unrepr>");
-        return;
-    }
+// Trace writer. Records are collected into blocks (see traceformat.h), and
+// sealed blocks are copied into a ring buffer. A native thread compresses
+// them and writes them to the trace file, so the traced program never waits
+// on zlib or a write syscall unless the ring is full. There is one producer at
+// a time (the recorder runs under the GIL) and one consumer, so the ring only
+// needs the two positions below; the mutex and conditions are used to sleep
+// and wake, never on the fast path.
+#define DEFAULT_BUFFER_SIZE (8 * 1024 * 1024)
+#define MIN_BUFFER_SIZE (64 * 1024)
+#define DEFAULT_FLUSH_BYTES (1024 * 1024)
+#define DEFAULT_FLUSH_INTERVAL 0.5
+#define DEFAULT_BLOCK_SIZE (256 * 1024)
+#define MIN_BLOCK_SIZE 4096
+#define FLIGHT_BLOCKS 8
+#define DEFAULT_COMPRESS_LEVEL 1
+#define BLOCK_HEADER_MAX (1 + 4 * TRACE_VARINT_MAX)
 
-    for (i = 0; text[i] != '\0' && i < max_chars; i++) {
-        char ch[2] = {text[i], '\0'};
-        switch (text[i]) {
-        case '\n':
-            append_buffer(buffer, buffer_size, "\\n");
-            break;
-        case '\r':
-            append_buffer(buffer, buffer_size, "\\r");
-            break;
-        case ';':
-            append_buffer(buffer, buffer_size, "\\x3b");
-            break;
-        case '|':
-            append_buffer(buffer, buffer_size, "\\x7c");
-            break;
-        default:
-            append_buffer(buffer, buffer_size, ch);
-            break;
-        }
-    }
+typedef struct BlockIndexEntry {
+    uint64_t offset;
+    int type;
+    uint64_t compressed_length;
+    uint64_t raw_length;
+    uint64_t first_seq;
+    uint64_t event_count;
+} BlockIndexEntry;
 
-    if (text[i] != '\0') {
-        append_buffer(buffer, buffer_size, "...<truncated>");
+// A compressed block kept in memory: by the flight recorder, and strings
+// blocks for the start of every new segment
+typedef struct KeptBlock {
+    int type;
+    uint64_t raw_length;
+    uint64_t first_seq;
+    uint64_t event_count;
+    unsigned char *data;
+    size_t length;
+} KeptBlock;
+
+typedef struct KeptBlocks {
+    KeptBlock *items;
+    size_t count;
+    size_t capacity;
+} KeptBlocks;
+
+// A segment file of a segmented trace
+typedef struct TraceSegment {
+    uint64_t number;
+    uint64_t first_seq;
+    uint64_t event_count;
+} TraceSegment;
+
+typedef struct TraceWriter {
+    int fd;                         // -1 when no trace is open
+    unsigned char *ring;
+    size_t capacity;
+    _Atomic size_t head;            // Bytes produced so far
+    _Atomic size_t tail;            // Bytes written so far
+    size_t flush_bytes;             // Wake the writer at this much pending data, 0 = never
+    double flush_interval;          // Write pending data at least this often, 0 = never
+    int drop_when_full;             // Backpressure: drop line records instead of blocking
+    pthread_t thread;
+    int thread_started;
+    pthread_mutex_t mutex;
+    pthread_cond_t data_ready;
+    pthread_cond_t space_ready;
+    atomic_int writer_sleeping;
+    atomic_int producer_waiting;
+    atomic_int ring_full;           // A producer dropped a block for lack of room
+    atomic_int stopping;
+    _Atomic uint64_t bytes_written;
+    uint64_t dropped_events;
+    int error;                      // errno of the first failed write
+    int compress_level;
+    // Owned by whoever writes blocks: the writer thread, or the producer
+    // while the ring is empty (see writer_reserve)
+    uint64_t file_offset;
+    _Atomic uint64_t raw_bytes;
+    BlockIndexEntry *index;
+    size_t index_count;
+    size_t index_capacity;
+    ByteBuffer scratch;             // Block copied out of the ring when it wraps
+    ByteBuffer compressed;
+    // Flight recorder: compressed blocks stay in memory and only reach a file
+    // when a dump is requested (see flight_store). Also owned by the writer.
+    int flight;
+    uint64_t flight_events;         // Keep the newest blocks holding this many events, 0 = no limit
+    size_t flight_bytes;            // Keep events blocks within this many bytes, 0 = no limit
+    KeptBlocks kept_strings;        // Flight recorder or segments: every strings block
+    KeptBlocks flight_blocks;       // Events and watch blocks, oldest first
+    uint64_t flight_event_total;
+    size_t flight_byte_total;
+    char *dump_filename;            // Requested dump, guarded by the mutex
+    uint64_t dump_requests;
+    uint64_t dumps_done;
+    int dump_error;
+    pthread_cond_t dump_done;
+    // Segments: the trace is split into complete trace files listed by a
+    // manifest (see rotate_segment). Owned like file_offset.
+    char *manifest;                 // Manifest filename, NULL when not segmenting
+    uint64_t segment_bytes;         // Start a new segment at this file size, 0 = no limit
+    uint64_t segment_events;        // or at this many events, 0 = no limit
+    size_t keep_segments;           // Delete the oldest segments beyond this many, 0 = keep all
+    TraceSegment *segments;         // Segments on disk, oldest first; the last is open
+    size_t segment_count;
+    size_t segment_capacity;
+    uint64_t segments_started;      // Number of the newest segment
+} TraceWriter;
+
+static TraceWriter trace_writer = {
+    .fd = -1,
+    .mutex = PTHREAD_MUTEX_INITIALIZER,
+    .data_ready = PTHREAD_COND_INITIALIZER,
+    .space_ready = PTHREAD_COND_INITIALIZER,
+    .dump_done = PTHREAD_COND_INITIALIZER,
+};
+
+static int
+write_all(int fd, const unsigned char *data, size_t length)
+{
+    while (length > 0) {
+        ssize_t written = write(fd, data, length);
+        if (written < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            return errno;
+        }
+        data += written;
+        length -= written;
     }
+    return 0;
 }
 
 static void
-append_repr(char *buffer, size_t buffer_size, PyObject *value)
+writer_wake(pthread_cond_t *cond)
 {
-    PyObject *repr = PyObject_Repr(value);
-    if (repr == NULL) {
-        PyErr_Clear();
-        append_buffer(buffer, buffer_size, "<unrepr>");
-        return;
-    }
-
-    const char *utf8 = PyUnicode_AsUTF8(repr);
-    if (utf8 == NULL) {
-        PyErr_Clear();
-        append_buffer(buffer, buffer_size, "<unrepr>");
-    } else {
-        append_trace_text(buffer, buffer_size, utf8, 100);
-    }
+    TraceWriter *w = &trace_writer;
 
-    Py_XDECREF(repr);
+    pthread_mutex_lock(&w->mutex);
+    pthread_cond_broadcast(cond);
+    pthread_mutex_unlock(&w->mutex);
 }
 
-// Trace history for step back
-#define MAX_TRACE_HISTORY 1000
-typedef struct TraceEntry {
-    char *filename;
-    int lineno;
-    char *code;
-    char *variables;
-    char *globals;
-    long exec_num;
-} TraceEntry;
+static void
+ring_read(size_t position, unsigned char *out, size_t length)
+{
+    TraceWriter *w = &trace_writer;
+    size_t offset = position % w->capacity;
+    size_t first = length < w->capacity - offset ? length : w->capacity - offset;
 
-static TraceEntry trace_history[MAX_TRACE_HISTORY];
-static int trace_history_count = 0;
-static int trace_history_index = 0;
+    memcpy(out, w->ring + offset, first);
+    memcpy(out + first, w->ring, length - first);
+}
 
-// Helper function to add entry to trace history
-static void add_trace_entry(const char *filename, int lineno, const char *code, const char *variables) {
-    if (trace_history_count < MAX_TRACE_HISTORY) {
-        TraceEntry *entry = &trace_history[trace_history_count];
-        entry->filename = strdup(filename);
-        entry->lineno = lineno;
-        entry->code = strdup(code);
-        entry->variables = strdup(variables ? variables : "");
-        entry->exec_num = execution_counter - 1;
-        trace_history_count++;
-        trace_history_index = trace_history_count;
+// Append one compressed block to the file and to the block index.
+// Returns 0 or an errno value.
+static int
+append_block(int type, uint64_t first_seq, uint64_t event_count, uint64_t raw_length,
+             const unsigned char *compressed, size_t compressed_length)
+{
+    TraceWriter *w = &trace_writer;
+    unsigned char header[BLOCK_HEADER_MAX];
+    size_t header_length = 0;
+    header[header_length++] = (unsigned char)type;
+    header_length += trace_put_varint(header + header_length, compressed_length);
+    header_length += trace_put_varint(header + header_length, raw_length);
+    header_length += trace_put_varint(header + header_length, first_seq);
+    header_length += trace_put_varint(header + header_length, event_count);
+
+    if (w->index_count == w->index_capacity) {
+        size_t capacity = w->index_capacity ? w->index_capacity * 2 : 256;
+        BlockIndexEntry *index = (BlockIndexEntry *)realloc(w->index, capacity * sizeof(BlockIndexEntry));
+        if (index == NULL) {
+            return ENOMEM;
+        }
+        w->index = index;
+        w->index_capacity = capacity;
     }
-}
+    BlockIndexEntry *entry = &w->index[w->index_count++];
+    entry->offset = w->file_offset;
+    entry->type = type;
+    entry->compressed_length = compressed_length;
+    entry->raw_length = raw_length;
+    entry->first_seq = first_seq;
+    entry->event_count = event_count;
 
-// Helper function to show trace entry
-static void show_trace_entry(int index) {
-    if (index < 0 || index >= trace_history_count) {
-        return;
+    int err = write_all(w->fd, header, header_length);
+    if (err == 0) {
+        err = write_all(w->fd, compressed, compressed_length);
     }
+    w->file_offset += header_length + compressed_length;
+    atomic_fetch_add(&w->bytes_written, header_length + compressed_length);
+    return err;
+}
 
-    TraceEntry *entry = &trace_history[index];
-    printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
-    printf("\033[1;35m⟲ TRACE HISTORY [%d/%d]\033[0m\n", index + 1, trace_history_count);
-    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
-    printf("Execution: \033[1;32m#%ld\033[0m\n", entry->exec_num);
-    printf("File: \033[1;32m%s\033[0m Line: \033[1;32m%d\033[0m\n", entry->filename, entry->lineno);
-    printf("Code: %s\n", entry->code);
-    if (entry->variables && strlen(entry->variables) > 0) {
-        printf("Variables: %s\n", entry->variables);
+static void
+kept_blocks_free(KeptBlocks *blocks)
+{
+    for (size_t i = 0; i < blocks->count; i++) {
+        free(blocks->items[i].data);
     }
-    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    free(blocks->items);
+    blocks->items = NULL;
+    blocks->count = 0;
+    blocks->capacity = 0;
 }
 
-// Helper function to free trace history
-static void free_trace_history() {
-    for (int i = 0; i < trace_history_count; i++) {
-        free(trace_history[i].filename);
-        free(trace_history[i].code);
-        free(trace_history[i].variables);
+// Copy a compressed block into blocks. Returns 0 or an errno value.
+static int
+keep_block(KeptBlocks *blocks, int type, uint64_t first_seq, uint64_t event_count,
+           uint64_t raw_length, const unsigned char *compressed, size_t compressed_length)
+{
+    if (blocks->count == blocks->capacity) {
+        size_t capacity = blocks->capacity ? blocks->capacity * 2 : 64;
+        KeptBlock *items = (KeptBlock *)realloc(blocks->items, capacity * sizeof(KeptBlock));
+        if (items == NULL) {
+            return ENOMEM;
+        }
+        blocks->items = items;
+        blocks->capacity = capacity;
     }
-    trace_history_count = 0;
-    trace_history_index = 0;
+    unsigned char *data = (unsigned char *)malloc(compressed_length);
+    if (data == NULL) {
+        return ENOMEM;
+    }
+    memcpy(data, compressed, compressed_length);
+    blocks->items[blocks->count++] = (KeptBlock){type, raw_length, first_seq, event_count,
+                                                 data, compressed_length};
+    return 0;
 }
 
-// Helper function to add a breakpoint
-static int add_breakpoint(const char *filename, int lineno) {
-    Breakpoint *bp = (Breakpoint *)malloc(sizeof(Breakpoint));
-    if (bp == NULL) {
-        return 0;
+// Keep a compressed block in memory. Strings blocks are all kept, since any
+// events block may use their strings; the oldest events blocks are dropped
+// while the newer ones still hold flight_events events, or while the events
+// blocks take more than flight_bytes. The newest block is always kept.
+static int
+flight_store(int type, uint64_t first_seq, uint64_t event_count, uint64_t raw_length,
+             const unsigned char *compressed, size_t compressed_length)
+{
+    TraceWriter *w = &trace_writer;
+    KeptBlocks *blocks = type == BLOCK_STRINGS ? &w->kept_strings : &w->flight_blocks;
+    int err = keep_block(blocks, type, first_seq, event_count, raw_length,
+                         compressed, compressed_length);
+    if (err != 0 || type == BLOCK_STRINGS) {
+        return err;
     }
 
-    bp->filename = strdup(filename);
-    bp->lineno = lineno;
-    bp->enabled = 1;
-    bp->hit_count = 0;
-    bp->next = breakpoints;
-    breakpoints = bp;
+    w->flight_event_total += event_count;
+    w->flight_byte_total += compressed_length;
+    size_t dropped = 0;
+    while (blocks->count - dropped > 1) {
+        KeptBlock *oldest = &blocks->items[dropped];
+        if (!(w->flight_events > 0 && w->flight_event_total - oldest->event_count >= w->flight_events) &&
+            !(w->flight_bytes > 0 && w->flight_byte_total > w->flight_bytes)) {
+            break;
+        }
+        w->flight_event_total -= oldest->event_count;
+        w->flight_byte_total -= oldest->length;
+        free(oldest->data);
+        dropped++;
+    }
+    if (dropped > 0) {
+        blocks->count -= dropped;
+        memmove(blocks->items, blocks->items + dropped, blocks->count * sizeof(KeptBlock));
+    }
+    return 0;
+}
 
-    return 1;
+static int
+write_trace_header(int fd)
+{
+    unsigned char header[TRACE_HEADER_SIZE] = {0};
+    memcpy(header, TRACE_MAGIC, TRACE_MAGIC_SIZE);
+    header[TRACE_MAGIC_SIZE] = TRACE_FORMAT_VERSION;
+    return write_all(fd, header, sizeof(header));
 }
 
-// Helper function to extract basename from path
-static const char* get_basename(const char *path) {
-    const char *basename = strrchr(path, '/');
-    if (basename != NULL) {
-        return basename + 1;  // Skip the '/'
+static int write_block_index(void);
+
+// Segment files are named after the manifest: trace.log.0001, ...
+static char*
+segment_filename(const char *manifest, uint64_t number)
+{
+    size_t length = strlen(manifest) + 2 + 20;
+    char *name = (char *)malloc(length);
+    if (name != NULL) {
+        snprintf(name, length, "%s.%04llu", manifest, (unsigned long long)number);
     }
-    return path;  // No slash found, return as-is
+    return name;
 }
 
-// Helper function to check if two filenames match
-// Supports exact match, absolute path match, and basename match
-static int filenames_match(const char *bp_filename, const char *current_filename) {
-    // Exact match
-    if (strcmp(bp_filename, current_filename) == 0) {
-        return 1;
+// Rewrite the manifest (see traceformat.h) next to it and rename it into
+// place. The last segment's event count is written as "-" while it is open.
+static int
+write_manifest(int last_open)
+{
+    TraceWriter *w = &trace_writer;
+    size_t length = strlen(w->manifest);
+    char *temporary = (char *)malloc(length + 5);
+    if (temporary == NULL) {
+        return ENOMEM;
     }
+    memcpy(temporary, w->manifest, length);
+    memcpy(temporary + length, ".tmp", 5);
 
-    // Check if one is absolute and contains the other
-    if (strstr(current_filename, bp_filename) != NULL) {
-        // Check if it's a proper path match (not just substring)
-        const char *found = strstr(current_filename, bp_filename);
-        // Verify it's at the end or followed by end of string
-        if (found + strlen(bp_filename) == current_filename + strlen(current_filename)) {
-            return 1;
+    FILE *file = fopen(temporary, "w");
+    if (file == NULL) {
+        int err = errno;
+        free(temporary);
+        return err;
+    }
+    const char *slash = strrchr(w->manifest, '/');
+    const char *basename = slash ? slash + 1 : w->manifest;
+    fprintf(file, "%s %d\n", TRACE_MANIFEST_MAGIC, TRACE_MANIFEST_VERSION);
+    for (size_t i = 0; i < w->segment_count; i++) {
+        TraceSegment *segment = &w->segments[i];
+        fprintf(file, "%llu ", (unsigned long long)segment->first_seq);
+        if (last_open && i == w->segment_count - 1) {
+            fprintf(file, "- ");
+        } else {
+            fprintf(file, "%llu ", (unsigned long long)segment->event_count);
         }
+        fprintf(file, "%s.%04llu\n", basename, (unsigned long long)segment->number);
     }
 
-    // Check basename match as fallback
-    const char *bp_base = get_basename(bp_filename);
-    const char *current_base = get_basename(current_filename);
-    if (strcmp(bp_base, current_base) == 0) {
-        return 1;
+    int err = ferror(file) ? EIO : 0;
+    if (fclose(file) != 0 && err == 0) {
+        err = errno;
     }
-
-    return 0;
+    if (err == 0 && rename(temporary, w->manifest) != 0) {
+        err = errno;
+    }
+    if (err != 0) {
+        unlink(temporary);
+    }
+    free(temporary);
+    return err;
 }
 
-// Helper function to check if we're at a breakpoint
-static Breakpoint* check_breakpoint(const char *filename, int lineno) {
-    Breakpoint *bp = breakpoints;
-    while (bp != NULL) {
-        if (bp->enabled && 
-            bp->lineno == lineno && 
-            filenames_match(bp->filename, filename)) {
-            bp->hit_count++;
-            return bp;
+// Start the next segment file: the header, then every strings block so far,
+// so the segment decodes without the ones before it
+static int
+open_segment(void)
+{
+    TraceWriter *w = &trace_writer;
+
+    if (w->segment_count == w->segment_capacity) {
+        size_t capacity = w->segment_capacity ? w->segment_capacity * 2 : 16;
+        TraceSegment *segments = (TraceSegment *)realloc(w->segments, capacity * sizeof(TraceSegment));
+        if (segments == NULL) {
+            return ENOMEM;
         }
-        bp = bp->next;
+        w->segments = segments;
+        w->segment_capacity = capacity;
     }
-    return NULL;
+    uint64_t number = w->segments_started + 1;
+    char *name = segment_filename(w->manifest, number);
+    if (name == NULL) {
+        return ENOMEM;
+    }
+    w->fd = open(name, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0666);
+    free(name);
+    if (w->fd < 0) {
+        return errno;
+    }
+    // Until its first events block, a segment starts where the last one ended
+    uint64_t first_seq = 0;
+    if (w->segment_count > 0) {
+        TraceSegment *last = &w->segments[w->segment_count - 1];
+        first_seq = last->first_seq + last->event_count;
+    }
+    w->segments[w->segment_count++] = (TraceSegment){number, first_seq, 0};
+    w->segments_started = number;
+    w->file_offset = TRACE_HEADER_SIZE;
+    w->index_count = 0;
+
+    int err = write_trace_header(w->fd);
+    atomic_fetch_add(&w->bytes_written, TRACE_HEADER_SIZE);
+    for (size_t i = 0; i < w->kept_strings.count && err == 0; i++) {
+        KeptBlock *block = &w->kept_strings.items[i];
+        err = append_block(block->type, block->first_seq, block->event_count,
+                           block->raw_length, block->data, block->length);
+    }
+    return err == 0 ? write_manifest(1) : err;
 }
 
-// Helper function to write variable values to file
+// Finish the open segment with its block index
 static int
-write_variables(FILE *fp, PyObject *locals, int locals_are_globals)
+close_segment(void)
 {
-    int first = 1;
-    if (locals == NULL || !PyDict_Check(locals)) {
-        return first;
+    TraceWriter *w = &trace_writer;
+    int err = write_block_index();
+
+    if (close(w->fd) != 0 && err == 0) {
+        err = errno;
     }
+    w->fd = -1;
+    return err;
+}
 
-    PyObject *key, *value;
-    Py_ssize_t pos = 0;
+// Close the open segment, delete the oldest ones beyond keep_segments and
+// open the next
+static int
+rotate_segment(void)
+{
+    TraceWriter *w = &trace_writer;
+    int err = close_segment();
+    if (err != 0) {
+        return err;
+    }
 
-    while (PyDict_Next(locals, &pos, &key, &value)) {
-        const char *var_name = PyUnicode_AsUTF8(key);
-        if (var_name == NULL) {
-            PyErr_Clear();
-            continue;
+    size_t removed = 0;
+    while (w->keep_segments > 0 && w->segment_count - removed + 1 > w->keep_segments) {
+        char *name = segment_filename(w->manifest, w->segments[removed].number);
+        if (name != NULL) {
+            unlink(name);
+            free(name);
         }
+        removed++;
+    }
+    if (removed > 0) {
+        w->segment_count -= removed;
+        memmove(w->segments, w->segments + removed, w->segment_count * sizeof(TraceSegment));
+    }
+    return open_segment();
+}
 
-        if (should_skip_local_variable(var_name, value, locals_are_globals)) {
-            continue;
-        }
+// Compress one block and append it to the file, or keep it in memory in
+// flight recorder mode. Returns 0 or an errno value.
+static int
+write_block(int type, uint64_t first_seq, uint64_t event_count,
+            const unsigned char *raw, size_t raw_length)
+{
+    TraceWriter *w = &trace_writer;
+
+    uLongf compressed_length = compressBound(raw_length);
+    w->compressed.length = 0;
+    if (!buffer_reserve(&w->compressed, compressed_length)) {
+        return ENOMEM;
+    }
+    if (compress2(w->compressed.data, &compressed_length, raw, raw_length,
+                  w->compress_level) != Z_OK) {
+        return EIO;
+    }
 
-        if (!first) {
-            fprintf(fp, ";");
+    atomic_fetch_add(&w->raw_bytes, raw_length);
+    if (w->flight) {
+        return flight_store(type, first_seq, event_count, raw_length,
+                            w->compressed.data, compressed_length);
+    }
+    if (w->manifest == NULL) {
+        return append_block(type, first_seq, event_count, raw_length,
+                            w->compressed.data, compressed_length);
+    }
+
+    // Segments end before an events block that would take them past a limit
+    int err = 0;
+    TraceSegment *segment = &w->segments[w->segment_count - 1];
+    if (type == BLOCK_STRINGS) {
+        err = keep_block(&w->kept_strings, type, first_seq, event_count, raw_length,
+                         w->compressed.data, compressed_length);
+    } else if (type == BLOCK_EVENTS && segment->event_count > 0 &&
+               ((w->segment_bytes > 0 && w->file_offset + compressed_length > w->segment_bytes) ||
+                (w->segment_events > 0 && segment->event_count + event_count > w->segment_events))) {
+        err = rotate_segment();
+        segment = &w->segments[w->segment_count - 1];
+    }
+    if (err == 0) {
+        err = append_block(type, first_seq, event_count, raw_length,
+                           w->compressed.data, compressed_length);
+    }
+    if (type == BLOCK_EVENTS) {
+        if (segment->event_count == 0) {
+            segment->first_seq = first_seq;
         }
-        first = 0;
+        segment->event_count += event_count;
+    }
+    return err;
+}
+
+// Write the block index and the trailer that points at it
+static int
+write_block_index(void)
+{
+    TraceWriter *w = &trace_writer;
+    ByteBuffer payload = {0};
+
+    buffer_put_varint(&payload, w->index_count);
+    for (size_t i = 0; i < w->index_count; i++) {
+        BlockIndexEntry *entry = &w->index[i];
+        unsigned char type = (unsigned char)entry->type;
+        buffer_put_varint(&payload, entry->offset);
+        buffer_put_bytes(&payload, &type, 1);
+        buffer_put_varint(&payload, entry->compressed_length);
+        buffer_put_varint(&payload, entry->raw_length);
+        buffer_put_varint(&payload, entry->first_seq);
+        buffer_put_varint(&payload, entry->event_count);
+    }
 
-        fprintf(fp, "%s=", var_name);
-        write_repr(fp, value);
+    ByteBuffer block = {0};
+    unsigned char kind = BLOCK_INDEX;
+    buffer_put_bytes(&block, &kind, 1);
+    buffer_put_varint(&block, payload.length);
+    buffer_put_bytes(&block, payload.data, payload.length);
+
+    unsigned char trailer[TRACE_TRAILER_SIZE];
+    uint64_t offset = w->file_offset;
+    for (int i = 0; i < 8; i++) {
+        trailer[i] = (unsigned char)(offset >> (8 * i));
     }
-    return first;
+    memcpy(trailer + 8, TRACE_TRAILER_MAGIC, 4);
+    buffer_put_bytes(&block, trailer, sizeof(trailer));
+
+    int err = block.data == NULL ? ENOMEM : write_all(w->fd, block.data, block.length);
+    atomic_fetch_add(&w->bytes_written, block.length);
+    buffer_free(&payload);
+    buffer_free(&block);
+    return err;
 }
-// hopefully this works
-static void
-write_globals(FILE *fp, PyObject *globals, PyObject *locals, int first)
+
+// Write the blocks the flight recorder holds as a complete trace file. The
+// file is written next to filename and renamed over it, so a reader never
+// sees half a dump. All strings blocks go first, so every events block
+// follows the strings it uses. Returns 0 or an errno value.
+static int
+flight_dump(const char *filename)
 {
-    if (globals == NULL || !PyDict_Check(globals)) {
-        return;
+    TraceWriter *w = &trace_writer;
+    size_t length = strlen(filename);
+    char *temporary = (char *)malloc(length + 5);
+    if (temporary == NULL) {
+        return ENOMEM;
     }
+    memcpy(temporary, filename, length);
+    memcpy(temporary + length, ".tmp", 5);
 
-    PyObject *key, *value;
-    Py_ssize_t pos = 0;
+    w->fd = open(temporary, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0666);
+    if (w->fd < 0) {
+        int err = errno;
+        free(temporary);
+        return err;
+    }
+    w->file_offset = TRACE_HEADER_SIZE;
+    w->index_count = 0;
 
-    while (PyDict_Next(globals, &pos, &key, &value)) {
-        const char *var_name = PyUnicode_AsUTF8(key);
-        if (var_name == NULL) {
-            PyErr_Clear();
-            continue;
+    int err = write_trace_header(w->fd);
+    KeptBlocks *lists[] = {&w->kept_strings, &w->flight_blocks};
+    for (int i = 0; i < 2 && err == 0; i++) {
+        for (size_t j = 0; j < lists[i]->count && err == 0; j++) {
+            KeptBlock *block = &lists[i]->items[j];
+            err = append_block(block->type, block->first_seq, block->event_count,
+                               block->raw_length, block->data, block->length);
         }
+    }
+    if (err == 0) {
+        err = write_block_index();
+    }
+    if (close(w->fd) != 0 && err == 0) {
+        err = errno;
+    }
+    w->fd = -1;
+    if (err == 0 && rename(temporary, filename) != 0) {
+        err = errno;
+    }
+    if (err != 0) {
+        unlink(temporary);
+    }
+    free(temporary);
+    return err;
+}
 
-        if (should_skip_global_variable(var_name, value)) {
-            continue;
+// Writer thread: sleep until there is enough pending data, the flush
+// interval passes, the producer is blocked, a dump is requested or tracing
+// stops, then write everything pending.
+static void*
+writer_main(void *arg)
+{
+    TraceWriter *w = &trace_writer;
+
+    for (;;) {
+        pthread_mutex_lock(&w->mutex);
+        atomic_store(&w->writer_sleeping, 1);
+
+        struct timespec deadline;
+        if (w->flush_interval > 0) {
+            clock_gettime(CLOCK_REALTIME, &deadline);
+            double seconds = deadline.tv_nsec / 1e9 + w->flush_interval;
+            deadline.tv_sec += (time_t)seconds;
+            deadline.tv_nsec = (long)((seconds - (time_t)seconds) * 1e9);
         }
 
-        if (locals != NULL && PyDict_Contains(locals, key)) {
-            continue;
+        for (;;) {
+            size_t pending = atomic_load(&w->head) - atomic_load(&w->tail);
+            if (atomic_load(&w->stopping) || atomic_load(&w->producer_waiting) ||
+                atomic_load(&w->ring_full) || w->dump_filename != NULL ||
+                (w->flush_bytes > 0 && pending >= w->flush_bytes)) {
+                break;
+            }
+            if (w->flush_interval > 0) {
+                if (pthread_cond_timedwait(&w->data_ready, &w->mutex, &deadline) == ETIMEDOUT) {
+                    break;
+                }
+            } else {
+                pthread_cond_wait(&w->data_ready, &w->mutex);
+            }
+        }
+
+        atomic_store(&w->writer_sleeping, 0);
+        atomic_store(&w->ring_full, 0);
+        pthread_mutex_unlock(&w->mutex);
+
+        int stopping = atomic_load(&w->stopping);
+        size_t tail = atomic_load(&w->tail);
+        size_t head = atomic_load_explicit(&w->head, memory_order_acquire);
+
+        // The ring holds whole blocks: u8 type, varint raw_length,
+        // varint first_seq, varint event_count, raw bytes
+        while (tail != head) {
+            unsigned char header[BLOCK_HEADER_MAX];
+            size_t header_available = head - tail < sizeof(header) ? head - tail : sizeof(header);
+            ring_read(tail, header, header_available);
+
+            const unsigned char *pos = header + 1;
+            const unsigned char *end = header + header_available;
+            uint64_t raw_length = 0, first_seq = 0, event_count = 0;
+            trace_get_varint(&pos, end, &raw_length);
+            trace_get_varint(&pos, end, &first_seq);
+            trace_get_varint(&pos, end, &event_count);
+            size_t header_length = pos - header;
+
+            // Compress straight from the ring unless the block wraps around
+            const unsigned char *raw;
+            size_t raw_offset = (tail + header_length) % w->capacity;
+            if (raw_offset + raw_length <= w->capacity) {
+                raw = w->ring + raw_offset;
+            } else {
+                w->scratch.length = 0;
+                if (!buffer_reserve(&w->scratch, raw_length)) {
+                    w->error = ENOMEM;
+                }
+                ring_read(tail + header_length, w->scratch.data, raw_length);
+                raw = w->scratch.data;
+            }
+
+            // After a failed write the data is discarded so the producer never blocks forever
+            if (w->error == 0) {
+                w->error = write_block(header[0], first_seq, event_count, raw, raw_length);
+            }
+            tail += header_length + raw_length;
+            atomic_store_explicit(&w->tail, tail, memory_order_release);
         }
 
-        if (!first){
-            fprintf(fp, ";");
+        if (atomic_load(&w->producer_waiting)) {
+            writer_wake(&w->space_ready);
         }
-        first = 0;
 
-        fprintf(fp, "%s=", var_name);
-        write_repr(fp, value);
+        // Everything sealed before the request has been drained above
+        pthread_mutex_lock(&w->mutex);
+        char *dump_filename = w->dump_filename;
+        pthread_mutex_unlock(&w->mutex);
+        if (dump_filename != NULL) {
+            int err = flight_dump(dump_filename);
+            pthread_mutex_lock(&w->mutex);
+            free(w->dump_filename);
+            w->dump_filename = NULL;
+            w->dump_error = err;
+            w->dumps_done++;
+            pthread_cond_broadcast(&w->dump_done);
+            pthread_mutex_unlock(&w->mutex);
+        }
+
+        if (stopping && atomic_load(&w->head) == tail) {
+            break;
+        }
     }
+    return NULL;
 }
 
-// Helper function to get the source line
-static char*
-get_source_line(const char *filename, int lineno)
+static void
+segments_free(void)
 {
-    FILE *fp = fopen(filename, "r");
-    if (fp == NULL) {
-        return strdup("<unavailable>");
+    TraceWriter *w = &trace_writer;
+
+    free(w->manifest);
+    w->manifest = NULL;
+    free(w->segments);
+    w->segments = NULL;
+    w->segment_count = 0;
+    w->segment_capacity = 0;
+}
+
+// Start the writer. With flight_events or flight_bytes set the file is not
+// opened: blocks are kept in memory until writer_dump(). With segment_bytes
+// or segment_events set, filename is the manifest of the segment files.
+static int
+writer_start(const char *filename, size_t capacity, size_t flush_bytes,
+             double flush_interval, int drop_when_full, int compress_level,
+             uint64_t flight_events, size_t flight_bytes,
+             uint64_t segment_bytes, uint64_t segment_events, size_t keep_segments)
+{
+    TraceWriter *w = &trace_writer;
+    int err = 0;
+
+    w->flight = flight_events > 0 || flight_bytes > 0;
+    w->segment_bytes = segment_bytes;
+    w->segment_events = segment_events;
+    w->keep_segments = keep_segments;
+    w->segments_started = 0;
+    if (!w->flight && (segment_bytes > 0 || segment_events > 0)) {
+        w->manifest = strdup(filename);
+        err = w->manifest ? open_segment() : ENOMEM;
+    } else if (!w->flight) {
+        w->fd = open(filename, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0666);
+        if (w->fd < 0) {
+            return errno;
+        }
+        err = write_trace_header(w->fd);
+    }
+
+    w->ring = err == 0 ? (unsigned char *)malloc(capacity) : NULL;
+    if (w->ring == NULL) {
+        if (w->fd >= 0) {
+            close(w->fd);
+            w->fd = -1;
+        }
+        segments_free();
+        return err ? err : ENOMEM;
     }
 
-    char *line = NULL;
-    size_t len = 0;
-    int current_line = 0;
+    w->capacity = capacity;
+    atomic_store(&w->head, 0);
+    atomic_store(&w->tail, 0);
+    w->flush_bytes = flush_bytes;
+    w->flush_interval = flush_interval;
+    w->drop_when_full = drop_when_full;
+    atomic_store(&w->writer_sleeping, 0);
+    atomic_store(&w->producer_waiting, 0);
+    atomic_store(&w->ring_full, 0);
+    atomic_store(&w->stopping, 0);
+    atomic_store(&w->bytes_written, w->flight ? 0 : TRACE_HEADER_SIZE);
+    w->dropped_events = 0;
+    w->error = 0;
+    w->compress_level = compress_level;
+    w->file_offset = TRACE_HEADER_SIZE;
+    atomic_store(&w->raw_bytes, 0);
+    w->index_count = 0;
+    w->flight_events = flight_events;
+    w->flight_bytes = flight_bytes;
+    w->flight_event_total = 0;
+    w->flight_byte_total = 0;
+    w->dump_error = 0;
+    w->dump_requests = 0;
+    w->dumps_done = 0;
 
-    while (getline(&line, &len, fp) != -1) {
-        current_line++;
-        if (current_line == lineno) {
-            size_t line_len = strlen(line);
-            if (line_len > 0 && line[line_len - 1] == '\n') {
-                line[line_len - 1] = '\0';
-            }
-            fclose(fp);
-            return line;
+    err = pthread_create(&w->thread, NULL, writer_main, NULL);
+    if (err != 0) {
+        free(w->ring);
+        w->ring = NULL;
+        if (w->fd >= 0) {
+            close(w->fd);
+            w->fd = -1;
         }
+        segments_free();
+        return err;
     }
+    w->thread_started = 1;
+    return 0;
+}
 
-    fclose(fp);
-    free(line);
-    return strdup("<unavailable>");
+// Free the ring and the writer's buffers
+static void
+writer_free(void)
+{
+    TraceWriter *w = &trace_writer;
+
+    segments_free();
+    free(w->ring);
+    w->ring = NULL;
+    free(w->index);
+    w->index = NULL;
+    w->index_capacity = 0;
+    buffer_free(&w->scratch);
+    buffer_free(&w->compressed);
+    kept_blocks_free(&w->kept_strings);
+    kept_blocks_free(&w->flight_blocks);
 }
 
-// Main trace function with breakpoint support
+// Drain the ring, stop the writer thread and close the file. Returns the
+// errno of the first failed write, or 0.
 static int
-trace_callback(PyObject *obj, PyFrameObject *frame, int what, PyObject *arg)
+writer_stop(void)
 {
-    if (!is_tracing || trace_file == NULL) {
-        return 0;
+    TraceWriter *w = &trace_writer;
+
+    if (w->thread_started) {
+        atomic_store(&w->stopping, 1);
+        writer_wake(&w->data_ready);
+        pthread_join(w->thread, NULL);
+        w->thread_started = 0;
+    }
+    if (w->fd >= 0) {
+        if (w->error == 0) {
+            w->error = write_block_index();
+        }
+        if (close(w->fd) != 0 && w->error == 0) {
+            w->error = errno;
+        }
+        w->fd = -1;
+    }
+    if (w->manifest != NULL && w->error == 0) {
+        w->error = write_manifest(0);
+    }
+    writer_free();
+    return w->error;
+}
+
+// Before fork the writer thread is stopped once it has written everything
+// pending, so the child starts with an empty ring and no other thread
+// holding the writer's mutex, and Python sees a single-threaded process.
+// Like writer_dump, this keeps the GIL, so nothing is pushed meanwhile. The
+// parent restarts the thread when it next hands over a block, since Python
+// 3.13 warns about threads that exist right after fork.
+static void
+writer_pause(void)
+{
+    TraceWriter *w = &trace_writer;
+
+    if (w->thread_started) {
+        atomic_store(&w->stopping, 1);
+        writer_wake(&w->data_ready);
+        pthread_join(w->thread, NULL);
+        w->thread_started = 0;
+        atomic_store(&w->stopping, 0);
     }
+}
+
+// Restart the writer thread if writer_pause stopped it. Returns 0 or an
+// errno value; the ring is empty if it could not be started.
+static int
+writer_resume(void)
+{
+    TraceWriter *w = &trace_writer;
 
-    // Only trace LINE events
-    if (what != PyTrace_LINE) {
+    if (w->thread_started) {
         return 0;
     }
+    int err = pthread_create(&w->thread, NULL, writer_main, NULL);
+    w->thread_started = err == 0;
+    return err;
+}
 
-    // Get filename and line number
-    PyCodeObject *code = COMPAT_PyFrame_GetCode(frame);
-    PyObject *filename_obj = code->co_filename;
-    const char *filename = PyUnicode_AsUTF8(filename_obj);
-    int lineno = PyFrame_GetLineNumber(frame);
-    COMPAT_Py_XDECREF_Code(code);
+// After fork, in the child. The file is the parent's, so close it without
+// writing anything.
+static void
+writer_forget(void)
+{
+    TraceWriter *w = &trace_writer;
 
-    if (filename == NULL) {
-        PyErr_Clear();
+    if (w->fd >= 0) {
+        close(w->fd);
+        w->fd = -1;
+    }
+    free(w->dump_filename);
+    w->dump_filename = NULL;
+    writer_free();
+}
+
+// Ask the writer thread to write the flight recorder's blocks to filename
+// once everything pushed so far is compressed, and wait for it. Returns 0
+// or an errno value. Like a producer waiting for room in the ring, this
+// keeps the GIL: no line is recorded and tracing cannot stop until the
+// dump is written, and the writer never needs the GIL.
+static int
+writer_dump(const char *filename)
+{
+    TraceWriter *w = &trace_writer;
+    int err = writer_resume();
+    if (err != 0) {
+        return err;
+    }
+    char *copy = strdup(filename);
+    if (copy == NULL) {
+        return ENOMEM;
+    }
+
+    pthread_mutex_lock(&w->mutex);
+    w->dump_filename = copy;
+    uint64_t ticket = ++w->dump_requests;
+    pthread_cond_broadcast(&w->data_ready);
+    while (w->dumps_done < ticket) {
+        pthread_cond_wait(&w->dump_done, &w->mutex);
+    }
+    err = w->dump_error;
+    pthread_mutex_unlock(&w->mutex);
+    return err;
+}
+
+// Make sure the ring has room for length bytes. Returns 0 if the record
+// should be dropped, 1 if it fits in the ring, 2 if it is larger than the
+// ring and the ring has been drained so it can be written directly.
+static int
+writer_reserve(size_t length, int droppable)
+{
+    TraceWriter *w = &trace_writer;
+    size_t head = atomic_load_explicit(&w->head, memory_order_relaxed);
+    int direct = length > w->capacity;
+
+    if (!direct && w->capacity - (head - atomic_load_explicit(&w->tail, memory_order_acquire)) >= length) {
+        return 1;
+    }
+    if (droppable && w->drop_when_full) {
+        // A block larger than the whole ring can only go straight to the file
+        if (direct && head == atomic_load(&w->tail)) {
+            return 2;
+        }
+        // Without it the writer would wait for flush_bytes or flush_interval
+        // and, with both 0, never make room again
+        if (!atomic_exchange(&w->ring_full, 1)) {
+            writer_wake(&w->data_ready);
+        }
         return 0;
     }
 
-    // Skip system files
-    if (strstr(filename, "site-packages") != NULL ||
-        strstr(filename, "/usr/lib") != NULL ||
-        strstr(filename, "/usr/local/lib") != NULL ||
-        strstr(filename, "python3.") != NULL ||
-        strstr(filename, "<frozen") != NULL ||
-        strstr(filename, "importlib") != NULL ||
-        strstr(filename, "cdebugger") != NULL ||
-        strstr(filename, "runner.py") != NULL ||
-        strstr(filename, "idebug.py") != NULL ||
-        filename[0] == '<') {
+    pthread_mutex_lock(&w->mutex);
+    atomic_store(&w->producer_waiting, 1);
+    for (;;) {
+        size_t used = head - atomic_load(&w->tail);
+        if (direct ? used == 0 : w->capacity - used >= length) {
+            break;
+        }
+        pthread_cond_broadcast(&w->data_ready);
+        pthread_cond_wait(&w->space_ready, &w->mutex);
+    }
+    atomic_store(&w->producer_waiting, 0);
+    pthread_mutex_unlock(&w->mutex);
+    return direct ? 2 : 1;
+}
+
+// Wait until the writer thread has written every block pushed so far. Like
+// a producer waiting for room, this keeps the GIL.
+static void
+writer_sync(void)
+{
+    TraceWriter *w = &trace_writer;
+    size_t head = atomic_load_explicit(&w->head, memory_order_relaxed);
+
+    // Without a writer thread the blocks were written when they were pushed
+    if (!w->thread_started) {
+        return;
+    }
+    pthread_mutex_lock(&w->mutex);
+    atomic_store(&w->producer_waiting, 1);
+    while (atomic_load(&w->tail) != head) {
+        pthread_cond_broadcast(&w->data_ready);
+        pthread_cond_wait(&w->space_ready, &w->mutex);
+    }
+    atomic_store(&w->producer_waiting, 0);
+    pthread_mutex_unlock(&w->mutex);
+}
+
+static void
+writer_copy(size_t *head, const unsigned char *data, size_t length)
+{
+    TraceWriter *w = &trace_writer;
+    size_t offset = *head % w->capacity;
+    size_t first = length < w->capacity - offset ? length : w->capacity - offset;
+
+    memcpy(w->ring + offset, data, first);
+    memcpy(w->ring, data + first, length - first);
+    *head += length;
+}
+
+// Hand a sealed block to the writer thread. Returns 0 if it was dropped
+// because the ring was full.
+static int
+writer_push_block(int type, uint64_t first_seq, uint64_t event_count,
+                  const unsigned char *raw, size_t raw_length, int droppable)
+{
+    TraceWriter *w = &trace_writer;
+    unsigned char header[BLOCK_HEADER_MAX];
+    size_t header_length = 0;
+
+    header[header_length++] = (unsigned char)type;
+    header_length += trace_put_varint(header + header_length, raw_length);
+    header_length += trace_put_varint(header + header_length, first_seq);
+    header_length += trace_put_varint(header + header_length, event_count);
+
+    // Without a writer thread (it could not be restarted after fork) the
+    // block is written here
+    int reserved = writer_resume() == 0 ? writer_reserve(header_length + raw_length, droppable) : 2;
+    if (reserved == 0) {
         return 0;
     }
+    if (reserved == 2) {
+        // The writer is idle with an empty ring, so ordering is preserved
+        if (w->error == 0) {
+            w->error = write_block(type, first_seq, event_count, raw, raw_length);
+        }
+        return 1;
+    }
 
-    // Check for breakpoint
-    Breakpoint *bp = check_breakpoint(filename, lineno);
-    if (bp != NULL) {
-        is_paused = 1;
-        printf("\n\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
-        printf("\033[1;31m⚫ BREAKPOINT HIT\033[0m\n");
-        printf("\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
-        printf("File: \033[1;32m%s\033[0m Line: \033[1;32m%d\033[0m\n", filename, lineno);
-        printf("Hit count: %d\n", bp->hit_count);
+    size_t head = atomic_load_explicit(&w->head, memory_order_relaxed);
+    writer_copy(&head, header, header_length);
+    writer_copy(&head, raw, raw_length);
+    atomic_store_explicit(&w->head, head, memory_order_release);
 
-        // Show current code
-        char *current_code = get_source_line(filename, lineno);
-        printf("Code: %s\n", current_code);
-        free(current_code);
+    if (w->flush_bytes > 0 && atomic_load(&w->writer_sleeping) &&
+        head - atomic_load(&w->tail) >= w->flush_bytes) {
+        writer_wake(&w->data_ready);
+    }
+    return 1;
+}
 
-        printf("\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
-        printf("\nCommands:\n");
-        printf("  \033[1;32mc\033[0m - Continue to next breakpoint\n");
-        printf("  \033[1;32mn\033[0m - Step to next line\n");
-        printf("  \033[1;32mb\033[0m - Step back to previous line\n");
-        printf("  \033[1;32mh\033[0m - Show trace history\n");
-        printf("  \033[1;32mq\033[0m - Quit execution\n");
-        printf("\n> ");
+// Records of the block being filled, split by block type
+static ByteBuffer block_strings;
+static ByteBuffer block_events;
+static ByteBuffer block_watch;
+static uint64_t block_first_seq = 0;
+static uint64_t block_event_count = 0;
+static size_t block_size = DEFAULT_BLOCK_SIZE;
+static struct timespec block_opened;
+static unsigned long block_serial = 0;  // Bumped every time the blocks are sealed
+static uint64_t block_event_limit = 0;  // Seal after this many events, 0 = no limit
 
-        char input[256];
-        while (1) {
-            if (fgets(input, sizeof(input), stdin)) {
-                input[strcspn(input, "\n")] = 0;  // Remove newline
+// Append one record (kind, payload length, payload) to the open block
+static void
+emit_record(int kind, const unsigned char *payload, size_t length)
+{
+    int is_event = kind == REC_LINE || kind == REC_CALL || kind == REC_RETURN;
+    ByteBuffer *block = is_event ? &block_events : kind == REC_WATCH ? &block_watch : &block_strings;
+    unsigned char header[1 + TRACE_VARINT_MAX];
 
-                if (strcmp(input, "c") == 0) {
-                    // Continue - breakpoint will hit again in loop
-                    is_paused = 0;
-                    step_mode = 0;
-                    break;
-                } else if (strcmp(input, "n") == 0) {
-                    // Step next
-                    is_paused = 0;
-                    step_mode = 1;
-                    break;
-                } else if (strcmp(input, "b") == 0) {
-                    // Step back
-                    if (trace_history_index > 1) {
-                        trace_history_index--;
-                        show_trace_entry(trace_history_index - 1);
-                        printf("\n> ");
-                    } else {
-                        printf("Already at the beginning of trace history.\n");
-                        printf("\n> ");
-                    }
-                } else if (strcmp(input, "h") == 0) {
-                    // Show history
-                    printf("\nTrace History (%d entries):\n", trace_history_count);
-                    int start = trace_history_count > 10 ? trace_history_count - 10 : 0;
-                    for (int i = start; i < trace_history_count; i++) {
-                        char marker = (i == trace_history_index - 1) ? '>' : ' ';
-                        printf("  %c [%d] #%ld %s:%d\n", 
-                               marker, i + 1, trace_history[i].exec_num,
-                               trace_history[i].filename, trace_history[i].lineno);
-                    }
-                    printf("\n> ");
-                } else if (strcmp(input, "q") == 0) {
-                    // Quit
-                    printf("Exiting...\n");
-                    exit(0);
-                } else {
-                    printf("Unknown command. Use: c, n, b, h, or q\n");
-                    printf("\n> ");
-                }
-            } else {
-                break;
-            }
+    header[0] = (unsigned char)kind;
+    size_t header_length = 1 + trace_put_varint(header + 1, length);
+    buffer_put_bytes(block, header, header_length);
+    buffer_put_bytes(block, payload, length);
+
+    if (kind == REC_LINE) {
+        if (block_event_count == 0) {
+            // A line record starts with its sequence number
+            const unsigned char *pos = payload;
+            trace_get_varint(&pos, payload + length, &block_first_seq);
         }
+        block_event_count++;
     }
+}
 
-    // If in step mode, pause after one line
-    if (step_mode == 1 && !is_paused) {
-        is_paused = 1;
-        step_mode = 0;  // Reset step mode
+// String interning. Each distinct string is written once as a REC_STRING
+// record; ids are only valid within one trace session.
+typedef struct InternEntry {
+    char *text;
+    size_t length;
+    unsigned int hash;
+    uint64_t id;
+} InternEntry;
 
-        char *source_line = get_source_line(filename, lineno);
-        printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
-        printf("\033[1;33m➜ STEP\033[0m\n");
-        printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
-        printf("File: \033[1;32m%s\033[0m Line: \033[1;32m%d\033[0m\n", filename, lineno);
-        printf("Code: %s\n", source_line);
-        printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
-        printf("\nCommands: c (continue), n (step), b (back), h (history), q (quit)\n");
-        printf("\n> ");
-        free(source_line);
+static InternEntry *intern_table = NULL;
+static size_t intern_capacity = 0;
+static size_t intern_count = 0;
 
-        char input[256];
-        while (1) {
-            if (fgets(input, sizeof(input), stdin)) {
-                input[strcspn(input, "\n")] = 0;
+static unsigned int
+hash_bytes(const char *text, size_t length)
+{
+    unsigned int hash = 2166136261u;
+    for (size_t i = 0; i < length; i++) {
+        hash = (hash ^ (unsigned char)text[i]) * 16777619u;
+    }
+    return hash;
+}
 
-                if (strcmp(input, "c") == 0) {
-                    is_paused = 0;
-                    step_mode = 0;
-                    break;
-                } else if (strcmp(input, "n") == 0) {
-                    is_paused = 0;
-                    step_mode = 1;
-                    break;
-                } else if (strcmp(input, "b") == 0) {
-                    // Step back
-                    if (trace_history_index > 1) {
+static int
+intern_grow(void)
+{
+    size_t capacity = intern_capacity ? intern_capacity * 2 : 1024;
+    InternEntry *table = (InternEntry *)calloc(capacity, sizeof(InternEntry));
+    if (table == NULL) {
+        return 0;
+    }
+
+    for (size_t i = 0; i < intern_capacity; i++) {
+        if (intern_table[i].text != NULL) {
+            size_t slot = intern_table[i].hash & (capacity - 1);
+            while (table[slot].text != NULL) {
+                slot = (slot + 1) & (capacity - 1);
+            }
+            table[slot] = intern_table[i];
+        }
+    }
+    free(intern_table);
+    intern_table = table;
+    intern_capacity = capacity;
+    return 1;
+}
+
+// Return the id for a string, emitting its REC_STRING record on first use.
+// Returns 0 if the string cannot be stored.
+static uint64_t
+intern_string(const char *text, size_t length, int kind)
+{
+    if (intern_count * 2 >= intern_capacity && !intern_grow()) {
+        return 0;
+    }
+
+    unsigned int hash = hash_bytes(text, length);
+    size_t slot = hash & (intern_capacity - 1);
+    while (intern_table[slot].text != NULL) {
+        InternEntry *entry = &intern_table[slot];
+        if (entry->hash == hash && entry->length == length &&
+            memcmp(entry->text, text, length) == 0) {
+            return entry->id;
+        }
+        slot = (slot + 1) & (intern_capacity - 1);
+    }
+
+    char *copy = (char *)malloc(length + 1);
+    if (copy == NULL) {
+        return 0;
+    }
+    memcpy(copy, text, length);
+    copy[length] = '\0';
+
+    InternEntry *entry = &intern_table[slot];
+    entry->text = copy;
+    entry->length = length;
+    entry->hash = hash;
+    entry->id = ++intern_count;
+
+    ByteBuffer string_record = {0};
+    buffer_put_varint(&string_record, entry->id);
+    buffer_put_bytes(&string_record, &(unsigned char){(unsigned char)kind}, 1);
+    buffer_put_bytes(&string_record, text, length);
+    emit_record(REC_STRING, string_record.data, string_record.length);
+    buffer_free(&string_record);
+
+    return entry->id;
+}
+
+static void
+intern_clear(void)
+{
+    for (size_t i = 0; i < intern_capacity; i++) {
+        free(intern_table[i].text);
+    }
+    free(intern_table);
+    intern_table = NULL;
+    intern_capacity = 0;
+    intern_count = 0;
+}
+
+static size_t
+escaped_char_length(char ch)
+{
+    switch (ch) {
+    case '\n':
+    case '\r':
+        return 2;
+    case ';':
+    case '|':
+        return 4;
+    default:
+        return 1;
+    }
+}
+
+// Write a length-prefixed value, escaped and truncated like the text format
+static void
+buffer_put_trace_text(ByteBuffer *buffer, const char *text, Py_ssize_t max_chars)
+{
+    static const char truncated[] = "...<truncated>";
+    Py_ssize_t i;
+    size_t length = 0;
+
+    for (i = 0; text[i] != '\0' && i < max_chars; i++) {
+        length += escaped_char_length(text[i]);
+    }
+    int is_truncated = text[i] != '\0';
+    if (is_truncated) {
+        length += sizeof(truncated) - 1;
+    }
+
+    buffer_put_varint(buffer, length);
+    if (!buffer_reserve(buffer, length)) {
+        return;
+    }
+
+    unsigned char *out = buffer->data + buffer->length;
+    for (i = 0; text[i] != '\0' && i < max_chars; i++) {
+        switch (text[i]) {
+        case '\n':
+            memcpy(out, "\\n", 2);
+            break;
+        case '\r':
+            memcpy(out, "\\r", 2);
+            break;
+        case ';':
+            memcpy(out, "\\x3b", 4);
+            break;
+        case '|':
+            memcpy(out, "\\x7c", 4);
+            break;
+        default:
+            *out = (unsigned char)text[i];
+            break;
+        }
+        out += escaped_char_length(text[i]);
+    }
+    if (is_truncated) {
+        memcpy(out, truncated, sizeof(truncated) - 1);
+    }
+    buffer->length += length;
+}
+
+// Repr cache. The encoded repr of immutable values (exact ints, floats,
+// strs, bytes, and tuples/frozensets of those) is kept in a bounded LRU
+// table keyed by object identity. Each entry holds a reference to its
+// object, so the address cannot be reused by another object while the entry
+// exists, and the type is checked on every hit.
+#define DEFAULT_REPR_CACHE_SIZE 4096
+#define REPR_CACHE_MAX_DEPTH 4
+
+typedef struct ReprCacheEntry {
+    PyObject *object;           // Strong reference
+    PyTypeObject *type;
+    unsigned char *encoded;     // Length-prefixed escaped repr
+    size_t length;
+    struct ReprCacheEntry *bucket_next;
+    struct ReprCacheEntry *lru_prev;    // Towards the most recently used
+    struct ReprCacheEntry *lru_next;
+} ReprCacheEntry;
+
+typedef struct ReprCache {
+    ReprCacheEntry **buckets;
+    size_t bucket_count;        // Power of two
+    ReprCacheEntry *lru_head;   // Most recently used
+    ReprCacheEntry *lru_tail;
+    Py_ssize_t capacity;        // Maximum entries, 0 disables the cache
+    Py_ssize_t count;
+    size_t bytes;               // Encoded reprs held by the cache
+    uint64_t hits;
+    uint64_t misses;
+    uint64_t evictions;
+} ReprCache;
+
+static ReprCache repr_cache = {.capacity = DEFAULT_REPR_CACHE_SIZE};
+
+static int
+repr_is_immutable(PyObject *value, int depth)
+{
+    if (value == Py_None || value == Py_True || value == Py_False ||
+        PyLong_CheckExact(value) || PyFloat_CheckExact(value) || PyComplex_CheckExact(value) ||
+        PyUnicode_CheckExact(value) || PyBytes_CheckExact(value)) {
+        return 1;
+    }
+    if (depth >= REPR_CACHE_MAX_DEPTH) {
+        return 0;
+    }
+
+    if (PyTuple_CheckExact(value)) {
+        for (Py_ssize_t i = 0; i < PyTuple_GET_SIZE(value); i++) {
+            if (!repr_is_immutable(PyTuple_GET_ITEM(value, i), depth + 1)) {
+                return 0;
+            }
+        }
+        return 1;
+    }
+    if (PyFrozenSet_CheckExact(value)) {
+        PyObject *iterator = PyObject_GetIter(value);
+        if (iterator == NULL) {
+            PyErr_Clear();
+            return 0;
+        }
+        int immutable = 1;
+        PyObject *item;
+        while (immutable && (item = PyIter_Next(iterator)) != NULL) {
+            immutable = repr_is_immutable(item, depth + 1);
+            Py_DECREF(item);
+        }
+        Py_DECREF(iterator);
+        return immutable;
+    }
+    return 0;
+}
+
+// Types whose values may be cached; containers are checked further on store
+static inline int
+repr_cache_candidate(PyObject *value)
+{
+    PyTypeObject *type = Py_TYPE(value);
+    return type == &PyLong_Type || type == &PyUnicode_Type || type == &PyFloat_Type ||
+           type == &PyTuple_Type || type == &PyBytes_Type || type == &PyFrozenSet_Type ||
+           type == &PyBool_Type || type == &PyComplex_Type || value == Py_None;
+}
+
+static size_t
+repr_cache_bucket(PyObject *value)
+{
+    return ((uintptr_t)value >> 4) & (repr_cache.bucket_count - 1);
+}
+
+static void
+repr_cache_unlink(ReprCacheEntry *entry)
+{
+    ReprCache *cache = &repr_cache;
+
+    if (entry->lru_prev != NULL) {
+        entry->lru_prev->lru_next = entry->lru_next;
+    } else {
+        cache->lru_head = entry->lru_next;
+    }
+    if (entry->lru_next != NULL) {
+        entry->lru_next->lru_prev = entry->lru_prev;
+    } else {
+        cache->lru_tail = entry->lru_prev;
+    }
+}
+
+static void
+repr_cache_push_front(ReprCacheEntry *entry)
+{
+    ReprCache *cache = &repr_cache;
+
+    entry->lru_prev = NULL;
+    entry->lru_next = cache->lru_head;
+    if (cache->lru_head != NULL) {
+        cache->lru_head->lru_prev = entry;
+    }
+    cache->lru_head = entry;
+    if (cache->lru_tail == NULL) {
+        cache->lru_tail = entry;
+    }
+}
+
+static ReprCacheEntry*
+repr_cache_lookup(PyObject *value)
+{
+    ReprCache *cache = &repr_cache;
+
+    if (cache->buckets == NULL) {
+        return NULL;
+    }
+
+    for (ReprCacheEntry *entry = cache->buckets[repr_cache_bucket(value)];
+         entry != NULL; entry = entry->bucket_next) {
+        if (entry->object == value && entry->type == Py_TYPE(value)) {
+            if (entry != cache->lru_head) {
+                repr_cache_unlink(entry);
+                repr_cache_push_front(entry);
+            }
+            cache->hits++;
+            return entry;
+        }
+    }
+    return NULL;
+}
+
+static void
+repr_cache_remove(ReprCacheEntry *entry)
+{
+    ReprCache *cache = &repr_cache;
+    ReprCacheEntry **link = &cache->buckets[repr_cache_bucket(entry->object)];
+
+    while (*link != entry) {
+        link = &(*link)->bucket_next;
+    }
+    *link = entry->bucket_next;
+    repr_cache_unlink(entry);
+
+    cache->count--;
+    cache->bytes -= entry->length;
+    Py_DECREF(entry->object);
+    free(entry->encoded);
+    free(entry);
+}
+
+static void
+repr_cache_store(PyObject *value, const unsigned char *encoded, size_t length)
+{
+    ReprCache *cache = &repr_cache;
+
+    if (cache->capacity <= 0) {
+        return;
+    }
+    if (cache->buckets == NULL) {
+        size_t bucket_count = 16;
+        while (bucket_count < (size_t)cache->capacity) {
+            bucket_count *= 2;
+        }
+        cache->buckets = (ReprCacheEntry **)calloc(bucket_count, sizeof(ReprCacheEntry *));
+        if (cache->buckets == NULL) {
+            return;
+        }
+        cache->bucket_count = bucket_count;
+    }
+
+    if (cache->count >= cache->capacity) {
+        repr_cache_remove(cache->lru_tail);
+        cache->evictions++;
+    }
+
+    ReprCacheEntry *entry = (ReprCacheEntry *)malloc(sizeof(ReprCacheEntry));
+    unsigned char *copy = (unsigned char *)malloc(length);
+    if (entry == NULL || copy == NULL) {
+        free(entry);
+        free(copy);
+        return;
+    }
+    memcpy(copy, encoded, length);
+
+    entry->object = Py_NewRef(value);
+    entry->type = Py_TYPE(value);
+    entry->encoded = copy;
+    entry->length = length;
+
+    size_t bucket = repr_cache_bucket(value);
+    entry->bucket_next = cache->buckets[bucket];
+    cache->buckets[bucket] = entry;
+    repr_cache_push_front(entry);
+
+    cache->count++;
+    cache->bytes += length;
+}
+
+static void
+repr_cache_clear(void)
+{
+    ReprCache *cache = &repr_cache;
+
+    while (cache->lru_tail != NULL) {
+        repr_cache_remove(cache->lru_tail);
+    }
+    free(cache->buckets);
+    cache->buckets = NULL;
+    cache->bucket_count = 0;
+}
+
+static void
+write_repr(ByteBuffer *buffer, PyObject *value)
+{
+    int candidate = repr_cache.capacity > 0 && repr_cache_candidate(value);
+    if (candidate) {
+        ReprCacheEntry *cached = repr_cache_lookup(value);
+        if (cached != NULL) {
+            buffer_put_bytes(buffer, cached->encoded, cached->length);
+            return;
+        }
+    }
+
+    PyObject *repr = PyObject_Repr(value);
+    if (repr == NULL) {
+        PyErr_Clear();
+        buffer_put_trace_text(buffer, "<unrepr>", MAX_REPR_CHARS);
+        return;
+    }
+
+    const char *utf8 = PyUnicode_AsUTF8(repr);
+    if (utf8 == NULL) {
+        PyErr_Clear();
+        buffer_put_trace_text(buffer, "<unrepr>", MAX_REPR_CHARS);
+    } else {
+        size_t start = buffer->length;
+        buffer_put_trace_text(buffer, utf8, MAX_REPR_CHARS);
+        if (candidate && repr_is_immutable(value, 0)) {
+            repr_cache.misses++;
+            repr_cache_store(value, buffer->data + start, buffer->length - start);
+        }
+    }
+
+    Py_XDECREF(repr);
+}
+
+// Variables of one event, encoded as (name, length, value)* with an index
+// of where each variable sits in the encoding
+typedef struct VarSlot {
+    uint64_t name;
+    size_t offset;              // Start of the name
+    size_t value_offset;        // Start of the length-prefixed value
+    size_t end;
+} VarSlot;
+
+typedef struct Snapshot {
+    ByteBuffer values;
+    VarSlot *vars;
+    int var_count;
+    int var_capacity;
+} Snapshot;
+
+static void
+snapshot_free(Snapshot *snapshot)
+{
+    buffer_free(&snapshot->values);
+    free(snapshot->vars);
+    snapshot->vars = NULL;
+    snapshot->var_count = 0;
+    snapshot->var_capacity = 0;
+}
+
+// Make room for one more variable
+static int
+snapshot_reserve(Snapshot *snapshot)
+{
+    if (snapshot->var_count == snapshot->var_capacity) {
+        int capacity = snapshot->var_capacity ? snapshot->var_capacity * 2 : 32;
+        VarSlot *vars = (VarSlot *)realloc(snapshot->vars, capacity * sizeof(VarSlot));
+        if (vars == NULL) {
+            return 0;
+        }
+        snapshot->vars = vars;
+        snapshot->var_capacity = capacity;
+    }
+    return 1;
+}
+
+// Add a variable by interned name id
+static void
+write_variable_id(Snapshot *snapshot, uint64_t name, PyObject *value)
+{
+    // A repr can run Python code, during which another thread may stop tracing
+    if (!is_tracing || !snapshot_reserve(snapshot)) {
+        return;
+    }
+
+    ByteBuffer *buffer = &snapshot->values;
+    VarSlot *slot = &snapshot->vars[snapshot->var_count++];
+    slot->name = name;
+    slot->offset = buffer->length;
+    buffer_put_varint(buffer, slot->name);
+    slot->value_offset = buffer->length;
+    write_repr(buffer, value);
+    slot->end = buffer->length;
+}
+
+static void
+write_variable(Snapshot *snapshot, const char *var_name, PyObject *value)
+{
+    if (!is_tracing) {
+        return;
+    }
+    write_variable_id(snapshot, intern_string(var_name, strlen(var_name), STR_NAME), value);
+}
+
+static void
+append_buffer(char *buffer, size_t buffer_size, const char *text)
+{
+    size_t used = strlen(buffer);
+    if (used >= buffer_size - 1) {
+        return;
+    }
+    strncat(buffer, text, buffer_size - used - 1);
+}
+
+static void
+append_trace_text(char *buffer, size_t buffer_size, const char *text, Py_ssize_t max_chars)
+{
+    Py_ssize_t i;
+
+    if (text == NULL) {
+        append_buffer(buffer, buffer_size, "<unrepr>");
+        return;
+    }
+
+    for (i = 0; text[i] != '\0' && i < max_chars; i++) {
+        char ch[2] = {text[i], '\0'};
+        switch (text[i]) {
+        case '\n':
+            append_buffer(buffer, buffer_size, "\\n");
+            break;
+        case '\r':
+            append_buffer(buffer, buffer_size, "\\r");
+            break;
+        case ';':
+            append_buffer(buffer, buffer_size, "\\x3b");
+            break;
+        case '|':
+            append_buffer(buffer, buffer_size, "\\x7c");
+            break;
+        default:
+            append_buffer(buffer, buffer_size, ch);
+            break;
+        }
+    }
+
+    if (text[i] != '\0') {
+        append_buffer(buffer, buffer_size, "...<truncated>");
+    }
+}
+
+static void
+append_repr(char *buffer, size_t buffer_size, PyObject *value)
+{
+    PyObject *repr = PyObject_Repr(value);
+    if (repr == NULL) {
+        PyErr_Clear();
+        append_buffer(buffer, buffer_size, "<unrepr>");
+        return;
+    }
+
+    const char *utf8 = PyUnicode_AsUTF8(repr);
+    if (utf8 == NULL) {
+        PyErr_Clear();
+        append_buffer(buffer, buffer_size, "<unrepr>");
+    } else {
+        append_trace_text(buffer, buffer_size, utf8, 100);
+    }
+
+    Py_XDECREF(repr);
+}
+
+// Add "name=repr" to a step-back history entry's variables
+static void
+append_history_variable(char *buffer, size_t buffer_size, const char *name, PyObject *value)
+{
+    if (buffer[0] != '\0') {
+        append_buffer(buffer, buffer_size, "; ");
+    }
+    append_buffer(buffer, buffer_size, name);
+    append_buffer(buffer, buffer_size, "=");
+    append_repr(buffer, buffer_size, value);
+}
+
+// Trace history for step back
+#define MAX_TRACE_HISTORY 1000
+typedef struct TraceEntry {
+    char *filename;
+    int lineno;
+    char *code;
+    char *variables;
+    char *globals;
+    long exec_num;
+} TraceEntry;
+
+static TraceEntry trace_history[MAX_TRACE_HISTORY];
+static int trace_history_count = 0;
+static int trace_history_index = 0;
+
+// Helper function to add entry to trace history
+static void add_trace_entry(const char *filename, int lineno, const char *code, const char *variables) {
+    if (trace_history_count < MAX_TRACE_HISTORY) {
+        TraceEntry *entry = &trace_history[trace_history_count];
+        entry->filename = strdup(filename);
+        entry->lineno = lineno;
+        entry->code = strdup(code);
+        entry->variables = strdup(variables ? variables : "");
+        entry->exec_num = execution_counter - 1;
+        trace_history_count++;
+        trace_history_index = trace_history_count;
+    }
+}
+
+// Helper function to show trace entry
+static void show_trace_entry(int index) {
+    if (index < 0 || index >= trace_history_count) {
+        return;
+    }
+
+    TraceEntry *entry = &trace_history[index];
+    printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("\033[1;35m⟲ TRACE HISTORY [%d/%d]\033[0m\n", index + 1, trace_history_count);
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("Execution: \033[1;32m#%ld\033[0m\n", entry->exec_num);
+    printf("File: \033[1;32m%s\033[0m Line: \033[1;32m%d\033[0m\n", entry->filename, entry->lineno);
+    printf("Code: %s\n", entry->code);
+    if (entry->variables && strlen(entry->variables) > 0) {
+        printf("Variables: %s\n", entry->variables);
+    }
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+}
+
+// Helper function to free trace history
+static void free_trace_history() {
+    for (int i = 0; i < trace_history_count; i++) {
+        free(trace_history[i].filename);
+        free(trace_history[i].code);
+        free(trace_history[i].variables);
+    }
+    trace_history_count = 0;
+    trace_history_index = 0;
+}
+
+// Helper function to add a breakpoint. Takes the reference to condition.
+static int add_breakpoint(const char *filename, int lineno, const char *condition_text,
+                          PyObject *condition, long hits) {
+    Breakpoint *bp = (Breakpoint *)malloc(sizeof(Breakpoint));
+    if (bp == NULL) {
+        Py_XDECREF(condition);
+        return 0;
+    }
+
+    bp->filename = strdup(filename);
+    bp->lineno = lineno;
+    bp->enabled = 1;
+    bp->hit_count = 0;
+    bp->skip = hits > 1 ? hits - 1 : 0;
+    bp->condition_text = condition_text ? strdup(condition_text) : NULL;
+    bp->condition = condition;
+    bp->next = breakpoints;
+    breakpoints = bp;
+    breakpoint_generation++;
+
+    return 1;
+}
+
+// Helper function to extract basename from path
+static const char* get_basename(const char *path) {
+    const char *basename = strrchr(path, '/');
+    if (basename != NULL) {
+        return basename + 1;  // Skip the '/'
+    }
+    return path;  // No slash found, return as-is
+}
+
+// Helper function to check if two filenames match
+// Supports exact match, absolute path match, and basename match
+static int filenames_match(const char *bp_filename, const char *current_filename) {
+    // Exact match
+    if (strcmp(bp_filename, current_filename) == 0) {
+        return 1;
+    }
+
+    // Check if one is absolute and contains the other
+    if (strstr(current_filename, bp_filename) != NULL) {
+        // Check if it's a proper path match (not just substring)
+        const char *found = strstr(current_filename, bp_filename);
+        // Verify it's at the end or followed by end of string
+        if (found + strlen(bp_filename) == current_filename + strlen(current_filename)) {
+            return 1;
+        }
+    }
+
+    // Check basename match as fallback
+    const char *bp_base = get_basename(bp_filename);
+    const char *current_base = get_basename(current_filename);
+    if (strcmp(bp_base, current_base) == 0) {
+        return 1;
+    }
+
+    return 0;
+}
+
+// Helper function to write variable values to the record
+static void
+write_variables(Snapshot *snapshot, PyObject *locals, int locals_are_globals)
+{
+    if (locals == NULL || !PyDict_Check(locals)) {
+        return;
+    }
+
+    PyObject *key, *value;
+    Py_ssize_t pos = 0;
+
+    while (PyDict_Next(locals, &pos, &key, &value)) {
+        const char *var_name = PyUnicode_AsUTF8(key);
+        if (var_name == NULL) {
+            PyErr_Clear();
+            continue;
+        }
+
+        if (should_skip_local_variable(var_name, value, locals_are_globals)) {
+            continue;
+        }
+
+        write_variable(snapshot, var_name, value);
+    }
+}
+
+// Whether a global is hidden by a local of the same name: a key of the
+// locals dict, or without one, one of the first local_count variables
+static int
+is_shadowed(Snapshot *snapshot, int local_count, PyObject *locals, PyObject *key, uint64_t name)
+{
+    if (locals != NULL) {
+        return PyDict_Contains(locals, key) == 1;
+    }
+    for (int i = 0; i < local_count; i++) {
+        if (snapshot->vars[i].name == name) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static void
+write_globals(Snapshot *snapshot, PyObject *globals, PyObject *locals, int local_count)
+{
+    if (globals == NULL || !PyDict_Check(globals)) {
+        return;
+    }
+
+    PyObject *key, *value;
+    Py_ssize_t pos = 0;
+
+    while (PyDict_Next(globals, &pos, &key, &value)) {
+        const char *var_name = PyUnicode_AsUTF8(key);
+        if (var_name == NULL) {
+            PyErr_Clear();
+            continue;
+        }
+
+        if (should_skip_global_variable(var_name, value)) {
+            continue;
+        }
+
+        uint64_t name = local_count > 0 ? intern_string(var_name, strlen(var_name), STR_NAME) : 0;
+        if ((locals != NULL || local_count > 0) &&
+            is_shadowed(snapshot, local_count, locals, key, name)) {
+            continue;
+        }
+
+        write_variable(snapshot, var_name, value);
+    }
+}
+
+// Source line cache. Each file is read once and split in place into lines,
+// so the text of any line is an O(1) lookup instead of a reopen and scan.
+// Entries are keyed by filename and revalidated against the file's mtime
+// and size once per trace session.
+typedef struct SourceFile {
+    char *filename;
+    time_t mtime;
+    off_t size;
+    unsigned long generation;   // Trace session the entry was validated in
+    char *data;                 // File contents with '\n' replaced by '\0'
+    size_t *lines;              // Offset of each line in data
+    int line_count;
+    uint64_t *line_ids;         // Interned string id of each line, 0 if unset
+    unsigned long ids_generation;
+    struct SourceFile *next;
+} SourceFile;
+
+#define SOURCE_CACHE_BUCKETS 256
+#define SOURCE_UNAVAILABLE "<unavailable>"
+
+static SourceFile *source_cache[SOURCE_CACHE_BUCKETS];
+static unsigned long trace_generation = 0;
+
+static unsigned int
+hash_string(const char *text)
+{
+    unsigned int hash = 2166136261u;
+    for (; *text; text++) {
+        hash = (hash ^ (unsigned char)*text) * 16777619u;
+    }
+    return hash;
+}
+
+static void
+unload_source_file(SourceFile *file)
+{
+    free(file->data);
+    free(file->lines);
+    free(file->line_ids);
+    file->data = NULL;
+    file->lines = NULL;
+    file->line_ids = NULL;
+    file->line_count = 0;
+}
+
+// Read the whole file and build the line offset table
+static void
+load_source_file(SourceFile *file)
+{
+    struct stat st;
+
+    unload_source_file(file);
+    if (stat(file->filename, &st) != 0) {
+        file->mtime = 0;
+        file->size = -1;
+        return;
+    }
+    file->mtime = st.st_mtime;
+    file->size = st.st_size;
+
+    FILE *fp = fopen(file->filename, "rb");
+    if (fp == NULL) {
+        return;
+    }
+
+    char *data = (char *)malloc((size_t)st.st_size + 1);
+    size_t length = data ? fread(data, 1, (size_t)st.st_size, fp) : 0;
+    fclose(fp);
+    if (data == NULL) {
+        return;
+    }
+    data[length] = '\0';
+
+    int capacity = 64;
+    size_t *lines = (size_t *)malloc(capacity * sizeof(size_t));
+    int count = 0;
+    size_t line_start = 0;
+    if (lines == NULL) {
+        free(data);
+        return;
+    }
+
+    for (size_t i = 0; i <= length; i++) {
+        if (i < length && data[i] != '\n') {
+            continue;
+        }
+        if (i == length && line_start == length) {
+            break;  // No text after the final newline
+        }
+        if (count == capacity) {
+            capacity *= 2;
+            size_t *grown = (size_t *)realloc(lines, capacity * sizeof(size_t));
+            if (grown == NULL) {
+                free(lines);
+                free(data);
+                return;
+            }
+            lines = grown;
+        }
+        lines[count++] = line_start;
+        data[i] = '\0';
+        line_start = i + 1;
+    }
+
+    file->data = data;
+    file->lines = lines;
+    file->line_count = count;
+    file->line_ids = (uint64_t *)calloc(count ? count : 1, sizeof(uint64_t));
+    file->ids_generation = trace_generation;
+}
+
+// Look up (loading on first use) the cached contents of a source file
+static SourceFile*
+get_source_file(const char *filename)
+{
+    unsigned int bucket = hash_string(filename) % SOURCE_CACHE_BUCKETS;
+    SourceFile *file = source_cache[bucket];
+
+    while (file != NULL && strcmp(file->filename, filename) != 0) {
+        file = file->next;
+    }
+
+    if (file == NULL) {
+        file = (SourceFile *)calloc(1, sizeof(SourceFile));
+        if (file == NULL) {
+            return NULL;
+        }
+        file->filename = strdup(filename);
+        if (file->filename == NULL) {
+            free(file);
+            return NULL;
+        }
+        file->next = source_cache[bucket];
+        source_cache[bucket] = file;
+        load_source_file(file);
+        file->generation = trace_generation;
+        return file;
+    }
+
+    if (file->generation != trace_generation) {
+        struct stat st;
+        int exists = stat(filename, &st) == 0;
+        if (!exists || st.st_mtime != file->mtime || st.st_size != file->size) {
+            load_source_file(file);
+        }
+        file->generation = trace_generation;
+    }
+    return file;
+}
+
+// Helper function to get the source line. The result is owned by the cache.
+static const char*
+source_file_line(SourceFile *file, int lineno)
+{
+    if (file == NULL || file->data == NULL || lineno < 1 || lineno > file->line_count) {
+        return SOURCE_UNAVAILABLE;
+    }
+    return file->data + file->lines[lineno - 1];
+}
+
+// Interned string id of a source line, cached per file and session
+static uint64_t
+source_line_id(SourceFile *file, int lineno)
+{
+    if (file == NULL || file->data == NULL || file->line_ids == NULL ||
+        lineno < 1 || lineno > file->line_count) {
+        return intern_string(SOURCE_UNAVAILABLE, strlen(SOURCE_UNAVAILABLE), STR_CODE);
+    }
+
+    if (file->ids_generation != trace_generation) {
+        memset(file->line_ids, 0, file->line_count * sizeof(uint64_t));
+        file->ids_generation = trace_generation;
+    }
+
+    uint64_t *id = &file->line_ids[lineno - 1];
+    if (*id == 0) {
+        const char *line = file->data + file->lines[lineno - 1];
+        *id = intern_string(line, strlen(line), STR_CODE);
+    }
+    return *id;
+}
+
+// Helper function to decide whether a file is part of Python or a library
+static int
+is_system_filename(const char *filename)
+{
+    return strstr(filename, "site-packages") != NULL ||
+           strstr(filename, "/usr/lib") != NULL ||
+           strstr(filename, "/usr/local/lib") != NULL ||
+           strstr(filename, "python3.") != NULL ||
+           strstr(filename, "<frozen") != NULL ||
+           strstr(filename, "importlib") != NULL ||
+           filename[0] == '<';
+}
+
+// The debugger's own files are never traced
+static int
+is_debugger_filename(const char *filename)
+{
+    return strstr(filename, "cdebugger") != NULL ||
+           strstr(filename, "runner.py") != NULL ||
+           strstr(filename, "idebug.py") != NULL;
+}
+
+// Recording scope given to start_trace(): fnmatch(3) patterns, parsed once
+// per trace session and applied once per code object (see get_code_info)
+typedef struct ScopePatterns {
+    char **patterns;
+    int count;
+} ScopePatterns;
+
+static ScopePatterns scope_include;     // Files to trace, libraries included
+static ScopePatterns scope_exclude;     // Files never to trace
+static ScopePatterns scope_functions;   // Qualified names of functions to trace
+
+static void
+scope_clear(ScopePatterns *scope)
+{
+    for (int i = 0; i < scope->count; i++) {
+        free(scope->patterns[i]);
+    }
+    free(scope->patterns);
+    scope->patterns = NULL;
+    scope->count = 0;
+}
+
+// Fill scope from None, a string or an iterable of strings. Returns -1 with
+// an exception set on failure.
+static int
+scope_parse(PyObject *value, ScopePatterns *scope, const char *name)
+{
+    scope_clear(scope);
+    if (value == NULL || value == Py_None) {
+        return 0;
+    }
+
+    PyObject *items = PyUnicode_Check(value) ? PyTuple_Pack(1, value) :
+                      PySequence_Fast(value, "");
+    if (items == NULL) {
+        PyErr_Format(PyExc_TypeError, "%s must be a string or a sequence of strings", name);
+        return -1;
+    }
+    Py_ssize_t count = PySequence_Fast_GET_SIZE(items);
+    scope->patterns = (char **)calloc(count ? count : 1, sizeof(char *));
+    if (scope->patterns == NULL) {
+        Py_DECREF(items);
+        PyErr_NoMemory();
+        return -1;
+    }
+    for (Py_ssize_t i = 0; i < count; i++) {
+        PyObject *item = PySequence_Fast_GET_ITEM(items, i);
+        const char *pattern = PyUnicode_Check(item) ? PyUnicode_AsUTF8(item) : NULL;
+        if (pattern == NULL) {
+            Py_DECREF(items);
+            if (!PyErr_Occurred()) {
+                PyErr_Format(PyExc_TypeError, "%s must be a string or a sequence of strings", name);
+            }
+            return -1;
+        }
+        scope->patterns[scope->count] = strdup(pattern);
+        if (scope->patterns[scope->count] == NULL) {
+            Py_DECREF(items);
+            PyErr_NoMemory();
+            return -1;
+        }
+        scope->count++;
+    }
+    Py_DECREF(items);
+    return 0;
+}
+
+// Filename patterns with a '/' match the whole path, others match the
+// basename. '*' also matches '/'.
+static int
+scope_match_filename(const ScopePatterns *scope, const char *filename)
+{
+    const char *slash = strrchr(filename, '/');
+    const char *basename = slash ? slash + 1 : filename;
+
+    for (int i = 0; i < scope->count; i++) {
+        const char *pattern = scope->patterns[i];
+        if (fnmatch(pattern, strchr(pattern, '/') ? filename : basename, 0) == 0) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static int
+scope_match_function(const ScopePatterns *scope, const char *function)
+{
+    for (int i = 0; i < scope->count; i++) {
+        if (fnmatch(scope->patterns[i], function, 0) == 0) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+// Decide whether a code object is traced. Without include patterns, Python's
+// own files and installed libraries are left out; include patterns replace
+// that rule, so they can opt libraries in.
+static int
+code_in_scope(const char *filename, const char *function)
+{
+    if (is_debugger_filename(filename) || scope_match_filename(&scope_exclude, filename)) {
+        return 0;
+    }
+    if (scope_include.count > 0 ? !scope_match_filename(&scope_include, filename)
+                                : is_system_filename(filename)) {
+        return 0;
+    }
+    return scope_functions.count == 0 || scope_match_function(&scope_functions, function);
+}
+
+static void
+scope_clear_all(void)
+{
+    scope_clear(&scope_include);
+    scope_clear(&scope_exclude);
+    scope_clear(&scope_functions);
+}
+
+// Watch expressions (start_trace(..., watch=[...])). Each is compiled once
+// and evaluated in the frame of every recorded line; its value goes to the
+// watch channel only when its repr differs from the last one written.
+typedef struct WatchExpression {
+    char *text;
+    PyObject *code;
+    uint64_t text_id;       // Interned expression, 0 until first written
+    ByteBuffer last;        // Encoded repr last written
+    int has_value;
+} WatchExpression;
+
+static WatchExpression *watches = NULL;
+static int watch_count = 0;
+static ByteBuffer watch_value;
+
+static void
+watch_clear(void)
+{
+    for (int i = 0; i < watch_count; i++) {
+        free(watches[i].text);
+        Py_XDECREF(watches[i].code);
+        buffer_free(&watches[i].last);
+    }
+    free(watches);
+    watches = NULL;
+    watch_count = 0;
+    buffer_free(&watch_value);
+}
+
+// Compile the watch expressions from None, a string or a sequence of
+// strings. Returns -1 with an exception set on failure.
+static int
+watch_parse(PyObject *value)
+{
+    ScopePatterns texts = {NULL, 0};
+
+    watch_clear();
+    if (scope_parse(value, &texts, "watch") < 0) {
+        scope_clear(&texts);
+        return -1;
+    }
+    watches = (WatchExpression *)calloc(texts.count ? texts.count : 1, sizeof(WatchExpression));
+    if (watches == NULL) {
+        scope_clear(&texts);
+        PyErr_NoMemory();
+        return -1;
+    }
+    for (int i = 0; i < texts.count; i++) {
+        PyObject *code = Py_CompileString(texts.patterns[i], "<watch>", Py_eval_input);
+        if (code == NULL) {
+            scope_clear(&texts);
+            return -1;
+        }
+        watches[watch_count].code = code;
+        watches[watch_count].text = texts.patterns[i];
+        texts.patterns[i] = NULL;
+        watch_count++;
+    }
+    scope_clear(&texts);
+    return 0;
+}
+
+// Evaluate the watch expressions for the line numbered seq and write the
+// ones that changed. An expression that raises (e.g. a name that is not
+// visible in this frame) keeps its last value.
+static void
+record_watches(PyObject *globals, PyObject *locals, uint64_t seq)
+{
+    for (int i = 0; i < watch_count; i++) {
+        WatchExpression *watch = &watches[i];
+        PyObject *value = PyEval_EvalCode(watch->code, globals, locals);
+        if (value == NULL) {
+            PyErr_Clear();
+            continue;
+        }
+        watch_value.length = 0;
+        write_repr(&watch_value, value);
+        Py_DECREF(value);
+
+        if (watch->has_value && watch->last.length == watch_value.length &&
+            memcmp(watch->last.data, watch_value.data, watch_value.length) == 0) {
+            continue;
+        }
+        watch->last.length = 0;
+        buffer_put_bytes(&watch->last, watch_value.data, watch_value.length);
+        watch->has_value = 1;
+
+        if (watch->text_id == 0) {
+            watch->text_id = intern_string(watch->text, strlen(watch->text), STR_WATCH);
+        }
+        ByteBuffer *record = &record_buffer;
+        record->length = 0;
+        buffer_put_varint(record, seq);
+        buffer_put_varint(record, watch->text_id);
+        // write_repr() already put the value's length in front of it
+        buffer_put_bytes(record, watch_value.data, watch_value.length);
+        emit_record(REC_WATCH, record->data, record->length);
+    }
+}
+
+// Recording regions (record() and recorded()). With start_trace(...,
+// regions=True) a thread's lines are only recorded while it is inside one.
+// The count is per thread and belongs to the session it was entered in.
+static int regions_only = 0;
+static _Thread_local int region_depth = 0;
+static _Thread_local unsigned long region_generation = 0;
+
+static inline int
+in_region(void)
+{
+    return !regions_only || (region_generation == trace_generation && region_depth > 0);
+}
+
+// Hot-loop sampling, per (code, line). Off unless sample_every > 1 or
+// sample_rate > 0.
+typedef struct LineSample {
+    uint64_t hits;              // Times the line ran
+    uint64_t elided;            // Hits left out since the last recorded one
+    uint64_t window_hits;       // Hits recorded in the current rate window
+    double window_start;
+} LineSample;
+
+static Py_ssize_t sample_first = 0;     // Hits always recorded
+static Py_ssize_t sample_every = 1;     // Then record every Nth hit
+static double sample_rate = 0;          // At most this many hits per second
+static int sampling = 0;
+static uint64_t elided_lines = 0;
+
+// Per-code-object cache stored in the code object's co_extra slot, so the
+// include/exclude decision is made once per code object instead of running
+// the filename filter on every event. Entries from an earlier trace session
+// are recomputed on first use.
+// A breakpoint whose file matched a code object's file
+typedef struct CodeBreakpoint {
+    int lineno;
+    Breakpoint *breakpoint;
+} CodeBreakpoint;
+
+// A fast local of a function, as its locals() would show it
+typedef struct LocalSlot {
+    int index;                  // In the frame's fast locals array
+    int deref;                  // Cell or free variable: the value is in a cell
+    PyObject *name_object;      // Borrowed from the code object
+    const char *name;           // UTF-8, owned by the code object
+    uint64_t name_id;           // Interned name, 0 until first written
+} LocalSlot;
+
+typedef struct CodeInfo {
+    unsigned long generation;   // Trace session the entry was computed for
+    int traced;                 // Include/exclude decision
+    const char *filename;       // UTF-8 co_filename, owned by the code object
+    SourceFile *source;         // Cached source, loaded on the first traced line
+    uint64_t file_id;           // Interned filename, 0 until first written
+    const char *function;       // UTF-8 co_qualname, owned by the code object
+    uint64_t function_id;       // Interned function, 0 until first written
+    int monitored;              // sys.monitoring events enabled on the code
+    LineSample *samples;        // Sampling state of lines sample_base...
+    int sample_base;
+    int sample_count;
+    unsigned long breakpoint_generation;  // Breakpoints the list was resolved for
+    CodeBreakpoint *breakpoints;    // Breakpoints in the code's file, by line
+    int breakpoint_count;
+    LocalSlot *locals;          // Functions only: fast locals in frame order
+    int local_count;            // -1 to read locals through PyEval_GetLocals()
+} CodeInfo;
+
+static Py_ssize_t code_extra_index = -1;
+
+static void
+free_code_info(void *info)
+{
+    free(((CodeInfo *)info)->samples);
+    free(((CodeInfo *)info)->breakpoints);
+    free(((CodeInfo *)info)->locals);
+    free(info);
+}
+
+#if COMPAT_FAST_LOCALS
+static int
+add_local_slot(CodeInfo *info, PyObject *names, Py_ssize_t name_index, int index, int deref)
+{
+    const char *name = PyUnicode_AsUTF8(PyTuple_GET_ITEM(names, name_index));
+    if (name == NULL) {
+        PyErr_Clear();
+        return 0;
+    }
+    if (is_runtime_name(name)) {
+        return 1;
+    }
+    LocalSlot *slot = &info->locals[info->local_count++];
+    slot->index = index;
+    slot->deref = deref;
+    slot->name_object = PyTuple_GET_ITEM(names, name_index);
+    slot->name = name;
+    slot->name_id = 0;
+    return 1;
+}
+#endif
+
+// Lay out which fast locals a function's locals() holds, so lines read them
+// from the frame instead of building the locals dict. Module and class
+// bodies keep their locals in a dict and are left with local_count -1, as
+// are all functions on Python 3.11.
+static void
+resolve_fast_locals(CodeInfo *info, PyCodeObject *code)
+{
+    free(info->locals);
+    info->locals = NULL;
+    info->local_count = -1;
+#if COMPAT_FAST_LOCALS
+    if (!(code->co_flags & CO_OPTIMIZED)) {
+        return;
+    }
+
+#if PY_VERSION_HEX >= 0x030C0000
+    PyObject *varnames = PyCode_GetVarnames(code);
+    PyObject *cellvars = PyCode_GetCellvars(code);
+    PyObject *freevars = PyCode_GetFreevars(code);
+    if (varnames == NULL || cellvars == NULL || freevars == NULL) {
+        PyErr_Clear();
+        Py_XDECREF(varnames);
+        Py_XDECREF(cellvars);
+        Py_XDECREF(freevars);
+        return;
+    }
+#else
+    PyObject *varnames = code->co_varnames;
+    PyObject *cellvars = code->co_cellvars;
+    PyObject *freevars = code->co_freevars;
+#endif
+    Py_ssize_t locals = PyTuple_GET_SIZE(varnames);
+    Py_ssize_t cells = PyTuple_GET_SIZE(cellvars);
+    Py_ssize_t frees = PyTuple_GET_SIZE(freevars);
+    int count = (int)(locals + cells + frees);
+    info->locals = (LocalSlot *)malloc((count ? count : 1) * sizeof(LocalSlot));
+    int ok = info->locals != NULL;
+    info->local_count = 0;
+
+    // Arguments that are also cells are moved into their cell, so the
+    // argument slot is empty (before 3.11) or holds the cell (from 3.11),
+    // which PyFrame_GetVar() reads by the argument's name
+    for (Py_ssize_t i = 0; i < locals && ok; i++) {
+        ok = add_local_slot(info, varnames, i, (int)i, 0);
+    }
+    for (Py_ssize_t i = 0; i < cells && ok; i++) {
+#if PY_VERSION_HEX >= 0x030C0000
+        int argument = PySequence_Contains(varnames, PyTuple_GET_ITEM(cellvars, i));
+        if (argument < 0) {
+            PyErr_Clear();
+        }
+        if (argument != 0) {
+            continue;
+        }
+#endif
+        ok = add_local_slot(info, cellvars, i, (int)(locals + i), 1);
+    }
+    for (Py_ssize_t i = 0; i < frees && ok; i++) {
+        ok = add_local_slot(info, freevars, i, (int)(locals + cells + i), 1);
+    }
+#if PY_VERSION_HEX >= 0x030C0000
+    // The names stay alive in the code object
+    Py_DECREF(varnames);
+    Py_DECREF(cellvars);
+    Py_DECREF(freevars);
+#endif
+    if (!ok) {
+        free(info->locals);
+        info->locals = NULL;
+        info->local_count = -1;
+    }
+#else
+    (void)code;
+#endif
+}
+
+// Returns NULL only when the cache entry cannot be allocated
+static CodeInfo*
+get_code_info(PyCodeObject *code)
+{
+    void *extra = NULL;
+
+    if (code_extra_index < 0 ||
+        COMPAT_Code_GetExtra((PyObject *)code, code_extra_index, &extra) < 0) {
+        PyErr_Clear();
+        return NULL;
+    }
+
+    CodeInfo *info = (CodeInfo *)extra;
+    if (info != NULL && info->generation == trace_generation) {
+        return info;
+    }
+
+    if (info == NULL) {
+        info = (CodeInfo *)calloc(1, sizeof(CodeInfo));
+        if (info == NULL) {
+            return NULL;
+        }
+        if (COMPAT_Code_SetExtra((PyObject *)code, code_extra_index, info) < 0) {
+            PyErr_Clear();
+            free(info);
+            return NULL;
+        }
+    }
+
+    info->generation = trace_generation;
+    info->source = NULL;
+    info->file_id = 0;
+    info->function_id = 0;
+    info->monitored = 0;
+    free(info->samples);
+    info->samples = NULL;
+    info->sample_count = 0;
+    info->breakpoint_generation = 0;
+    info->function = PyUnicode_AsUTF8(COMPAT_Code_GetQualname(code));
+    if (info->function == NULL) {
+        PyErr_Clear();
+        info->function = "?";
+    }
+    info->filename = PyUnicode_AsUTF8(code->co_filename);
+    if (info->filename == NULL) {
+        PyErr_Clear();
+        info->traced = 0;
+    } else {
+        info->traced = code_in_scope(info->filename, info->function);
+    }
+    resolve_fast_locals(info, code);
+    return info;
+}
+
+// Match the breakpoints against the code's file once, keeping them sorted by
+// line, those of one line newest first like the list. Returns 0 if out of
+// memory.
+static int
+resolve_breakpoints(CodeInfo *info)
+{
+    int count = 0;
+    for (Breakpoint *bp = breakpoints; bp != NULL; bp = bp->next) {
+        count++;
+    }
+    CodeBreakpoint *lines = count ? (CodeBreakpoint *)malloc(count * sizeof(CodeBreakpoint)) : NULL;
+    if (count > 0 && lines == NULL) {
+        return 0;
+    }
+
+    count = 0;
+    for (Breakpoint *bp = breakpoints; bp != NULL; bp = bp->next) {
+        if (!filenames_match(bp->filename, info->filename)) {
+            continue;
+        }
+        int low = 0, high = count;
+        while (low < high) {
+            int mid = (low + high) / 2;
+            if (lines[mid].lineno <= bp->lineno) {
+                low = mid + 1;
+            } else {
+                high = mid;
+            }
+        }
+        memmove(lines + low + 1, lines + low, (count - low) * sizeof(CodeBreakpoint));
+        lines[low] = (CodeBreakpoint){bp->lineno, bp};
+        count++;
+    }
+
+    free(info->breakpoints);
+    info->breakpoints = lines;
+    info->breakpoint_count = count;
+    info->breakpoint_generation = breakpoint_generation;
+    return 1;
+}
+
+// Evaluate a breakpoint's condition in the current frame. A condition that
+// raises counts as true, so a mistake in it stops instead of never stopping,
+// and the message says the stop is due to the error.
+static int
+breakpoint_condition_true(Breakpoint *bp, PyFrameObject *frame)
+{
+    if (frame == NULL) {
+        return 1;
+    }
+#if PY_VERSION_HEX < 0x030B0000
+    // The borrowed f_locals is only current after copying the fast locals
+    if (PyFrame_FastToLocalsWithError(frame) < 0) {
+        PyErr_Clear();
+        return 1;
+    }
+    Py_XINCREF(frame->f_globals);
+    Py_XINCREF(frame->f_locals);
+#endif
+    PyObject *globals = COMPAT_PyFrame_GetGlobals(frame);
+    PyObject *locals = COMPAT_PyFrame_GetLocals(frame);
+    if (globals == NULL || locals == NULL) {
+        PyErr_Clear();
+        Py_XDECREF(globals);
+        Py_XDECREF(locals);
+        return 1;
+    }
+
+    PyObject *result = PyEval_EvalCode(bp->condition, globals, locals);
+    Py_DECREF(globals);
+    Py_DECREF(locals);
+    int truth = result != NULL ? PyObject_IsTrue(result) : -1;
+    Py_XDECREF(result);
+    if (truth < 0) {
+        PyObject *type, *value, *traceback;
+        PyErr_Fetch(&type, &value, &traceback);
+        PyObject *message = value != NULL ? PyObject_Str(value) : NULL;
+        const char *text = message != NULL ? PyUnicode_AsUTF8(message) : NULL;
+        PyErr_Clear();
+        printf("\n\033[1;31mBreakpoint condition '%s' raised %s: %s\n"
+               "Stopping because the condition could not be evaluated\033[0m\n",
+               bp->condition_text,
+               type != NULL ? ((PyTypeObject *)type)->tp_name : "an exception",
+               text != NULL ? text : "?");
+        Py_XDECREF(message);
+        Py_XDECREF(type);
+        Py_XDECREF(value);
+        Py_XDECREF(traceback);
+        return 1;
+    }
+    return truth;
+}
+
+// The first breakpoint at this line of the code that stops, counting the
+// hit for every enabled breakpoint on the line. Every visit of the line is a
+// hit, whether or not the condition holds: hits>=N means the Nth time the
+// line runs, as with gdb's ignore counts. So the hit count is
+// checked before the condition, skipped hits never run Python code, and once
+// one breakpoint stops the conditions of the rest are not evaluated.
+// Conditions are evaluated in frame, the frame running the line.
+static Breakpoint*
+check_breakpoint(CodeInfo *info, int lineno, PyFrameObject *frame)
+{
+    if (info->breakpoint_generation != breakpoint_generation && !resolve_breakpoints(info)) {
+        return NULL;
+    }
+
+    int low = 0, high = info->breakpoint_count;
+    while (low < high) {
+        int mid = (low + high) / 2;
+        if (info->breakpoints[mid].lineno < lineno) {
+            low = mid + 1;
+        } else {
+            high = mid;
+        }
+    }
+    Breakpoint *stop = NULL;
+    for (int i = low; i < info->breakpoint_count && info->breakpoints[i].lineno == lineno; i++) {
+        Breakpoint *bp = info->breakpoints[i].breakpoint;
+        if (!bp->enabled) {
+            continue;
+        }
+        bp->hit_count++;
+        if (bp->skip > 0) {
+            bp->skip--;
+            continue;
+        }
+        if (stop == NULL && (bp->condition == NULL || breakpoint_condition_true(bp, frame))) {
+            stop = bp;
+        }
+    }
+    return stop;
+}
+
+// Sampling state of a line, or NULL if it cannot be allocated
+static LineSample*
+get_line_sample(CodeInfo *info, int lineno)
+{
+    int base = info->sample_base;
+    int end = info->sample_base + info->sample_count;
+
+    if (info->samples != NULL && lineno >= base && lineno < end) {
+        return &info->samples[lineno - base];
+    }
+
+    // Grow to cover lineno, with some room for the lines after it
+    if (info->samples == NULL) {
+        base = lineno;
+        end = lineno + 16;
+    } else if (lineno < base) {
+        base = lineno;
+    } else {
+        end = lineno + 16;
+    }
+    LineSample *samples = (LineSample *)calloc(end - base, sizeof(LineSample));
+    if (samples == NULL) {
+        return NULL;
+    }
+    if (info->samples != NULL) {
+        memcpy(samples + (info->sample_base - base), info->samples,
+               info->sample_count * sizeof(LineSample));
+        free(info->samples);
+    }
+    info->samples = samples;
+    info->sample_base = base;
+    info->sample_count = end - base;
+    return &info->samples[lineno - base];
+}
+
+// Whether to record this hit of a line: the first sample_first hits, then
+// every sample_every-th, at most sample_rate per second. *elided is set to
+// the hits left out since the line was last recorded.
+static int
+sample_line(CodeInfo *info, int lineno, uint64_t *elided)
+{
+    LineSample *sample = get_line_sample(info, lineno);
+    *elided = 0;
+    if (sample == NULL) {
+        return 1;
+    }
+
+    sample->hits++;
+    if (sample->hits > (uint64_t)sample_first) {
+        if ((sample->hits - sample_first) % sample_every != 0) {
+            goto skip;
+        }
+        if (sample_rate > 0) {
+            struct timespec now;
+            clock_gettime(CLOCK_MONOTONIC, &now);
+            double seconds = now.tv_sec + now.tv_nsec / 1e9;
+            if (seconds - sample->window_start >= 1.0) {
+                sample->window_start = seconds;
+                sample->window_hits = 0;
+            }
+            if (sample->window_hits >= sample_rate) {
+                goto skip;
+            }
+            sample->window_hits++;
+        }
+    }
+
+    *elided = sample->elided;
+    sample->elided = 0;
+    return 1;
+
+skip:
+    sample->elided++;
+    elided_lines++;
+    return 0;
+}
+
+// Interned function name of a traced code object
+static uint64_t
+code_function_id(CodeInfo *info)
+{
+    if (info->function_id == 0) {
+        info->function_id = intern_string(info->function, strlen(info->function), STR_FUNCTION);
+    }
+    return info->function_id;
+}
+
+// A fast local's value as a new reference, or NULL while it is unbound
+static PyObject*
+read_fast_local(PyFrameObject *frame, LocalSlot *slot)
+{
+#if PY_VERSION_HEX >= 0x030C0000
+    PyObject *value = PyFrame_GetVar(frame, slot->name_object);
+    if (value == NULL) {
+        PyErr_Clear();
+    }
+    return value;
+#elif COMPAT_FAST_LOCALS
+    PyObject *value = frame->f_localsplus[slot->index];
+    if (value != NULL && slot->deref && PyCell_Check(value)) {
+        value = PyCell_GET(value);
+    }
+    Py_XINCREF(value);
+    return value;
+#else
+    (void)frame;
+    (void)slot;
+    return NULL;
+#endif
+}
+
+// Add a function's locals to snapshot, read from its frame in the order
+// locals() would list them
+static void
+write_fast_locals(Snapshot *snapshot, CodeInfo *info, PyFrameObject *frame)
+{
+    for (int i = 0; i < info->local_count; i++) {
+        LocalSlot *slot = &info->locals[i];
+        // A reference, since the repr may run code that rebinds the variable
+        PyObject *value = read_fast_local(frame, slot);
+        if (value == NULL) {
+            continue;
+        }
+        if (slot->name_id == 0) {
+            slot->name_id = intern_string(slot->name, strlen(slot->name), STR_NAME);
+        }
+        write_variable_id(snapshot, slot->name_id, value);
+        Py_DECREF(value);
+    }
+}
+
+// Record one traced line: breakpoint/step prompts, trace file, history.
+// Shared by the settrace and sys.monitoring backends.
+// Delta encoding. Each frame remembers the variables of its previous event;
+// later events only record what changed, with a full snapshot (keyframe)
+// every keyframe_interval events. Frames share a fixed table keyed by
+// address, so a frame evicted by a collision just starts over with a new id
+// and a keyframe.
+#define FRAME_STATE_SLOTS 256
+#define DEFAULT_KEYFRAME_INTERVAL 100
+
+typedef struct FrameState {
+    const void *frame;
+    unsigned long generation;
+    uint64_t id;
+    int events;                 // Events since the last keyframe
+    Snapshot last;
+} FrameState;
+
+static FrameState frame_states[FRAME_STATE_SLOTS];
+static uint64_t next_frame_id = 0;
+static int keyframe_interval = DEFAULT_KEYFRAME_INTERVAL;  // 0 disables deltas
+static ByteBuffer delta_buffer;
+static int *delta_matches = NULL;
+static int delta_match_capacity = 0;
+
+static FrameState*
+get_frame_state(const void *frame)
+{
+    FrameState *state = &frame_states[((uintptr_t)frame >> 4) % FRAME_STATE_SLOTS];
+
+    if (state->frame != frame || state->generation != trace_generation) {
+        state->frame = frame;
+        state->generation = trace_generation;
+        state->id = next_frame_id++;
+        state->events = 0;
+    }
+    return state;
+}
+
+// Make the next line of every frame a keyframe
+static void
+reset_frame_states(void)
+{
+    for (int i = 0; i < FRAME_STATE_SLOTS; i++) {
+        frame_states[i].frame = NULL;
+    }
+}
+
+// Hand the open blocks to the writer. Every frame restarts with a keyframe
+// so the next events block decodes without this one.
+static void
+seal_blocks(void)
+{
+    TraceWriter *w = &trace_writer;
+
+    if (block_strings.length > 0) {
+        writer_push_block(BLOCK_STRINGS, 0, 0, block_strings.data, block_strings.length, 0);
+        block_strings.length = 0;
+    }
+    if (block_event_count > 0) {
+        if (!writer_push_block(BLOCK_EVENTS, block_first_seq, block_event_count,
+                               block_events.data, block_events.length, 1)) {
+            w->dropped_events += block_event_count;
+        }
+        block_events.length = 0;
+        block_event_count = 0;
+    }
+    if (block_watch.length > 0) {
+        writer_push_block(BLOCK_WATCH, 0, 0, block_watch.data, block_watch.length, 0);
+        block_watch.length = 0;
+    }
+    reset_frame_states();
+    // Like frames, watches restate their value in every block
+    for (int i = 0; i < watch_count; i++) {
+        watches[i].has_value = 0;
+    }
+    block_serial++;
+    clock_gettime(CLOCK_MONOTONIC, &block_opened);
+}
+
+// Seal the open block once it is full, or once it has been open longer
+// than flush_interval (checked every BLOCK_CLOCK_EVENTS events)
+#define BLOCK_CLOCK_EVENTS 256
+
+static void
+maybe_seal_blocks(void)
+{
+    if (block_events.length >= block_size ||
+        (block_event_limit > 0 && block_event_count >= block_event_limit)) {
+        seal_blocks();
+        return;
+    }
+
+    double interval = trace_writer.flush_interval;
+    if (interval > 0 && block_event_count % BLOCK_CLOCK_EVENTS == 0) {
+        struct timespec now;
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        double elapsed = (now.tv_sec - block_opened.tv_sec) +
+                         (now.tv_nsec - block_opened.tv_nsec) / 1e9;
+        if (elapsed >= interval) {
+            seal_blocks();
+        }
+    }
+}
+
+// The capture window of an armed trace (see arm_trace). A capture ends at
+// its first line after capture_events lines or capture_seconds seconds,
+// whichever comes first; the time is checked every BLOCK_CLOCK_EVENTS lines.
+static int capture_window = 0;
+static long capture_events = 0;
+static double capture_seconds = 0;
+static struct timespec capture_started;
+
+static int
+capture_window_over(void)
+{
+    if (capture_events > 0 && execution_counter >= capture_events) {
+        return 1;
+    }
+    if (capture_seconds > 0 && execution_counter % BLOCK_CLOCK_EVENTS == 0) {
+        struct timespec now;
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        double elapsed = (now.tv_sec - capture_started.tv_sec) +
+                         (now.tv_nsec - capture_started.tv_nsec) / 1e9;
+        return elapsed >= capture_seconds;
+    }
+    return 0;
+}
+
+static void close_capture_window(void);
+
+// Checkpoints (Linux). With checkpoint_every=N the recorder forks a paused
+// copy of the program every N recorded lines, when only one thread is
+// running. A checkpoint listens on an abstract socket named after its pid
+// (see traceformat.h) and only answers processes of its own user, since
+// it runs whatever they ask. Asked to run to a seq, it forks a runner that
+// resumes the program, with its input and output on /dev/null, counts
+// recorded lines without writing them, and at that seq evaluates
+// expressions in the live frame for the viewer. The newest keep_checkpoints
+// are kept and listed in filename.ckpt. Checkpoints are forked twice so they
+// are not the program's children, and lead a process group of their own
+// with their runners. stop_trace kills the groups; stop_trace(live=True)
+// leaves them for the viewer until kill_checkpoints() or until the process
+// exits, which closes the pipe they watch.
+#define DEFAULT_KEEP_CHECKPOINTS 8
+static void inputs_forget(void);
+static int input_hooks_installed(void);
+#define CHECKPOINT_REQUEST_MAX 65536
+
+typedef struct {
+    pid_t pid;
+    long seq;
+} Checkpoint;
+
+static long checkpoint_every = 0;
+static long keep_checkpoints = DEFAULT_KEEP_CHECKPOINTS;
+static long next_checkpoint = 0;
+static Checkpoint *checkpoints = NULL;
+static int checkpoint_count = 0;
+static int checkpoint_pipe[2] = {-1, -1};   // Checkpoints see EOF once the process exits
+static char *checkpoint_list = NULL;        // filename.ckpt
+static long checkpoint_target = -1;         // In a runner, the seq to stop at
+static int checkpoint_connection = -1;      // In a runner, the viewer's connection
+static long checkpoint_seq = -1;            // In a checkpoint, the seq it was taken at
+static int replaying = 0;                   // In a runner, answering inputs from the log
+
+// Set in a child forked by fork() from C (see note_fork_child) until its
+// first event takes over the recording
+static volatile sig_atomic_t unseen_fork = 0;
+static void after_fork_child(void);
+static volatile sig_atomic_t recorder_forking = 0;
+
+// fork() for the recorder's own processes, checkpoints and their runners,
+// which keep the parent's recording state
+static pid_t
+recorder_fork(void)
+{
+    recorder_forking = 1;
+    pid_t pid = fork();
+    recorder_forking = 0;
+    return pid;
+}
+
+// The hooks do nothing once the writer is gone, except in a runner, which
+// only counts lines
+static inline int
+hooks_active(void)
+{
+    if (unseen_fork) {
+        unseen_fork = 0;
+        after_fork_child();
+    }
+    return is_tracing && (trace_writer.ring != NULL || checkpoint_target >= 0);
+}
+
+// Rewrite filename.ckpt and rename it into place. The path is kept, since
+// checkpoints left by stop_trace(live=True) outlive trace_filename.
+static void
+write_checkpoint_list(void)
+{
+    size_t length = strlen(trace_filename);
+    if (checkpoint_list == NULL) {
+        checkpoint_list = (char *)malloc(2 * length + 16);
+        if (checkpoint_list == NULL) {
+            return;
+        }
+        memcpy(checkpoint_list, trace_filename, length);
+        memcpy(checkpoint_list + length, ".ckpt", 6);
+    }
+    char *temporary = checkpoint_list + length + 6;
+    memcpy(temporary, checkpoint_list, length + 5);
+    memcpy(temporary + length + 5, ".tmp", 5);
+
+    FILE *file = fopen(temporary, "w");
+    if (file != NULL) {
+        fprintf(file, "%s %d\n", TRACE_CHECKPOINT_LIST_MAGIC, TRACE_CHECKPOINT_LIST_VERSION);
+        for (int i = 0; i < checkpoint_count; i++) {
+            fprintf(file, "%ld %ld\n", checkpoints[i].seq, (long)checkpoints[i].pid);
+        }
+        int failed = ferror(file);
+        if (fclose(file) != 0 || failed || rename(temporary, checkpoint_list) != 0) {
+            unlink(temporary);
+        }
+    }
+}
+
+// Kill a checkpoint and its runners. Its group may not exist yet if it has
+// not reached setsid, but then it has no runners either.
+static void
+kill_checkpoint(pid_t pid)
+{
+    killpg(pid, SIGKILL);
+    kill(pid, SIGKILL);
+}
+
+// Whether the connecting process runs as this process's user
+static int
+checkpoint_peer_allowed(int connection)
+{
+    struct ucred peer;
+    socklen_t length = sizeof(peer);
+    return getsockopt(connection, SOL_SOCKET, SO_PEERCRED, &peer, &length) == 0 &&
+           length == sizeof(peer) && peer.uid == getuid();
+}
+
+static socklen_t
+checkpoint_address(long pid, struct sockaddr_un *address)
+{
+    memset(address, 0, sizeof(*address));
+    address->sun_family = AF_UNIX;
+    // Abstract names start with a NUL byte and leave nothing on disk
+    int length = snprintf(address->sun_path + 1, sizeof(address->sun_path) - 1,
+                          TRACE_CHECKPOINT_SOCKET, pid);
+    return (socklen_t)(offsetof(struct sockaddr_un, sun_path) + 1 + length);
+}
+
+// Read one request line, without its newline. Returns its length or -1.
+static ssize_t
+read_request(int fd, char *request, size_t size)
+{
+    size_t length = 0;
+    while (length < size - 1) {
+        ssize_t n = read(fd, request + length, 1);
+        if (n < 0 && errno == EINTR) {
+            continue;
+        }
+        if (n <= 0) {
+            return -1;
+        }
+        if (request[length] == '\n') {
+            break;
+        }
+        length++;
+    }
+    request[length] = '\0';
+    return (ssize_t)length;
+}
+
+// Replies are "ok <length>\n" or "error <length>\n", then length bytes
+static int
+send_reply(int fd, int ok, const char *text, size_t length)
+{
+    char header[32];
+    int header_length = snprintf(header, sizeof(header), "%s %zu\n", ok ? "ok" : "error", length);
+    int err = write_all(fd, (const unsigned char *)header, header_length);
+    return err == 0 ? write_all(fd, (const unsigned char *)text, length) : err;
+}
+
+// Evaluate expression in the runner's current frame and send its full repr
+static void
+checkpoint_eval(const char *expression)
+{
+    PyObject *globals = PyEval_GetGlobals();
+    PyObject *locals = PyEval_GetLocals();
+    PyErr_Clear();
+    PyObject *value = globals == NULL ? NULL :
+        PyRun_String(expression, Py_eval_input, globals, locals ? locals : globals);
+    PyObject *text = value ? PyObject_Repr(value) : NULL;
+    Py_XDECREF(value);
+    int ok = text != NULL;
+    if (!ok) {
+        PyObject *type, *error, *traceback;
+        PyErr_Fetch(&type, &error, &traceback);
+        PyErr_NormalizeException(&type, &error, &traceback);
+        text = error ? PyUnicode_FromFormat("%s: %S", Py_TYPE(error)->tp_name, error) :
+                       PyUnicode_FromString("no frame to evaluate in");
+        Py_XDECREF(type);
+        Py_XDECREF(error);
+        Py_XDECREF(traceback);
+    }
+    Py_ssize_t length = 0;
+    const char *utf8 = text ? PyUnicode_AsUTF8AndSize(text, &length) : NULL;
+    if (utf8 == NULL) {
+        PyErr_Clear();
+        utf8 = "?";
+        length = 1;
+    }
+    send_reply(checkpoint_connection, ok, utf8, length);
+    Py_XDECREF(text);
+}
+
+// The runner reached its target: answer eval requests until the viewer
+// says "quit" or goes away
+static void
+checkpoint_serve(CodeInfo *info, int lineno)
+{
+    char *request = (char *)malloc(CHECKPOINT_REQUEST_MAX);
+    char location[PATH_MAX + 32];
+    int length = snprintf(location, sizeof(location), "%s:%d", info->filename, lineno);
+    int err = send_reply(checkpoint_connection, 1, location,
+                         length < (int)sizeof(location) ? length : (int)sizeof(location) - 1);
+    while (err == 0 && request != NULL &&
+           read_request(checkpoint_connection, request, CHECKPOINT_REQUEST_MAX) >= 0 &&
+           strncmp(request, "eval ", 5) == 0) {
+        checkpoint_eval(request + 5);
+    }
+    _exit(0);
+}
+
+// The runner's program stopped before reaching the target
+static void
+checkpoint_missed(void)
+{
+    char message[96];
+    int length = snprintf(message, sizeof(message), "the program ended at seq %ld", execution_counter);
+    send_reply(checkpoint_connection, 0, message, length);
+    _exit(0);
+}
+
+// A recorded line in a runner
+static void
+checkpoint_count_line(CodeInfo *info, int lineno)
+{
+    if (execution_counter == checkpoint_target) {
+        checkpoint_serve(info, lineno);
+    }
+    execution_counter++;
+}
+
+// A process the program forks in a runner runs on untraced by the viewer
+static void
+mute_runner(void)
+{
+    replaying = 0;
+    close(checkpoint_connection);
+    checkpoint_connection = -1;
+    checkpoint_target = LONG_MAX;
+}
+
+// Wait for run requests in a new checkpoint. Returns only in a runner.
+static void
+checkpoint_wait(long seq)
+{
+    close(checkpoint_pipe[1]);
+    checkpoint_pipe[1] = -1;
+    // Out of the terminal's process group, so ^C in the program or the
+    // viewer leaves checkpoints alone, and off the program's input and
+    // output, so a pipe from the program ends when the program does
+    setsid();
+    int null = open("/dev/null", O_RDWR);
+    if (null >= 0) {
+        dup2(null, 0);
+        dup2(null, 1);
+        dup2(null, 2);
+        if (null > 2) {
+            close(null);
+        }
+    }
+    // The blocks and the file are the tracer's to write
+    block_strings.length = 0;
+    block_events.length = 0;
+    block_watch.length = 0;
+    block_event_count = 0;
+    writer_forget();
+    inputs_forget();
+    checkpoint_seq = seq;
+
+    struct sockaddr_un address;
+    socklen_t address_length = checkpoint_address((long)getpid(), &address);
+    int listener = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (listener < 0 || bind(listener, (struct sockaddr *)&address, address_length) != 0 ||
+        listen(listener, 4) != 0) {
+        _exit(1);
+    }
+
+    struct pollfd fds[2] = {{listener, POLLIN, 0}, {checkpoint_pipe[0], POLLIN, 0}};
+    char request[64];
+    for (;;) {
+        while (waitpid(-1, NULL, WNOHANG) > 0) {
+        }
+        if (poll(fds, 2, 1000) <= 0) {
+            continue;
+        }
+        if (fds[1].revents != 0) {
+            // The process that took the checkpoint is gone: so are its runners
+            if (getpgrp() == getpid()) {
+                kill(0, SIGKILL);
+            }
+            _exit(0);
+        }
+        if (!(fds[0].revents & POLLIN)) {
+            continue;
+        }
+
+        int connection = accept4(listener, NULL, NULL, SOCK_CLOEXEC);
+        if (connection < 0) {
+            continue;
+        }
+        if (!checkpoint_peer_allowed(connection)) {
+            const char *message = "not the recording's user";
+            send_reply(connection, 0, message, strlen(message));
+            close(connection);
+            continue;
+        }
+        long target = -1;
+        if (read_request(connection, request, sizeof(request)) < 0 ||
+            sscanf(request, "run %ld", &target) != 1 || target < seq) {
+            const char *message = "expected run <seq> at or after the checkpoint";
+            send_reply(connection, 0, message, strlen(message));
+            close(connection);
+            continue;
+        }
+        pid_t runner = recorder_fork();
+        if (runner == 0) {
+            close(listener);
+            if (checkpoint_pipe[0] >= 0) {
+                close(checkpoint_pipe[0]);
+                checkpoint_pipe[0] = -1;
+            }
+            capture_window = 0;
+            checkpoint_every = 0;
+            checkpoint_target = target;
+            checkpoint_connection = connection;
+            replaying = input_hooks_installed();
+            return;
+        }
+        close(connection);
+    }
+}
+
+// Fork a checkpoint of the program as it is before the line at
+// execution_counter runs
+static void
+take_checkpoint(void)
+{
+    next_checkpoint = execution_counter + checkpoint_every;
+
+    // Only the thread that forks goes on in a checkpoint
+    PyInterpreterState *interp = PyThreadState_GetInterpreter(PyThreadState_Get());
+    PyThreadState *head = PyInterpreterState_ThreadHead(interp);
+    if (head == NULL || PyThreadState_Next(head) != NULL) {
+        return;
+    }
+    if (checkpoint_pipe[0] < 0 && pipe2(checkpoint_pipe, O_CLOEXEC) != 0) {
+        return;
+    }
+    int handoff[2];
+    if (pipe2(handoff, O_CLOEXEC) != 0) {
+        return;
+    }
+    if (checkpoint_count == keep_checkpoints) {
+        kill_checkpoint(checkpoints[0].pid);
+        memmove(checkpoints, checkpoints + 1, (checkpoint_count - 1) * sizeof(Checkpoint));
+        checkpoint_count--;
+    }
+    if (checkpoints == NULL) {
+        checkpoints = (Checkpoint *)malloc(keep_checkpoints * sizeof(Checkpoint));
+        if (checkpoints == NULL) {
+            close(handoff[0]);
+            close(handoff[1]);
+            return;
+        }
+    }
+
+    // No writer thread may hold a lock across the fork
+    writer_pause();
+    pid_t middle = recorder_fork();
+    if (middle == 0) {
+        pid_t pid = recorder_fork();
+        if (pid != 0) {
+            write_all(handoff[1], (const unsigned char *)&pid, sizeof(pid));
+            _exit(0);
+        }
+        close(handoff[0]);
+        close(handoff[1]);
+        checkpoint_wait(execution_counter);
+        return;
+    }
+
+    pid_t pid = -1;
+    close(handoff[1]);
+    if (middle > 0) {
+        ssize_t n;
+        do {
+            n = read(handoff[0], &pid, sizeof(pid));
+        } while (n < 0 && errno == EINTR);
+        if (n != sizeof(pid)) {
+            pid = -1;
+        }
+        while (waitpid(middle, NULL, 0) < 0 && errno == EINTR) {
+        }
+    }
+    close(handoff[0]);
+    if (pid > 0) {
+        checkpoints[checkpoint_count].pid = pid;
+        checkpoints[checkpoint_count].seq = execution_counter;
+        checkpoint_count++;
+        write_checkpoint_list();
+    }
+}
+
+// Forget the checkpoints without killing them, in a forked child, where
+// they are the parent's
+static void
+forget_checkpoints(void)
+{
+    for (int i = 0; i < 2; i++) {
+        if (checkpoint_pipe[i] >= 0) {
+            close(checkpoint_pipe[i]);
+            checkpoint_pipe[i] = -1;
+        }
+    }
+    free(checkpoints);
+    checkpoints = NULL;
+    checkpoint_count = 0;
+    free(checkpoint_list);
+    checkpoint_list = NULL;
+}
+
+// Kill the checkpoints and their runners, and remove filename.ckpt
+static void
+release_checkpoints(void)
+{
+    for (int i = 0; i < checkpoint_count; i++) {
+        kill_checkpoint(checkpoints[i].pid);
+    }
+    if (checkpoint_list != NULL) {
+        unlink(checkpoint_list);
+    }
+    forget_checkpoints();
+}
+
+// Inputs. With record_inputs=True, a trace that takes checkpoints also logs
+// what the program reads from outside itself that a re-run would read
+// differently: the time module's clocks, os.urandom (and so
+// random.SystemRandom), os.getpid(), input(), os.read(), socket receives
+// and reads of files it opens, of socket.makefile() files and of sys.stdin.
+// Only calls made by traced code are logged, so the standard library and the
+// event loop keep the real clock. Files the program opens for reading are
+// wrapped in an InputFile, whose reads are logged wherever they are made;
+// sys.stdin is wrapped for the whole trace, so its reads are only logged
+// when traced code makes them. What a logged call reads through other
+// hooks, such as input() reading sys.stdin, is not logged again. Each call is logged to filename.inputs
+// with the seq of the next line and its marshalled result (see
+// traceformat.h). A runner answers the same calls from the log, from its
+// checkpoint on, so it retraces the recording; once the program asks for
+// something the log does not hold at that seq, the real functions answer
+// again. The random module's state and os.environ need no log, since a
+// checkpoint copies them. Only calls through the module attributes are
+// seen, so a name bound by "from time import time" before tracing started
+// is not.
+#define INPUTS_FLUSH_BYTES 4096
+#define REPLAY_READ_SIZE 65536
+
+enum {
+    INPUT_FUNCTION,     // module.name
+    INPUT_METHOD,       // module.owner.name, a method of a class
+    INPUT_OPEN,         // Either, wrapping the files it opens for reading; not logged
+    INPUT_FILE,         // A method of an InputFile's file
+};
+
+typedef struct {
+    int kind;
+    const char *module;
+    const char *owner;
+    const char *name;
+    int buffer_arg;     // The argument the call reads into, or -1
+} InputSource;
+
+// A source's index is its number in the log, so new ones go at the end
+static const InputSource input_sources[] = {
+    {INPUT_FUNCTION, "time", NULL, "time", -1},
+    {INPUT_FUNCTION, "time", NULL, "time_ns", -1},
+    {INPUT_FUNCTION, "time", NULL, "monotonic", -1},
+    {INPUT_FUNCTION, "time", NULL, "monotonic_ns", -1},
+    {INPUT_FUNCTION, "time", NULL, "perf_counter", -1},
+    {INPUT_FUNCTION, "time", NULL, "perf_counter_ns", -1},
+    {INPUT_FUNCTION, "os", NULL, "urandom", -1},
+    {INPUT_FUNCTION, "random", NULL, "_urandom", -1},
+    {INPUT_FUNCTION, "os", NULL, "getpid", -1},
+    {INPUT_FUNCTION, "builtins", NULL, "input", -1},
+    {INPUT_METHOD, "socket", "socket", "recv", -1},
+    {INPUT_METHOD, "socket", "socket", "recvfrom", -1},
+    {INPUT_METHOD, "socket", "socket", "recv_into", 1},
+    {INPUT_METHOD, "socket", "socket", "recvfrom_into", 1},
+    {INPUT_OPEN, "builtins", NULL, "open", -1},
+    {INPUT_OPEN, "io", NULL, "open", -1},
+    {INPUT_FILE, NULL, NULL, "read", -1},
+    {INPUT_FILE, NULL, NULL, "read1", -1},
+    {INPUT_FILE, NULL, NULL, "readline", -1},
+    {INPUT_FILE, NULL, NULL, "readlines", -1},
+    {INPUT_FILE, NULL, NULL, "readinto", 0},
+    {INPUT_FILE, NULL, NULL, "readinto1", 0},
+    {INPUT_FILE, NULL, NULL, "__next__", -1},
+    {INPUT_FUNCTION, "os", NULL, "read", -1},
+    {INPUT_OPEN, "socket", "socket", "makefile", -1},
+};
+#define INPUT_SOURCE_COUNT (int)(sizeof(input_sources) / sizeof(input_sources[0]))
+
+static PyObject *input_originals[INPUT_SOURCE_COUNT];
+static char input_inherited[INPUT_SOURCE_COUNT];    // Not in the owner's own dict
+static int inputs_fd = -1;
+static ByteBuffer inputs_buffer;
+static uint64_t inputs_logged = 0;
+static PyObject *input_stdin = NULL;                // sys.stdin, while it is wrapped
+static _Thread_local int input_depth = 0;           // Logged calls running on this thread
+static int replay_fd = -1;
+static ByteBuffer replay_buffer;
+static size_t replay_offset = 0;
+
+static char*
+inputs_path(const char *filename)
+{
+    size_t length = strlen(filename);
+    char *path = (char *)malloc(length + 8);
+    if (path != NULL) {
+        memcpy(path, filename, length);
+        memcpy(path + length, ".inputs", 8);
+    }
+    return path;
+}
+
+static void
+inputs_flush(void)
+{
+    if (inputs_fd >= 0 && inputs_buffer.length > 0) {
+        write_all(inputs_fd, inputs_buffer.data, inputs_buffer.length);
+    }
+    inputs_buffer.length = 0;
+}
+
+// Start the log of filename's trace. Returns 0 or an errno value.
+static int
+inputs_open(const char *filename)
+{
+    char *path = inputs_path(filename);
+    if (path == NULL) {
+        return ENOMEM;
+    }
+    inputs_fd = open(path, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0666);
+    free(path);
+    if (inputs_fd < 0) {
+        return errno;
+    }
+    unsigned char version = TRACE_INPUTS_VERSION;
+    inputs_buffer.length = 0;
+    buffer_put_bytes(&inputs_buffer, TRACE_INPUTS_MAGIC, TRACE_MAGIC_SIZE);
+    buffer_put_bytes(&inputs_buffer, &version, 1);
+    inputs_flush();
+    inputs_logged = 0;
+    return 0;
+}
+
+static void
+inputs_close(void)
+{
+    inputs_flush();
+    if (inputs_fd >= 0) {
+        close(inputs_fd);
+        inputs_fd = -1;
+    }
+    buffer_free(&inputs_buffer);
+}
+
+// After fork, in a checkpoint or child. The log and what is pending for it
+// are the parent's.
+static void
+inputs_forget(void)
+{
+    inputs_buffer.length = 0;
+    if (inputs_fd >= 0) {
+        close(inputs_fd);
+        inputs_fd = -1;
+    }
+}
+
+static void
+log_input(int source, PyObject *value)
+{
+    PyObject *data = PyMarshal_WriteObjectToString(value, Py_MARSHAL_VERSION);
+    if (data == NULL) {
+        // A re-run stops replaying here
+        PyErr_Clear();
+        return;
+    }
+    unsigned char kind = (unsigned char)source;
+    buffer_put_varint(&inputs_buffer, (uint64_t)execution_counter);
+    buffer_put_bytes(&inputs_buffer, &kind, 1);
+    buffer_put_varint(&inputs_buffer, (uint64_t)PyBytes_GET_SIZE(data));
+    buffer_put_bytes(&inputs_buffer, PyBytes_AS_STRING(data), PyBytes_GET_SIZE(data));
+    Py_DECREF(data);
+    inputs_logged++;
+    if (inputs_buffer.length >= INPUTS_FLUSH_BYTES) {
+        inputs_flush();
+    }
+}
+
+// Read more of the log into replay_buffer. Returns 0 at its end, or if it
+// cannot be read.
+static int
+replay_fill(void)
+{
+    if (replay_fd < 0) {
+        char *path = inputs_path(trace_filename);
+        replay_fd = path ? open(path, O_RDONLY | O_CLOEXEC) : -1;
+        free(path);
+        replay_offset = TRACE_MAGIC_SIZE + 1;
+        if (replay_fd < 0) {
+            return 0;
+        }
+    }
+    if (!buffer_reserve(&replay_buffer, REPLAY_READ_SIZE)) {
+        return 0;
+    }
+    ssize_t n;
+    do {
+        n = read(replay_fd, replay_buffer.data + replay_buffer.length, REPLAY_READ_SIZE);
+    } while (n < 0 && errno == EINTR);
+    if (n <= 0) {
+        return 0;
+    }
+    replay_buffer.length += n;
+    return 1;
+}
+
+// The logged result of this call in a runner, or NULL without an exception
+// once the log has none, after which the real functions answer
+static PyObject*
+replay_input(int source)
+{
+    for (;;) {
+        const unsigned char *start = replay_buffer.data;
+        const unsigned char *end = start + replay_buffer.length;
+        const unsigned char *pos = start + replay_offset;
+        uint64_t seq, length;
+        if (replay_buffer.length >= TRACE_MAGIC_SIZE + 1 &&
+            (memcmp(start, TRACE_INPUTS_MAGIC, TRACE_MAGIC_SIZE) != 0 ||
+             start[TRACE_MAGIC_SIZE] > TRACE_INPUTS_VERSION)) {
+            break;
+        }
+        if (pos < end && trace_get_varint(&pos, end, &seq) && pos < end) {
+            int kind = *pos++;
+            if (trace_get_varint(&pos, end, &length) && (uint64_t)(end - pos) >= length) {
+                replay_offset = (size_t)(pos + length - start);
+                // Calls before the checkpoint are behind the runner
+                if ((long)seq <= checkpoint_seq) {
+                    continue;
+                }
+                if (kind != source || (long)seq != execution_counter) {
+                    break;
+                }
+                PyObject *value = PyMarshal_ReadObjectFromString((const char *)pos, (Py_ssize_t)length);
+                if (value == NULL) {
+                    PyErr_Clear();
+                    break;
+                }
+                return value;
+            }
+        }
+        if (!replay_fill()) {
+            break;
+        }
+    }
+    replaying = 0;
+    return NULL;
+}
+
+// Whether the Python code calling a hook is traced
+static int
+input_caller_traced(void)
+{
+    PyFrameObject *frame = PyEval_GetFrame();
+    if (frame == NULL) {
+        return 0;
+    }
+    PyCodeObject *code = PyFrame_GetCode(frame);
+    CodeInfo *info = get_code_info(code);
+    Py_DECREF(code);
+    return info != NULL && info->traced;
+}
+
+// What a call read into buffer, logged as (data, result). The result is the
+// byte count or a tuple that starts with it.
+static PyObject*
+input_filled(PyObject *buffer, PyObject *result)
+{
+    PyObject *count = PyTuple_Check(result) && PyTuple_GET_SIZE(result) > 0 ?
+                      PyTuple_GET_ITEM(result, 0) : result;
+    Py_ssize_t length = PyLong_Check(count) ? PyLong_AsSsize_t(count) : -1;
+    Py_buffer view;
+    if (length < 0 || PyObject_GetBuffer(buffer, &view, PyBUF_SIMPLE) < 0) {
+        return NULL;
+    }
+    PyObject *data = PyBytes_FromStringAndSize((const char *)view.buf,
+                                               length < view.len ? length : view.len);
+    PyBuffer_Release(&view);
+    PyObject *value = data != NULL ? PyTuple_Pack(2, data, result) : NULL;
+    Py_XDECREF(data);
+    return value;
+}
+
+// Put logged (data, result) back into buffer and return the result, or NULL
+// without an exception if it does not fit
+static PyObject*
+input_refill(PyObject *buffer, PyObject *value)
+{
+    PyObject *result = NULL;
+    Py_buffer view;
+    if (PyTuple_Check(value) && PyTuple_GET_SIZE(value) == 2 &&
+        PyBytes_Check(PyTuple_GET_ITEM(value, 0)) &&
+        PyObject_GetBuffer(buffer, &view, PyBUF_WRITABLE) == 0) {
+        PyObject *data = PyTuple_GET_ITEM(value, 0);
+        if (PyBytes_GET_SIZE(data) <= view.len) {
+            memcpy(view.buf, PyBytes_AS_STRING(data), PyBytes_GET_SIZE(data));
+            result = Py_NewRef(PyTuple_GET_ITEM(value, 1));
+        }
+        PyBuffer_Release(&view);
+    }
+    PyErr_Clear();
+    Py_DECREF(value);
+    return result;
+}
+
+// Whether calls of source are logged now: while recording or replaying,
+// outside another logged call, and for everything but files, only when
+// traced code makes them
+static inline int
+input_logged(int source)
+{
+    return (replaying || (inputs_fd >= 0 && is_tracing)) && input_depth == 0 &&
+           (input_sources[source].kind == INPUT_FILE || input_caller_traced());
+}
+
+// Call original for source and log its result, or in a runner answer from
+// the log
+static PyObject*
+input_call(int source, PyObject *original, PyObject *args, PyObject *kwargs)
+{
+    int buffer_arg = input_sources[source].buffer_arg;
+    PyObject *buffer = NULL;
+    if (buffer_arg >= 0) {
+        // A buffer passed by keyword is not logged
+        if (buffer_arg >= PyTuple_GET_SIZE(args)) {
+            return PyObject_Call(original, args, kwargs);
+        }
+        buffer = PyTuple_GET_ITEM(args, buffer_arg);
+    }
+    if (!input_logged(source)) {
+        return PyObject_Call(original, args, kwargs);
+    }
+
+    if (replaying) {
+        PyObject *value = replay_input(source);
+        if (value != NULL && buffer == NULL) {
+            return value;
+        }
+        PyObject *result = value != NULL ? input_refill(buffer, value) : NULL;
+        if (result != NULL) {
+            return result;
+        }
+        replaying = 0;
+    }
+    input_depth++;
+    PyObject *result = PyObject_Call(original, args, kwargs);
+    input_depth--;
+    if (result != NULL && inputs_fd >= 0 && is_tracing) {
+        PyObject *value = buffer != NULL ? input_filled(buffer, result) : Py_NewRef(result);
+        if (value != NULL) {
+            log_input(source, value);
+            Py_DECREF(value);
+        }
+        PyErr_Clear();
+    }
+    return result;
+}
+
+// Index of the InputFile method called name, or -1
+static int
+input_file_source(const char *name)
+{
+    for (int i = 0; i < INPUT_SOURCE_COUNT; i++) {
+        if (input_sources[i].kind == INPUT_FILE && strcmp(input_sources[i].name, name) == 0) {
+            return i;
+        }
+    }
+    return -1;
+}
+
+static PyObject *input_open(PyObject *original, PyObject *args, PyObject *kwargs);
+
+// Replaces a function of input_sources; self is (source, original function)
+static PyObject*
+input_hook(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    int source = (int)PyLong_AsLong(PyTuple_GET_ITEM(self, 0));
+    PyObject *original = PyTuple_GET_ITEM(self, 1);
+    if (input_sources[source].kind == INPUT_OPEN) {
+        return input_open(original, args, kwargs);
+    }
+    return input_call(source, original, args, kwargs);
+}
+
+static PyMethodDef input_hook_def = {
+    "input_hook", (PyCFunction)(void(*)(void))input_hook, METH_VARARGS | METH_KEYWORDS, NULL
+};
+
+// InputFile: a file traced code opened for reading. Its read methods are
+// logged; everything else, isinstance() included, goes to the file.
+typedef struct {
+    PyObject_HEAD
+    PyObject *file;
+    int traced_only;    // Only log reads made by traced code (sys.stdin)
+} InputFileObject;
+
+static void
+input_file_dealloc(InputFileObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    Py_CLEAR(self->file);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static int
+input_file_traverse(InputFileObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->file);
+    return 0;
+}
+
+static int
+input_file_clear(InputFileObject *self)
+{
+    Py_CLEAR(self->file);
+    return 0;
+}
+
+static PyObject*
+input_file_getattro(InputFileObject *self, PyObject *name)
+{
+    PyObject *attribute = PyObject_GetAttr(self->file, name);
+    const char *text = attribute != NULL ? PyUnicode_AsUTF8(name) : NULL;
+    int source = text != NULL ? input_file_source(text) : -1;
+    if (source < 0 || (self->traced_only && !input_caller_traced())) {
+        return attribute;
+    }
+    PyObject *hook_self = Py_BuildValue("(iN)", source, attribute);
+    PyObject *hook = hook_self != NULL ? PyCFunction_New(&input_hook_def, hook_self) : NULL;
+    Py_XDECREF(hook_self);
+    return hook;
+}
+
+static int
+input_file_setattro(InputFileObject *self, PyObject *name, PyObject *value)
+{
+    return PyObject_SetAttr(self->file, name, value);
+}
+
+static PyObject*
+input_file_repr(InputFileObject *self)
+{
+    return PyObject_Repr(self->file);
+}
+
+// Lines of "for line in file"; the end is logged as None
+static PyObject*
+input_file_next(InputFileObject *self)
+{
+    int source = input_file_source("__next__");
+    int logged = input_logged(source) && (!self->traced_only || input_caller_traced());
+    if (logged && replaying) {
+        PyObject *line = replay_input(source);
+        if (line == Py_None) {
+            Py_DECREF(line);
+            return NULL;
+        }
+        if (line != NULL) {
+            return line;
+        }
+    }
+    input_depth += logged;
+    PyObject *line = PyIter_Next(self->file);
+    input_depth -= logged;
+    if (logged && inputs_fd >= 0 && is_tracing && !PyErr_Occurred()) {
+        log_input(source, line != NULL ? line : Py_None);
+    }
+    return line;
+}
+
+static PyObject*
+input_file_enter(InputFileObject *self, PyObject *args)
+{
+    PyObject *result = PyObject_CallMethod(self->file, "__enter__", NULL);
+    if (result == NULL) {
+        return NULL;
+    }
+    Py_DECREF(result);
+    return Py_NewRef(self);
+}
+
+static PyObject*
+input_file_exit(InputFileObject *self, PyObject *args)
+{
+    PyObject *exit = PyObject_GetAttrString(self->file, "__exit__");
+    if (exit == NULL) {
+        return NULL;
+    }
+    PyObject *result = PyObject_Call(exit, args, NULL);
+    Py_DECREF(exit);
+    return result;
+}
+
+static PyMethodDef input_file_methods[] = {
+    {"__enter__", (PyCFunction)input_file_enter, METH_NOARGS, NULL},
+    {"__exit__", (PyCFunction)input_file_exit, METH_VARARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject InputFileType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "cdebugger.InputFile",
+    .tp_basicsize = sizeof(InputFileObject),
+    .tp_dealloc = (destructor)input_file_dealloc,
+    .tp_repr = (reprfunc)input_file_repr,
+    .tp_getattro = (getattrofunc)input_file_getattro,
+    .tp_setattro = (setattrofunc)input_file_setattro,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_traverse = (traverseproc)input_file_traverse,
+    .tp_clear = (inquiry)input_file_clear,
+    .tp_iter = PyObject_SelfIter,
+    .tp_iternext = (iternextfunc)input_file_next,
+    .tp_methods = input_file_methods,
+};
+
+// Wrap file, taking its reference, in an InputFile
+static PyObject*
+input_file_new(PyObject *file, int traced_only)
+{
+    InputFileObject *wrapper = PyObject_GC_New(InputFileObject, &InputFileType);
+    if (wrapper == NULL) {
+        Py_DECREF(file);
+        return NULL;
+    }
+    wrapper->file = file;
+    wrapper->traced_only = traced_only;
+    PyObject_GC_Track(wrapper);
+    return (PyObject *)wrapper;
+}
+
+// open() and socket.makefile(): a file traced code opens for reading comes
+// back as an InputFile. A makefile() call's socket comes first, so the mode
+// is the second argument of both.
+static PyObject*
+input_open(PyObject *original, PyObject *args, PyObject *kwargs)
+{
+    PyObject *file = PyObject_Call(original, args, kwargs);
+    if (file == NULL || !(replaying || (inputs_fd >= 0 && is_tracing)) || !input_caller_traced()) {
+        return file;
+    }
+    PyObject *mode = PyTuple_GET_SIZE(args) > 1 ? PyTuple_GET_ITEM(args, 1) :
+                     kwargs != NULL ? PyDict_GetItemString(kwargs, "mode") : NULL;
+    const char *text = mode == NULL ? "r" : PyUnicode_Check(mode) ? PyUnicode_AsUTF8(mode) : NULL;
+    if (text == NULL || (strchr(text, 'r') == NULL && strchr(text, '+') == NULL)) {
+        PyErr_Clear();
+        return file;
+    }
+    return input_file_new(file, 0);
+}
+
+// The module or class whose attribute a source replaces, or NULL
+static PyObject*
+input_source_owner(int source)
+{
+    const InputSource *input = &input_sources[source];
+    PyObject *module;
+    if (input->kind == INPUT_FILE) {
+        return NULL;
+    }
+    // random binds os.urandom when it is imported, so its copy only needs
+    // replacing if it already was
+    if (strcmp(input->module, "random") == 0) {
+        module = PyDict_GetItemString(PyImport_GetModuleDict(), "random");
+        Py_XINCREF(module);
+    } else {
+        module = PyImport_ImportModule(input->module);
+    }
+    if (module == NULL || input->owner == NULL) {
+        return module;
+    }
+    PyObject *owner = PyObject_GetAttrString(module, input->owner);
+    Py_DECREF(module);
+    return owner;
+}
+
+static void
+install_input_hooks(void)
+{
+    for (int i = 0; i < INPUT_SOURCE_COUNT; i++) {
+        const char *name = input_sources[i].name;
+        PyObject *owner = input_source_owner(i);
+        PyObject *original = owner ? PyObject_GetAttrString(owner, name) : NULL;
+        PyObject *self = original ? Py_BuildValue("(iO)", i, original) : NULL;
+        PyObject *hook = self ? PyCFunction_New(&input_hook_def, self) : NULL;
+        PyObject *own = NULL;
+        if (hook != NULL && input_sources[i].owner != NULL) {
+            // Bound like the method it replaces, so it gets the instance
+            Py_SETREF(hook, PyInstanceMethod_New(hook));
+            PyObject *dict = hook ? PyObject_GetAttrString(owner, "__dict__") : NULL;
+            own = dict ? PyMapping_GetItemString(dict, name) : NULL;
+            Py_XDECREF(dict);
+        }
+        if (hook != NULL && PyObject_SetAttrString(owner, name, hook) == 0) {
+            input_originals[i] = original;
+            input_inherited[i] = input_sources[i].owner != NULL && own == NULL;
+            original = NULL;
+        }
+        PyErr_Clear();
+        Py_XDECREF(own);
+        Py_XDECREF(hook);
+        Py_XDECREF(self);
+        Py_XDECREF(original);
+        Py_XDECREF(owner);
+    }
+
+    PyObject *stdin_file = PySys_GetObject("stdin");
+    if (stdin_file != NULL && stdin_file != Py_None) {
+        PyObject *wrapper = input_file_new(Py_NewRef(stdin_file), 1);
+        if (wrapper != NULL && PySys_SetObject("stdin", wrapper) == 0) {
+            input_stdin = Py_NewRef(stdin_file);
+        }
+        Py_XDECREF(wrapper);
+        PyErr_Clear();
+    }
+}
+
+static void
+restore_input_hooks(void)
+{
+    for (int i = 0; i < INPUT_SOURCE_COUNT; i++) {
+        if (input_originals[i] == NULL) {
+            continue;
+        }
+        const char *name = input_sources[i].name;
+        PyObject *owner = input_source_owner(i);
+        if (owner == NULL ||
+            (input_inherited[i] ? PyObject_DelAttrString(owner, name) :
+                                  PyObject_SetAttrString(owner, name, input_originals[i])) < 0) {
+            PyErr_Clear();
+        }
+        Py_XDECREF(owner);
+        Py_CLEAR(input_originals[i]);
+    }
+
+    // Unless the program replaced sys.stdin itself
+    if (input_stdin != NULL) {
+        PyObject *current = PySys_GetObject("stdin");
+        if (current != NULL && Py_IS_TYPE(current, &InputFileType) &&
+            ((InputFileObject *)current)->file == input_stdin &&
+            PySys_SetObject("stdin", input_stdin) < 0) {
+            PyErr_Clear();
+        }
+        Py_CLEAR(input_stdin);
+    }
+}
+
+static int
+input_hooks_installed(void)
+{
+    for (int i = 0; i < INPUT_SOURCE_COUNT; i++) {
+        if (input_originals[i] != NULL) {
+            return 1;
+        }
+    }
+    return input_stdin != NULL;
+}
+
+// Flush everything if the process exits while tracing (e.g. "q" at a breakpoint)
+static void
+writer_atexit(void)
+{
+    if (checkpoint_connection >= 0) {
+        checkpoint_missed();
+    }
+    if (trace_writer.thread_started) {
+        seal_blocks();
+        writer_stop();
+    }
+}
+
+static void
+free_frame_states(void)
+{
+    for (int i = 0; i < FRAME_STATE_SLOTS; i++) {
+        snapshot_free(&frame_states[i].last);
+        frame_states[i].frame = NULL;
+    }
+    buffer_free(&delta_buffer);
+    free(delta_matches);
+    delta_matches = NULL;
+    delta_match_capacity = 0;
+}
+
+// Globals of each traced module, rendered once and reused for every line
+// until the dict changes. A dict watcher tells when it does on Python 3.12+;
+// older versions compare the dict's version tag. Immutable values are reused
+// as rendered. Mutable ones can change in place without changing the dict,
+// so they are rendered again on every line, or with globals_refresh=N only
+// every N lines.
+//
+// The caches are found by the dict's address and do not keep it alive. On
+// 3.12+ the watcher drops a dict's cache when the dict goes away. Older
+// versions cannot tell, but version tags are never reused, so a cache left
+// by a dead dict never matches a new dict at its address; there the table
+// is emptied when it reaches GLOBALS_CACHE_MAX entries.
+#define GLOBALS_CACHE_BUCKETS 256
+#define GLOBALS_CACHE_MAX 1024
+
+typedef struct GlobalsCache {
+    PyObject *globals;          // Borrowed, and only read through a live dict
+    PyObject **keys;            // Of rendered.vars; owned by globals, which
+    PyObject **values;          // the cache only uses while it is unchanged
+    char *mutable;              // Per rendered.vars entry
+    Snapshot rendered;          // As write_globals() writes them
+    int valid;
+    int busy;                   // Rendering; reprs may run other threads
+    Py_ssize_t uses;            // Lines since the rendering
+#if PY_VERSION_HEX < 0x030C0000
+    uint64_t version;           // ma_version_tag of the rendering
+#endif
+    struct GlobalsCache *next;  // In its bucket
+} GlobalsCache;
+
+static GlobalsCache *globals_caches[GLOBALS_CACHE_BUCKETS];
+static int globals_cache_count = 0;
+static int globals_cache_busy = 0;  // Caches being rendered or copied
+static Py_ssize_t globals_refresh = 1;
+static int record_variables = 1;   // 0 records lines without their variables
+
+static inline GlobalsCache**
+globals_cache_bucket(PyObject *globals)
+{
+    return &globals_caches[((uintptr_t)globals >> 4) % GLOBALS_CACHE_BUCKETS];
+}
+
+static GlobalsCache*
+globals_cache_find(PyObject *globals)
+{
+    GlobalsCache *cache = *globals_cache_bucket(globals);
+    while (cache != NULL && cache->globals != globals) {
+        cache = cache->next;
+    }
+    return cache;
+}
+
+static void
+globals_cache_free(GlobalsCache *cache)
+{
+    free(cache->keys);
+    free(cache->values);
+    free(cache->mutable);
+    snapshot_free(&cache->rendered);
+    free(cache);
+}
+
+static void globals_cache_clear(void);
+
+#if PY_VERSION_HEX >= 0x030C0000
+static int globals_watcher = -1;
+
+static int
+globals_changed(PyDict_WatchEvent event, PyObject *dict, PyObject *key, PyObject *new_value)
+{
+    if (event != PyDict_EVENT_DEALLOCATED) {
+        GlobalsCache *cache = globals_cache_find(dict);
+        if (cache != NULL) {
+            cache->valid = 0;
+        }
+        return 0;
+    }
+    // Nothing renders a dict that is going away, so its cache is not busy
+    for (GlobalsCache **link = globals_cache_bucket(dict); *link != NULL; link = &(*link)->next) {
+        if ((*link)->globals == dict) {
+            GlobalsCache *cache = *link;
+            *link = cache->next;
+            globals_cache_count--;
+            globals_cache_free(cache);
+            break;
+        }
+    }
+    return 0;
+}
+#endif
+
+static GlobalsCache*
+get_globals_cache(PyObject *globals)
+{
+    GlobalsCache *cache = globals_cache_find(globals);
+    if (cache != NULL) {
+        return cache;
+    }
+    if (globals_cache_count >= GLOBALS_CACHE_MAX) {
+        if (globals_cache_busy) {
+            return NULL;
+        }
+        globals_cache_clear();
+    }
+
+#if PY_VERSION_HEX >= 0x030C0000
+    if (globals_watcher < 0) {
+        globals_watcher = PyDict_AddWatcher(globals_changed);
+        if (globals_watcher < 0) {
+            PyErr_Clear();
+            return NULL;
+        }
+    }
+    if (PyDict_Watch(globals_watcher, globals) < 0) {
+        PyErr_Clear();
+        return NULL;
+    }
+#endif
+    cache = (GlobalsCache *)calloc(1, sizeof(GlobalsCache));
+    if (cache == NULL) {
+#if PY_VERSION_HEX >= 0x030C0000
+        PyDict_Unwatch(globals_watcher, globals);
+#endif
+        return NULL;
+    }
+    GlobalsCache **bucket = globals_cache_bucket(globals);
+    cache->globals = globals;
+    cache->next = *bucket;
+    *bucket = cache;
+    globals_cache_count++;
+    return cache;
+}
+
+// Whether the dict is unchanged since the rendering
+static inline int
+globals_cache_current(GlobalsCache *cache)
+{
+#if PY_VERSION_HEX < 0x030C0000
+    if (cache->valid && cache->version != ((PyDictObject *)cache->globals)->ma_version_tag) {
+        cache->valid = 0;
+    }
+#endif
+    return cache->valid && is_tracing;
+}
+
+// Render the globals into the cache
+static int
+render_globals_cache(GlobalsCache *cache)
+{
+    PyObject *globals = cache->globals;
+    Py_ssize_t size = PyDict_Size(globals) + 1;
+    PyObject **keys = (PyObject **)realloc(cache->keys, size * sizeof(PyObject *));
+    if (keys != NULL) {
+        cache->keys = keys;
+    }
+    PyObject **values = (PyObject **)realloc(cache->values, size * sizeof(PyObject *));
+    if (values != NULL) {
+        cache->values = values;
+    }
+    char *mutable = (char *)realloc(cache->mutable, size);
+    if (mutable != NULL) {
+        cache->mutable = mutable;
+    }
+    if (keys == NULL || values == NULL || mutable == NULL) {
+        cache->valid = 0;
+        return 0;
+    }
+
+    cache->rendered.values.length = 0;
+    cache->rendered.var_count = 0;
+    cache->valid = 1;
+    cache->uses = 0;
+#if PY_VERSION_HEX < 0x030C0000
+    cache->version = ((PyDictObject *)globals)->ma_version_tag;
+#endif
+
+    PyObject *key, *value;
+    Py_ssize_t pos = 0;
+    while (PyDict_Next(globals, &pos, &key, &value)) {
+        const char *var_name = PyUnicode_AsUTF8(key);
+        if (var_name == NULL) {
+            PyErr_Clear();
+            continue;
+        }
+        if (should_skip_global_variable(var_name, value)) {
+            continue;
+        }
+        int count = cache->rendered.var_count;
+        write_variable(&cache->rendered, var_name, value);
+        if (cache->rendered.var_count > count) {
+            keys[count] = key;
+            values[count] = value;
+            mutable[count] = !repr_is_immutable(value, 0);
+        }
+        // A repr that changed the dict leaves entries it no longer owns
+        if (!globals_cache_current(cache)) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+// Add the globals not shadowed by locals to snapshot, from the cached
+// rendering when possible. Locals are the locals dict or, with locals NULL,
+// the first local_count variables of snapshot.
+static void
+write_cached_globals(Snapshot *snapshot, PyObject *globals, PyObject *locals, int local_count)
+{
+    GlobalsCache *cache = PyDict_CheckExact(globals) ? get_globals_cache(globals) : NULL;
+    if (cache == NULL || cache->busy) {
+        write_globals(snapshot, globals, locals, local_count);
+        return;
+    }
+
+    int var_count = snapshot->var_count;
+    size_t length = snapshot->values.length;
+    cache->busy = 1;
+    globals_cache_busy++;
+
+    int rendered = globals_cache_current(cache) &&
+                   (globals_refresh == 1 || cache->uses < globals_refresh);
+    if (!rendered) {
+        rendered = render_globals_cache(cache);
+    }
+    cache->uses++;
+
+    for (int i = 0; rendered && i < cache->rendered.var_count; i++) {
+        VarSlot *from = &cache->rendered.vars[i];
+        if ((locals != NULL || local_count > 0) &&
+            is_shadowed(snapshot, local_count, locals, cache->keys[i], from->name)) {
+            continue;
+        }
+        if (globals_refresh == 1 && cache->mutable[i] && cache->uses > 1) {
+            write_variable_id(snapshot, from->name, cache->values[i]);
+            rendered = globals_cache_current(cache);
+            continue;
+        }
+        if (!snapshot_reserve(snapshot)) {
+            break;
+        }
+        VarSlot *slot = &snapshot->vars[snapshot->var_count++];
+        size_t start = snapshot->values.length;
+        buffer_put_bytes(&snapshot->values, cache->rendered.values.data + from->offset,
+                         from->end - from->offset);
+        slot->name = from->name;
+        slot->offset = start;
+        slot->value_offset = start + (from->value_offset - from->offset);
+        slot->end = start + (from->end - from->offset);
+    }
+    cache->busy = 0;
+    globals_cache_busy--;
+
+    // The dict changed under a repr: start over the plain way
+    if (!rendered) {
+        snapshot->var_count = var_count;
+        snapshot->values.length = length;
+        write_globals(snapshot, globals, locals, local_count);
+    }
+}
+
+static void
+globals_cache_clear(void)
+{
+    for (int i = 0; i < GLOBALS_CACHE_BUCKETS; i++) {
+        while (globals_caches[i] != NULL) {
+            GlobalsCache *cache = globals_caches[i];
+            globals_caches[i] = cache->next;
+#if PY_VERSION_HEX >= 0x030C0000
+            // Still alive: the watcher frees the caches of dicts that are not
+            if (PyDict_Unwatch(globals_watcher, cache->globals) < 0) {
+                PyErr_Clear();
+            }
+#endif
+            globals_cache_free(cache);
+        }
+    }
+    globals_cache_count = 0;
+}
+
+// Per-thread recorder state. Tracing is installed on every thread, and a
+// repr that runs Python code lets other threads record lines in between,
+// so each thread collects its variables in its own snapshot. The record
+// itself is assembled and emitted without calling back into Python, which
+// keeps sequence numbers in emit order across threads.
+typedef struct RecorderThread {
+    unsigned long ident;
+    long serial;                // Tells apart threads that reuse an ident
+    unsigned long generation;
+    uint64_t id;                // Numbered per trace in order of first line
+    int busy;                   // Running Python code; do not free
+    Snapshot snapshot;
+    PyObject *task;             // asyncio task of the last line, or NULL
+    uint64_t task_id;           // Its id, 0 outside of a task
+    uint64_t block_task;        // Task the reader assumes in the open block
+    unsigned long task_block;   // block_serial that block_task belongs to
+    uint64_t depth;             // Traced frames running, see record_call_event()
+    uint64_t block_depth;       // Depth and function the reader assumes in
+    uint64_t block_function;    // the open block
+    unsigned long call_block;   // block_serial they belong to
+    int call_pending;           // Sampling: a call is waiting for a recorded line
+    uint64_t pending_depth;     // Depth of the oldest such call
+} RecorderThread;
+
+static RecorderThread **recorder_threads = NULL;
+static int recorder_thread_count = 0;
+static int recorder_thread_capacity = 0;
+static RecorderThread *last_thread = NULL;
+static uint64_t next_thread_id = 0;
+static PyObject *thread_serial_key = NULL;  // Key in each thread's state dict
+static long next_thread_serial = 0;
+
+// Serial number of the current thread, stored in its thread state dict so
+// it goes away with the thread. -1 if it cannot be stored.
+static long
+get_thread_serial(void)
+{
+    PyObject *dict = PyThreadState_GetDict();
+    if (dict == NULL) {
+        return -1;
+    }
+    if (thread_serial_key == NULL) {
+        thread_serial_key = PyUnicode_InternFromString("cdebugger.thread_serial");
+        if (thread_serial_key == NULL) {
+            PyErr_Clear();
+            return -1;
+        }
+    }
+
+    PyObject *value = PyDict_GetItemWithError(dict, thread_serial_key);
+    if (value != NULL) {
+        return PyLong_AsLong(value);
+    }
+
+    long serial = ++next_thread_serial;
+    value = PyLong_FromLong(serial);
+    if (value == NULL || PyDict_SetItem(dict, thread_serial_key, value) < 0) {
+        serial = -1;
+    }
+    Py_XDECREF(value);
+    PyErr_Clear();
+    return serial;
+}
+
+// Name of a thread from threading's registry, without importing threading
+// or creating a dummy thread object
+static PyObject*
+get_thread_name(unsigned long ident)
+{
+    PyObject *module_name = PyUnicode_FromString("threading");
+    PyObject *threading = module_name ? PyImport_GetModule(module_name) : NULL;
+    Py_XDECREF(module_name);
+    if (threading == NULL) {
+        PyErr_Clear();
+        return NULL;
+    }
+
+    PyObject *name = NULL;
+    PyObject *active = PyObject_GetAttrString(threading, "_active");
+    PyObject *key = PyLong_FromUnsignedLong(ident);
+    if (active != NULL && key != NULL && PyDict_Check(active)) {
+        PyObject *thread = PyDict_GetItemWithError(active, key);
+        if (thread != NULL) {
+            name = PyObject_GetAttrString(thread, "name");
+        }
+    }
+    Py_XDECREF(key);
+    Py_XDECREF(active);
+    Py_DECREF(threading);
+
+    if (name != NULL && !PyUnicode_Check(name)) {
+        Py_CLEAR(name);
+    }
+    PyErr_Clear();
+    return name;
+}
+
+static RecorderThread*
+get_recorder_thread(void)
+{
+    unsigned long ident = PyThread_get_thread_ident();
+    long serial = get_thread_serial();
+    RecorderThread *thread = last_thread;
+
+    if (thread == NULL || thread->ident != ident) {
+        thread = NULL;
+        for (int i = 0; i < recorder_thread_count; i++) {
+            if (recorder_threads[i]->ident == ident) {
+                thread = recorder_threads[i];
+                break;
+            }
+        }
+    }
+
+    if (thread == NULL) {
+        if (recorder_thread_count == recorder_thread_capacity) {
+            int capacity = recorder_thread_capacity ? recorder_thread_capacity * 2 : 16;
+            RecorderThread **threads = (RecorderThread **)realloc(
+                recorder_threads, capacity * sizeof(RecorderThread *));
+            if (threads == NULL) {
+                return NULL;
+            }
+            recorder_threads = threads;
+            recorder_thread_capacity = capacity;
+        }
+        thread = (RecorderThread *)calloc(1, sizeof(RecorderThread));
+        if (thread == NULL) {
+            return NULL;
+        }
+        thread->ident = ident;
+        thread->serial = serial;
+        recorder_threads[recorder_thread_count++] = thread;
+    } else if (thread->serial != serial) {
+        // The thread that had this ident has exited; this is a new thread
+        thread->serial = serial;
+        thread->generation = 0;
+    }
+    last_thread = thread;
+
+    if (thread->generation != trace_generation) {
+        thread->generation = trace_generation;
+        thread->id = next_thread_id++;
+        thread->depth = 0;
+        thread->call_block = 0;
+        thread->call_pending = 0;
+
+        thread->busy = 1;
+        PyObject *name = get_thread_name(ident);
+        thread->busy = 0;
+        const char *utf8 = name ? PyUnicode_AsUTF8(name) : NULL;
+        if (utf8 == NULL) {
+            PyErr_Clear();
+            utf8 = "";
+        }
+        if (is_tracing) {
+            ByteBuffer *record = &record_buffer;
+            record->length = 0;
+            buffer_put_varint(record, thread->id);
+            buffer_put_varint(record, ident);
+            buffer_put_bytes(record, utf8, strlen(utf8));
+            emit_record(REC_THREAD, record->data, record->length);
+        }
+        Py_XDECREF(name);
+    }
+    return thread;
+}
+
+// Free the state of every thread that is not in the middle of a line
+static void
+free_recorder_threads(void)
+{
+    int kept = 0;
+
+    for (int i = 0; i < recorder_thread_count; i++) {
+        RecorderThread *thread = recorder_threads[i];
+        Py_CLEAR(thread->task);
+        thread->task_id = 0;
+        if (thread->busy) {
+            recorder_threads[kept++] = thread;
+        } else {
+            snapshot_free(&thread->snapshot);
+            free(thread);
+        }
+    }
+    recorder_thread_count = kept;
+    last_thread = NULL;
+}
+
+// asyncio task tracking. Lines are tagged with the task that is running
+// on their thread's event loop. Tasks are numbered from 1 in the order they
+// are first seen; a table keyed by address holds a weak reference to each,
+// so a new task allocated where a dead one lived gets a new number.
+typedef struct TaskEntry {
+    const void *task;
+    PyObject *ref;              // Weak reference; NULL for an empty slot
+    uint64_t id;
+} TaskEntry;
+
+static TaskEntry *task_table = NULL;
+static size_t task_capacity = 0;
+static size_t task_count = 0;
+static uint64_t next_task_id = 1;
+static PyObject *asyncio_name = NULL;
+static PyObject *asyncio_get_running_loop = NULL;
+static PyObject *asyncio_current_task = NULL;
+
+static int
+task_ref_alive(PyObject *ref, PyObject *task)
+{
+#if PY_VERSION_HEX >= 0x030D0000
+    PyObject *object = NULL;
+    if (PyWeakref_GetRef(ref, &object) < 0) {
+        PyErr_Clear();
+    }
+    Py_XDECREF(object);
+    return object == task;
+#else
+    return PyWeakref_GetObject(ref) == task;
+#endif
+}
+
+static TaskEntry*
+task_slot(TaskEntry *table, size_t capacity, const void *task)
+{
+    size_t index = ((uintptr_t)task >> 4) & (capacity - 1);
+    while (table[index].ref != NULL && table[index].task != task) {
+        index = (index + 1) & (capacity - 1);
+    }
+    return &table[index];
+}
+
+// Rebuild the table without dead tasks, growing it if it is still half full
+static int
+task_table_rebuild(void)
+{
+    size_t live = 0;
+    for (size_t i = 0; i < task_capacity; i++) {
+        TaskEntry *entry = &task_table[i];
+        if (entry->ref != NULL && !task_ref_alive(entry->ref, (PyObject *)entry->task)) {
+            Py_CLEAR(entry->ref);
+        }
+        live += entry->ref != NULL;
+    }
+
+    size_t capacity = task_capacity ? task_capacity : 64;
+    while ((live + 1) * 2 > capacity) {
+        capacity *= 2;
+    }
+    TaskEntry *table = (TaskEntry *)calloc(capacity, sizeof(TaskEntry));
+    if (table == NULL) {
+        return -1;
+    }
+    for (size_t i = 0; i < task_capacity; i++) {
+        if (task_table[i].ref != NULL) {
+            *task_slot(table, capacity, task_table[i].task) = task_table[i];
+        }
+    }
+    free(task_table);
+    task_table = table;
+    task_capacity = capacity;
+    task_count = live;
+    return 0;
+}
+
+static void
+task_table_clear(void)
+{
+    for (size_t i = 0; i < task_capacity; i++) {
+        Py_XDECREF(task_table[i].ref);
+    }
+    free(task_table);
+    task_table = NULL;
+    task_capacity = 0;
+    task_count = 0;
+    Py_CLEAR(asyncio_get_running_loop);
+    Py_CLEAR(asyncio_current_task);
+}
+
+// The running asyncio task of this thread (new reference), or NULL. Only
+// looks once asyncio has been imported by the traced program.
+static PyObject*
+get_current_task(void)
+{
+    if (asyncio_current_task == NULL) {
+        if (asyncio_name == NULL) {
+            asyncio_name = PyUnicode_InternFromString("asyncio");
+            if (asyncio_name == NULL) {
+                PyErr_Clear();
+                return NULL;
+            }
+        }
+        PyObject *asyncio = PyImport_GetModule(asyncio_name);
+        if (asyncio == NULL) {
+            PyErr_Clear();
+            return NULL;
+        }
+        asyncio_get_running_loop = PyObject_GetAttrString(asyncio, "_get_running_loop");
+        asyncio_current_task = PyObject_GetAttrString(asyncio, "current_task");
+        Py_DECREF(asyncio);
+        if (asyncio_get_running_loop == NULL || asyncio_current_task == NULL) {
+            // Partially imported; try again on a later line
+            Py_CLEAR(asyncio_get_running_loop);
+            Py_CLEAR(asyncio_current_task);
+            PyErr_Clear();
+            return NULL;
+        }
+    }
+
+    // current_task() raises outside of a loop, so ask for the loop first
+    PyObject *loop = PyObject_CallNoArgs(asyncio_get_running_loop);
+    if (loop == NULL || loop == Py_None) {
+        Py_XDECREF(loop);
+        PyErr_Clear();
+        return NULL;
+    }
+    PyObject *task = PyObject_CallOneArg(asyncio_current_task, loop);
+    Py_DECREF(loop);
+    if (task == NULL || task == Py_None) {
+        Py_XDECREF(task);
+        PyErr_Clear();
+        return NULL;
+    }
+    return task;
+}
+
+// Id of task, emitting a REC_TASK record the first time it is seen
+static uint64_t
+get_task_id(PyObject *task, RecorderThread *thread)
+{
+    if ((task_count + 1) * 2 > task_capacity && task_table_rebuild() < 0) {
+        return 0;
+    }
+
+    TaskEntry *entry = task_slot(task_table, task_capacity, task);
+    if (entry->ref != NULL) {
+        if (task_ref_alive(entry->ref, task)) {
+            return entry->id;
+        }
+        Py_CLEAR(entry->ref);  // A dead task lived at this address
+        task_count--;
+    }
+
+    PyObject *ref = PyWeakref_NewRef(task, NULL);
+    if (ref == NULL) {
+        PyErr_Clear();
+        return 0;
+    }
+    entry->task = task;
+    entry->ref = ref;
+    entry->id = next_task_id++;
+    task_count++;
+    uint64_t id = entry->id;
+
+    // get_name() can run Python code, which may rebuild the table
+    PyObject *name = PyObject_CallMethod(task, "get_name", NULL);
+    const char *utf8 = name != NULL && PyUnicode_Check(name) ? PyUnicode_AsUTF8(name) : NULL;
+    if (utf8 == NULL) {
+        PyErr_Clear();
+        utf8 = "";
+    }
+    if (is_tracing) {
+        ByteBuffer *record = &record_buffer;
+        record->length = 0;
+        buffer_put_varint(record, id);
+        buffer_put_varint(record, thread->id);
+        buffer_put_bytes(record, utf8, strlen(utf8));
+        emit_record(REC_TASK, record->data, record->length);
+    }
+    Py_XDECREF(name);
+    return id;
+}
+
+// Update the thread's current task. The thread keeps a reference to it, so
+// comparing the pointer with the next line's task is enough.
+static void
+update_thread_task(RecorderThread *thread)
+{
+    thread->busy = 1;
+    PyObject *task = get_current_task();
+    if (task != thread->task) {
+        uint64_t id = task != NULL ? get_task_id(task, thread) : 0;
+        Py_XSETREF(thread->task, task);
+        thread->task_id = id;
+    } else {
+        Py_XDECREF(task);
+    }
+    thread->busy = 0;
+}
+
+// Write a REC_CALL for the thread's current depth
+static void
+emit_call(RecorderThread *thread, uint64_t function_id)
+{
+    ByteBuffer *record = &record_buffer;
+    record->length = 0;
+    buffer_put_varint(record, thread->id);
+    buffer_put_varint(record, thread->depth);
+    buffer_put_varint(record, function_id);
+    emit_record(REC_CALL, record->data, record->length);
+
+    thread->call_block = block_serial;
+    thread->block_depth = thread->depth;
+    thread->block_function = function_id;
+}
+
+static int
+slot_values_equal(const Snapshot *a, const VarSlot *x, const Snapshot *b, const VarSlot *y)
+{
+    size_t length = x->end - x->value_offset;
+    return length == y->end - y->value_offset &&
+           memcmp(a->values.data + x->value_offset, b->values.data + y->value_offset, length) == 0;
+}
+
+static void
+put_slot_value(ByteBuffer *out, const Snapshot *snapshot, const VarSlot *slot)
+{
+    buffer_put_bytes(out, snapshot->values.data + slot->value_offset,
+                     slot->end - slot->value_offset);
+}
+
+// Encode the changes from prev to cur. Returns 0 if the variables that
+// survive were reordered, which the delta ops cannot express.
+static int
+write_delta(ByteBuffer *out, const Snapshot *prev, const Snapshot *cur)
+{
+    int needed = prev->var_count + cur->var_count;
+    if (needed > delta_match_capacity) {
+        int *matches = (int *)realloc(delta_matches, needed * sizeof(int));
+        if (matches == NULL) {
+            return 0;
+        }
+        delta_matches = matches;
+        delta_match_capacity = needed;
+    }
+    int *prev_match = delta_matches;
+    int *cur_match = delta_matches + prev->var_count;
+
+    for (int j = 0; j < prev->var_count; j++) {
+        prev_match[j] = -1;
+    }
+
+    // Variables usually keep their order, so try the next slot first
+    int hint = 0;
+    int last = -1;
+    for (int k = 0; k < cur->var_count; k++) {
+        uint64_t name = cur->vars[k].name;
+        int found = -1;
+
+        if (hint < prev->var_count && prev->vars[hint].name == name) {
+            found = hint;
+        } else {
+            for (int j = 0; j < prev->var_count; j++) {
+                if (prev->vars[j].name == name) {
+                    found = j;
+                    break;
+                }
+            }
+        }
+
+        cur_match[k] = found;
+        if (found >= 0) {
+            if (found < last) {
+                return 0;
+            }
+            last = found;
+            prev_match[found] = k;
+            hint = found + 1;
+        }
+    }
+
+    for (int j = 0; j < prev->var_count; j++) {
+        if (prev_match[j] < 0) {
+            buffer_put_varint(out, prev->vars[j].name);
+            buffer_put_varint(out, VAR_DELETE);
+        }
+    }
+
+    for (int k = 0; k < cur->var_count; k++) {
+        const VarSlot *slot = &cur->vars[k];
+        int j = cur_match[k];
+
+        if (j < 0) {
+            buffer_put_varint(out, slot->name);
+            buffer_put_varint(out, VAR_INSERT);
+            buffer_put_varint(out, k);
+            put_slot_value(out, cur, slot);
+        } else if (!slot_values_equal(prev, &prev->vars[j], cur, slot)) {
+            buffer_put_varint(out, slot->name);
+            buffer_put_varint(out, VAR_SET);
+            put_slot_value(out, cur, slot);
+        }
+    }
+    return 1;
+}
+
+static void
+record_line_event(CodeInfo *info, int lineno)
+{
+    const char *filename = info->filename;
+
+    if (capture_window && capture_window_over()) {
+        close_capture_window();
+        return;
+    }
+    if (!in_region()) {
+        return;
+    }
+
+    // A runner only counts lines up to its target
+    if (checkpoint_target >= 0) {
+        uint64_t elided = 0;
+        if (!sampling || sample_line(info, lineno, &elided)) {
+            checkpoint_count_line(info, lineno);
+        }
+        return;
+    }
+
+    if (info->source == NULL) {
+        info->source = get_source_file(filename);
+    }
+    const char *source_line = source_file_line(info->source, lineno);
+
+    // Check for breakpoint
+    Breakpoint *bp = check_breakpoint(info, lineno, PyEval_GetFrame());
+    if (bp != NULL) {
+        is_paused = 1;
+        printf("\n\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+        printf("\033[1;31m⚫ BREAKPOINT HIT\033[0m\n");
+        printf("\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+        printf("File: \033[1;32m%s\033[0m Line: \033[1;32m%d\033[0m\n", filename, lineno);
+        printf("Hit count: %d\n", bp->hit_count);
+
+        // Show current code
+        printf("Code: %s\n", source_line);
+
+        printf("\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+        printf("\nCommands:\n");
+        printf("  \033[1;32mc\033[0m - Continue to next breakpoint\n");
+        printf("  \033[1;32mn\033[0m - Step to next line\n");
+        printf("  \033[1;32mb\033[0m - Step back to previous line\n");
+        printf("  \033[1;32mh\033[0m - Show trace history\n");
+        printf("  \033[1;32mq\033[0m - Quit execution\n");
+        printf("\n> ");
+
+        char input[256];
+        while (1) {
+            if (fgets(input, sizeof(input), stdin)) {
+                input[strcspn(input, "\n")] = 0;  // Remove newline
+
+                if (strcmp(input, "c") == 0) {
+                    // Continue - breakpoint will hit again in loop
+                    is_paused = 0;
+                    step_mode = 0;
+                    break;
+                } else if (strcmp(input, "n") == 0) {
+                    // Step next
+                    is_paused = 0;
+                    step_mode = 1;
+                    step_thread = PyThread_get_thread_ident();
+                    break;
+                } else if (strcmp(input, "b") == 0) {
+                    // Step back
+                    if (trace_history_index > 1) {
+                        trace_history_index--;
+                        show_trace_entry(trace_history_index - 1);
+                        printf("\n> ");
+                    } else {
+                        printf("Already at the beginning of trace history.\n");
+                        printf("\n> ");
+                    }
+                } else if (strcmp(input, "h") == 0) {
+                    // Show history
+                    printf("\nTrace History (%d entries):\n", trace_history_count);
+                    int start = trace_history_count > 10 ? trace_history_count - 10 : 0;
+                    for (int i = start; i < trace_history_count; i++) {
+                        char marker = (i == trace_history_index - 1) ? '>' : ' ';
+                        printf("  %c [%d] #%ld %s:%d\n", 
+                               marker, i + 1, trace_history[i].exec_num,
+                               trace_history[i].filename, trace_history[i].lineno);
+                    }
+                    printf("\n> ");
+                } else if (strcmp(input, "q") == 0) {
+                    // Quit
+                    printf("Exiting...\n");
+                    exit(0);
+                } else {
+                    printf("Unknown command. Use: c, n, b, h, or q\n");
+                    printf("\n> ");
+                }
+            } else {
+                break;
+            }
+        }
+    }
+
+    // If in step mode, pause after one line of the stepping thread
+    if (step_mode == 1 && !is_paused && step_thread == PyThread_get_thread_ident()) {
+        is_paused = 1;
+        step_mode = 0;  // Reset step mode
+
+        printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+        printf("\033[1;33m➜ STEP\033[0m\n");
+        printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+        printf("File: \033[1;32m%s\033[0m Line: \033[1;32m%d\033[0m\n", filename, lineno);
+        printf("Code: %s\n", source_line);
+        printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+        printf("\nCommands: c (continue), n (step), b (back), h (history), q (quit)\n");
+        printf("\n> ");
+
+        char input[256];
+        while (1) {
+            if (fgets(input, sizeof(input), stdin)) {
+                input[strcspn(input, "\n")] = 0;
+
+                if (strcmp(input, "c") == 0) {
+                    is_paused = 0;
+                    step_mode = 0;
+                    break;
+                } else if (strcmp(input, "n") == 0) {
+                    is_paused = 0;
+                    step_mode = 1;
+                    step_thread = PyThread_get_thread_ident();
+                    break;
+                } else if (strcmp(input, "b") == 0) {
+                    // Step back
+                    if (trace_history_index > 1) {
                         trace_history_index--;
                         show_trace_entry(trace_history_index - 1);
                         printf("\n> ");
@@ -612,182 +5097,2147 @@ trace_callback(PyObject *obj, PyFrameObject *frame, int what, PyObject *arg)
         }
     }
 
-    // Write to trace file
-    char *source_line = get_source_line(filename, lineno);
+    // Hot lines may be left out of the trace
+    uint64_t elided = 0;
+    if (sampling && !sample_line(info, lineno, &elided)) {
+        return;
+    }
+
+    if (checkpoint_every > 0 && execution_counter >= next_checkpoint) {
+        take_checkpoint();
+        if (checkpoint_target >= 0) {
+            checkpoint_count_line(info, lineno);
+            return;
+        }
+    }
+
+    // Write to trace file. Functions' locals are read from the frame; the
+    // locals dict is only built for module and class bodies and for watch
+    // expressions.
+    PyObject *locals = NULL;
+    PyObject *globals = NULL;
+    PyFrameObject *frame = PyEval_GetFrame();
+    int fast_locals = frame != NULL && info->local_count >= 0;
+
+    if (!fast_locals || watch_count > 0) {
+        locals = PyEval_GetLocals();
+        if (locals == NULL) {
+            PyErr_Clear();
+            locals = PyDict_New();
+        } else {
+            Py_INCREF(locals);
+        }
+    }
+    globals = PyEval_GetGlobals();
+//     COMPAT_Py_XDECREF_Code(code_obj);
+//    #else
+//        if (frame->f_locals == NULL) {
+            // Create the locals dict
+//            frame->f_locals = PyDict_New();
+//        }
+
+    int frame_globals = globals != NULL;
+    if (globals == NULL) {
+        PyErr_Clear();
+        globals = PyDict_New();
+    } else {
+        Py_INCREF(globals);
+    }
+
+    int locals_are_globals = !fast_locals && locals == globals;
+    unsigned long generation = trace_generation;
+
+    RecorderThread *thread = get_recorder_thread();
+    if (thread != NULL) {
+        update_thread_task(thread);
+    }
+    if (thread == NULL || !is_tracing) {
+        Py_XDECREF(locals);
+        Py_XDECREF(globals);
+        return;
+    }
+
+    // Write to trace file with properly initialized locals
+    if (info->file_id == 0) {
+        info->file_id = intern_string(filename, strlen(filename), STR_FILE);
+    }
+    uint64_t code_id = source_line_id(info->source, lineno);
+
+    Snapshot *snapshot = &thread->snapshot;
+    snapshot->values.length = 0;
+    snapshot->var_count = 0;
+    thread->busy = 1;
+    if (!record_variables) {
+        // Lines only; a re-run from a checkpoint shows the variables
+    } else if (fast_locals) {
+        write_fast_locals(snapshot, info, frame);
+    } else if (!locals_are_globals || !frame_globals) {
+        write_variables(snapshot, locals, locals_are_globals);
+    }
+    if (frame_globals && record_variables) {
+        write_cached_globals(snapshot, globals, fast_locals || locals_are_globals ? NULL : locals,
+                             fast_locals ? snapshot->var_count : 0);
+    }
+    thread->busy = 0;
+
+    if (!is_tracing || trace_generation != generation) {
+        Py_XDECREF(locals);
+        Py_XDECREF(globals);
+        return;
+    }
+
+    int flags = 0;
+    FrameState *state = NULL;
+    const ByteBuffer *body = &snapshot->values;
+
+    if (keyframe_interval > 0) {
+        state = get_frame_state(frame);
+        flags |= LINE_HAS_FRAME;
+
+        if (state->events > 0 && state->events < keyframe_interval) {
+            delta_buffer.length = 0;
+            if (write_delta(&delta_buffer, &state->last, snapshot) &&
+                delta_buffer.length < snapshot->values.length) {
+                flags |= LINE_DELTA;
+                body = &delta_buffer;
+            }
+        }
+        state->events = (flags & LINE_DELTA) ? state->events + 1 : 1;
+    }
+    if (thread->id != 0) {
+        flags |= LINE_HAS_THREAD;
+    }
+
+    // Lines carry the task when it changes; a block starts with no task
+    if (thread->task_block != block_serial) {
+        thread->task_block = block_serial;
+        thread->block_task = 0;
+    }
+    if (thread->task_id != thread->block_task) {
+        thread->block_task = thread->task_id;
+        flags |= LINE_HAS_TASK;
+    }
+
+    // Likewise the depth and function, unless a REC_CALL already gave them
+    uint64_t function_id = code_function_id(info);
+    if (thread->call_pending) {
+        thread->call_pending = 0;
+        emit_call(thread, function_id);
+    }
+    if (thread->call_block != block_serial || thread->block_depth != thread->depth ||
+        thread->block_function != function_id) {
+        thread->call_block = block_serial;
+        thread->block_depth = thread->depth;
+        thread->block_function = function_id;
+        flags |= LINE_HAS_CALL;
+    }
+    if (elided > 0) {
+        flags |= LINE_HAS_ELIDED;
+    }
+
+    ByteBuffer *record = &record_buffer;
+    record->length = 0;
+    buffer_put_varint(record, execution_counter++);
+    buffer_put_varint(record, flags);
+    buffer_put_varint(record, info->file_id);
+    buffer_put_varint(record, lineno);
+    buffer_put_varint(record, code_id);
+    if (state != NULL) {
+        buffer_put_varint(record, state->id);
+    }
+    if (thread->id != 0) {
+        buffer_put_varint(record, thread->id);
+    }
+    if (flags & LINE_HAS_TASK) {
+        buffer_put_varint(record, thread->task_id);
+    }
+    if (flags & LINE_HAS_CALL) {
+        buffer_put_varint(record, thread->depth);
+        buffer_put_varint(record, function_id);
+    }
+    if (elided > 0) {
+        buffer_put_varint(record, elided);
+    }
+    buffer_put_bytes(record, body->data, body->length);
+    emit_record(REC_LINE, record->data, record->length);
+    if (watch_count > 0) {
+        record_watches(globals, locals, execution_counter - 1);
+    }
+
+    if (state != NULL) {
+        // The frame keeps this event's variables; reuse its old buffers next time
+        Snapshot previous = state->last;
+        state->last = *snapshot;
+        *snapshot = previous;
+    }
+    maybe_seal_blocks();
+
+    // Add to trace history for step back
+    // Build variables string
+    char var_buffer[4096] = {0};
+    if (trace_history_count >= MAX_TRACE_HISTORY) {
+        // Full: add_trace_entry() keeps nothing more
+    } else if (fast_locals) {
+        for (int i = 0; i < info->local_count && strlen(var_buffer) < 3900; i++) {
+            PyObject *value = read_fast_local(frame, &info->locals[i]);
+            if (value != NULL) {
+                append_history_variable(var_buffer, sizeof(var_buffer), info->locals[i].name, value);
+                Py_DECREF(value);
+            }
+        }
+    } else if (locals && PyDict_Check(locals)) {
+        PyObject *key, *value;
+        Py_ssize_t pos = 0;
+
+        while (PyDict_Next(locals, &pos, &key, &value) && strlen(var_buffer) < 3900) {
+            const char *var_name = PyUnicode_AsUTF8(key);
+            if (var_name == NULL) {
+                PyErr_Clear();
+                continue;
+            }
+            if (should_skip_local_variable(var_name, value, locals_are_globals)) {
+                continue;
+            }
+            append_history_variable(var_buffer, sizeof(var_buffer), var_name, value);
+        }
+    }
+
+//    if (globals && PyDict_Check(globals)) {
+//        PyObject *key, *value;
+//        Py_ssize_t pos = 0;
+
+//        while (PyDict_Next(globals, &pos, &key, &value) && strlen(var_buffer) < 3900) {
+//            const char *var_name = PyUnicode_AsUTF8(key);
+//            if(var_name) {
+//                strcat(var_buffer, var_name);
+//                strcat(var_buffer, "=");
+//
+//                PyObject *repr = PyObject_Repr(value);
+//               if(repr) {
+//                    const char *var_value = PyUnicode_AsUTF8(repr);
+//                    if (var_value) {
+//                        strncat(var_buffer, var_value, 100);
+//                    }
+//                    Py_XDECREF(repr);
+//                }
+//           }
+//        }
+//    }
+
+    add_trace_entry(filename, lineno, source_line, var_buffer);
+
+    Py_XDECREF(locals);
+    Py_XDECREF(globals);
+}
+
+// Call depth. Each thread counts the traced frames it is running: a call
+// (or a generator resuming) goes one deeper and is recorded with its depth
+// and function, a return (or yield, or exception leaving the frame) comes
+// back up. Frames that were already running when tracing started are at
+// depth 0, so their returns do not go below it.
+static void
+record_call_event(CodeInfo *info, int is_return)
+{
+    if (!in_region() || checkpoint_target >= 0) {
+        return;
+    }
+    RecorderThread *thread = get_recorder_thread();
+    if (thread == NULL || !is_tracing) {
+        return;
+    }
+
+    // When sampling, a call is only written before the next line of its
+    // thread that is recorded, and returns are not written, so calls made
+    // from a hot loop cost nothing once their lines are left out
+    if (sampling) {
+        if (is_return) {
+            if (thread->call_pending && thread->depth <= thread->pending_depth) {
+                thread->call_pending = 0;
+            }
+            if (thread->depth > 0) {
+                thread->depth--;
+            }
+        } else {
+            thread->depth++;
+            if (!thread->call_pending) {
+                thread->call_pending = 1;
+                thread->pending_depth = thread->depth;
+            }
+        }
+        return;
+    }
+
+    ByteBuffer *record = &record_buffer;
+    record->length = 0;
+    buffer_put_varint(record, thread->id);
+    if (is_return) {
+        buffer_put_varint(record, thread->depth);
+        emit_record(REC_RETURN, record->data, record->length);
+        if (thread->depth > 0) {
+            thread->depth--;
+        }
+        return;
+    }
+
+    thread->depth++;
+    emit_call(thread, code_function_id(info));
+}
+
+// Main trace function with breakpoint support
+static int
+trace_callback(PyObject *obj, PyFrameObject *frame, int what, PyObject *arg)
+{
+    if (!hooks_active()) {
+        return 0;
+    }
+
+    // Only trace LINE, CALL and RETURN events
+    if (what != PyTrace_LINE && what != PyTrace_CALL && what != PyTrace_RETURN) {
+        return 0;
+    }
+
+    // Excluded code leaves after a single cache lookup
+    PyCodeObject *code = COMPAT_PyFrame_GetCode(frame);
+    CodeInfo *info = get_code_info(code);
+    COMPAT_Py_XDECREF_Code(code);
+    if (info == NULL || !info->traced) {
+        return 0;
+    }
+
+    // The frame keeps the code object, and so info->filename, alive
+    if (what == PyTrace_LINE) {
+        record_line_event(info, PyFrame_GetLineNumber(frame));
+    } else {
+        record_call_event(info, what == PyTrace_RETURN);
+    }
+    return 0;
+}
+
+// Install trace_callback on every existing thread, or remove it with NULL
+static void
+set_trace_all_threads(Py_tracefunc func)
+{
+#if PY_VERSION_HEX >= 0x030C0000
+    PyEval_SetTraceAllThreads(func, NULL);
+#else
+    PyInterpreterState *interp = PyThreadState_GetInterpreter(PyThreadState_Get());
+    for (PyThreadState *tstate = PyInterpreterState_ThreadHead(interp);
+         tstate != NULL; tstate = PyThreadState_Next(tstate)) {
+        if (_PyEval_SetTrace(tstate, func, NULL) < 0) {
+            PyErr_Clear();
+        }
+    }
+#endif
+}
+
+// Threads started later install their trace function from threading's
+// hook, which runs once in the new thread before its target. The hook
+// swaps itself for trace_callback.
+static PyObject *previous_thread_hook = NULL;
+
+static PyObject*
+thread_trace_hook(PyObject *self, PyObject *args)
+{
+    if (is_tracing && trace_backend == BACKEND_SETTRACE) {
+        PyEval_SetTrace((Py_tracefunc)trace_callback, NULL);
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef thread_trace_hook_def = {
+    "_thread_trace_hook", thread_trace_hook, METH_VARARGS, NULL
+};
+
+// Call threading.settrace(hook). With save set, remember the current hook
+// so it can be restored when tracing stops.
+static int
+set_threading_hook(PyObject *hook, int save)
+{
+    PyObject *threading = PyImport_ImportModule("threading");
+    if (threading == NULL) {
+        return -1;
+    }
+    if (save) {
+        Py_XSETREF(previous_thread_hook, PyObject_CallMethod(threading, "gettrace", NULL));
+        if (previous_thread_hook == NULL) {
+            Py_DECREF(threading);
+            return -1;
+        }
+    }
+    PyObject *result = PyObject_CallMethod(threading, "settrace", "O", hook);
+    Py_DECREF(threading);
+    if (result == NULL) {
+        return -1;
+    }
+    Py_DECREF(result);
+    return 0;
+}
+
+static int
+settrace_start(void)
+{
+    PyObject *hook = PyCFunction_New(&thread_trace_hook_def, NULL);
+    if (hook == NULL) {
+        return -1;
+    }
+    int err = set_threading_hook(hook, 1);
+    Py_DECREF(hook);
+    if (err < 0) {
+        return -1;
+    }
+    set_trace_all_threads((Py_tracefunc)trace_callback);
+    return 0;
+}
+
+static void
+settrace_stop(void)
+{
+    set_trace_all_threads(NULL);
+    if (previous_thread_hook != NULL) {
+        if (set_threading_hook(previous_thread_hook, 0) < 0) {
+            PyErr_WriteUnraisable(NULL);
+        }
+        Py_CLEAR(previous_thread_hook);
+    }
+}
+
+#ifdef HAVE_SYS_MONITORING
+// sys.monitoring (PEP 669) backend for Python 3.12+.
+//
+// PY_START is enabled globally. The first time a code object starts we
+// decide whether it is traced: traced code gets LINE, JUMP and the other
+// call and return events enabled locally, and untraced code returns DISABLE
+// from PY_START so it never calls back into the debugger again and runs at
+// full speed. PY_THROW and PY_UNWIND can only be enabled globally; they keep
+// the call depth right when exceptions enter or leave traced frames.
+//
+// LINE does not fire when a jump lands back on the line it left, as in a
+// loop written on one line or a comprehension, where settrace sees every
+// iteration. JUMP records those lines, as CPython's own settrace does on
+// sys.monitoring; every other jump returns DISABLE at its first call.
+static PyObject *monitoring_module = NULL;
+static PyObject *monitoring_disable = NULL;
+static PyObject *monitoring_codes = NULL;   // Code objects with local events
+static int monitoring_tool_id = -1;
+static long monitoring_event_line = 0;
+static long monitoring_event_jump = 0;
+static long monitoring_event_py_start = 0;
+static long monitoring_event_py_resume = 0;
+static long monitoring_event_py_return = 0;
+static long monitoring_event_py_yield = 0;
+static long monitoring_event_py_throw = 0;
+static long monitoring_event_py_unwind = 0;
+
+static long
+get_monitoring_event(PyObject *events, const char *name)
+{
+    PyObject *value = PyObject_GetAttrString(events, name);
+    if (value == NULL) {
+        return -1;
+    }
+    long result = PyLong_AsLong(value);
+    Py_DECREF(value);
+    return result;
+}
+
+static int
+monitoring_enable_events(PyObject *code, CodeInfo *info)
+{
+    if (info->monitored) {
+        return 0;
+    }
+    long events = monitoring_event_line | monitoring_event_jump | monitoring_event_py_start |
+                  monitoring_event_py_resume | monitoring_event_py_return | monitoring_event_py_yield;
+    PyObject *result = PyObject_CallMethod(monitoring_module, "set_local_events", "iOl",
+                                           monitoring_tool_id, code, events);
+    if (result == NULL) {
+        return -1;
+    }
+    Py_DECREF(result);
+    info->monitored = 1;
+    return PyList_Append(monitoring_codes, code);
+}
+
+// Traced code object of a call or return event, or NULL
+static CodeInfo*
+monitoring_traced_code(PyObject *const *args, Py_ssize_t nargs)
+{
+    if (!hooks_active() || nargs < 1 || !PyCode_Check(args[0])) {
+        return NULL;
+    }
+    CodeInfo *info = get_code_info((PyCodeObject *)args[0]);
+    return info != NULL && info->traced ? info : NULL;
+}
+
+static PyObject*
+monitoring_py_start(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    if (nargs < 1 || !PyCode_Check(args[0])) {
+        Py_RETURN_NONE;
+    }
+
+    CodeInfo *info = get_code_info((PyCodeObject *)args[0]);
+    if (info == NULL || !info->traced) {
+        return Py_NewRef(monitoring_disable);
+    }
+    if (monitoring_enable_events(args[0], info) < 0) {
+        PyErr_WriteUnraisable(args[0]);
+    }
+    if (is_tracing && trace_writer.ring != NULL) {
+        record_call_event(info, 0);
+    }
+    Py_RETURN_NONE;
+}
+
+// PY_RESUME and PY_THROW
+static PyObject*
+monitoring_py_resume(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    CodeInfo *info = monitoring_traced_code(args, nargs);
+    if (info != NULL) {
+        record_call_event(info, 0);
+    }
+    Py_RETURN_NONE;
+}
+
+// PY_RETURN, PY_YIELD and PY_UNWIND
+static PyObject*
+monitoring_py_return(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    CodeInfo *info = monitoring_traced_code(args, nargs);
+    if (info != NULL) {
+        record_call_event(info, 1);
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+monitoring_line(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    // LINE is only enabled on traced code, in every thread
+    if (!hooks_active()) {
+        Py_RETURN_NONE;
+    }
+    if (nargs < 2 || !PyCode_Check(args[0])) {
+        Py_RETURN_NONE;
+    }
+
+    CodeInfo *info = get_code_info((PyCodeObject *)args[0]);
+    int lineno = (int)PyLong_AsLong(args[1]);
+    if (info == NULL || !info->traced || (lineno == -1 && PyErr_Occurred())) {
+        PyErr_Clear();
+        Py_RETURN_NONE;
+    }
+
+    record_line_event(info, lineno);
+    Py_RETURN_NONE;
+}
+
+// JUMP: a jump back to the start of its own line runs the line again
+static PyObject*
+monitoring_jump(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    if (nargs < 3 || !PyCode_Check(args[0])) {
+        Py_RETURN_NONE;
+    }
+    long from = PyLong_AsLong(args[1]);
+    long to = PyLong_AsLong(args[2]);
+    if (PyErr_Occurred()) {
+        PyErr_Clear();
+        Py_RETURN_NONE;
+    }
+    PyCodeObject *code = (PyCodeObject *)args[0];
+    int lineno = to < from ? PyCode_Addr2Line(code, (int)to) : -1;
+    if (lineno < 0 || lineno != PyCode_Addr2Line(code, (int)from)) {
+        // Forward, or to another line, which gets its LINE event
+        return Py_NewRef(monitoring_disable);
+    }
+    if (!hooks_active()) {
+        Py_RETURN_NONE;
+    }
+
+    CodeInfo *info = get_code_info(code);
+    if (info != NULL && info->traced) {
+        record_line_event(info, lineno);
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef monitoring_py_start_def = {
+    "_monitoring_py_start", (PyCFunction)(void(*)(void))monitoring_py_start, METH_FASTCALL, NULL
+};
+static PyMethodDef monitoring_line_def = {
+    "_monitoring_line", (PyCFunction)(void(*)(void))monitoring_line, METH_FASTCALL, NULL
+};
+static PyMethodDef monitoring_jump_def = {
+    "_monitoring_jump", (PyCFunction)(void(*)(void))monitoring_jump, METH_FASTCALL, NULL
+};
+static PyMethodDef monitoring_py_resume_def = {
+    "_monitoring_py_resume", (PyCFunction)(void(*)(void))monitoring_py_resume, METH_FASTCALL, NULL
+};
+static PyMethodDef monitoring_py_return_def = {
+    "_monitoring_py_return", (PyCFunction)(void(*)(void))monitoring_py_return, METH_FASTCALL, NULL
+};
+
+static int
+monitoring_register(long event, PyMethodDef *def)
+{
+    PyObject *callback = def ? PyCFunction_New(def, NULL) : Py_NewRef(Py_None);
+    if (callback == NULL) {
+        return -1;
+    }
+    PyObject *result = PyObject_CallMethod(monitoring_module, "register_callback", "ilO",
+                                           monitoring_tool_id, event, callback);
+    Py_DECREF(callback);
+    if (result == NULL) {
+        return -1;
+    }
+    Py_DECREF(result);
+    return 0;
+}
+
+static void monitoring_stop(void);
+
+// Claim the debugger tool id and enable PY_START. Returns 0 on success, -1
+// with an exception set on failure.
+static int
+monitoring_start(void)
+{
+    PyObject *sys = PyImport_ImportModule("sys");
+    if (sys == NULL) {
+        return -1;
+    }
+    monitoring_module = PyObject_GetAttrString(sys, "monitoring");
+    Py_DECREF(sys);
+    if (monitoring_module == NULL) {
+        return -1;
+    }
+
+    PyObject *tool_id = PyObject_GetAttrString(monitoring_module, "DEBUGGER_ID");
+    PyObject *events = PyObject_GetAttrString(monitoring_module, "events");
+    monitoring_disable = PyObject_GetAttrString(monitoring_module, "DISABLE");
+    if (tool_id == NULL || events == NULL || monitoring_disable == NULL) {
+        Py_XDECREF(tool_id);
+        Py_XDECREF(events);
+        Py_CLEAR(monitoring_disable);
+        Py_CLEAR(monitoring_module);
+        return -1;
+    }
+    int tool = (int)PyLong_AsLong(tool_id);
+    Py_DECREF(tool_id);
+    monitoring_event_line = get_monitoring_event(events, "LINE");
+    monitoring_event_jump = get_monitoring_event(events, "JUMP");
+    monitoring_event_py_start = get_monitoring_event(events, "PY_START");
+    monitoring_event_py_resume = get_monitoring_event(events, "PY_RESUME");
+    monitoring_event_py_return = get_monitoring_event(events, "PY_RETURN");
+    monitoring_event_py_yield = get_monitoring_event(events, "PY_YIELD");
+    monitoring_event_py_throw = get_monitoring_event(events, "PY_THROW");
+    monitoring_event_py_unwind = get_monitoring_event(events, "PY_UNWIND");
+    Py_DECREF(events);
+    if (PyErr_Occurred()) {
+        Py_CLEAR(monitoring_disable);
+        Py_CLEAR(monitoring_module);
+        return -1;
+    }
+
+    PyObject *result = PyObject_CallMethod(monitoring_module, "use_tool_id", "is", tool, "cdebugger");
+    if (result == NULL) {
+        Py_CLEAR(monitoring_disable);
+        Py_CLEAR(monitoring_module);
+        return -1;
+    }
+    Py_DECREF(result);
+    monitoring_tool_id = tool;
+
+    monitoring_codes = PyList_New(0);
+    if (monitoring_codes == NULL ||
+        monitoring_register(monitoring_event_py_start, &monitoring_py_start_def) < 0 ||
+        monitoring_register(monitoring_event_line, &monitoring_line_def) < 0 ||
+        monitoring_register(monitoring_event_jump, &monitoring_jump_def) < 0 ||
+        monitoring_register(monitoring_event_py_resume, &monitoring_py_resume_def) < 0 ||
+        monitoring_register(monitoring_event_py_throw, &monitoring_py_resume_def) < 0 ||
+        monitoring_register(monitoring_event_py_return, &monitoring_py_return_def) < 0 ||
+        monitoring_register(monitoring_event_py_yield, &monitoring_py_return_def) < 0 ||
+        monitoring_register(monitoring_event_py_unwind, &monitoring_py_return_def) < 0) {
+        goto error;
+    }
+
+    // Frames that are already running, in any thread, never see PY_START
+    PyInterpreterState *interp = PyThreadState_GetInterpreter(PyThreadState_Get());
+    for (PyThreadState *tstate = PyInterpreterState_ThreadHead(interp);
+         tstate != NULL; tstate = PyThreadState_Next(tstate)) {
+        PyFrameObject *frame = PyThreadState_GetFrame(tstate);
+        while (frame != NULL) {
+            PyCodeObject *code = PyFrame_GetCode(frame);
+            CodeInfo *info = get_code_info(code);
+            int failed = info != NULL && info->traced &&
+                         monitoring_enable_events((PyObject *)code, info) < 0;
+            Py_DECREF(code);
+
+            PyFrameObject *back = PyFrame_GetBack(frame);
+            Py_DECREF(frame);
+            frame = back;
+            if (failed) {
+                Py_XDECREF(frame);
+                goto error;
+            }
+        }
+    }
+
+    result = PyObject_CallMethod(monitoring_module, "restart_events", NULL);
+    if (result == NULL) {
+        goto error;
+    }
+    Py_DECREF(result);
+    result = PyObject_CallMethod(monitoring_module, "set_events", "il", monitoring_tool_id,
+                                 monitoring_event_py_start | monitoring_event_py_throw |
+                                 monitoring_event_py_unwind);
+    if (result == NULL) {
+        goto error;
+    }
+    Py_DECREF(result);
+    return 0;
+
+error:
+    {
+        PyObject *type, *value, *traceback;
+        PyErr_Fetch(&type, &value, &traceback);
+        monitoring_stop();
+        PyErr_Restore(type, value, traceback);
+    }
+    return -1;
+}
+
+// Release the tool id and remove every event this backend installed
+static void
+monitoring_stop(void)
+{
+    if (monitoring_module == NULL) {
+        return;
+    }
+
+    if (monitoring_tool_id >= 0) {
+        PyObject *result = PyObject_CallMethod(monitoring_module, "set_events", "ii",
+                                               monitoring_tool_id, 0);
+        Py_XDECREF(result);
+        if (monitoring_codes != NULL) {
+            for (Py_ssize_t i = 0; i < PyList_GET_SIZE(monitoring_codes); i++) {
+                result = PyObject_CallMethod(monitoring_module, "set_local_events", "iOi",
+                                             monitoring_tool_id,
+                                             PyList_GET_ITEM(monitoring_codes, i), 0);
+                Py_XDECREF(result);
+            }
+        }
+        monitoring_register(monitoring_event_py_start, NULL);
+        monitoring_register(monitoring_event_line, NULL);
+        monitoring_register(monitoring_event_jump, NULL);
+        monitoring_register(monitoring_event_py_resume, NULL);
+        monitoring_register(monitoring_event_py_throw, NULL);
+        monitoring_register(monitoring_event_py_return, NULL);
+        monitoring_register(monitoring_event_py_yield, NULL);
+        monitoring_register(monitoring_event_py_unwind, NULL);
+        result = PyObject_CallMethod(monitoring_module, "free_tool_id", "i", monitoring_tool_id);
+        Py_XDECREF(result);
+        PyErr_Clear();
+    }
+
+    monitoring_tool_id = -1;
+    Py_CLEAR(monitoring_codes);
+    Py_CLEAR(monitoring_disable);
+    Py_CLEAR(monitoring_module);
+}
+#endif
+
+// Flight recorder dumps. The recorder seals its open blocks and waits
+// for the writer thread to write them (see writer_dump).
+static int
+flight_dump_now(const char *filename)
+{
+    seal_blocks();
+    return writer_dump(filename);
+}
+
+// The dump signal runs a Python-level handler, so the dump happens in the
+// main thread between bytecodes rather than inside a C signal handler. A
+// Python handler that was installed before still runs afterwards.
+static int dump_signal = 0;
+static PyObject *previous_signal_handler = NULL;
+
+static PyObject*
+dump_signal_handler(PyObject *self, PyObject *args)
+{
+    if (is_tracing && trace_writer.flight) {
+        int err = flight_dump_now(trace_filename);
+        if (err != 0) {
+            fprintf(stderr, "cdebugger: could not write %s: %s\n", trace_filename, strerror(err));
+        }
+    }
+    if (previous_signal_handler != NULL && PyCallable_Check(previous_signal_handler)) {
+        return PyObject_Call(previous_signal_handler, args, NULL);
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef dump_signal_handler_def = {
+    "_dump_signal_handler", dump_signal_handler, METH_VARARGS, NULL
+};
+
+// Install a Python-level handler for signum, keeping the handler it
+// replaces in *previous. Returns -1 with an exception set on failure.
+static int
+install_signal_handler(int signum, PyMethodDef *def, PyObject **previous)
+{
+    PyObject *signal = PyImport_ImportModule("signal");
+    if (signal == NULL) {
+        return -1;
+    }
+    PyObject *handler = PyCFunction_New(def, NULL);
+    *previous = handler ? PyObject_CallMethod(signal, "getsignal", "i", signum) : NULL;
+    PyObject *result = *previous ?
+        PyObject_CallMethod(signal, "signal", "iO", signum, handler) : NULL;
+    Py_XDECREF(handler);
+    Py_DECREF(signal);
+    if (result == NULL) {
+        Py_CLEAR(*previous);
+        return -1;
+    }
+    Py_DECREF(result);
+    return 0;
+}
+
+// Put back the handler that was installed before (the default action if
+// it was not installed from Python)
+static void
+restore_signal_handler(int signum, PyObject **previous)
+{
+    PyObject *signal = PyImport_ImportModule("signal");
+    if (signal != NULL) {
+        PyObject *handler = *previous;
+        if (handler == Py_None) {
+            handler = PyObject_GetAttrString(signal, "SIG_DFL");
+        } else {
+            Py_INCREF(handler);
+        }
+        if (handler != NULL) {
+            PyObject *result = PyObject_CallMethod(signal, "signal", "iO", signum, handler);
+            Py_XDECREF(result);
+            Py_DECREF(handler);
+        }
+        Py_DECREF(signal);
+    }
+    PyErr_Clear();
+    Py_CLEAR(*previous);
+}
+
+static int
+install_dump_signal(int signum)
+{
+    if (install_signal_handler(signum, &dump_signal_handler_def, &previous_signal_handler) < 0) {
+        return -1;
+    }
+    dump_signal = signum;
+    return 0;
+}
+
+static void
+restore_dump_signal(void)
+{
+    if (dump_signal == 0) {
+        return;
+    }
+    restore_signal_handler(dump_signal, &previous_signal_handler);
+    dump_signal = 0;
+}
+
+// Processes. A traced program that forks goes on recording in the child,
+// into a trace of the child's own: trace_root.p<pid>, where trace_root is
+// the file the first process traces to. Every process is listed in
+// trace_root.procs with its parent and the seq it was forked at (see
+// traceformat.h). The first process lists itself when it first forks.
+static char *trace_root = NULL;
+static int process_listed = 0;
+
+static char*
+process_list_path(void)
+{
+    size_t length = strlen(trace_root);
+    char *list = (char *)malloc(length + 7);
+    if (list != NULL) {
+        memcpy(list, trace_root, length);
+        memcpy(list + length, ".procs", 7);
+    }
+    return list;
+}
+
+// Append process pid to the process list; the first process starts it.
+// Returns 0 or an errno value.
+static int
+list_process(long pid, long parent, uint64_t fork_seq, const char *filename)
+{
+    char *list = process_list_path();
+    if (list == NULL) {
+        return ENOMEM;
+    }
+
+    int flags = O_WRONLY | O_CREAT | O_CLOEXEC | (parent == 0 ? O_TRUNC : O_APPEND);
+    int fd = open(list, flags, 0666);
+    free(list);
+    if (fd < 0) {
+        return errno;
+    }
+
+    // One write per line, so children listing themselves at once do not
+    // interleave
+    const char *slash = strrchr(filename, '/');
+    char line[PATH_MAX + 96];
+    int line_length = 0;
+    if (parent == 0) {
+        line_length = snprintf(line, sizeof(line), "%s %d\n",
+                               TRACE_PROCESS_LIST_MAGIC, TRACE_PROCESS_LIST_VERSION);
+    }
+    line_length += snprintf(line + line_length, sizeof(line) - line_length, "%ld %ld %llu %s\n",
+                            pid, parent, (unsigned long long)fork_seq,
+                            slash ? slash + 1 : filename);
+    int err = line_length < (int)sizeof(line) ? write_all(fd, (unsigned char *)line, line_length) : ENAMETOOLONG;
+    if (close(fd) != 0 && err == 0) {
+        err = errno;
+    }
+    return err;
+}
+
+// Start the process list with pid as the first process, unless it already
+// is: a child forked from C lists its parent, which has not forked through
+// os.fork() yet (see note_fork_child). Returns 0 or an errno value.
+static int
+list_root_process(long pid)
+{
+    char *list = process_list_path();
+    if (list == NULL) {
+        return ENOMEM;
+    }
+    int fd = open(list, O_RDONLY | O_CLOEXEC);
+    free(list);
+    if (fd >= 0) {
+        char head[128];
+        ssize_t n = read(fd, head, sizeof(head) - 1);
+        close(fd);
+        long root = 0;
+        int version = 0;
+        char magic[8];
+        if (n > 0) {
+            head[n] = '\0';
+            if (sscanf(head, "%7s %d\n%ld ", magic, &version, &root) == 3 &&
+                strcmp(magic, TRACE_PROCESS_LIST_MAGIC) == 0 && root == pid) {
+                return 0;
+            }
+        }
+    }
+    return list_process(pid, 0, 0, trace_root);
+}
+
+// A child that ends with os._exit(), as multiprocessing's do, skips atexit,
+// so a traced child replaces os._exit with this, which stops tracing first
+static PyObject *previous_os_exit = NULL;
+static PyObject* stop_tracing(int live);
+
+static PyObject*
+os_exit_hook(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *os_exit = previous_os_exit;
+    Py_XINCREF(os_exit);
+    PyObject *result = stop_tracing(0);
+    if (result == NULL) {
+        PyErr_WriteUnraisable(NULL);
+    }
+    Py_XDECREF(result);
+    if (os_exit == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "os._exit is not available");
+        return NULL;
+    }
+    result = PyObject_Call(os_exit, args, kwargs);
+    Py_DECREF(os_exit);
+    return result;
+}
+
+static PyMethodDef os_exit_hook_def = {
+    "_exit", (PyCFunction)(void(*)(void))os_exit_hook, METH_VARARGS | METH_KEYWORDS, NULL
+};
+
+static void
+install_os_exit_hook(void)
+{
+    PyObject *os = PyImport_ImportModule("os");
+    PyObject *hook = os ? PyCFunction_New(&os_exit_hook_def, NULL) : NULL;
+    previous_os_exit = hook ? PyObject_GetAttrString(os, "_exit") : NULL;
+    if (previous_os_exit == NULL || PyObject_SetAttrString(os, "_exit", hook) < 0) {
+        Py_CLEAR(previous_os_exit);
+        PyErr_Clear();
+    }
+    Py_XDECREF(hook);
+    Py_XDECREF(os);
+}
+
+static void
+restore_os_exit(void)
+{
+    if (previous_os_exit == NULL) {
+        return;
+    }
+    PyObject *os = PyImport_ImportModule("os");
+    if (os == NULL || PyObject_SetAttrString(os, "_exit", previous_os_exit) < 0) {
+        PyErr_Clear();
+    }
+    Py_XDECREF(os);
+    Py_CLEAR(previous_os_exit);
+}
+
+// A child killed with SIGTERM, as multiprocessing's terminate() and a Pool
+// leaving its with block do, would lose what is not written yet, so a traced
+// child that leaves SIGTERM to its default action stops tracing first. Like
+// the dump signal this runs in the main thread between bytecodes.
+static PyObject*
+term_signal_handler(PyObject *self, PyObject *args)
+{
+    PyObject *result = stop_tracing(0);
+    if (result == NULL) {
+        PyErr_WriteUnraisable(NULL);
+    }
+    Py_XDECREF(result);
+    PyObject *signal = PyImport_ImportModule("signal");
+    PyObject *handler = signal ? PyObject_GetAttrString(signal, "SIG_DFL") : NULL;
+    result = handler ? PyObject_CallMethod(signal, "signal", "iO", SIGTERM, handler) : NULL;
+    Py_XDECREF(result);
+    Py_XDECREF(handler);
+    Py_XDECREF(signal);
+    if (result == NULL) {
+        return NULL;
+    }
+    kill(getpid(), SIGTERM);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef term_signal_handler_def = {
+    "_term_signal_handler", term_signal_handler, METH_VARARGS, NULL
+};
+
+static void
+install_term_handler(void)
+{
+    PyObject *signal = PyImport_ImportModule("signal");
+    PyObject *current = signal ? PyObject_CallMethod(signal, "getsignal", "i", SIGTERM) : NULL;
+    PyObject *default_action = current ? PyObject_GetAttrString(signal, "SIG_DFL") : NULL;
+    if (default_action != NULL && PyObject_RichCompareBool(current, default_action, Py_EQ) == 1) {
+        PyObject *handler = PyCFunction_New(&term_signal_handler_def, NULL);
+        PyObject *result = handler ?
+            PyObject_CallMethod(signal, "signal", "iO", SIGTERM, handler) : NULL;
+        Py_XDECREF(result);
+        Py_XDECREF(handler);
+    }
+    Py_XDECREF(default_action);
+    Py_XDECREF(current);
+    Py_XDECREF(signal);
+    PyErr_Clear();
+}
+
+// Start the child's own trace where the parent's left off: seqs continue
+// from the fork, with the parent's options, but strings, threads, tasks and
+// frames start over as in a new trace. Runs in the child right after fork
+// (os.register_at_fork), with the GIL and no other thread.
+static void
+trace_forked_child(void)
+{
+    TraceWriter *w = &trace_writer;
+    long parent = (long)getppid();
+    uint64_t fork_seq = (uint64_t)execution_counter;
+    size_t length = strlen(trace_root) + 24;
+    char *filename = (char *)malloc(length);
+    if (filename != NULL) {
+        snprintf(filename, length, "%s.p%ld", trace_root, (long)getpid());
+    }
+
+    // Blocks the parent had not sealed are the parent's to write
+    block_strings.length = 0;
+    block_events.length = 0;
+    block_watch.length = 0;
+    block_event_count = 0;
+    // Threads that were recording in the parent do not exist here
+    unsigned long ident = PyThread_get_thread_ident();
+    for (int i = 0; i < recorder_thread_count; i++) {
+        if (recorder_threads[i]->ident != ident) {
+            recorder_threads[i]->busy = 0;
+        }
+    }
+    free_recorder_threads();
+    intern_clear();
+    task_table_clear();
+    free_frame_states();
+    globals_cache_clear();
+    for (int i = 0; i < watch_count; i++) {
+        watches[i].text_id = 0;
+        watches[i].has_value = 0;
+    }
+    trace_generation++;
+    block_serial++;
+    next_frame_id = 0;
+    next_thread_id = 0;
+    next_task_id = 1;
+    elided_lines = 0;
+    repr_cache.hits = 0;
+    repr_cache.misses = 0;
+    repr_cache.evictions = 0;
+    clock_gettime(CLOCK_MONOTONIC, &block_opened);
+
+    size_t capacity = w->capacity;
+    int err = filename ? 0 : ENOMEM;
+    writer_forget();
+    if (err == 0) {
+        err = writer_start(filename, capacity, w->flush_bytes, w->flush_interval,
+                           w->drop_when_full, w->compress_level,
+                           w->flight_events, w->flight_bytes,
+                           w->segment_bytes, w->segment_events, w->keep_segments);
+    }
+    if (err != 0) {
+        fprintf(stderr, "cdebugger: could not trace child process %ld to %s: %s\n",
+                (long)getpid(), filename ? filename : trace_root, strerror(err));
+        free(filename);
+        PyObject *result = stop_tracing(0);
+        Py_XDECREF(result);
+        PyErr_Clear();
+        return;
+    }
+
+    free(trace_filename);
+    trace_filename = filename;
+    // After fork() from C the parent is not listed yet
+    err = process_listed ? 0 : list_root_process(parent);
+    if (err == 0) {
+        err = list_process((long)getpid(), parent, fork_seq, filename);
+    }
+    if (err != 0) {
+        fprintf(stderr, "cdebugger: could not list child process %ld: %s\n",
+                (long)getpid(), strerror(err));
+    }
+    process_listed = 1;
+    if (previous_os_exit == NULL) {
+        install_os_exit_hook();
+    }
+    install_term_handler();
+    // The parent's checkpoints and inputs log are the parent's
+    forget_checkpoints();
+    next_checkpoint = execution_counter;
+    if (inputs_fd >= 0) {
+        inputs_forget();
+        err = inputs_open(filename);
+        if (err != 0) {
+            fprintf(stderr, "cdebugger: could not log the inputs of child process %ld: %s\n",
+                    (long)getpid(), strerror(err));
+        }
+    }
+}
+
+// os.register_at_fork hooks, registered once at import
+static PyObject*
+process_before_fork(PyObject *self, PyObject *args)
+{
+    if (!is_tracing || checkpoint_target >= 0) {
+        Py_RETURN_NONE;
+    }
+    if (!process_listed) {
+        int err = list_root_process((long)getpid());
+        if (err != 0) {
+            fprintf(stderr, "cdebugger: could not list process %ld: %s\n",
+                    (long)getpid(), strerror(err));
+        }
+        process_listed = 1;
+    }
+    writer_pause();
+    inputs_flush();
+    Py_RETURN_NONE;
+}
+
+static void
+after_fork_child(void)
+{
+    if (checkpoint_target >= 0) {
+        mute_runner();
+    } else if (is_tracing) {
+        trace_forked_child();
+    } else {
+        // Checkpoints left by stop_trace(live=True) end with the parent
+        forget_checkpoints();
+    }
+}
+
+static PyObject*
+process_after_fork_child(PyObject *self, PyObject *args)
+{
+    unseen_fork = 0;
+    after_fork_child();
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef process_before_fork_def = {
+    "_before_fork", process_before_fork, METH_NOARGS, NULL
+};
+
+static PyMethodDef process_after_fork_child_def = {
+    "_after_fork_child", process_after_fork_child, METH_NOARGS, NULL
+};
+
+// fork() called from C, by an extension or an embedding application,
+// skips os.register_at_fork: without this the child would go on recording
+// into the parent's ring and trace file. Runs in every child, but the
+// after_in_child hook clears unseen_fork again when Python forked, and the
+// recorder's own forks keep its state on purpose. Otherwise the writer
+// thread is gone and the writer's lock may have been held by it, so it is
+// made over here, and the child's first event starts its own trace as
+// after os.fork(). A child that never runs Python code writes nothing.
+static void
+note_fork_child(void)
+{
+    if (recorder_forking) {
+        return;
+    }
+    TraceWriter *w = &trace_writer;
+    w->thread_started = 0;
+    pthread_mutex_init(&w->mutex, NULL);
+    pthread_cond_init(&w->data_ready, NULL);
+    pthread_cond_init(&w->space_ready, NULL);
+    pthread_cond_init(&w->dump_done, NULL);
+    unseen_fork = 1;
+}
+
+// Returns -1 with an exception set on failure
+static int
+register_fork_hooks(void)
+{
+    int err = pthread_atfork(NULL, NULL, note_fork_child);
+    if (err != 0) {
+        errno = err;
+        PyErr_SetFromErrno(PyExc_OSError);
+        return -1;
+    }
+    PyObject *os = PyImport_ImportModule("os");
+    PyObject *before = os ? PyCFunction_New(&process_before_fork_def, NULL) : NULL;
+    PyObject *child = before ? PyCFunction_New(&process_after_fork_child_def, NULL) : NULL;
+    PyObject *register_at_fork = child ? PyObject_GetAttrString(os, "register_at_fork") : NULL;
+    PyObject *kwargs = register_at_fork ?
+        Py_BuildValue("{s:O,s:O}", "before", before, "after_in_child", child) : NULL;
+    PyObject *empty = kwargs ? PyTuple_New(0) : NULL;
+    PyObject *result = empty ? PyObject_Call(register_at_fork, empty, kwargs) : NULL;
+    Py_XDECREF(result);
+    Py_XDECREF(empty);
+    Py_XDECREF(kwargs);
+    Py_XDECREF(register_at_fork);
+    Py_XDECREF(child);
+    Py_XDECREF(before);
+    Py_XDECREF(os);
+    return result ? 0 : -1;
+}
+
+// start_trace() options, parsed and checked by parse_trace_options()
+typedef struct {
+    const char *filename;
+    const char *backend;
+    int keyframes;
+    Py_ssize_t buffer_size;
+    Py_ssize_t flush_bytes;
+    double flush_interval;
+    const char *backpressure;
+    Py_ssize_t repr_cache_size;
+    Py_ssize_t block_bytes;
+    int compress_level;
+    Py_ssize_t first;
+    Py_ssize_t every;
+    double rate;
+    Py_ssize_t flight_events;
+    Py_ssize_t flight_bytes;
+    int signum;
+    PyObject *include;
+    PyObject *exclude;
+    PyObject *functions;
+    int regions;
+    Py_ssize_t segment_bytes;
+    Py_ssize_t segment_events;
+    Py_ssize_t keep_segments;
+    PyObject *watch;
+    Py_ssize_t refresh;
+    Py_ssize_t checkpoint_every;
+    Py_ssize_t keep_checkpoints;
+    int record_inputs;
+    int variables;
+    int flight;
+    int segmented;
+} TraceOptions;
+
+// Returns -1 with an exception set if an option is invalid
+static int
+parse_trace_options(PyObject *args, PyObject *kwargs, TraceOptions *o)
+{
+    static char *kwlist[] = {"filename", "backend", "keyframe_interval", "buffer_size",
+                             "flush_bytes", "flush_interval", "backpressure",
+                             "repr_cache_size", "block_size", "compress_level",
+                             "sample_first", "sample_every", "sample_rate",
+                             "flight_events", "flight_bytes", "dump_signal",
+                             "include", "exclude", "functions", "regions",
+                             "segment_bytes", "segment_events", "keep_segments", "watch",
+                             "globals_refresh", "checkpoint_every", "keep_checkpoints",
+                             "record_inputs", "variables", NULL};
+    o->filename = NULL;
+    o->backend = "auto";
+    o->keyframes = DEFAULT_KEYFRAME_INTERVAL;
+    o->buffer_size = DEFAULT_BUFFER_SIZE;
+    o->flush_bytes = DEFAULT_FLUSH_BYTES;
+    o->flush_interval = DEFAULT_FLUSH_INTERVAL;
+    o->backpressure = "block";
+    o->repr_cache_size = DEFAULT_REPR_CACHE_SIZE;
+    o->block_bytes = DEFAULT_BLOCK_SIZE;
+    o->compress_level = DEFAULT_COMPRESS_LEVEL;
+    o->first = 0;
+    o->every = 1;
+    o->rate = 0;
+    o->flight_events = 0;
+    o->flight_bytes = 0;
+    o->signum = 0;
+    o->include = NULL;
+    o->exclude = NULL;
+    o->functions = NULL;
+    o->regions = 0;
+    o->segment_bytes = 0;
+    o->segment_events = 0;
+    o->keep_segments = 0;
+    o->watch = NULL;
+    o->refresh = 1;
+    o->checkpoint_every = 0;
+    o->keep_checkpoints = DEFAULT_KEEP_CHECKPOINTS;
+    o->record_inputs = 0;
+    o->variables = 1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s|sinndsnninndnniOOOpnnnOnnnpp", kwlist,
+                                     &o->filename, &o->backend, &o->keyframes, &o->buffer_size,
+                                     &o->flush_bytes, &o->flush_interval, &o->backpressure,
+                                     &o->repr_cache_size, &o->block_bytes, &o->compress_level,
+                                     &o->first, &o->every, &o->rate,
+                                     &o->flight_events, &o->flight_bytes, &o->signum,
+                                     &o->include, &o->exclude, &o->functions, &o->regions,
+                                     &o->segment_bytes, &o->segment_events, &o->keep_segments, &o->watch,
+                                     &o->refresh, &o->checkpoint_every, &o->keep_checkpoints,
+                                     &o->record_inputs, &o->variables)) {
+        return -1;
+    }
+
+    if (o->keyframes < 0) {
+        PyErr_SetString(PyExc_ValueError, "keyframe_interval must be >= 0");
+        return -1;
+    }
+    if (o->buffer_size < MIN_BUFFER_SIZE) {
+        PyErr_Format(PyExc_ValueError, "buffer_size must be at least %d", MIN_BUFFER_SIZE);
+        return -1;
+    }
+    if (o->flush_bytes < 0 || o->flush_interval < 0) {
+        PyErr_SetString(PyExc_ValueError, "flush_bytes and flush_interval must be >= 0");
+        return -1;
+    }
+    if (o->block_bytes < MIN_BLOCK_SIZE) {
+        PyErr_Format(PyExc_ValueError, "block_size must be at least %d", MIN_BLOCK_SIZE);
+        return -1;
+    }
+    if (o->compress_level < 0 || o->compress_level > 9) {
+        PyErr_SetString(PyExc_ValueError, "compress_level must be between 0 and 9");
+        return -1;
+    }
+    if (o->repr_cache_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "repr_cache_size must be >= 0");
+        return -1;
+    }
+    if (o->refresh < 1) {
+        PyErr_SetString(PyExc_ValueError, "globals_refresh must be >= 1");
+        return -1;
+    }
+    if (o->first < 0 || o->every < 1 || o->rate < 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "sample_first and sample_rate must be >= 0 and sample_every >= 1");
+        return -1;
+    }
+    if (o->flight_events < 0 || o->flight_bytes < 0) {
+        PyErr_SetString(PyExc_ValueError, "flight_events and flight_bytes must be >= 0");
+        return -1;
+    }
+    o->flight = o->flight_events > 0 || o->flight_bytes > 0;
+    if (o->signum != 0 && !o->flight) {
+        PyErr_SetString(PyExc_ValueError, "dump_signal requires flight_events or flight_bytes");
+        return -1;
+    }
+    if (o->segment_bytes < 0 || o->segment_events < 0 || o->keep_segments < 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "segment_bytes, segment_events and keep_segments must be >= 0");
+        return -1;
+    }
+    o->segmented = o->segment_bytes > 0 || o->segment_events > 0;
+    if (o->segmented && o->flight) {
+        PyErr_SetString(PyExc_ValueError, "A flight recorder trace cannot be segmented");
+        return -1;
+    }
+    if (o->keep_segments > 0 && !o->segmented) {
+        PyErr_SetString(PyExc_ValueError, "keep_segments requires segment_bytes or segment_events");
+        return -1;
+    }
+    if (o->checkpoint_every < 0 || o->keep_checkpoints < 1) {
+        PyErr_SetString(PyExc_ValueError, "checkpoint_every must be >= 0 and keep_checkpoints >= 1");
+        return -1;
+    }
+    if (o->record_inputs && o->checkpoint_every == 0) {
+        PyErr_SetString(PyExc_ValueError, "record_inputs requires checkpoint_every: only re-runs from checkpoints read the log");
+        return -1;
+    }
+#ifndef __linux__
+    if (o->checkpoint_every > 0) {
+        PyErr_SetString(PyExc_ValueError, "Checkpoints are only supported on Linux");
+        return -1;
+    }
+#endif
+    if (strcmp(o->backpressure, "block") != 0 && strcmp(o->backpressure, "drop") != 0) {
+        PyErr_Format(PyExc_ValueError,
+                     "Unknown backpressure '%s' (expected 'block' or 'drop')", o->backpressure);
+        return -1;
+    }
+    // A block that does not fit in the ring is only written once the ring
+    // is empty, so with "drop" nearly every block would be lost
+    if (strcmp(o->backpressure, "drop") == 0 && o->buffer_size < o->block_bytes) {
+        PyErr_SetString(PyExc_ValueError,
+                        "backpressure='drop' needs buffer_size to be at least block_size");
+        return -1;
+    }
+
+    // "auto" prefers sys.monitoring and falls back to settrace
+    if (strcmp(o->backend, "monitoring") == 0) {
+#ifndef HAVE_SYS_MONITORING
+        PyErr_SetString(PyExc_ValueError, "The monitoring backend requires Python 3.12 or newer");
+        return -1;
+#endif
+    } else if (strcmp(o->backend, "auto") != 0 && strcmp(o->backend, "settrace") != 0) {
+        PyErr_Format(PyExc_ValueError,
+                     "Unknown backend '%s' (expected 'auto', 'monitoring' or 'settrace')", o->backend);
+        return -1;
+    }
+    return 0;
+}
+
+// Start tracing
+static PyObject*
+start_trace(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    TraceOptions o;
+
+    if (parse_trace_options(args, kwargs, &o) < 0) {
+        return NULL;
+    }
+    if (is_tracing) {
+        PyErr_SetString(PyExc_RuntimeError, "Tracing already active");
+        return NULL;
+    }
+
+    if (scope_parse(o.include, &scope_include, "include") < 0 ||
+        scope_parse(o.exclude, &scope_exclude, "exclude") < 0 ||
+        scope_parse(o.functions, &scope_functions, "functions") < 0 ||
+        watch_parse(o.watch) < 0) {
+        scope_clear_all();
+        watch_clear();
+        return NULL;
+    }
+    if (o.signum != 0 && install_dump_signal(o.signum) < 0) {
+        scope_clear_all();
+        watch_clear();
+        return NULL;
+    }
+
+    int err = writer_start(o.filename, o.buffer_size, o.flush_bytes, o.flush_interval,
+                           strcmp(o.backpressure, "drop") == 0, o.compress_level,
+                           o.flight_events, o.flight_bytes,
+                           o.segment_bytes, o.segment_events, o.keep_segments);
+    if (err != 0) {
+        restore_dump_signal();
+        scope_clear_all();
+        watch_clear();
+        errno = err;
+        PyErr_SetFromErrnoWithFilename(PyExc_IOError, o.filename);
+        return NULL;
+    }
+
+    trace_filename = strdup(o.filename);
+    free(trace_root);
+    trace_root = strdup(o.filename);
+    process_listed = 0;
+    // Lists left by an earlier trace would name its children and
+    // checkpoints, and its inputs log would be replayed
+    size_t root_length = strlen(o.filename);
+    char *stale_list = (char *)malloc(root_length + 8);
+    if (stale_list != NULL) {
+        memcpy(stale_list, o.filename, root_length);
+        memcpy(stale_list + root_length, ".procs", 7);
+        unlink(stale_list);
+        memcpy(stale_list + root_length, ".ckpt", 6);
+        unlink(stale_list);
+        memcpy(stale_list + root_length, ".inputs", 8);
+        unlink(stale_list);
+        free(stale_list);
+    }
+    if (o.record_inputs && (err = inputs_open(o.filename)) != 0) {
+        writer_stop();
+        restore_dump_signal();
+        scope_clear_all();
+        watch_clear();
+        free(trace_filename);
+        trace_filename = NULL;
+        errno = err;
+        PyErr_SetFromErrnoWithFilename(PyExc_IOError, o.filename);
+        return NULL;
+    }
+    record_variables = o.variables;
+    // Checkpoints left by stop_trace(live=True) belong to the last trace
+    release_checkpoints();
+    checkpoint_every = o.checkpoint_every;
+    keep_checkpoints = o.keep_checkpoints;
+    next_checkpoint = 0;
+    globals_cache_clear();
+    globals_refresh = o.refresh;
+    trace_generation++;
+    execution_counter = 0;
+    keyframe_interval = o.keyframes;
+    next_frame_id = 0;
+    next_thread_id = 0;
+    next_task_id = 1;
+    repr_cache.capacity = o.repr_cache_size;
+    repr_cache.hits = 0;
+    repr_cache.misses = 0;
+    repr_cache.evictions = 0;
+    // A flight recorder drops whole events blocks, so keep them to about an
+    // eighth of what it holds
+    block_size = o.block_bytes;
+    if (o.flight_bytes > 0 && (size_t)o.flight_bytes / FLIGHT_BLOCKS < block_size) {
+        block_size = o.flight_bytes / FLIGHT_BLOCKS > MIN_BLOCK_SIZE ? o.flight_bytes / FLIGHT_BLOCKS : MIN_BLOCK_SIZE;
+    }
+    block_event_limit = o.flight_events > 0 ? (o.flight_events + FLIGHT_BLOCKS - 1) / FLIGHT_BLOCKS : 0;
+    // Segments end between events blocks, so no block may hold more
+    if (o.segment_events > 0 && (block_event_limit == 0 || (uint64_t)o.segment_events < block_event_limit)) {
+        block_event_limit = o.segment_events;
+    }
+    block_event_count = 0;
+    sample_first = o.first;
+    sample_every = o.every;
+    sample_rate = o.rate;
+    sampling = o.every > 1 || o.rate > 0;
+    elided_lines = 0;
+    regions_only = o.regions;
+    clock_gettime(CLOCK_MONOTONIC, &block_opened);
+    is_tracing = 1;
+    is_paused = 0;
+    step_mode = 0;
+
+    trace_backend = BACKEND_SETTRACE;
+#ifdef HAVE_SYS_MONITORING
+    if (strcmp(o.backend, "settrace") != 0) {
+        if (monitoring_start() == 0) {
+            trace_backend = BACKEND_MONITORING;
+        } else if (strcmp(o.backend, "monitoring") == 0) {
+            is_tracing = 0;
+            writer_stop();
+            inputs_close();
+            restore_dump_signal();
+            scope_clear_all();
+            watch_clear();
+            free(trace_filename);
+            trace_filename = NULL;
+            return NULL;
+        } else {
+            // Another tool owns the debugger id; fall back to settrace
+            PyErr_Clear();
+        }
+    }
+#endif
+
+    if (trace_backend == BACKEND_SETTRACE && settrace_start() < 0) {
+        is_tracing = 0;
+        writer_stop();
+        inputs_close();
+        restore_dump_signal();
+        scope_clear_all();
+        watch_clear();
+        free(trace_filename);
+        trace_filename = NULL;
+        return NULL;
+    }
+    if (o.record_inputs) {
+        install_input_hooks();
+    }
+
+    Py_RETURN_NONE;
+}
+
+// Stop tracing, leaving the checkpoints running if live is set
+static PyObject*
+stop_tracing(int live)
+{
+    if (!is_tracing) {
+        Py_RETURN_NONE;
+    }
+    if (checkpoint_connection >= 0) {
+        checkpoint_missed();
+    }
+
+#ifdef HAVE_SYS_MONITORING
+    if (trace_backend == BACKEND_MONITORING) {
+        monitoring_stop();
+    }
+#endif
+    if (trace_backend == BACKEND_SETTRACE) {
+        settrace_stop();
+    }
+    is_tracing = 0;
+    capture_window = 0;
+    restore_dump_signal();
+    restore_os_exit();
+    if (!live) {
+        release_checkpoints();
+    }
+    checkpoint_every = 0;
+    restore_input_hooks();
+    inputs_close();
+
+    seal_blocks();
+    buffer_free(&block_strings);
+    buffer_free(&block_events);
+    buffer_free(&block_watch);
 
-    // Get locals - force materialization
-    PyObject *locals = NULL;
-    PyObject *globals = NULL;
-
-    locals = PyEval_GetLocals();
-    globals = PyEval_GetGlobals();
+    int err;
+    Py_BEGIN_ALLOW_THREADS
+    err = writer_stop();
+    Py_END_ALLOW_THREADS
+    intern_clear();
+    buffer_free(&record_buffer);
+    free_recorder_threads();
+    task_table_clear();
+    free_frame_states();
+    repr_cache_clear();
+    globals_cache_clear();
+    scope_clear_all();
+    watch_clear();
 
-    if (locals == NULL) {
-        PyErr_Clear();
-        locals = PyDict_New();
-    } else {
-        Py_INCREF(locals);
+    if (err != 0) {
+        errno = err;
+        PyErr_SetFromErrnoWithFilename(PyExc_IOError, trace_filename);
     }
-//     COMPAT_Py_XDECREF_Code(code_obj);
-//    #else
-//        if (frame->f_locals == NULL) {
-            // Create the locals dict
-//            frame->f_locals = PyDict_New();
-//        }
 
-    if (globals == NULL) {
-        PyErr_Clear();
-        globals = PyDict_New();
-    } else {
-        Py_INCREF(globals);
+    if (trace_filename != NULL) {
+        free(trace_filename);
+        trace_filename = NULL;
     }
+    free(trace_root);
+    trace_root = NULL;
 
-    int locals_are_globals = locals == globals;
+    // Free trace history
+    free_trace_history();
 
-    // Write to trace file with properly initialized locals
-    fprintf(trace_file, "%ld|||%s|||%d|||%s|||",
-        execution_counter++, filename, lineno, source_line);
+    if (err != 0) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
 
-    int has_locals = write_variables(trace_file, locals, locals_are_globals);
-    write_globals(trace_file, globals, locals, has_locals);
-    fprintf(trace_file, "\n");
-    fflush(trace_file);
+// Write the flight recorder's events to a trace file now
+static PyObject*
+dump_trace(PyObject *self, PyObject *args)
+{
+    const char *filename = NULL;
 
-    // Add to trace history for step back
-    // Build variables string
-    char var_buffer[4096] = {0};
-    if (locals && PyDict_Check(locals)) {
-        PyObject *key, *value;
-        Py_ssize_t pos = 0;
-        int first = 1;
+    if (!PyArg_ParseTuple(args, "|z", &filename)) {
+        return NULL;
+    }
+    if (!is_tracing || !trace_writer.flight) {
+        PyErr_SetString(PyExc_RuntimeError, "No flight recorder trace active");
+        return NULL;
+    }
+    if (filename == NULL) {
+        filename = trace_filename;
+    }
 
-        while (PyDict_Next(locals, &pos, &key, &value) && strlen(var_buffer) < 3900) {
-            const char *var_name = PyUnicode_AsUTF8(key);
-            if (var_name == NULL) {
-                PyErr_Clear();
-                continue;
-            }
-            if (should_skip_local_variable(var_name, value, locals_are_globals)) {
-                continue;
-            }
+    int err = flight_dump_now(filename);
+    if (err != 0) {
+        errno = err;
+        PyErr_SetFromErrnoWithFilename(PyExc_IOError, filename);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
 
-            if (!first) {
-                append_buffer(var_buffer, sizeof(var_buffer), "; ");
-            }
-            first = 0;
+// Armed tracing. arm_trace() keeps a trace's options but installs no hook,
+// so the program runs at full speed. trigger_trace() or the arm signal
+// starts a capture, a trace of its own (filename.1, filename.2, ...), that
+// removes its hooks again when its window ends.
+static char *armed_filename = NULL;
+static PyObject *armed_options = NULL;     // start_trace() keyword arguments
+static long armed_events = 0;
+static double armed_seconds = 0;
+static int arm_signal = 0;
+static PyObject *previous_arm_handler = NULL;
+static unsigned long capture_count = 0;
 
-            append_buffer(var_buffer, sizeof(var_buffer), var_name);
-            append_buffer(var_buffer, sizeof(var_buffer), "=");
-            append_repr(var_buffer, sizeof(var_buffer), value);
-        }
+// Start the next capture and return its filename
+static PyObject*
+start_capture(void)
+{
+    PyObject *filename = PyUnicode_FromFormat("%s.%lu", armed_filename, capture_count + 1);
+    PyObject *start_args = filename ? PyTuple_Pack(1, filename) : NULL;
+    PyObject *result = start_args ? start_trace(NULL, start_args, armed_options) : NULL;
+    Py_XDECREF(start_args);
+    if (result == NULL) {
+        Py_XDECREF(filename);
+        return NULL;
     }
+    Py_DECREF(result);
+    capture_count++;
+    capture_events = armed_events;
+    capture_seconds = armed_seconds;
+    clock_gettime(CLOCK_MONOTONIC, &capture_started);
+    capture_window = 1;
+    return filename;
+}
 
-//    if (globals && PyDict_Check(globals)) {
-//        PyObject *key, *value;
-//        Py_ssize_t pos = 0;
-
-//        while (PyDict_Next(globals, &pos, &key, &value) && strlen(var_buffer) < 3900) {
-//            const char *var_name = PyUnicode_AsUTF8(key);
-//            if(var_name) {
-//                strcat(var_buffer, var_name);
-//                strcat(var_buffer, "=");
-//
-//                PyObject *repr = PyObject_Repr(value);
-//               if(repr) {
-//                    const char *var_value = PyUnicode_AsUTF8(repr);
-//                    if (var_value) {
-//                        strncat(var_buffer, var_value, 100);
-//                    }
-//                    Py_XDECREF(repr);
-//                }
-//           }
-//        }
-//    }
+// Called from the recorder at the first line after the window
+static void
+close_capture_window(void)
+{
+    capture_window = 0;
+    PyObject *result = stop_tracing(0);
+    if (result == NULL) {
+        PyErr_WriteUnraisable(NULL);
+    }
+    Py_XDECREF(result);
+}
 
-    add_trace_entry(filename, lineno, source_line, var_buffer);
+// Like the dump signal, the arm signal runs between bytecodes in the main
+// thread. It is ignored while a trace is running.
+static PyObject*
+arm_signal_handler(PyObject *self, PyObject *args)
+{
+    if (!is_tracing && armed_options != NULL) {
+        PyObject *filename = start_capture();
+        if (filename == NULL) {
+            PyErr_WriteUnraisable(NULL);
+        }
+        Py_XDECREF(filename);
+    }
+    if (previous_arm_handler != NULL && PyCallable_Check(previous_arm_handler)) {
+        return PyObject_Call(previous_arm_handler, args, NULL);
+    }
+    Py_RETURN_NONE;
+}
 
-    free(source_line);
-    Py_XDECREF(locals);
-    Py_XDECREF(globals);
+static PyMethodDef arm_signal_handler_def = {
+    "_arm_signal_handler", arm_signal_handler, METH_VARARGS, NULL
+};
 
-    return 0;
+// Remove an arm_trace() option from options into *value (NULL if absent)
+static int
+take_option(PyObject *options, const char *name, PyObject **value)
+{
+    PyObject *key = PyUnicode_FromString(name);
+    if (key == NULL) {
+        return -1;
+    }
+    *value = PyDict_GetItemWithError(options, key);
+    Py_XINCREF(*value);
+    int err = *value != NULL ? PyDict_DelItem(options, key) : (PyErr_Occurred() ? -1 : 0);
+    Py_DECREF(key);
+    return err;
 }
 
-// Start tracing
 static PyObject*
-start_trace(PyObject *self, PyObject *args)
+arm_trace(PyObject *self, PyObject *args, PyObject *kwargs)
 {
     const char *filename = NULL;
 
-    if (!PyArg_ParseTuple(args, "s", &filename)) {
+    if (!PyArg_ParseTuple(args, "s:arm_trace", &filename)) {
+        return NULL;
+    }
+    if (armed_options != NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Tracing already armed");
         return NULL;
     }
-
     if (is_tracing) {
         PyErr_SetString(PyExc_RuntimeError, "Tracing already active");
         return NULL;
     }
 
-    trace_file = fopen(filename, "w");
-    if (trace_file == NULL) {
-        PyErr_SetString(PyExc_IOError, "Cannot open trace file");
-        return NULL;
+    // events, seconds and signal are arm_trace()'s own; the rest are for
+    // start_trace()
+    PyObject *options = kwargs ? PyDict_Copy(kwargs) : PyDict_New();
+    PyObject *events_arg = NULL, *seconds_arg = NULL, *signal_arg = NULL;
+    if (options == NULL || take_option(options, "events", &events_arg) < 0 ||
+        take_option(options, "seconds", &seconds_arg) < 0 ||
+        take_option(options, "signal", &signal_arg) < 0) {
+        goto error;
+    }
+    long events = events_arg ? PyLong_AsLong(events_arg) : 0;
+    double seconds = seconds_arg ? PyFloat_AsDouble(seconds_arg) : 0;
+    int signum = signal_arg ? (int)PyLong_AsLong(signal_arg) : 0;
+    if (PyErr_Occurred()) {
+        goto error;
+    }
+    if (events < 0 || seconds < 0) {
+        PyErr_SetString(PyExc_ValueError, "events and seconds must be >= 0");
+        goto error;
+    }
+    if (events == 0 && seconds == 0) {
+        PyErr_SetString(PyExc_ValueError, "arm_trace needs events or seconds to end a capture");
+        goto error;
+    }
+    // Bad options fail now rather than when a capture starts
+    TraceOptions checked;
+    if (parse_trace_options(args, options, &checked) < 0) {
+        goto error;
+    }
+    if (signum != 0 && install_signal_handler(signum, &arm_signal_handler_def, &previous_arm_handler) < 0) {
+        goto error;
     }
 
-    fprintf(trace_file, "EXECUTION_ORDER|||FILENAME|||LINE_NUMBER|||CODE|||VARIABLES\n");
-    fflush(trace_file);
+    armed_filename = strdup(filename);
+    armed_options = options;
+    armed_events = events;
+    armed_seconds = seconds;
+    arm_signal = signum;
+    Py_XDECREF(events_arg);
+    Py_XDECREF(seconds_arg);
+    Py_XDECREF(signal_arg);
+    Py_RETURN_NONE;
 
-    trace_filename = strdup(filename);
-    execution_counter = 0;
-    is_tracing = 1;
-    is_paused = 0;
-    step_mode = 0;
+error:
+    Py_XDECREF(options);
+    Py_XDECREF(events_arg);
+    Py_XDECREF(seconds_arg);
+    Py_XDECREF(signal_arg);
+    return NULL;
+}
 
-    PyEval_SetTrace((Py_tracefunc)trace_callback, NULL);
+static PyObject*
+trigger_trace(PyObject *self, PyObject *args)
+{
+    if (armed_options == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Tracing is not armed");
+        return NULL;
+    }
+    return start_capture();
+}
 
+// Stop a running capture and forget the armed trace
+static PyObject*
+disarm_trace(PyObject *self, PyObject *args)
+{
+    if (armed_options == NULL) {
+        Py_RETURN_NONE;
+    }
+    if (arm_signal != 0) {
+        restore_signal_handler(arm_signal, &previous_arm_handler);
+        arm_signal = 0;
+    }
+    Py_CLEAR(armed_options);
+    free(armed_filename);
+    armed_filename = NULL;
+    if (capture_window) {
+        return stop_tracing(0);
+    }
     Py_RETURN_NONE;
 }
 
-// Stop tracing
+// Enter and leave a recording region on the current thread. leave_region()
+// ignores regions entered in an earlier trace session.
+static unsigned long
+enter_region(void)
+{
+    if (region_generation != trace_generation) {
+        region_generation = trace_generation;
+        region_depth = 0;
+    }
+    region_depth++;
+    return trace_generation;
+}
+
+static void
+leave_region(unsigned long generation)
+{
+    if (region_generation == generation && region_depth > 0) {
+        region_depth--;
+    }
+}
+
+// record(filename=None, **options): context manager around a recording
+// region. With a filename it also starts a trace with the given start_trace()
+// options on entry and stops it on exit.
+typedef struct {
+    PyObject_HEAD
+    PyObject *filename;
+    PyObject *options;
+    int started;
+    unsigned long generation;
+} RecordObject;
+
 static PyObject*
-stop_trace(PyObject *self, PyObject *args)
+record_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
 {
-    if (!is_tracing) {
-        Py_RETURN_NONE;
+    PyObject *filename = Py_None;
+
+    if (!PyArg_ParseTuple(args, "|O:record", &filename)) {
+        return NULL;
+    }
+    if (filename == Py_None && kwargs != NULL && PyDict_GET_SIZE(kwargs) > 0) {
+        PyErr_SetString(PyExc_TypeError, "record() options need a filename");
+        return NULL;
     }
 
-    PyEval_SetTrace(NULL, NULL);
-    is_tracing = 0;
+    RecordObject *self = (RecordObject *)type->tp_alloc(type, 0);
+    if (self == NULL) {
+        return NULL;
+    }
+    self->filename = Py_NewRef(filename);
+    self->options = kwargs ? PyDict_Copy(kwargs) : PyDict_New();
+    if (self->options == NULL) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    return (PyObject *)self;
+}
+
+static void
+record_dealloc(RecordObject *self)
+{
+    Py_XDECREF(self->filename);
+    Py_XDECREF(self->options);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
 
-    if (trace_file != NULL) {
-        fclose(trace_file);
-        trace_file = NULL;
+static PyObject*
+record_enter(RecordObject *self, PyObject *args)
+{
+    if (self->filename != Py_None) {
+        PyObject *start_args = PyTuple_Pack(1, self->filename);
+        if (start_args == NULL) {
+            return NULL;
+        }
+        PyObject *result = start_trace(NULL, start_args, self->options);
+        Py_DECREF(start_args);
+        if (result == NULL) {
+            return NULL;
+        }
+        Py_DECREF(result);
+        self->started = 1;
     }
+    self->generation = enter_region();
+    return Py_NewRef(self);
+}
 
-    if (trace_filename != NULL) {
-        free(trace_filename);
-        trace_filename = NULL;
+static PyObject*
+record_exit(RecordObject *self, PyObject *args)
+{
+    leave_region(self->generation);
+    if (self->started) {
+        self->started = 0;
+        PyObject *result = stop_tracing(0);
+        if (result == NULL) {
+            return NULL;
+        }
+        Py_DECREF(result);
     }
+    Py_RETURN_FALSE;
+}
 
-    // Free trace history
-    free_trace_history();
+static PyMethodDef record_methods[] = {
+    {"__enter__", (PyCFunction)record_enter, METH_NOARGS, NULL},
+    {"__exit__", (PyCFunction)record_exit, METH_VARARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
 
-    Py_RETURN_NONE;
+static PyTypeObject RecordType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "cdebugger.record",
+    .tp_basicsize = sizeof(RecordObject),
+    .tp_dealloc = (destructor)record_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "record(filename=None, **options)\n"
+              "Context manager that records the lines run inside it when the trace was\n"
+              "started with regions=True. With a filename, also starts a trace with the\n"
+              "given start_trace() options on entry and stops it on exit.",
+    .tp_methods = record_methods,
+    .tp_new = record_new,
+};
+
+// recorded(func): wrapper that runs every call of func inside a region
+typedef struct {
+    PyObject_HEAD
+    PyObject *func;
+    PyObject *dict;             // __name__, __doc__, __wrapped__... from update_wrapper
+} RecordedObject;
+
+static void
+recorded_dealloc(RecordedObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    Py_CLEAR(self->func);
+    Py_CLEAR(self->dict);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static int
+recorded_traverse(RecordedObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->func);
+    Py_VISIT(self->dict);
+    return 0;
+}
+
+static int
+recorded_clear(RecordedObject *self)
+{
+    Py_CLEAR(self->func);
+    Py_CLEAR(self->dict);
+    return 0;
+}
+
+static PyObject*
+recorded_call(RecordedObject *self, PyObject *args, PyObject *kwargs)
+{
+    unsigned long generation = enter_region();
+    PyObject *result = PyObject_Call(self->func, args, kwargs);
+    leave_region(generation);
+    return result;
+}
+
+// Bind like a function, so decorated methods get self
+static PyObject*
+recorded_get(PyObject *self, PyObject *obj, PyObject *type)
+{
+    if (obj == NULL || obj == Py_None) {
+        return Py_NewRef(self);
+    }
+    return PyMethod_New(self, obj);
+}
+
+static PyGetSetDef recorded_getset[] = {
+    {"__dict__", PyObject_GenericGetDict, PyObject_GenericSetDict, NULL, NULL},
+    {NULL, NULL, NULL, NULL, NULL}
+};
+
+static PyTypeObject RecordedType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "cdebugger.recorded",
+    .tp_basicsize = sizeof(RecordedObject),
+    .tp_dealloc = (destructor)recorded_dealloc,
+    .tp_call = (ternaryfunc)recorded_call,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_traverse = (traverseproc)recorded_traverse,
+    .tp_clear = (inquiry)recorded_clear,
+    .tp_getset = recorded_getset,
+    .tp_descr_get = recorded_get,
+    .tp_dictoffset = offsetof(RecordedObject, dict),
+};
+
+static PyObject*
+recorded(PyObject *self, PyObject *func)
+{
+    if (!PyCallable_Check(func)) {
+        PyErr_SetString(PyExc_TypeError, "recorded() argument must be callable");
+        return NULL;
+    }
+    RecordedObject *wrapper = PyObject_GC_New(RecordedObject, &RecordedType);
+    if (wrapper == NULL) {
+        return NULL;
+    }
+    wrapper->func = Py_NewRef(func);
+    wrapper->dict = NULL;
+    PyObject_GC_Track(wrapper);
+
+    PyObject *functools = PyImport_ImportModule("functools");
+    PyObject *result = functools ?
+        PyObject_CallMethod(functools, "update_wrapper", "OO", wrapper, func) : NULL;
+    Py_XDECREF(functools);
+    if (result == NULL) {
+        Py_DECREF(wrapper);
+        return NULL;
+    }
+    Py_DECREF(result);
+    return (PyObject *)wrapper;
+}
+
+// Recorder statistics of the current or last trace
+static PyObject*
+get_stats(PyObject *self, PyObject *args)
+{
+    ReprCache *cache = &repr_cache;
+    uint64_t lookups = cache->hits + cache->misses;
+
+    // The writer thread opens segments as it writes the blocks, so hand it
+    // the open block and wait for it, and segments counts every event so far
+    if (is_tracing && trace_writer.manifest != NULL) {
+        seal_blocks();
+        writer_sync();
+    }
+    return Py_BuildValue("{s:l,s:K,s:K,s:K,s:K,s:K,s:K,s:K,s:K,s:K,s:K,s:K,s:K,s:K,s:d,s:n,s:n}",
+                         "events", execution_counter,
+                         "elided_events", (unsigned long long)elided_lines,
+                         "threads", (unsigned long long)next_thread_id,
+                         "tasks", (unsigned long long)(next_task_id - 1),
+                         "dropped_events", (unsigned long long)trace_writer.dropped_events,
+                         "bytes_written", (unsigned long long)atomic_load(&trace_writer.bytes_written),
+                         "raw_bytes", (unsigned long long)atomic_load(&trace_writer.raw_bytes),
+                         "dumps", (unsigned long long)trace_writer.dumps_done,
+                         "segments", (unsigned long long)trace_writer.segments_started,
+                         "captures", (unsigned long long)capture_count,
+                         "inputs", (unsigned long long)inputs_logged,
+                         "repr_cache_hits", (unsigned long long)cache->hits,
+                         "repr_cache_misses", (unsigned long long)cache->misses,
+                         "repr_cache_evictions", (unsigned long long)cache->evictions,
+                         "repr_cache_hit_rate", lookups ? (double)cache->hits / lookups : 0.0,
+                         "repr_cache_entries", cache->count,
+                         "repr_cache_bytes", (Py_ssize_t)(cache->bytes + cache->count * sizeof(ReprCacheEntry) +
+                                                          cache->bucket_count * sizeof(ReprCacheEntry *)));
 }
 
 // Set breakpoint
 static PyObject*
-set_breakpoint(PyObject *self, PyObject *args)
+set_breakpoint(PyObject *self, PyObject *args, PyObject *kwargs)
 {
+    static char *kwlist[] = {"filename", "lineno", "condition", "hits", NULL};
     const char *filename;
     int lineno;
+    const char *condition_text = NULL;
+    long hits = 0;
 
-    if (!PyArg_ParseTuple(args, "si", &filename, &lineno)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "si|zl", kwlist,
+                                     &filename, &lineno, &condition_text, &hits)) {
+        return NULL;
+    }
+    if (hits < 0) {
+        PyErr_SetString(PyExc_ValueError, "hits must be >= 0");
         return NULL;
     }
 
-    if (add_breakpoint(filename, lineno)) {
-        printf("✓ Breakpoint set at %s:%d\n", filename, lineno);
+    // Compile once; the code runs only when the location is hit
+    PyObject *condition = NULL;
+    if (condition_text != NULL) {
+        condition = Py_CompileString(condition_text, "<breakpoint condition>", Py_eval_input);
+        if (condition == NULL) {
+            return NULL;
+        }
+    }
+
+    if (add_breakpoint(filename, lineno, condition_text, condition, hits)) {
+        printf("✓ Breakpoint set at %s:%d", filename, lineno);
+        if (hits > 1) {
+            printf(" hits>=%ld", hits);
+        }
+        if (condition_text != NULL) {
+            printf(" if %s", condition_text);
+        }
+        printf("\n");
         Py_RETURN_TRUE;
     } else {
         PyErr_SetString(PyExc_RuntimeError, "Failed to set breakpoint");
@@ -803,14 +7253,40 @@ clear_breakpoints(PyObject *self, PyObject *args)
     while (bp != NULL) {
         Breakpoint *next = bp->next;
         free(bp->filename);
+        free(bp->condition_text);
+        Py_XDECREF(bp->condition);
         free(bp);
         bp = next;
     }
     breakpoints = NULL;
+    breakpoint_generation++;
 
     Py_RETURN_NONE;
 }
 
+// Stop tracing
+static PyObject*
+stop_trace(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"live", NULL};
+    int live = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|p", kwlist, &live)) {
+        return NULL;
+    }
+    return stop_tracing(live);
+}
+
+// Kill the checkpoints left by stop_trace(live=True)
+static PyObject*
+kill_checkpoints(PyObject *self, PyObject *args)
+{
+    if (!is_tracing) {
+        release_checkpoints();
+    }
+    Py_RETURN_NONE;
+}
+
 // Get trace filename
 static PyObject*
 get_trace_filename(PyObject *self, PyObject *args)
@@ -821,13 +7297,56 @@ get_trace_filename(PyObject *self, PyObject *args)
     return PyUnicode_FromString(trace_filename);
 }
 
+// Get the active recording backend
+static PyObject*
+get_backend(PyObject *self, PyObject *args)
+{
+    if (!is_tracing) {
+        Py_RETURN_NONE;
+    }
+    return PyUnicode_FromString(trace_backend == BACKEND_MONITORING ? "monitoring" : "settrace");
+}
+
 // Module methods
 static PyMethodDef DebuggerMethods[] = {
-    {"start_trace", start_trace, METH_VARARGS, "Start tracing to file"},
-    {"stop_trace", stop_trace, METH_NOARGS, "Stop tracing"},
-    {"set_breakpoint", set_breakpoint, METH_VARARGS, "Set a breakpoint at file:line"},
+    {"start_trace", (PyCFunction)(void(*)(void))start_trace, METH_VARARGS | METH_KEYWORDS,
+     "start_trace(filename, **options)\n"
+     "Start tracing to file; README.md lists the options"},
+    {"stop_trace", (PyCFunction)(void(*)(void))stop_trace, METH_VARARGS | METH_KEYWORDS,
+     "stop_trace(live=False)\n"
+     "Stop tracing. The trace's checkpoints are killed, unless live is true: then they\n"
+     "stay for traceviewer's live command until kill_checkpoints() is called or this\n"
+     "process exits."},
+    {"kill_checkpoints", kill_checkpoints, METH_NOARGS,
+     "Kill the checkpoints left by stop_trace(live=True)"},
+    {"set_breakpoint", (PyCFunction)(void(*)(void))set_breakpoint, METH_VARARGS | METH_KEYWORDS,
+     "set_breakpoint(filename, lineno, condition=None, hits=0)\n"
+     "Set a breakpoint at file:line. It stops from its hits-th hit on, and only when\n"
+     "the condition expression is true in the frame. Every time the line runs is a\n"
+     "hit, whether or not the condition holds, and the condition is not evaluated\n"
+     "for the hits before."},
     {"clear_breakpoints", clear_breakpoints, METH_NOARGS, "Clear all breakpoints"},
     {"get_trace_filename", get_trace_filename, METH_NOARGS, "Get trace filename"},
+    {"get_backend", get_backend, METH_NOARGS, "Get the active recording backend"},
+    {"get_stats", get_stats, METH_NOARGS, "Get recorder statistics of the current or last trace"},
+    {"recorded", recorded, METH_O,
+     "recorded(func)\n"
+     "Decorator that records every call of func when the trace was started with\n"
+     "regions=True. Generators and coroutines are only recorded up to their creation."},
+    {"dump_trace", dump_trace, METH_VARARGS,
+     "dump_trace(filename=None)\n"
+     "Write the flight recorder's events to filename (default: the trace file)"},
+    {"arm_trace", (PyCFunction)(void(*)(void))arm_trace, METH_VARARGS | METH_KEYWORDS,
+     "arm_trace(filename, events=0, seconds=0, signal=0, **options)\n"
+     "Get ready to trace without installing any hook. trigger_trace(), or the signal\n"
+     "signal when given, starts a capture: a trace to filename.1, filename.2, ...\n"
+     "with the given start_trace() options, on every thread, that stops itself after\n"
+     "events lines or seconds seconds, whichever comes first. Signals that arrive\n"
+     "while a capture is running are ignored."},
+    {"trigger_trace", trigger_trace, METH_NOARGS,
+     "Start a capture of the armed trace now and return its filename"},
+    {"disarm_trace", disarm_trace, METH_NOARGS,
+     "Stop a running capture and forget the armed trace"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -844,5 +7363,31 @@ static struct PyModuleDef debuggermodule = {
 PyMODINIT_FUNC
 PyInit_cdebugger(void)
 {
-    return PyModule_Create(&debuggermodule);
+    if (code_extra_index < 0) {
+        code_extra_index = COMPAT_RequestCodeExtraIndex(free_code_info);
+        if (code_extra_index < 0) {
+            PyErr_SetString(PyExc_ImportError, "cdebugger: no free code object extra slot");
+            return NULL;
+        }
+        atexit(writer_atexit);
+        if (register_fork_hooks() < 0) {
+            return NULL;
+        }
+    }
+    if (PyType_Ready(&RecordType) < 0 || PyType_Ready(&RecordedType) < 0 ||
+        PyType_Ready(&InputFileType) < 0) {
+        return NULL;
+    }
+
+    PyObject *module = PyModule_Create(&debuggermodule);
+    if (module == NULL) {
+        return NULL;
+    }
+    Py_INCREF(&RecordType);
+    if (PyModule_AddObject(module, "record", (PyObject *)&RecordType) < 0) {
+        Py_DECREF(&RecordType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
 }
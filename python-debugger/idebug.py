@@ -12,6 +12,7 @@ import subprocess
 import cmd
 import readline
 import atexit
+import re
 
 
 # ANSI color codes for consistent styling
@@ -43,11 +44,14 @@ Set breakpoints and watchpoints before running your program.
 \033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m
 \033[1;32mBreakpoints:\033[0m
   \033[1mb <file> <line>\033[0m      - Set a breakpoint (long: \033[1;32mbreak\033[0m)
+      \033[1m[hits>=N] [if <expr>]\033[0m  Stop from the Nth hit on, only when <expr> is true
+                             Every run of the line is a hit, true <expr> or not
   \033[1mlist\033[0m                 - List all breakpoints (short: \033[1;32ml\033[0m)
   \033[1mclear [num]\033[0m          - Clear breakpoint(s)
 
 \033[1;32mWatchpoints:\033[0m
   \033[1mw <var>\033[0m              - Watch variable (read/write)
+  \033[1mw <expr>\033[0m             - Record an expression and stop where it changes
   \033[1mrw <var>\033[0m             - Watch variable (read only)
   \033[1mww <var>\033[0m             - Watch variable (write only)
   \033[1mlistw\033[0m                - List all watchpoints
@@ -57,6 +61,8 @@ Set breakpoints and watchpoints before running your program.
   \033[1mshow [file]\033[0m          - Show file with line numbers
 
 \033[1;32mExecution:\033[0m
+  \033[1mflight [n|off]\033[0m       - Keep only the last n events, saved if the program raises
+  \033[1mcheckpoint [n|off]\033[0m   - Checkpoint every n lines, for the viewer's live command
   \033[1mrun\033[0m                  - Start execution (short: \033[1;32mr\033[0m)
   \033[1mhelp\033[0m                 - Show this help
   \033[1mquit\033[0m or \033[1mq\033[0m           - Exit without running
@@ -64,7 +70,9 @@ Set breakpoints and watchpoints before running your program.
 
 \033[1;33mExample:\033[0m
   > b test.py 25
+  > b test.py 40 if balance < 0
   > w counter
+  > w len(queue)
   > ww result
   > list
   > run
@@ -79,8 +87,10 @@ Set breakpoints and watchpoints before running your program.
             self.prompt = "> "
         self.python_file = python_file
         self.trace_file = trace_file
-        self.breakpoints = []  # List of (file, line) tuples
+        self.breakpoints = []  # List of (file, line, condition, hits) tuples
         self.watchpoints = []  # List of (variable, type) tuples
+        self.flight_events = 0  # Flight recorder size, 0 = record everything
+        self.checkpoint_every = 0  # Lines between checkpoints, 0 = none
         self.should_run = False
         self.last_command = None
 
@@ -153,30 +163,35 @@ Set breakpoints and watchpoints before running your program.
     # ── Breakpoints ───────────────────────────────────────────────────────────
 
     def do_break(self, arg):
-        """Set a breakpoint: break <file> <line>"""
+        """Set a breakpoint: break <file> <line> [hits>=N] [if <expr>]"""
         try:
-            parts = arg.split()
-            if len(parts) != 2:
-                print("\033[1;31mUsage:\033[0m break <file> <line>")
+            try:
+                parsed = parse_breakpoint(arg)
+            except SyntaxError as e:
+                print(f"\033[1;31mError:\033[0m Invalid condition: {e.msg}")
+                return
+            if parsed is None:
+                print("\033[1;31mUsage:\033[0m break <file> <line> [hits>=N] [if <expr>]")
                 print("\033[1;33mExample:\033[0m break test.py 25")
+                print("\033[1;33mExample:\033[0m break bank.py 40 hits>=50000 if balance < 0")
                 return
-            filename = parts[0]
-            line = int(parts[1])
+            filename, line, condition, hits = parsed
             if not os.path.exists(filename):
                 print(f"\033[1;31m⚠ Warning:\033[0m File '{filename}' not found")
                 response = input("Set breakpoint anyway? (y/n): ")
                 if response.lower() != "y":
                     return
             abs_filename = os.path.abspath(filename)
-            if (abs_filename, line) in self.breakpoints:
+            bp = (abs_filename, line, condition, hits)
+            if bp in self.breakpoints:
                 print(
-                    f"\033[1;33m⚠ Breakpoint already set at\033[0m {abs_filename}:{line}"
+                    f"\033[1;33m⚠ Breakpoint already set at\033[0m {describe_breakpoint(bp)}"
                 )
                 return
-            self.breakpoints.append((abs_filename, line))
-            print(f"\033[1;32m✓ Breakpoint set at\033[0m {abs_filename}:{line}")
+            self.breakpoints.append(bp)
+            print(f"\033[1;32m✓ Breakpoint set at\033[0m {describe_breakpoint(bp)}")
         except ValueError:
-            print("\033[1;31mError:\033[0m Line number must be an integer")
+            print("\033[1;31mError:\033[0m Line number and hit count must be integers")
         except Exception as e:
             print(f"\033[1;31mError:\033[0m {e}")
 
@@ -196,8 +211,8 @@ Set breakpoints and watchpoints before running your program.
         print(
             "\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m"
         )
-        for i, (file, line) in enumerate(self.breakpoints, 1):
-            print(f"  \033[1;32m{i}.\033[0m {file}:{line}")
+        for i, bp in enumerate(self.breakpoints, 1):
+            print(f"  \033[1;32m{i}.\033[0m {describe_breakpoint(bp)}")
         print(
             "\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m"
         )
@@ -220,7 +235,7 @@ Set breakpoints and watchpoints before running your program.
             num = int(arg)
             if 1 <= num <= len(self.breakpoints):
                 bp = self.breakpoints.pop(num - 1)
-                print(f"\033[1;32m✓ Cleared breakpoint at\033[0m {bp[0]}:{bp[1]}")
+                print(f"\033[1;32m✓ Cleared breakpoint at\033[0m {describe_breakpoint(bp)}")
             else:
                 print(f"\033[1;31mError:\033[0m Breakpoint {num} doesn't exist")
         except ValueError:
@@ -241,12 +256,19 @@ Set breakpoints and watchpoints before running your program.
         return True
 
     def do_w(self, arg):
-        """Set a read/write watchpoint: w <variable>"""
+        """Set a read/write watchpoint: w <variable>, or watch an expression: w <expr>"""
         var = arg.strip()
         if not var:
-            print("\033[1;31mUsage:\033[0m w <variable>")
+            print("\033[1;31mUsage:\033[0m w <variable|expression>")
             print("\033[1;33mExample:\033[0m w counter")
             return
+        # Anything but a plain name is recorded as a watch expression
+        if not var.isidentifier():
+            try:
+                compile(var, "<watch>", "eval")
+            except SyntaxError as e:
+                print(f"\033[1;31m✗ Invalid watch expression:\033[0m {e.msg}")
+                return
         self._add_watchpoint(var, WATCHPOINT_BOTH)
 
     def do_rw(self, arg):
@@ -330,7 +352,7 @@ Set breakpoints and watchpoints before running your program.
                 lines = f.readlines()
             arg_abs = os.path.abspath(arg)
             bp_lines = set()
-            for file, line in self.breakpoints:
+            for file, line, _, _ in self.breakpoints:
                 if os.path.abspath(file) == arg_abs:
                     bp_lines.add(line)
             for i, line in enumerate(lines, 1):
@@ -348,6 +370,59 @@ Set breakpoints and watchpoints before running your program.
 
     # ── Execution ─────────────────────────────────────────────────────────────
 
+    def do_flight(self, arg):
+        """Keep only the last n events in memory: flight [n|off]"""
+        if not arg:
+            if self.flight_events:
+                print(f"Flight recorder: last \033[1m{self.flight_events}\033[0m events")
+            else:
+                print("Flight recorder: \033[1moff\033[0m (every event is recorded)")
+            return
+        if arg.strip() == "off":
+            self.flight_events = 0
+            print("\033[1;32m✓ Flight recorder off\033[0m")
+            return
+        try:
+            events = int(arg)
+            if events <= 0:
+                raise ValueError
+        except ValueError:
+            print("\033[1;31mUsage:\033[0m flight [n|off]  (n > 0)")
+            return
+        self.flight_events = events
+        print(
+            f"\033[1;32m✓ Flight recorder:\033[0m last {events} events, "
+            f"written only if the program raises"
+        )
+
+    def do_checkpoint(self, arg):
+        """Fork a paused checkpoint of the program every n lines: checkpoint [n|off]"""
+        if not arg:
+            if self.checkpoint_every:
+                print(f"Checkpoints: every \033[1m{self.checkpoint_every}\033[0m lines")
+            else:
+                print("Checkpoints: \033[1moff\033[0m")
+            return
+        if arg.strip() == "off":
+            self.checkpoint_every = 0
+            print("\033[1;32m✓ Checkpoints off\033[0m")
+            return
+        if not sys.platform.startswith("linux"):
+            print("\033[1;31mCheckpoints are only supported on Linux\033[0m")
+            return
+        try:
+            lines = int(arg)
+            if lines <= 0:
+                raise ValueError
+        except ValueError:
+            print("\033[1;31mUsage:\033[0m checkpoint [n|off]  (n > 0)")
+            return
+        self.checkpoint_every = lines
+        print(
+            f"\033[1;32m✓ Checkpoints:\033[0m every {lines} lines; "
+            f"'live <expr>' in the viewer re-runs the program to the current line"
+        )
+
     def do_run(self, arg):
         """Start execution with configured breakpoints and watchpoints"""
         print(
@@ -359,14 +434,18 @@ Set breakpoints and watchpoints before running your program.
         )
         if self.breakpoints:
             print(f"Breakpoints: \033[1m{len(self.breakpoints)}\033[0m")
-            for file, line in self.breakpoints:
-                print(f"  \033[1;32m•\033[0m {file}:{line}")
+            for bp in self.breakpoints:
+                print(f"  \033[1;32m•\033[0m {describe_breakpoint(bp)}")
         else:
             print(f"\033[1;33mNo breakpoints set (will trace only)\033[0m")
         if self.watchpoints:
             print(f"Watchpoints: \033[1m{len(self.watchpoints)}\033[0m")
             for var, wp_type in self.watchpoints:
                 print(f"  \033[1;32m•\033[0m {var} ({wp_type})")
+        if self.flight_events:
+            print(f"Flight recorder: last \033[1m{self.flight_events}\033[0m events")
+        if self.checkpoint_every:
+            print(f"Checkpoints: every \033[1m{self.checkpoint_every}\033[0m lines")
         print(
             f"\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n"
         )
@@ -400,6 +479,58 @@ Set breakpoints and watchpoints before running your program.
         return self.do_quit(arg)
 
 
+BREAKPOINT_HITS = re.compile(r"\s+hits\s*>=\s*(\S+)\s*$")
+
+
+def parse_breakpoint(arg):
+    """Split "<file> <line> [hits>=N] [if <expr>]" into (file, line, condition, hits).
+
+    Returns None if arg does not have that form. Raises ValueError if the
+    line or hit count is not an integer, and SyntaxError if the condition
+    does not compile.
+    """
+    condition = None
+    if " if " in f" {arg} ":
+        arg, condition = f" {arg} ".split(" if ", 1)
+        condition = condition.strip()
+        compile(condition, "<breakpoint condition>", "eval")
+    hits = 0
+    match = BREAKPOINT_HITS.search(arg)
+    if match:
+        hits = int(match.group(1))
+        arg = arg[: match.start()]
+    parts = arg.split()
+    if len(parts) != 2 or hits < 0:
+        return None
+    return parts[0], int(parts[1]), condition, hits
+
+
+def describe_breakpoint(bp):
+    """Format a (file, line, condition, hits) breakpoint for display."""
+    filename, line, condition, hits = bp
+    text = f"{filename}:{line}"
+    if hits > 1:
+        text += f" hits>={hits}"
+    if condition:
+        text += f" if {condition}"
+    return text
+
+
+def print_trace_saved(trace_file):
+    """Say where the trace went, and the traces of any forked processes."""
+    print(f"\nTrace saved to: \033[1m{trace_file}\033[0m")
+    try:
+        with open(trace_file + ".procs", "r") as f:
+            processes = len(f.readlines()) - 2
+    except OSError:
+        return
+    if processes > 0:
+        print(
+            f"Forked processes: \033[1m{processes}\033[0m, traced to {trace_file}.p<pid> "
+            f"(see 'procs' in the viewer)"
+        )
+
+
 def launch_trace_viewer(trace_file, breakpoints=None, watchpoints=None):
     """Launch the trace viewer CLI, pre-loading breakpoints and watchpoints."""
     traceviewer_path = "./build/traceviewer"
@@ -420,8 +551,11 @@ def launch_trace_viewer(trace_file, breakpoints=None, watchpoints=None):
     # into traceviewer so they carry over from the pre-execution setup.
     startup_cmds = []
     if breakpoints:
-        for filename, line in breakpoints:
-            startup_cmds.append(f"b {os.path.basename(filename)} {line}\n")
+        # traceviewer breakpoints are unconditional; conditional ones would
+        # stop on every recorded hit, so only plain breakpoints carry over
+        for filename, line, condition, hits in breakpoints:
+            if condition is None and hits <= 1:
+                startup_cmds.append(f"b {os.path.basename(filename)} {line}\n")
     if watchpoints:
         type_to_cmd = {
             WATCHPOINT_BOTH: "w",
@@ -462,18 +596,34 @@ def launch_trace_viewer(trace_file, breakpoints=None, watchpoints=None):
         subprocess.run([traceviewer_path, trace_file])
 
 
-def run_with_breakpoints(python_file, trace_file, breakpoints, watchpoints=None):
-    """Run a Python file with breakpoints set, then open the trace viewer."""
-    print(f"Starting trace to: \033[1m{trace_file}\033[0m")
-    cdebugger.start_trace(trace_file)
+def run_with_breakpoints(
+    python_file, trace_file, breakpoints, watchpoints=None, flight_events=0,
+    checkpoint_every=0
+):
+    """Run a Python file with breakpoints set, then open the trace viewer.
 
-    for filename, line in breakpoints:
+    With flight_events set, only the last flight_events events are kept in
+    memory and the trace is written only if the program raises. With
+    checkpoint_every set, the recorder forks a checkpoint every
+    checkpoint_every lines for the viewer's live command, which it keeps
+    until the viewer exits, and logs the program's inputs so its re-runs see
+    the same values.
+    """
+    print(f"Starting trace to: \033[1m{trace_file}\033[0m")
+    watch = [var for var, _ in watchpoints or () if not var.isidentifier()]
+    cdebugger.start_trace(trace_file, flight_events=flight_events, watch=watch or None,
+                          checkpoint_every=checkpoint_every,
+                          record_inputs=checkpoint_every > 0)
+    print(f"Recording backend: \033[1m{cdebugger.get_backend()}\033[0m")
+
+    for bp in breakpoints:
+        filename, line, condition, hits = bp
         try:
-            cdebugger.set_breakpoint(filename, line)
-            print(f"\033[1;32m✓ Breakpoint active at\033[0m {filename}:{line}")
+            cdebugger.set_breakpoint(filename, line, condition=condition, hits=hits)
+            print(f"\033[1;32m✓ Breakpoint active at\033[0m {describe_breakpoint(bp)}")
         except Exception as e:
             print(
-                f"\033[1;31m⚠ Warning:\033[0m Could not set breakpoint at {filename}:{line}: {e}"
+                f"\033[1;31m⚠ Warning:\033[0m Could not set breakpoint at {describe_breakpoint(bp)}: {e}"
             )
 
     try:
@@ -486,6 +636,8 @@ def run_with_breakpoints(python_file, trace_file, breakpoints, watchpoints=None)
         exec(compile(code, python_file, "exec"), globals_dict)
 
     except KeyboardInterrupt:
+        if flight_events:
+            cdebugger.dump_trace()
         cdebugger.stop_trace()
         print(
             f"\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m"
@@ -494,11 +646,13 @@ def run_with_breakpoints(python_file, trace_file, breakpoints, watchpoints=None)
         print(
             f"\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m"
         )
-        print(f"\nTrace saved to: \033[1m{trace_file}\033[0m")
+        print_trace_saved(trace_file)
         return False
 
     except Exception as e:
-        cdebugger.stop_trace()
+        if flight_events:
+            cdebugger.dump_trace()
+        cdebugger.stop_trace(live=checkpoint_every > 0)
         print(
             f"\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m"
         )
@@ -510,20 +664,25 @@ def run_with_breakpoints(python_file, trace_file, breakpoints, watchpoints=None)
         print(
             f"\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m"
         )
-        print(f"\nTrace saved to: \033[1m{trace_file}\033[0m")
+        print_trace_saved(trace_file)
         print(f"\033[1;33mLaunching post-execution debugger...\033[0m")
         launch_trace_viewer(trace_file, breakpoints, watchpoints)
+        cdebugger.kill_checkpoints()
         return False
 
-    cdebugger.stop_trace()
+    cdebugger.stop_trace(live=checkpoint_every > 0)
     print(
         f"\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m"
     )
     print(f"\033[1;32mExecution completed successfully.\033[0m")
     print(f"\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m")
-    print(f"\nTrace saved to: \033[1m{trace_file}\033[0m")
+    if flight_events:
+        print(f"\nNo exception was raised, so the flight recorder was not saved.")
+        return True
+    print_trace_saved(trace_file)
     print(f"\033[1;33mLaunching post-execution debugger...\033[0m")
     launch_trace_viewer(trace_file, breakpoints, watchpoints)
+    cdebugger.kill_checkpoints()
     return True
 
 
@@ -572,7 +731,8 @@ def main():
 
     if cli.should_run:
         success = run_with_breakpoints(
-            python_file, trace_file, cli.breakpoints, cli.watchpoints
+            python_file, trace_file, cli.breakpoints, cli.watchpoints, cli.flight_events,
+            cli.checkpoint_every
         )
         sys.exit(0 if success else 1)
     else:
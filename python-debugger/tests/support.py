@@ -0,0 +1,181 @@
+"""
+Helpers for the regression tests
+Record scripts in a fresh interpreter and read traces back with traceviewer
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import zlib
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+TRACEVIEWER = os.path.join(ROOT, "build", "traceviewer")
+
+# Run in the child: trace one script with the given start_trace options
+RECORD = """
+import sys
+sys.path.insert(0, {root!r})
+import json
+import cdebugger
+STATS = {stats!r}
+for breakpoint in {breakpoints!r}:
+    cdebugger.set_breakpoint(*breakpoint[:2], condition=breakpoint[2], hits=breakpoint[3])
+cdebugger.start_trace({trace!r}, **{options!r})
+try:
+    exec(compile(open({script!r}).read(), {script!r}, "exec"), {{"__name__": "__main__"}})
+finally:
+    cdebugger.stop_trace()
+    print(STATS + json.dumps(cdebugger.get_stats()))
+"""
+
+# Deterministic, with no reprs that hold addresses, so dumps of separate
+# recordings compare equal
+PROGRAM = """\
+def accumulate(values):
+    total = 0
+    window = []
+    for value in values:
+        total += value
+        window.append(value)
+        if len(window) > 3:
+            window.pop(0)
+    return total, window
+
+counts = {}
+for word in "the quick brown fox jumps over the lazy dog the end".split():
+    counts[word] = counts.get(word, 0) + 1
+result = accumulate(range(40))
+label = "total=%d" % result[0]
+"""
+
+# Header size and the index block type of trace format version 2 (see
+# traceformat.h)
+TRACE_HEADER_SIZE = 8
+BLOCK_INDEX = 0x7F
+
+# Prefix of the line with the recording's get_stats()
+STATS = "cdebugger stats: "
+
+HEADER = "EXECUTION_ORDER|||FILENAME|||LINE_NUMBER|||CODE|||VARIABLES"
+
+
+def write_script(directory, name, source):
+    """Write source to directory/name and return its path."""
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write(source)
+    return path
+
+
+def run_python(code, stdin="", cwd=None):
+    """Run code in a fresh interpreter that can import cdebugger."""
+    return subprocess.run([sys.executable, "-c", code], input=stdin, capture_output=True,
+                          text=True, timeout=120, cwd=cwd,
+                          env=dict(os.environ, PYTHONPATH=ROOT))
+
+
+def record(script, trace, breakpoints=(), stdin="", **options):
+    """Trace script into trace in a fresh interpreter and return the result."""
+    code = RECORD.format(root=ROOT, stats=STATS, breakpoints=list(breakpoints), trace=trace,
+                         options=options, script=script)
+    return run_python(code, stdin, cwd=os.path.dirname(script))
+
+
+def dump(trace):
+    """Run traceviewer --text on trace and return the result."""
+    return subprocess.run([TRACEVIEWER, "--text", trace], capture_output=True, text=True,
+                          timeout=120)
+
+
+def view(trace, commands):
+    """Run the interactive traceviewer on trace with commands as its input."""
+    return subprocess.run([TRACEVIEWER, trace], input="".join(c + "\n" for c in commands) + "q\n",
+                          capture_output=True, text=True, timeout=120)
+
+
+def read_varint(data, pos):
+    """Decode an unsigned LEB128 varint, returning (value, next position)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def read_blocks(path):
+    """The blocks of a version 2 trace as (type, first_seq, event_count, raw bytes)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[4] != 2:
+        raise ValueError(f"{path} is not a version 2 trace")
+    blocks = []
+    pos = TRACE_HEADER_SIZE
+    while pos < len(data) and data[pos] != BLOCK_INDEX:
+        block_type = data[pos]
+        compressed_length, pos = read_varint(data, pos + 1)
+        raw_length, pos = read_varint(data, pos)
+        first_seq, pos = read_varint(data, pos)
+        event_count, pos = read_varint(data, pos)
+        raw = zlib.decompress(data[pos:pos + compressed_length])
+        if len(raw) != raw_length:
+            raise ValueError(f"{path}: block at {pos} decompresses to the wrong length")
+        blocks.append((block_type, first_seq, event_count, raw))
+        pos += compressed_length
+    return blocks
+
+
+def convert_to_v1(source, target):
+    """Rewrite a version 2 trace as version 1: its blocks' records, uncompressed.
+
+    Returns the number of blocks.
+    """
+    with open(source, "rb") as f:
+        header = bytearray(f.read(TRACE_HEADER_SIZE))
+    header[4] = 1
+    blocks = read_blocks(source)
+    with open(target, "wb") as f:
+        f.write(bytes(header) + b"".join(block[3] for block in blocks))
+    return len(blocks)
+
+
+class TraceTestCase(unittest.TestCase):
+    """Records into a temporary directory; PROGRAM is the default script."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.script = write_script(self.directory.name, "program.py", PROGRAM)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write(self, name, source):
+        return write_script(self.directory.name, name, source)
+
+    def record(self, name, script=None, **options):
+        """Record into name; its get_stats() are left in self.stats."""
+        trace = self.path(name)
+        result = record(script or self.script, trace, **options)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.output = result.stdout
+        self.stats = json.loads(result.stdout.rpartition(STATS)[2])
+        return trace
+
+    def dump(self, trace):
+        result = dump(trace)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.splitlines()[0], HEADER)
+        return result.stdout.splitlines()
+
+    def entries(self, trace):
+        """The dumped lines split into (seq, file, line, code, variables)."""
+        return [line.split("|||") for line in self.dump(trace)[1:]]
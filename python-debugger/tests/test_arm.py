@@ -0,0 +1,119 @@
+"""
+Armed traces
+arm_trace() installs nothing until a trigger starts a bounded capture
+"""
+
+import os
+import unittest
+
+from support import TraceTestCase, run_python
+
+PROGRAM = """\
+import os
+import signal
+import sys
+import cdebugger
+
+def work(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+trace = sys.argv[1]
+cdebugger.arm_trace(trace, events=50)
+print("hook", sys.gettrace())
+work(100)
+first = cdebugger.trigger_trace()
+work(100)
+second = cdebugger.trigger_trace()
+work(3)
+cdebugger.disarm_trace()
+work(100)
+print("captures", first, second, cdebugger.get_stats()["captures"])
+
+cdebugger.arm_trace(trace + ".sig", events=10, signal=signal.SIGUSR1)
+os.kill(os.getpid(), signal.SIGUSR1)
+work(100)
+os.kill(os.getpid(), signal.SIGUSR1)
+work(100)
+cdebugger.disarm_trace()
+"""
+
+RUN = """\
+import runpy
+import sys
+sys.argv = [{script!r}, {trace!r}]
+runpy.run_path({script!r}, run_name="__main__")
+"""
+
+ERRORS = """\
+import cdebugger
+
+def attempt(call):
+    try:
+        call()
+    except Exception as e:
+        print(type(e).__name__, e)
+
+attempt(lambda: cdebugger.arm_trace({trace!r}))
+cdebugger.arm_trace({trace!r}, seconds=1)
+attempt(lambda: cdebugger.arm_trace({trace!r}, events=5))
+cdebugger.disarm_trace()
+cdebugger.start_trace({trace!r})
+attempt(lambda: cdebugger.arm_trace({trace!r}, events=5))
+cdebugger.stop_trace()
+"""
+
+
+class ArmTest(TraceTestCase):
+    def setUp(self):
+        super().setUp()
+        script = self.write("armed.py", PROGRAM)
+        self.trace = self.path("trace.log")
+        result = run_python(RUN.format(script=script, trace=self.trace),
+                            cwd=self.directory.name)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.output = result.stdout.splitlines()
+
+    def codes(self, trace):
+        return [entry[3].strip() for entry in self.entries(trace)]
+
+    def test_armed_trace_installs_no_hook(self):
+        self.assertEqual(self.output[0], "hook None")
+        self.assertFalse(os.path.exists(self.trace))
+
+    def test_trigger_captures_a_bounded_window(self):
+        self.assertEqual(self.output[1], "captures %s.1 %s.2 2" % (self.trace, self.trace))
+        codes = self.codes(self.trace + ".1")
+        # From the line after the trigger, 50 lines in all
+        self.assertEqual(codes[0], "work(100)")
+        self.assertEqual(len(codes), 50)
+        self.assertEqual(set(codes[1:]), {"total = 0", "for i in range(n):", "total += i"})
+
+    def test_disarm_stops_a_running_capture(self):
+        codes = self.codes(self.trace + ".2")
+        self.assertEqual(codes[0], "work(3)")
+        self.assertEqual(codes[-1], "cdebugger.disarm_trace()")
+        self.assertEqual(codes.count("total += i"), 3)
+
+    def test_signal_triggers_numbered_captures(self):
+        # Numbering carries on from the first arming's two captures
+        self.assertEqual(sorted(name for name in os.listdir(self.directory.name)
+                                if name.startswith("trace.log.sig")),
+                         ["trace.log.sig.3", "trace.log.sig.4"])
+        self.assertEqual(len(self.entries(self.trace + ".sig.3")), 10)
+
+
+    def test_bad_arming_raises(self):
+        result = run_python(ERRORS.format(trace=self.trace), cwd=self.directory.name)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.splitlines(), [
+            "ValueError arm_trace needs events or seconds to end a capture",
+            "RuntimeError Tracing already armed",
+            "RuntimeError Tracing already active",
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
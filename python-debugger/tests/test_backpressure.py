@@ -0,0 +1,55 @@
+"""
+Backpressure
+A full ring blocks the recorder, or with backpressure='drop' drops whole blocks
+"""
+
+import unittest
+
+from support import TraceTestCase, record
+
+# Enough records to fill a 64 KiB ring many times over
+PROGRAM = """\
+def work():
+    data = []
+    for i in range(20000):
+        data.append("x" * 90 + str(i))
+        data = data[-20:]
+
+work()
+"""
+
+# Only a full ring wakes the writer, so the first time it fills a block is lost
+SMALL_RING = dict(buffer_size=64 * 1024, block_size=4096, flush_bytes=0, flush_interval=0)
+
+
+class BackpressureTest(TraceTestCase):
+    def seqs(self, trace):
+        return [int(entry[0]) for entry in self.entries(trace)]
+
+    def test_block_records_every_line(self):
+        trace = self.record("trace.log", self.write("work.py", PROGRAM), **SMALL_RING)
+        self.assertEqual(self.stats["dropped_events"], 0)
+        self.assertEqual(self.seqs(trace), list(range(self.stats["events"])))
+
+    def test_drop_leaves_gaps_it_counts(self):
+        trace = self.record("trace.log", self.write("work.py", PROGRAM), backpressure="drop",
+                            **SMALL_RING)
+        dropped = self.stats["dropped_events"]
+        self.assertGreater(dropped, 0)
+        seqs = self.seqs(trace)
+        self.assertEqual(len(seqs) + dropped, self.stats["events"])
+        self.assertEqual(sorted(set(seqs)), seqs)
+        # Dropped blocks go missing whole, and only those
+        gaps = sum(b - a - 1 for a, b in zip(seqs, seqs[1:]))
+        self.assertEqual(gaps + seqs[0] + self.stats["events"] - 1 - seqs[-1], dropped)
+
+    def test_drop_needs_a_block_to_fit_in_the_ring(self):
+        result = record(self.script, self.path("trace.log"), backpressure="drop",
+                        buffer_size=64 * 1024, block_size=256 * 1024)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("backpressure='drop' needs buffer_size to be at least block_size",
+                      result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
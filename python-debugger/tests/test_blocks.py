@@ -0,0 +1,58 @@
+"""
+Block-compressed trace files
+Version 2 traces read back like the text and version 1 formats
+"""
+
+import os
+import unittest
+
+from support import HEADER, TraceTestCase, convert_to_v1, read_blocks
+
+BLOCK_EVENTS = 2
+
+
+class BlockTraceTest(TraceTestCase):
+    def test_recording_reads_back(self):
+        lines = self.dump(self.record("trace.log"))
+        self.assertEqual(lines[0], HEADER)
+        self.assertEqual([line.split("|||")[0] for line in lines[1:]],
+                         [str(seq) for seq in range(len(lines) - 1)])
+        self.assertIn("label = \"total=%d\" % result[0]|||", lines[-1])
+        self.assertIn("result=(780, [37, 38, 39])", lines[-1])
+
+    def test_text_dump_round_trips(self):
+        lines = self.dump(self.record("trace.log"))
+        text = self.path("trace.txt")
+        with open(text, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        self.assertEqual(self.dump(text), lines)
+
+    def test_version_1_reads_like_version_2(self):
+        trace = self.record("trace.log", block_size=4096)
+        version_1 = self.path("trace.v1")
+        self.assertGreater(convert_to_v1(trace, version_1), 2)
+        self.assertEqual(self.dump(version_1), self.dump(trace))
+
+    def test_blocks_cover_every_event_once(self):
+        trace = self.record("trace.log", block_size=4096)
+        events = [block for block in read_blocks(trace) if block[0] == BLOCK_EVENTS]
+        self.assertGreater(len(events), 1)
+        seq = 0
+        for _, first_seq, event_count, _ in events:
+            self.assertEqual(first_seq, seq)
+            seq += event_count
+        self.assertEqual(seq, len(self.dump(trace)) - 1)
+
+    def test_trace_without_index_is_walked(self):
+        trace = self.record("trace.log", block_size=4096)
+        with open(trace, "rb") as f:
+            data = f.read()
+        # Cut the index and trailer, as if the recorder had been killed
+        with open(self.path("cut.log"), "wb") as f:
+            f.write(data[:data.rindex(bytes([0x7F]), 0, len(data) - 12)])
+        self.assertEqual(self.dump(self.path("cut.log")), self.dump(trace))
+        self.assertLess(os.path.getsize(self.path("cut.log")), len(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
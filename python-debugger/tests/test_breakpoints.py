@@ -0,0 +1,106 @@
+"""
+Breakpoint regression tests
+idebug's break command parser and the recorder's breakpoint checks
+"""
+
+import sys
+import unittest
+
+from support import ROOT, TraceTestCase
+
+sys.path.insert(0, ROOT)
+from idebug import parse_breakpoint  # noqa: E402
+
+
+PROGRAM = """\
+total = 0
+for i in range(6):
+    total += i
+print("done", total)
+"""
+
+# Conditions on a local, a cell and free variables of a nested function
+SCOPES = """\
+def scale(factor):
+    total = 0
+    def add(x):
+        return total + x * factor
+    for i in range(5):
+        total = add(i)
+    return total
+print("done", scale(3))
+"""
+
+
+class ParseBreakpointTest(unittest.TestCase):
+    def test_file_and_line(self):
+        self.assertEqual(parse_breakpoint("bank.py 40"), ("bank.py", 40, None, 0))
+
+    def test_hits(self):
+        for arg in ("bank.py 40 hits>=3", "bank.py 40 hits >= 3", "bank.py 40 hits>= 3",
+                    "bank.py 40 hits >=3", "bank.py 40  hits  >=  3 "):
+            with self.subTest(arg=arg):
+                self.assertEqual(parse_breakpoint(arg), ("bank.py", 40, None, 3))
+
+    def test_condition(self):
+        self.assertEqual(parse_breakpoint("bank.py 40 if balance < 0"),
+                         ("bank.py", 40, "balance < 0", 0))
+        self.assertEqual(parse_breakpoint("bank.py 40 hits >= 50000 if balance < 0"),
+                         ("bank.py", 40, "balance < 0", 50000))
+        self.assertEqual(parse_breakpoint("bank.py 40 if a if b else c"),
+                         ("bank.py", 40, "a if b else c", 0))
+
+    def test_bad_forms(self):
+        for arg in ("", "bank.py", "bank.py 40 50", "bank.py 40 hits>=-1", "bank.py 40 hits"):
+            with self.subTest(arg=arg):
+                self.assertIsNone(parse_breakpoint(arg))
+
+    def test_bad_numbers(self):
+        for arg in ("bank.py forty", "bank.py 40 hits>=many"):
+            with self.subTest(arg=arg):
+                with self.assertRaises(ValueError):
+                    parse_breakpoint(arg)
+
+    def test_bad_condition(self):
+        with self.assertRaises(SyntaxError):
+            parse_breakpoint("bank.py 40 if balance <")
+
+
+class BreakpointStopTest(TraceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.script = self.write("program.py", PROGRAM)
+
+    def run_with(self, *breakpoints):
+        """Run the program continuing at every stop; return the hit counts it stopped at."""
+        self.record("trace.log", breakpoints=[(self.script,) + bp for bp in breakpoints],
+                    stdin="c\n" * 20)
+        self.assertIn("done ", self.output)
+        return self.output, [int(line.split(":")[1]) for line in self.output.splitlines()
+                             if line.startswith("Hit count:")]
+
+    def test_every_breakpoint_on_a_line_stops(self):
+        _, hits = self.run_with((3, "i == 4", 0), (3, "i == 1", 2))
+        self.assertEqual(hits, [2, 5])
+
+    def test_hits_are_counted_before_the_condition(self):
+        _, hits = self.run_with((3, "i % 2 == 0", 4))
+        self.assertEqual(hits, [5])
+
+    def test_raising_condition_stops_and_says_why(self):
+        output, hits = self.run_with((3, "missing > 1", 5))
+        self.assertEqual(hits, [5, 6])
+        self.assertIn("Breakpoint condition 'missing > 1' raised NameError", output)
+        self.assertIn("Stopping because the condition could not be evaluated", output)
+
+    def test_condition_sees_the_frame_variables(self):
+        self.script = self.write("scopes.py", SCOPES)
+        # A local and a cell of scale(), then an argument and free variables of add()
+        _, hits = self.run_with((6, "i == 3 and total == 9", 0), (4, "x == 2 and total == 3", 0),
+                                (4, "factor == 4", 0))
+        self.assertEqual(hits, [3, 4])
+        self.assertIn("done 30", self.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Checkpoint regression tests
+Checkpoints left by stop_trace(live=True) answer the viewer's live command
+"""
+
+import json
+import re
+import unittest
+
+from support import TRACEVIEWER, TraceTestCase, run_python
+
+PROGRAM = """\
+values = []
+for i in range(30):
+    values.append(i * i)
+total = sum(values)
+print("total", total)
+"""
+
+# Record with checkpoints, view the trace while they are alive, then kill them
+LIVE = """\
+import json
+import os
+import subprocess
+import time
+import cdebugger
+cdebugger.start_trace({trace!r}, variables=False, **{options!r})
+exec(compile(open({script!r}).read(), {script!r}, "exec"), {{"__name__": "__main__"}})
+cdebugger.stop_trace(live=True)
+try:
+    with open({trace!r} + ".ckpt") as f:
+        listed = f.read().splitlines()
+    view = subprocess.run([{viewer!r}, {trace!r}], capture_output=True, text=True,
+                          input="".join(c + "\\n" for c in {commands!r}) + "q\\n").stdout
+finally:
+    cdebugger.kill_checkpoints()
+
+def running(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rpartition(")")[2].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+# The kill is a signal, so give the checkpoints a moment to exit
+alive = [int(line.split()[1]) for line in listed[1:]]
+deadline = time.time() + 10
+while alive and time.time() < deadline:
+    time.sleep(0.05)
+    alive = [pid for pid in alive if running(pid)]
+print(json.dumps({{"listed": listed, "view": view, "alive": alive,
+                  "ckpt": os.path.exists({trace!r} + ".ckpt")}}))
+"""
+
+
+class CheckpointTest(TraceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.script = self.write("program.py", PROGRAM)
+
+    def run_live(self, commands, **options):
+        trace = self.path("trace.log")
+        code = LIVE.format(trace=trace, options=options, script=self.script,
+                           viewer=TRACEVIEWER, commands=commands)
+        result = run_python(code, cwd=self.directory.name)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout.splitlines()[-1])
+
+    def test_live_evaluates_in_a_re_run(self):
+        # Entry 49 is the for line after the append for i = 23
+        result = self.run_live([":50", "live len(values), i", "live values[-1]"],
+                               checkpoint_every=10)
+        view = re.sub(r"\033\[[0-9;]*m", "", result["view"])
+        self.assertIn("Re-running from the checkpoint at [41]", view)
+        self.assertIn("Result: (24, 23)", view)
+        self.assertIn("Result: 529", view)
+        # The second command reuses the re-run
+        self.assertEqual(view.count("Re-running"), 1)
+
+    def test_newest_checkpoints_are_kept_and_killed(self):
+        result = self.run_live(["checkpoints"], checkpoint_every=10, keep_checkpoints=3)
+        listed = result["listed"]
+        self.assertEqual(listed[0], "TTDC 1")
+        self.assertEqual([int(line.split()[0]) for line in listed[1:]], [40, 50, 60])
+        for line in listed[1:]:
+            self.assertIn("pid %s" % line.split()[1], result["view"])
+        self.assertEqual(result["alive"], [])
+        self.assertFalse(result["ckpt"])
+
+    def test_bad_options(self):
+        result = run_python("import cdebugger\n"
+                            "for options in ({'checkpoint_every': -1}, {'keep_checkpoints': 0},\n"
+                            "                {'record_inputs': True}):\n"
+                            "    try:\n"
+                            "        cdebugger.start_trace('trace.log', **options)\n"
+                            "    except ValueError as e:\n"
+                            "        print(e)\n", cwd=self.directory.name)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(len(result.stdout.splitlines()), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
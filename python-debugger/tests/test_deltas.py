@@ -0,0 +1,49 @@
+"""
+Delta-encoded snapshots
+Recordings with keyframes every N events read back like full snapshots
+"""
+
+import os
+import unittest
+
+from support import TraceTestCase
+
+
+class DeltaTest(TraceTestCase):
+    def test_keyframe_intervals_agree(self):
+        full = self.dump(self.record("full.log", keyframe_interval=0))
+        for interval in (1, 3, 100):
+            with self.subTest(keyframe_interval=interval):
+                trace = self.record(f"delta{interval}.log", keyframe_interval=interval)
+                self.assertEqual(self.dump(trace), full)
+
+    def test_deltas_survive_block_boundaries(self):
+        full = self.dump(self.record("full.log", keyframe_interval=0))
+        trace = self.record("small.log", keyframe_interval=100, block_size=4096)
+        self.assertEqual(self.dump(trace), full)
+
+    def test_deletions_and_insertions(self):
+        script = self.write("changes.py", """\
+def shuffle():
+    a = 1
+    b = 2
+    del a
+    c = 3
+    a = 4
+    del b, c
+    return a
+
+for _ in range(3):
+    shuffle()
+""")
+        full = self.dump(self.record("full.log", script=script, keyframe_interval=0))
+        self.assertEqual(self.dump(self.record("delta.log", script=script)), full)
+
+    def test_deltas_are_smaller(self):
+        delta = self.record("delta.log", keyframe_interval=100, compress_level=0)
+        full = self.record("full.log", keyframe_interval=0, compress_level=0)
+        self.assertLess(os.path.getsize(delta), os.path.getsize(full))
+
+
+if __name__ == "__main__":
+    unittest.main()
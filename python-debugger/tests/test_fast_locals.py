@@ -0,0 +1,63 @@
+"""
+Fast locals
+Function variables read from the frame match what locals() reports
+"""
+
+import json
+import unittest
+
+from support import TraceTestCase
+
+# Each SNAPS line records the variables before it runs, which is also what
+# its locals() sees
+PROGRAM = """\
+import json
+SNAPS = []
+
+def outer(a):
+    b = a + 1
+    def inner(c):
+        d = a + c
+        SNAPS.append(dict(locals()))
+        del d
+        SNAPS.append(dict(locals()))
+        return c * 2
+    SNAPS.append(dict(locals()))
+    e = inner(b)
+    SNAPS.append(dict(locals()))
+    return e
+
+outer(1)
+
+print("SNAPS " + json.dumps([{k: repr(v) for k, v in s.items()} for s in SNAPS]))
+"""
+
+
+class FastLocalsTest(TraceTestCase):
+    def test_variables_match_locals(self):
+        trace = self.record("trace.log", self.write("scopes.py", PROGRAM))
+        snaps = json.loads(self.output.partition("SNAPS ")[2].splitlines()[0])
+        recorded = [dict(pair.split("=", 1) for pair in entry[4].split(";") if pair)
+                    for entry in self.entries(trace)
+                    if entry[3].strip() == "SNAPS.append(dict(locals()))"]
+        self.assertEqual(len(recorded), len(snaps))
+        for variables, snap in zip(recorded, snaps):
+            with self.subTest(snap=snap):
+                # The module's SNAPS is shown alongside the locals
+                variables.pop("SNAPS")
+                self.assertEqual(variables, snap)
+
+    def test_cells_free_and_unbound_variables(self):
+        self.record("trace.log", self.write("scopes.py", PROGRAM))
+        snaps = json.loads(self.output.partition("SNAPS ")[2].splitlines()[0])
+        # outer: a is a cell, e is unbound
+        self.assertEqual(sorted(snaps[0]), ["a", "b", "inner"])
+        # inner: a is a free variable; d is bound, then deleted
+        self.assertEqual(sorted(snaps[1]), ["a", "c", "d"])
+        self.assertEqual(sorted(snaps[2]), ["a", "c"])
+        # outer again, with e bound
+        self.assertEqual(sorted(snaps[3]), ["a", "b", "e", "inner"])
+
+
+if __name__ == "__main__":
+    unittest.main()
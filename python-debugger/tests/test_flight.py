@@ -0,0 +1,67 @@
+"""
+Flight recorder
+Only the newest events are kept in memory, and written when dumped
+"""
+
+import os
+import signal
+import unittest
+
+from support import TraceTestCase
+
+PROGRAM = """\
+import os
+import signal
+import cdebugger
+
+total = 0
+for i in range(3000):
+    total += i
+if DUMP == "signal":
+    os.kill(os.getpid(), signal.SIGUSR1)
+elif DUMP is not None:
+    cdebugger.dump_trace(*DUMP)
+last = total
+"""
+
+
+class FlightRecorderTest(TraceTestCase):
+    def run_program(self, dump, **options):
+        script = self.write("flight.py", "DUMP = %r\n" % (dump,) + PROGRAM)
+        return self.record("trace.log", script, flight_events=200, block_size=4096, **options)
+
+    def check_window(self, trace, events):
+        entries = self.entries(trace)
+        seqs = [int(entry[0]) for entry in entries]
+        self.assertEqual(seqs, list(range(seqs[0], seqs[0] + len(seqs))))
+        # At least flight_events, plus at most an eighth for the open block
+        self.assertGreaterEqual(len(entries), events)
+        self.assertLessEqual(len(entries), events * 9 // 8)
+        self.assertGreater(seqs[0], 0)
+        return entries
+
+    def test_nothing_is_written_without_a_dump(self):
+        trace = self.run_program(None)
+        self.assertFalse(os.path.exists(trace))
+        self.assertEqual(self.stats["dumps"], 0)
+
+    def test_dump_keeps_the_newest_events(self):
+        trace = self.run_program(())
+        entries = self.check_window(trace, 200)
+        self.assertEqual(entries[-1][3], "    cdebugger.dump_trace(*DUMP)")
+        self.assertIn("total=4498500", entries[-1][4])
+        self.assertEqual(self.stats["dumps"], 1)
+
+    def test_dump_to_another_file(self):
+        trace = self.run_program((self.path("crash.trace"),))
+        self.assertFalse(os.path.exists(trace))
+        self.check_window(self.path("crash.trace"), 200)
+
+    def test_dump_signal(self):
+        trace = self.run_program("signal", dump_signal=int(signal.SIGUSR1))
+        entries = self.check_window(trace, 200)
+        self.assertEqual(entries[-1][3], "    os.kill(os.getpid(), signal.SIGUSR1)")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Forked processes
+Every process of a forking program records into a trace of its own
+"""
+
+import os
+import unittest
+
+from support import TraceTestCase, dump
+
+FORK_PROGRAM = """\
+import os
+before = 1
+pid = os.fork()
+if pid == 0:
+    child = before + 1
+    os._exit(0)
+os.waitpid(pid, 0)
+after = before + 2
+"""
+
+# fork() straight from libc skips os.register_at_fork
+C_FORK_PROGRAM = FORK_PROGRAM.replace("import os\n", """\
+import ctypes
+import os
+fork = ctypes.CDLL(None, use_errno=True).fork
+""").replace("os.fork()", "fork()")
+
+
+class ForkTest(TraceTestCase):
+    def processes(self, trace):
+        """The process list as (pid, parent pid, fork seq, trace name) tuples."""
+        with open(trace + ".procs") as f:
+            self.assertEqual(f.readline(), "TTDP 1\n")
+            return [tuple(line.rstrip("\n").split(" ", 3)) for line in f]
+
+    def check_child(self, trace, child_lines):
+        root, child = self.processes(trace)
+        self.assertEqual(root[1:], ("0", "0", "trace.log"))
+        pid, parent, fork_seq, name = child
+        self.assertEqual(name, "trace.log.p" + pid)
+        self.assertEqual(parent, root[0])
+
+        entries = self.entries(self.path(name))
+        self.assertEqual([entry[3] for entry in entries], child_lines)
+        # The child's execution numbers continue from the parent's at the fork
+        self.assertEqual(entries[0][0], fork_seq)
+        parent_entries = {entry[0]: entry for entry in self.entries(trace)}
+        self.assertEqual(parent_entries[fork_seq][3], "if pid == 0:")
+        self.assertIn("child=2", entries[-1][4])
+        self.assertNotIn("child=2", "".join(entry[4] for entry in parent_entries.values()))
+
+    def test_child_records_its_own_trace(self):
+        trace = self.record("trace.log", self.write("fork.py", FORK_PROGRAM))
+        self.check_child(trace, ["if pid == 0:", "    child = before + 1", "    os._exit(0)"])
+
+    def test_fork_from_c(self):
+        trace = self.record("trace.log", self.write("fork.py", C_FORK_PROGRAM))
+        self.check_child(trace, ["if pid == 0:", "    child = before + 1", "    os._exit(0)"])
+
+    def test_segmented_child_is_a_manifest(self):
+        trace = self.record("trace.log", self.write("fork.py", FORK_PROGRAM), segment_events=2)
+        _, (pid, _, fork_seq, name) = self.processes(trace)
+        with open(self.path(name)) as f:
+            self.assertEqual(f.readline(), "TTDM 1\n")
+        entries = self.entries(self.path(name))
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[0][0], fork_seq)
+
+    def test_process_list_is_not_a_trace(self):
+        trace = self.record("trace.log", self.write("fork.py", FORK_PROGRAM))
+        result = dump(trace + ".procs")
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("is a process list, not a trace", result.stderr)
+        self.assertIn(os.path.basename(trace), result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
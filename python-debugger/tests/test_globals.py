@@ -0,0 +1,79 @@
+"""
+Cached globals
+Module globals are rendered again after every change to them
+"""
+
+import unittest
+
+from support import TraceTestCase
+
+HELPER = """\
+value = None
+def poke(items):
+    items.append("poked")
+    return value
+"""
+
+PROGRAM = """\
+import helper
+items = []
+count = 0
+def bump():
+    global count
+    count += 1
+    return count
+for i in range(2):
+    items.append(i)
+    bump()
+    globals()["late"] = i
+    helper.value = i
+    helper.poke(items)
+done = True
+"""
+
+
+class GlobalsTest(TraceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("helper.py", HELPER)
+        self.script = self.write("program.py", PROGRAM)
+
+    def variables(self, trace):
+        """The variables of each line, as a list of (code, {name: repr})."""
+        return [(entry[3].strip(), dict(pair.split("=", 1) for pair in entry[4].split(";") if pair))
+                for entry in self.entries(trace)]
+
+    def after(self, lines, code, n=0):
+        """The variables of the line after the nth run of code."""
+        runs = [i for i, (line, _) in enumerate(lines) if line == code]
+        return lines[runs[n] + 1][1]
+
+    def check_rebinding(self, lines):
+        # Assigned in a function, through globals(), and from another module
+        self.assertEqual(self.after(lines, "count += 1")["count"], "1")
+        self.assertEqual(self.after(lines, "count += 1", 1)["count"], "2")
+        self.assertEqual(self.after(lines, 'globals()["late"] = i', 1)["late"], "1")
+        self.assertEqual(self.after(lines, "helper.poke(items)", 1)["value"], "1")
+
+    def test_every_change_is_seen_on_the_next_line(self):
+        lines = self.variables(self.record("trace.log"))
+        self.check_rebinding(lines)
+        # Changed in place, here and by another module
+        self.assertEqual(self.after(lines, "items.append(i)")["items"], "[0]")
+        self.assertEqual(self.after(lines, "return value")["items"], "[0, 'poked']")
+        self.assertEqual(self.after(lines, "items.append(i)", 1)["items"], "[0, 'poked', 1]")
+
+    def test_globals_refresh_only_delays_in_place_changes(self):
+        lines = self.variables(self.record("trace.log", globals_refresh=3))
+        self.check_rebinding(lines)
+        # An in-place change shows within globals_refresh lines
+        final = "[0, 'poked', 1, 'poked']"
+        self.assertEqual(dict(lines)["done = True"], {"items": final, "count": "2", "i": "1",
+                                                      "late": "1"})
+        runs = [i for i, (code, _) in enumerate(lines) if code == "items.append(i)"]
+        self.assertIn("[0]", [variables.get("items") for _, variables in lines[runs[0] + 1:
+                                                                               runs[0] + 4]])
+
+
+if __name__ == "__main__":
+    unittest.main()
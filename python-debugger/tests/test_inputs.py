@@ -0,0 +1,81 @@
+"""
+Input log regression tests
+Re-runs from checkpoints read what the recording read from outside
+"""
+
+import json
+import re
+import unittest
+
+from support import TRACEVIEWER, TraceTestCase, run_python
+
+# Every value it prints comes from outside the program
+PROGRAM = """\
+import os
+import socket
+import sys
+import time
+name = input()
+line = sys.stdin.readline()
+rest = sys.stdin.read()
+a, b = socket.socketpair()
+a.sendall(b"ping " + os.urandom(4).hex().encode() + b"\\n")
+got = b.makefile("rb").readline()
+with open("data.txt", "w") as f:
+    f.write(str(time.time()))
+with open("data.txt") as f:
+    saved = f.read()
+print("values", repr((name, line, rest, got, saved)))
+"""
+
+# Record with record_inputs and run the viewer's commands before the
+# checkpoints are killed
+LIVE = """\
+import json
+import subprocess
+import sys
+import cdebugger
+cdebugger.start_trace({trace!r}, checkpoint_every=100, record_inputs=True, variables=False)
+stdin = type(sys.stdin).__name__
+exec(compile(open({script!r}).read(), {script!r}, "exec"), {{"__name__": "__main__"}})
+cdebugger.stop_trace(live=True)
+try:
+    view = subprocess.run([{viewer!r}, {trace!r}], capture_output=True, text=True,
+                          input="".join(c + "\\n" for c in {commands!r}) + "q\\n").stdout
+finally:
+    cdebugger.kill_checkpoints()
+print(json.dumps({{"view": view, "stdin": [stdin, type(sys.stdin).__name__]}}))
+"""
+
+
+class InputReplayTest(TraceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.script = self.write("program.py", PROGRAM)
+
+    def run_live(self, commands):
+        code = LIVE.format(trace=self.path("trace.log"), script=self.script,
+                           viewer=TRACEVIEWER, commands=commands)
+        result = run_python(code, stdin="ada\nlovelace\nrest of\nstdin\n",
+                            cwd=self.directory.name)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        lines = result.stdout.splitlines()
+        values = next(line for line in lines if line.startswith("values "))
+        return values.partition(" ")[2], json.loads(lines[-1])
+
+    def test_re_run_reads_the_logged_inputs(self):
+        values, result = self.run_live(["jump 15",
+                                        "live repr((name, line, rest, got, saved))"])
+        view = re.sub(r"\033\[[0-9;]*m", "", result["view"])
+        # From the only checkpoint, before every read
+        self.assertIn("Re-running from the checkpoint at [1]", view)
+        self.assertIn("Result: %r" % values, view)
+        self.assertIn("'ada', 'lovelace\\n', 'rest of\\nstdin\\n', b'ping ", values)
+
+    def test_stdin_is_wrapped_while_recording(self):
+        _, result = self.run_live([])
+        self.assertEqual(result["stdin"], ["InputFile", "TextIOWrapper"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+"""
+Repr cache
+Cached reprs of immutable values read back the same as freshly made ones
+"""
+
+import unittest
+
+from support import TraceTestCase
+
+# Immutable values that stay put across lines, and ones rebuilt each line
+# with equal values but new identities
+PROGRAM = """\
+name = "ledger"
+limits = (10, 2.5, b"raw", frozenset({"a"}))
+rows = []
+for i in range(60):
+    key = "row%d" % (i % 7)
+    pair = (key, i // 3, -i * 1.5)
+    rows.append(pair)
+    big = 2 ** 80 + i % 4
+    label = name + ":" + key
+    nested = (pair, (limits, None, True))
+"""
+
+
+class ReprCacheTest(TraceTestCase):
+    def test_cached_reprs_match_uncached(self):
+        script = self.write("values.py", PROGRAM)
+        uncached = self.dump(self.record("uncached.log", script, repr_cache_size=0))
+        self.assertEqual(self.stats["repr_cache_hits"], 0)
+        for size in (4096, 3):
+            with self.subTest(repr_cache_size=size):
+                cached = self.dump(self.record("cached.log", script, repr_cache_size=size))
+                self.assertEqual(cached, uncached)
+                self.assertGreater(self.stats["repr_cache_hits"], 0)
+                self.assertLessEqual(self.stats["repr_cache_entries"], size)
+        # The tiny cache had to evict to keep to its size
+        self.assertGreater(self.stats["repr_cache_evictions"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
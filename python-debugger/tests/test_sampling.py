@@ -0,0 +1,52 @@
+"""
+Sampling
+Hot lines are recorded for their first hits and then every Nth hit
+"""
+
+import unittest
+
+from support import TraceTestCase, view
+
+PROGRAM = """\
+total = 0
+for i in range(100):
+    total += i
+done = total
+"""
+
+
+class SamplingTest(TraceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.script = self.write("loop.py", PROGRAM)
+
+    def test_first_hits_then_every_nth(self):
+        trace = self.record("trace.log", sample_first=3, sample_every=10)
+        entries = self.entries(trace)
+        self.assertEqual([entry[0] for entry in entries], [str(n) for n in range(len(entries))])
+        body = [entry[4] for entry in entries if entry[3] == "    total += i"]
+        self.assertEqual([vars.rpartition("i=")[2] for vars in body],
+                         ["0", "1", "2"] + [str(i) for i in range(12, 100, 10)])
+
+    def test_elided_hits_are_counted(self):
+        self.record("full.log")
+        events = self.stats["events"]
+        self.assertEqual(self.stats["elided_events"], 0)
+        self.record("trace.log", sample_first=3, sample_every=10)
+        self.assertEqual(self.stats["events"] + self.stats["elided_events"], events)
+        self.assertEqual(self.stats["elided_events"], 177)
+
+    def test_viewer_shows_elided_iterations(self):
+        trace = self.record("trace.log", sample_first=3, sample_every=10)
+        result = view(trace, ["n"] * 40)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        # Both loop lines, from their 13th hit on
+        self.assertEqual(result.stdout.count("…9 iterations elided"), 18)
+
+    def test_every_one_records_everything(self):
+        self.assertEqual(self.dump(self.record("sampled.log", sample_first=3, sample_every=1)),
+                         self.dump(self.record("full.log")))
+
+
+if __name__ == "__main__":
+    unittest.main()
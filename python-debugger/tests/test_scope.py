@@ -0,0 +1,99 @@
+"""
+Recording scope
+Filename and function patterns, and record() / @recorded regions
+"""
+
+import os
+import unittest
+
+from support import TraceTestCase
+
+HELPER = """\
+def double(x):
+    y = x * 2
+    return y
+"""
+
+PROGRAM = """\
+import cdebugger
+from helper import double
+
+
+class Order:
+    def total(self, n):
+        t = double(n)
+        return t
+
+
+def audit(n):
+    seen = n + 1
+    return seen
+
+
+@cdebugger.recorded
+def suspect(n):
+    flagged = audit(n)
+    return flagged
+
+
+a = Order().total(3)
+b = audit(4)
+with cdebugger.record():
+    c = double(5)
+d = suspect(6)
+e = audit(7)
+"""
+
+
+class ScopeTest(TraceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("helper.py", HELPER)
+        self.script = self.write("program.py", PROGRAM)
+
+    def recorded(self, **options):
+        """The (basename, code) of every recorded line."""
+        return [(os.path.basename(entry[1]), entry[3].strip())
+                for entry in self.entries(self.record("trace.log", **options))]
+
+    def test_include_by_basename(self):
+        lines = self.recorded(include="helper.py")
+        self.assertEqual({name for name, _ in lines}, {"helper.py"})
+        self.assertEqual(lines.count(("helper.py", "y = x * 2")), 2)
+
+    def test_include_by_path(self):
+        lines = self.recorded(include=["*/program.py"])
+        self.assertEqual({name for name, _ in lines}, {"program.py"})
+
+    def test_exclude(self):
+        lines = self.recorded(exclude=["helper.py"])
+        self.assertNotIn("helper.py", {name for name, _ in lines})
+        self.assertIn(("program.py", "e = audit(7)"), lines)
+
+    def test_functions(self):
+        # Python 3.10 has no qualified names, so match Order.total by suffix
+        lines = self.recorded(functions=["*total", "double"])
+        self.assertEqual(lines, [("program.py", "t = double(n)"), ("helper.py", "y = x * 2"),
+                                 ("helper.py", "return y"), ("program.py", "return t"),
+                                 ("helper.py", "y = x * 2"), ("helper.py", "return y")])
+
+    def test_regions(self):
+        lines = self.recorded(regions=True)
+        self.assertEqual(lines, [
+            # The record() block, including what it calls
+            ("program.py", "c = double(5)"), ("helper.py", "y = x * 2"),
+            ("helper.py", "return y"), ("program.py", "with cdebugger.record():"),
+            # The @recorded call, including what it calls
+            ("program.py", "flagged = audit(n)"), ("program.py", "seen = n + 1"),
+            ("program.py", "return seen"), ("program.py", "return flagged"),
+        ])
+
+    def test_recorded_functions_are_hidden_from_globals(self):
+        entries = self.entries(self.record("trace.log", include=["*/program.py"]))
+        last = [entry for entry in entries if entry[3] == "e = audit(7)"][0]
+        # Like the plain functions, the wrapped one is not a variable
+        self.assertEqual(last[4], "a=6;b=5;c=10;d=7")
+
+
+if __name__ == "__main__":
+    unittest.main()
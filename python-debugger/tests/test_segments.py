@@ -0,0 +1,64 @@
+"""
+Segmented traces
+A manifest and its segment files read back like one trace
+"""
+
+import glob
+import unittest
+
+from support import TraceTestCase
+
+# Reads get_stats() while recording, after some lines have gone to segments
+PROGRAM = """\
+import cdebugger
+
+for i in range(N):
+    square = str(i * i)
+live_segments = cdebugger.get_stats()["segments"]
+done = True
+"""
+
+
+class SegmentTest(TraceTestCase):
+    def segments(self, trace):
+        return sorted(glob.glob(trace + ".[0-9]*"))
+
+    def test_segments_read_like_one_file(self):
+        whole = self.dump(self.record("whole.log"))
+        trace = self.record("trace.log", segment_events=25)
+        with open(trace) as f:
+            self.assertEqual(f.readline(), "TTDM 1\n")
+        self.assertGreater(len(self.segments(trace)), 4)
+        self.assertEqual(self.dump(trace), whole)
+
+    def test_segments_by_size(self):
+        script = self.write("loop.py", "N = 3000\n" + PROGRAM)
+        trace = self.record("trace.log", script, segment_bytes=4096, block_size=4096)
+        self.assertGreater(len(self.segments(trace)), 1)
+        # All but the last line, which shows the segment count
+        self.assertEqual(self.dump(trace)[:-1], self.dump(self.record("whole.log", script))[:-1])
+
+    def test_keep_segments(self):
+        trace = self.record("trace.log", segment_events=25, keep_segments=2)
+        segments = self.segments(trace)
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[-1], trace + ".%04d" % self.stats["segments"])
+        # The kept segments hold the end of the run
+        entries = self.entries(trace)
+        self.assertEqual(entries[-1][3], 'label = "total=%d" % result[0]')
+        seqs = [int(entry[0]) for entry in entries]
+        self.assertEqual(seqs, list(range(seqs[0], self.stats["events"])))
+
+    def test_segments_stat_is_current(self):
+        script = self.write("loop.py", "N = 60\n" + PROGRAM)
+        trace = self.record("trace.log", script, segment_events=25)
+        entries = self.entries(trace)
+        # The line after get_stats() shows what it reported mid-run, counting
+        # the segment of the get_stats() line itself
+        live = int(entries[-1][4].rpartition("live_segments=")[2])
+        self.assertEqual(live, (len(entries) - 3) // 25 + 1)
+        self.assertEqual(self.stats["segments"], len(self.segments(trace)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+Watch expressions
+The recorder writes a watch expression's value only when it changes
+"""
+
+import re
+import unittest
+
+from support import TraceTestCase, view
+
+PROGRAM = """\
+queue = []
+for i in range(6):
+    queue.append(i)
+    if i % 2:
+        queue.pop(0)
+done = len(queue)
+"""
+
+
+class WatchTest(TraceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.script = self.write("queue.py", PROGRAM)
+
+    def view(self, trace, commands):
+        result = view(trace, commands)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return re.sub(r"\033\[[0-9;]*m", "", result.stdout)
+
+    def test_continue_stops_at_each_change(self):
+        trace = self.record("trace.log", watch="len(queue)")
+        output = self.view(trace, ["w len(queue)"] + ["c"] * 9)
+        self.assertIn("Watchpoint set on 'len(queue)' (type: recorded value)", output)
+        self.assertEqual([int(value) for value in
+                          re.findall(r"Watch 'len\(queue\)' changed to (\d+)", output)],
+                         [0, 1, 2, 1, 2, 3, 2, 3, 4])
+        # Each stop is the first line after the change
+        self.assertEqual(re.findall(r"Code: (.*)", output)[1:4],
+                         ["for i in range(6):", "    if i % 2:", "    if i % 2:"])
+
+    def test_reverse_continue_and_listw(self):
+        trace = self.record("trace.log", watch=["len(queue)"])
+        output = self.view(trace, ["w len(queue)"] + ["c"] * 9 + ["rc", "listw"])
+        self.assertIn("WATCHPOINT HIT (REVERSE)", output)
+        self.assertIn("1. len(queue) = 3 (10 changes)", output)
+
+    def test_raising_expression_is_never_recorded(self):
+        trace = self.record("trace.log", watch=["len(queue)", "missing + 1"])
+        output = self.view(trace, ["w missing + 1"])
+        self.assertIn("'missing + 1' was not recorded as a watch expression", output)
+
+    def test_watch_does_not_change_the_lines(self):
+        self.assertEqual(self.dump(self.record("watched.log", watch=["len(queue)"])),
+                         self.dump(self.record("plain.log")))
+
+
+if __name__ == "__main__":
+    unittest.main()
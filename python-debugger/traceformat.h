@@ -0,0 +1,221 @@
+// Binary trace format shared by cdebugger (debugger.c) and traceviewer
+// (traceviewer.c).
+//
+//   header:  "TTDB"  u8 version  u8 flags  u16 reserved
+//   record:  u8 kind  varint payload_length  payload
+//
+// Varints are unsigned LEB128. Filenames, source lines and variable names
+// are interned: the first use emits a REC_STRING record that assigns an id,
+// and later records refer to the id. Variable values are length-prefixed
+// and already escaped the way the text format escaped them, so the viewer
+// can rebuild "name=value;..." lists with plain copies. Readers skip record
+// kinds they do not recognise.
+//
+// Version 1 files hold records directly after the header. Version 2 files
+// hold zlib-compressed blocks of records:
+//
+//   block:   u8 type  varint compressed_length  varint raw_length
+//            varint first_seq  varint event_count  compressed bytes
+//
+// BLOCK_STRINGS blocks hold REC_STRING, REC_THREAD and REC_TASK records,
+// BLOCK_EVENTS blocks hold REC_LINE, REC_CALL and REC_RETURN records, and
+// BLOCK_WATCH blocks hold REC_WATCH records; the block's event_count counts
+// its REC_LINE records. Every frame starts with a
+// keyframe in each events block, so an events block decodes on its own once
+// the strings are known. A strings block is always written before the
+// events that use its strings.
+// The file ends with an index of all blocks and a fixed-size trailer:
+//
+//   index:   u8 BLOCK_INDEX  varint payload_length  varint block_count, then
+//            per block: varint offset, u8 type, varint compressed_length,
+//            varint raw_length, varint first_seq, varint event_count
+//   trailer: u64 little-endian offset of the index, "TIDX"
+//
+// A file without the trailer (the recorder did not stop cleanly) is read
+// by walking the blocks from the header.
+//
+// A segmented trace is a text manifest listing complete trace files, oldest
+// first, each starting with every strings block written before it:
+//
+//   "TTDM 1\n", then per segment: first_seq event_count filename "\n"
+//
+// Filenames are relative to the manifest's directory. The event count of a
+// segment still being written is "-". Segments the recorder deleted to keep
+// the last few are no longer listed.
+//
+// A traced program that forks records each process in a trace of its own.
+// A child's trace is named after the first process's, trace.log.p<pid> (a
+// manifest if segmented), and its seqs continue from the parent's at the
+// fork. A process list, trace.log.procs, names them all:
+//
+//   "TTDP 1\n", then per process: pid parent_pid fork_seq filename "\n"
+//
+// The first process has parent_pid 0 and writes the list's first line when
+// it first forks; each child appends its own line when it starts. fork_seq
+// is the seq the child's first line would have had in its parent.
+//
+// A recorder taking checkpoints lists the live ones, oldest first, in
+// trace.log.ckpt:
+//
+//   "TTDC 1\n", then per checkpoint: seq pid "\n"
+//
+// A checkpoint is a paused copy of the program from just before the line
+// with that seq ran. It accepts connections on the abstract Unix socket
+// named by TRACE_CHECKPOINT_SOCKET and its pid, from processes running as
+// the same user (SO_PEERCRED); others get an error. Requests are lines and
+// replies are "ok <length>\n" or "error <length>\n" followed by length bytes:
+//
+//   "run <seq>\n"    re-execute from the checkpoint up to that seq; the
+//                    reply gives the line's "filename:lineno"
+//   "eval <expr>\n"  the repr of expr evaluated in that line's frame
+//   "quit\n"         end the re-run (so does closing the connection)
+//
+// A recorder logging inputs for re-runs writes trace.log.inputs:
+//
+//   header:  "TTDI"  u8 version
+//   record:  varint seq  u8 source  varint length  marshalled result
+//
+// seq is the seq of the line after the call, and source indexes the
+// recorder's list of logged functions. The results are in the marshal
+// format of the recording interpreter. A call that reads into a buffer
+// (recv_into, readinto) logs the tuple (data, result), and iterating a
+// file logs each line and then None at its end.
+
+#ifndef TRACEFORMAT_H
+#define TRACEFORMAT_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+#define TRACE_MAGIC "TTDB"
+#define TRACE_MAGIC_SIZE 4
+#define TRACE_HEADER_SIZE 8
+#define TRACE_FORMAT_VERSION 2
+
+// Block types
+#define BLOCK_STRINGS 1
+#define BLOCK_EVENTS 2
+#define BLOCK_WATCH 3
+#define BLOCK_INDEX 0x7f
+
+#define TRACE_TRAILER_MAGIC "TIDX"
+#define TRACE_TRAILER_SIZE 12
+
+#define TRACE_MANIFEST_MAGIC "TTDM"
+#define TRACE_MANIFEST_VERSION 1
+
+#define TRACE_PROCESS_LIST_MAGIC "TTDP"
+#define TRACE_PROCESS_LIST_VERSION 1
+
+#define TRACE_CHECKPOINT_LIST_MAGIC "TTDC"
+#define TRACE_CHECKPOINT_LIST_VERSION 1
+#define TRACE_CHECKPOINT_SOCKET "cdebugger-checkpoint-%ld"
+
+#define TRACE_INPUTS_MAGIC "TTDI"
+#define TRACE_INPUTS_VERSION 1
+
+// Record kinds
+#define REC_STRING 1    // varint id, u8 string kind, bytes
+#define REC_LINE 2      // varint seq, varint flags, varint file, varint line,
+                        // varint code, [varint frame], [varint thread],
+                        // [varint task], [varint depth, varint function],
+                        // [varint elided], then variables
+#define REC_THREAD 3    // varint thread, varint ident, bytes name
+#define REC_TASK 4      // varint task, varint thread, bytes name
+#define REC_CALL 5      // varint thread, varint depth, varint function
+#define REC_RETURN 6    // varint thread, varint depth
+#define REC_WATCH 7     // varint seq, varint expression, varint len, bytes
+
+// REC_LINE flags. Without LINE_DELTA the variables are a full snapshot,
+// (varint name, varint len, bytes)*. With LINE_DELTA they are a list of
+// changes against the previous event of the same frame, (varint name,
+// varint op, op arguments)*, applied in order:
+//   VAR_DELETE  remove the variable
+//   VAR_SET     varint len, bytes: replace the value in place
+//   VAR_INSERT  varint index, varint len, bytes: insert at index
+// A frame's first event is always a full snapshot (a keyframe).
+//
+// Threads are numbered in the order they first record a line. Lines of
+// thread 0 omit the thread field; other lines set LINE_HAS_THREAD. A
+// REC_THREAD record gives the thread's threading ident and name.
+//
+// Lines that run in an asyncio task belong to a task number (from 1; 0 is
+// no task). A line sets LINE_HAS_TASK and ends its header with the task
+// number when its thread's task changes; every thread starts each block
+// with no task. REC_TASK records name the task and its thread.
+//
+// Each thread counts the traced frames it is running. REC_CALL starts a
+// frame at the given depth (from 1; frames that were running when tracing
+// started are depth 0) with a STR_FUNCTION name, and REC_RETURN ends one.
+// Generators and coroutines start a frame on every resume and end it on
+// every yield. A line sets LINE_HAS_CALL and ends its header with its depth
+// and function when they differ from its thread's last REC_CALL or
+// LINE_HAS_CALL line in the block, or when there is none.
+//
+// A recorder that samples hot lines leaves some hits of a line out of the
+// trace. The line's next recorded hit sets LINE_HAS_ELIDED and ends its
+// header with the number of hits left out since its previous recorded hit.
+// Sampled traces only write a REC_CALL just before the first recorded line
+// of the call, and write no REC_RETURN.
+//
+// A watch expression is evaluated in the frame of every recorded line. When
+// its escaped repr differs from the last one written, a REC_WATCH record
+// gives the line's seq, the expression (a STR_WATCH string) and the new
+// value. Lines where the expression raises leave its value unchanged. The
+// first value of each expression in an events block is always written, so
+// watch changes survive dropped blocks; readers skip repeats of a value.
+#define LINE_HAS_FRAME 0x1
+#define LINE_DELTA 0x2
+#define LINE_HAS_THREAD 0x4
+#define LINE_HAS_TASK 0x8
+#define LINE_HAS_CALL 0x10
+#define LINE_HAS_ELIDED 0x20
+
+#define VAR_DELETE 0
+#define VAR_SET 1
+#define VAR_INSERT 2
+
+// String kinds
+#define STR_FILE 1
+#define STR_CODE 2
+#define STR_NAME 3
+#define STR_FUNCTION 4
+#define STR_WATCH 5
+
+#define TRACE_VARINT_MAX 10
+
+static inline size_t
+trace_put_varint(unsigned char *out, uint64_t value)
+{
+    size_t length = 0;
+
+    while (value >= 0x80) {
+        out[length++] = (unsigned char)(value | 0x80);
+        value >>= 7;
+    }
+    out[length++] = (unsigned char)value;
+    return length;
+}
+
+// Returns 1 and advances *pos on success, 0 on truncated or oversized input
+static inline int
+trace_get_varint(const unsigned char **pos, const unsigned char *end, uint64_t *value)
+{
+    const unsigned char *p = *pos;
+    uint64_t result = 0;
+    int shift = 0;
+
+    while (p < end && shift < 64) {
+        unsigned char byte = *p++;
+        result |= (uint64_t)(byte & 0x7f) << shift;
+        if ((byte & 0x80) == 0) {
+            *pos = p;
+            *value = result;
+            return 1;
+        }
+        shift += 7;
+    }
+    return 0;
+}
+
+#endif
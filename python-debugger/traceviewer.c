@@ -2,15 +2,25 @@
 #include <stdlib.h>
 #include <string.h>
 #include <ctype.h>
+#include <errno.h>
 #include <unistd.h>
 #include <fcntl.h>
 #include <dirent.h>
 #include <limits.h>
 #include <stdarg.h>
 #include <termios.h>
+#include <signal.h>
 #include <sys/types.h>
 #include <sys/wait.h>
 #include <sys/ioctl.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+#include <zlib.h>
+
+#include "traceformat.h"
 
 // Readline support (mandatory)
 #include <readline/readline.h>
@@ -20,19 +30,90 @@
 
 
 #define MAX_LINE_LENGTH 10000
-#define MAX_LINES 100000
+#define INITIAL_ENTRIES 4096
 #define MAX_BREAKPOINTS 100
 #define MAX_WATCHPOINTS 50
 #define MAX_VARS 100
+#define VARIABLE_CACHE_SIZE 256
+#define FRAME_CACHE_SIZE 16
+#define BLOCK_CACHE_SIZE 8
+
+// TraceEntry flag set by the viewer, above the LINE_* flags: the first line
+// of a call, after a REC_CALL of its thread
+#define ENTRY_CALL_START 0x10000
 
 typedef struct {
     long exec_order;
-    char filename[512];
+    const char *filename;   // Owned by the viewer string pool
     int line_number;
-    char *code;
-    char *variables;
+    const char *code;       // Owned by the viewer string pool
+    char *variables;        // Use entry_variables(); built on demand for binary traces
+    int flags;              // LINE_* flags of a binary record
+    int thread;             // Recorder thread number, 0 for the first thread
+    int task;               // asyncio task number, 0 outside of a task
+    int depth;              // Call depth, 0 for frames running before tracing
+    const char *function;   // Owned by the viewer string pool; NULL if unknown
+    long elided;            // Hits of this line the recorder left out before it
+    int prev_in_frame;      // Previous entry of the same frame, -1 if none
+    const unsigned char *vars_start;  // Encoded variables in the mapped trace
+    const unsigned char *vars_end;
 } TraceEntry;
 
+// A recorded thread, from a REC_THREAD record
+typedef struct {
+    int id;
+    unsigned long ident;    // threading.get_ident() of the thread
+    const char *name;       // Owned by the viewer string pool; may be empty
+} TraceThread;
+
+// A recorded asyncio task, from a REC_TASK record, with the runs of
+// consecutive steps it owns (indexes into TraceViewer.task_runs, in order)
+typedef struct {
+    int id;
+    int thread;
+    const char *name;       // Owned by the viewer string pool; may be empty
+    int *runs;
+    int run_count;
+    int run_capacity;
+} TraceTask;
+
+typedef struct {
+    int first;              // First and last entry index of the run
+    int last;
+} TaskRun;
+
+// A call in the call tree: the lines of one frame activation (a generator
+// or coroutine starts a new call on every resume)
+typedef struct {
+    int first;              // First entry of the call
+    int caller;             // Calling line, -1 if it was not recorded
+} TraceCall;
+
+// An events block of a compressed trace, decompressed while it is in use
+typedef struct {
+    const unsigned char *map;   // Mapped trace or segment holding the block
+    size_t data_offset;         // Compressed bytes in the mapping
+    size_t compressed_length;
+    size_t raw_length;
+    long first_seq;
+    int event_count;
+    int first_index;            // Index of the block's first entry
+    unsigned char *raw;         // Decompressed records while loaded
+    TraceEntry *entries;        // NULL while not loaded
+    unsigned long last_used;
+} TraceBlock;
+
+// A segment file listed by a trace manifest, mapped on first use
+typedef struct {
+    char *path;
+    void *map;
+    size_t size;
+    long first_seq;
+    int first_index;        // Index of the segment's first entry
+    int event_count;        // -1 until opened if the manifest does not say
+    int state;              // 0 not opened yet, 1 opened, -1 failed to open
+} TraceSegment;
+
 // Breakpoint structure for post-execution navigation
 typedef struct {
     char filename[512];
@@ -43,21 +124,53 @@ typedef struct {
 typedef enum {
     WATCHPOINT_READ,
     WATCHPOINT_WRITE,
-    WATCHPOINT_BOTH
+    WATCHPOINT_BOTH,
+    WATCHPOINT_VALUE        // Changes of a watch expression the recorder evaluated
 } WatchpointType;
 
 // Watchpoint structure
 typedef struct {
     char variable[256];
     WatchpointType type;
+    int watch;              // TraceViewer.watches index for WATCHPOINT_VALUE
 } Watchpoint;
 
+// A new value of a watch expression, from a REC_WATCH record
+typedef struct {
+    long seq;
+    const char *value;      // Owned by the viewer string pool
+} WatchChange;
+
+// A watch expression evaluated by the recorder, with its changes by seq
+typedef struct {
+    uint64_t expression;    // STR_WATCH string id
+    WatchChange *changes;
+    int change_count;
+    int change_capacity;
+} TraceWatch;
+
 // Variable state for tracking changes
 typedef struct {
     char name[513];
     char value[512];
 } VarState;
 
+// A decoded variable of a binary trace; value points into the mapped trace
+typedef struct {
+    uint64_t name;
+    const unsigned char *value;
+    size_t length;
+} VarValue;
+
+// Variables of a frame as of one entry, kept to continue delta decoding
+typedef struct {
+    int entry_index;        // -1 when unused
+    VarValue *vars;
+    int count;
+    int capacity;
+    unsigned long last_used;
+} FrameCache;
+
 typedef struct {
     TraceEntry *entries;
     int entry_count;
@@ -70,6 +183,48 @@ typedef struct {
     int prev_var_count;
     char eval_temp_file[PATH_MAX];
     int eval_temp_file_ready;
+    char **strings;         // Filenames and source lines shared by entries
+    int string_count;
+    int string_capacity;
+    const char **string_ids;  // Binary trace string id -> string
+    uint64_t string_id_count;
+    void *map_data;         // Mapped binary trace, referenced by entries
+    size_t map_size;
+    int materialized[VARIABLE_CACHE_SIZE];  // Entries whose variables were built
+    int materialized_next;
+    FrameCache frame_cache[FRAME_CACHE_SIZE];
+    unsigned long frame_cache_clock;
+    long dropped_events;    // Lines the recorder dropped under backpressure
+    TraceBlock *blocks;     // Compressed traces only; entries is NULL then
+    int block_count;
+    int loaded_blocks;
+    unsigned long block_clock;
+    TraceWatch *watches;    // Watch channel of a binary trace
+    int watch_count;
+    int watches_loaded;     // Set by load_watches()
+    TraceSegment *segments; // Segmented traces only, in order
+    int segment_count;
+    int skip_strings;       // Set while opening a segment whose strings are known
+    const char **files;     // Distinct filenames in the trace
+    int file_count;
+    int file_capacity;
+    TraceThread *threads;
+    int thread_count;
+    int thread_filter;      // Thread followed by navigation, -1 for all
+    TraceTask *tasks;
+    int task_count;
+    int task_filter;        // Task followed by navigation, -1 for all
+    TaskRun *task_runs;     // Built on first use by build_task_index()
+    int task_run_count;
+    int task_index_built;
+    TraceCall *calls;       // Built on first use by build_call_index()
+    int call_count;
+    int *entry_call;        // Entry index -> call
+    int *next_in_call;      // Entry index -> next line of its call, -1 if last
+    int call_index_built;
+    char *trace_path;       // File the trace was opened from
+    int live_fd;            // Re-run serving 'live' at live_seq, -1 if none
+    long live_seq;
 } TraceViewer;
 
 // Global pointer for autocomplete (needs access to trace files)
@@ -79,7 +234,8 @@ static int g_tui_mode = 0;
 static const char* g_commands[] = {
     "n", "next", "back", "prev", "b", "break", "list", "c", "continue",
     "rc", "show", "summary", "find", "jump", "eval", "w", "rw", "ww",
-    "listw", "clearw", "view", "help", "quit", "q", NULL
+    "listw", "clearw", "view", "threads", "thread", "tasks", "task",
+    "procs", "proc", "checkpoints", "live", "over", "out", "reverse-out", "help", "quit", "q", NULL
 };
 
 static const char* g_lower_views[] = {
@@ -90,6 +246,15 @@ static const char* g_lower_views[] = {
 void print_current_entry(TraceViewer *viewer);
 void update_variable_state(TraceViewer *viewer, int entry_index);
 int check_watchpoint_triggered(TraceViewer *viewer, int entry_index, char *triggered_var, char *trigger_type, WatchpointType *wp_type);
+void cleanup(TraceViewer *viewer);
+const char* entry_variables(TraceViewer *viewer, int index);
+TraceEntry* get_entry(TraceViewer *viewer, int index);
+static int find_entry_by_exec(TraceViewer *viewer, long exec_num);
+static void load_watches(TraceViewer *viewer);
+static int is_python_identifier(const char *value);
+static void rstrip(char *value);
+static void live_close(TraceViewer *viewer);
+static int report_process_list(const char *filename);
 
 static char*
 xstrdup(const char *value) {
@@ -100,10 +265,67 @@ xstrdup(const char *value) {
     return copy;
 }
 
+// Keep an allocated string alive until cleanup; returns it, or NULL on failure
+static const char*
+keep_string(TraceViewer *viewer, char *value) {
+    if (!value) {
+        return NULL;
+    }
+    if (viewer->string_count == viewer->string_capacity) {
+        int capacity = viewer->string_capacity ? viewer->string_capacity * 2 : 1024;
+        char **strings = realloc(viewer->strings, capacity * sizeof(char *));
+        if (!strings) {
+            fprintf(stderr, "Memory allocation failed\n");
+            free(value);
+            return NULL;
+        }
+        viewer->strings = strings;
+        viewer->string_capacity = capacity;
+    }
+    viewer->strings[viewer->string_count++] = value;
+    return value;
+}
+
+// Record a distinct trace filename. With copy set, name is copied into the
+// string pool when it is new; otherwise it must already live in the pool.
+static const char*
+add_trace_file(TraceViewer *viewer, const char *name, int copy) {
+    // Consecutive entries usually share a file, so check the last match first
+    static int last_match = 0;
+    if (last_match < viewer->file_count && strcmp(viewer->files[last_match], name) == 0) {
+        return viewer->files[last_match];
+    }
+    for (int i = 0; i < viewer->file_count; i++) {
+        if (strcmp(viewer->files[i], name) == 0) {
+            last_match = i;
+            return viewer->files[i];
+        }
+    }
+
+    if (viewer->file_count == viewer->file_capacity) {
+        int capacity = viewer->file_capacity ? viewer->file_capacity * 2 : 64;
+        const char **files = realloc(viewer->files, capacity * sizeof(char *));
+        if (!files) {
+            fprintf(stderr, "Memory allocation failed\n");
+            return NULL;
+        }
+        viewer->files = files;
+        viewer->file_capacity = capacity;
+    }
+
+    const char *stored = copy ? keep_string(viewer, xstrdup(name)) : name;
+    if (stored) {
+        last_match = viewer->file_count;
+        viewer->files[viewer->file_count++] = stored;
+    }
+    return stored;
+}
+
 // Parse a trace line into a TraceEntry
-int parse_trace_line(char *line, TraceEntry *entry) {
+int parse_trace_line(TraceViewer *viewer, char *line, TraceEntry *entry) {
     // Format: EXECUTION_ORDER|||FILENAME|||LINE_NUMBER|||CODE|||VARIABLES
     memset(entry, 0, sizeof(*entry));
+    entry->prev_in_frame = -1;
     
     // Split by ||| delimiter
     char *parts[5] = {NULL};
@@ -136,14 +358,16 @@ int parse_trace_line(char *line, TraceEntry *entry) {
     entry->exec_order = atol(parts[0]);
     
     // Parse filename
-    strncpy(entry->filename, parts[1], sizeof(entry->filename) - 1);
-    entry->filename[sizeof(entry->filename) - 1] = '\0';
+    entry->filename = add_trace_file(viewer, parts[1], 1);
+    if (!entry->filename) {
+        return 0;
+    }
     
     // Parse line number
     entry->line_number = atoi(parts[2]);
     
     // Parse code
-    entry->code = xstrdup(parts[3]);
+    entry->code = keep_string(viewer, xstrdup(parts[3]));
     if (!entry->code) {
         return 0;
     }
@@ -155,7 +379,6 @@ int parse_trace_line(char *line, TraceEntry *entry) {
         entry->variables = xstrdup("");
     }
     if (!entry->variables) {
-        free(entry->code);
         entry->code = NULL;
         return 0;
     }
@@ -200,7 +423,7 @@ int is_at_breakpoint(TraceViewer *viewer, int entry_index) {
         return 0;
     }
     
-    TraceEntry *entry = &viewer->entries[entry_index];
+    TraceEntry *entry = get_entry(viewer, entry_index);
     
     for (int i = 0; i < viewer->breakpoint_count; i++) {
         if (viewer->breakpoints[i].line_number == entry->line_number &&
@@ -256,6 +479,376 @@ void list_breakpoints(TraceViewer *viewer) {
     printf("Total: \033[1;32m%d\033[0m breakpoint(s)\n\n", viewer->breakpoint_count);
 }
 
+// Whether an entry belongs to the thread and task selected with
+// "thread <n>" and "task <n>"
+static int entry_in_filter(TraceViewer *viewer, int index) {
+    TraceEntry *entry = get_entry(viewer, index);
+    return (viewer->thread_filter < 0 || entry->thread == viewer->thread_filter) &&
+           (viewer->task_filter < 0 || entry->task == viewer->task_filter);
+}
+
+static TraceTask* find_task(TraceViewer *viewer, int id) {
+    for (int i = 0; i < viewer->task_count; i++) {
+        if (viewer->tasks[i].id == id) {
+            return &viewer->tasks[i];
+        }
+    }
+    return NULL;
+}
+
+// Split the trace into runs of consecutive steps of one task and list each
+// task's runs, so stepping within a task jumps over other tasks' steps with
+// a binary search. Built on first use; reads every step once.
+static int build_task_index(TraceViewer *viewer) {
+    if (viewer->task_index_built) {
+        return 1;
+    }
+
+    int capacity = 0;
+    TraceTask *task = NULL;
+    for (int i = 0; i < viewer->entry_count; i++) {
+        int id = get_entry(viewer, i)->task;
+        if (task && id == task->id && viewer->task_runs[task->runs[task->run_count - 1]].last == i - 1) {
+            viewer->task_runs[task->runs[task->run_count - 1]].last = i;
+            continue;
+        }
+
+        task = id > 0 ? find_task(viewer, id) : NULL;
+        if (!task) {
+            continue;
+        }
+        if (viewer->task_run_count == capacity) {
+            capacity = capacity ? capacity * 2 : 1024;
+            TaskRun *runs = realloc(viewer->task_runs, capacity * sizeof(TaskRun));
+            if (!runs) {
+                fprintf(stderr, "Memory allocation failed\n");
+                return 0;
+            }
+            viewer->task_runs = runs;
+        }
+        if (task->run_count == task->run_capacity) {
+            int run_capacity = task->run_capacity ? task->run_capacity * 2 : 16;
+            int *task_runs = realloc(task->runs, run_capacity * sizeof(int));
+            if (!task_runs) {
+                fprintf(stderr, "Memory allocation failed\n");
+                return 0;
+            }
+            task->runs = task_runs;
+            task->run_capacity = run_capacity;
+        }
+        viewer->task_runs[viewer->task_run_count].first = i;
+        viewer->task_runs[viewer->task_run_count].last = i;
+        task->runs[task->run_count++] = viewer->task_run_count++;
+    }
+
+    viewer->task_index_built = 1;
+    return 1;
+}
+
+// Nearest step of a task after (step 1) or before (step -1) index, from the
+// task's runs, or -1
+static int step_in_task(TraceViewer *viewer, TraceTask *task, int index, int step) {
+    // Last run that starts at or before index
+    int low = 0, high = task->run_count - 1, run = -1;
+    while (low <= high) {
+        int mid = low + (high - low) / 2;
+        if (viewer->task_runs[task->runs[mid]].first <= index) {
+            run = mid;
+            low = mid + 1;
+        } else {
+            high = mid - 1;
+        }
+    }
+
+    if (step > 0) {
+        if (run >= 0 && index < viewer->task_runs[task->runs[run]].last) {
+            return index + 1;
+        }
+        return run + 1 < task->run_count ? viewer->task_runs[task->runs[run + 1]].first : -1;
+    }
+
+    if (run < 0) {
+        return -1;
+    }
+    TaskRun *current = &viewer->task_runs[task->runs[run]];
+    if (index > current->last) {
+        return current->last;
+    }
+    if (index > current->first) {
+        return index - 1;
+    }
+    return run > 0 ? viewer->task_runs[task->runs[run - 1]].last : -1;
+}
+
+// Nearest entry after (step 1) or before (step -1) index in the selected
+// thread and task, or -1 if there is none
+static int step_entry(TraceViewer *viewer, int index, int step) {
+    TraceTask *task = viewer->task_filter > 0 ? find_task(viewer, viewer->task_filter) : NULL;
+    if (task && build_task_index(viewer)) {
+        return step_in_task(viewer, task, index, step);
+    }
+
+    for (int i = index + step; i >= 0 && i < viewer->entry_count; i += step) {
+        if (entry_in_filter(viewer, i)) {
+            return i;
+        }
+    }
+    return -1;
+}
+
+// A call of a thread that has not returned yet, while building the index
+typedef struct {
+    int call;
+    int depth;
+    int last;               // Last line of the call so far
+} OpenCall;
+
+typedef struct {
+    OpenCall *calls;
+    int count;
+    int capacity;
+} CallStack;
+
+// Build the call tree: which call each line belongs to, the next line of
+// the same call, and the line each call was made from. "over", "out" and
+// "reverse-out" are then a lookup or two instead of a scan through every
+// nested line. Built on first use; reads every step once.
+static int build_call_index(TraceViewer *viewer) {
+    if (viewer->call_index_built) {
+        return 1;
+    }
+
+    int count = viewer->entry_count;
+    int call_capacity = 1024;
+    CallStack *stacks = NULL;
+    int stack_count = 0;
+    viewer->calls = malloc(call_capacity * sizeof(TraceCall));
+    viewer->entry_call = malloc((count ? count : 1) * sizeof(int));
+    viewer->next_in_call = malloc((count ? count : 1) * sizeof(int));
+    if (!viewer->calls || !viewer->entry_call || !viewer->next_in_call) {
+        goto fail;
+    }
+    viewer->call_count = 0;
+
+    for (int i = 0; i < count; i++) {
+        TraceEntry *entry = get_entry(viewer, i);
+        int depth = entry->depth;
+
+        if (entry->thread >= stack_count) {
+            int grown_count = entry->thread + 16;
+            CallStack *grown = realloc(stacks, grown_count * sizeof(CallStack));
+            if (!grown) {
+                goto fail;
+            }
+            memset(grown + stack_count, 0, (grown_count - stack_count) * sizeof(CallStack));
+            stacks = grown;
+            stack_count = grown_count;
+        }
+        CallStack *stack = &stacks[entry->thread];
+
+        // Calls deeper than this line have returned. A new call at this
+        // depth also ends the previous call at the same depth.
+        int start = entry->flags & ENTRY_CALL_START;
+        while (stack->count > 0 && (stack->calls[stack->count - 1].depth > depth ||
+                                    (start && stack->calls[stack->count - 1].depth == depth))) {
+            stack->count--;
+        }
+
+        if (stack->count == 0 || stack->calls[stack->count - 1].depth < depth) {
+            if (viewer->call_count == call_capacity) {
+                call_capacity *= 2;
+                TraceCall *calls = realloc(viewer->calls, call_capacity * sizeof(TraceCall));
+                if (!calls) {
+                    goto fail;
+                }
+                viewer->calls = calls;
+            }
+            if (stack->count == stack->capacity) {
+                int capacity = stack->capacity ? stack->capacity * 2 : 64;
+                OpenCall *open = realloc(stack->calls, capacity * sizeof(OpenCall));
+                if (!open) {
+                    goto fail;
+                }
+                stack->calls = open;
+                stack->capacity = capacity;
+            }
+
+            TraceCall *call = &viewer->calls[viewer->call_count];
+            call->first = i;
+            call->caller = stack->count > 0 ? stack->calls[stack->count - 1].last : -1;
+            stack->calls[stack->count].call = viewer->call_count++;
+            stack->calls[stack->count].depth = depth;
+            stack->calls[stack->count].last = -1;
+            stack->count++;
+        }
+
+        OpenCall *open = &stack->calls[stack->count - 1];
+        if (open->last >= 0) {
+            viewer->next_in_call[open->last] = i;
+        }
+        open->last = i;
+        viewer->entry_call[i] = open->call;
+        viewer->next_in_call[i] = -1;
+    }
+
+    for (int i = 0; i < stack_count; i++) {
+        free(stacks[i].calls);
+    }
+    free(stacks);
+    viewer->call_index_built = 1;
+    return 1;
+
+fail:
+    fprintf(stderr, "Memory allocation failed\n");
+    for (int i = 0; i < stack_count; i++) {
+        free(stacks[i].calls);
+    }
+    free(stacks);
+    free(viewer->calls);
+    free(viewer->entry_call);
+    free(viewer->next_in_call);
+    viewer->calls = NULL;
+    viewer->entry_call = NULL;
+    viewer->next_in_call = NULL;
+    viewer->call_count = 0;
+    return 0;
+}
+
+// Line after the current call returns: the next line of the nearest caller
+// that has one, or -1
+static int step_out(TraceViewer *viewer, int index) {
+    int call = viewer->entry_call[index];
+    while (viewer->calls[call].caller >= 0) {
+        int caller = viewer->calls[call].caller;
+        if (viewer->next_in_call[caller] >= 0) {
+            return viewer->next_in_call[caller];
+        }
+        call = viewer->entry_call[caller];
+    }
+
+    // The outermost call was already running when the trace starts (a
+    // flight recorder dump): the thread's next line above it
+    TraceEntry *first = get_entry(viewer, viewer->calls[call].first);
+    int thread = first->thread;
+    int depth = first->depth;
+    for (int i = index + 1; depth > 0 && i < viewer->entry_count; i++) {
+        TraceEntry *entry = get_entry(viewer, i);
+        if (entry->thread == thread && entry->depth < depth) {
+            return i;
+        }
+    }
+    return -1;
+}
+
+// Next line of the current call, stepping over calls it makes
+static int step_over(TraceViewer *viewer, int index) {
+    int next = viewer->next_in_call[index];
+    return next >= 0 ? next : step_out(viewer, index);
+}
+
+// Line the current call was made from
+static int reverse_step_out(TraceViewer *viewer, int index) {
+    return viewer->calls[viewer->entry_call[index]].caller;
+}
+
+static const char* thread_label(TraceViewer *viewer, int id) {
+    for (int i = 0; i < viewer->thread_count; i++) {
+        if (viewer->threads[i].id == id && viewer->threads[i].name[0]) {
+            return viewer->threads[i].name;
+        }
+    }
+    return "thread";
+}
+
+static const char* watch_expression(TraceViewer *viewer, int watch) {
+    uint64_t id = viewer->watches[watch].expression;
+    return id < (uint64_t)viewer->string_id_count && viewer->string_ids[id] ? viewer->string_ids[id] : "?";
+}
+
+// Index of the last change of watch at or before seq, or -1
+static int watch_change_at(TraceWatch *watch, long seq) {
+    int low = 0, high = watch->change_count;
+    while (low < high) {
+        int mid = (low + high) / 2;
+        if (watch->changes[mid].seq <= seq) {
+            low = mid + 1;
+        } else {
+            high = mid;
+        }
+    }
+    return low - 1;
+}
+
+// Value of a watch expression as of an entry, or NULL before its first value
+static const char* watch_value_at(TraceViewer *viewer, int watch, int entry_index) {
+    TraceWatch *trace_watch = &viewer->watches[watch];
+    int change = watch_change_at(trace_watch, get_entry(viewer, entry_index)->exec_order);
+    return change >= 0 ? trace_watch->changes[change].value : NULL;
+}
+
+// Whether c/rc can jump straight through the watch channel: only recorded
+// watch expressions are set and every entry is followed
+static int watch_channel_only(TraceViewer *viewer) {
+    if (viewer->breakpoint_count > 0 || viewer->thread_filter >= 0 || viewer->task_filter >= 0) {
+        return 0;
+    }
+    for (int i = 0; i < viewer->watchpoint_count; i++) {
+        if (viewer->watchpoints[i].type != WATCHPOINT_VALUE) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+// Next entry after (step 1) or before (step -1) from where a watched
+// expression changed, using only the watch channel. Sets *watchpoint to
+// the watchpoint that changed; returns -1 if none did.
+static int next_watch_change(TraceViewer *viewer, int from, int step, int *watchpoint) {
+    long seq = get_entry(viewer, from)->exec_order;
+
+    while (1) {
+        long best = -1;
+        for (int i = 0; i < viewer->watchpoint_count; i++) {
+            TraceWatch *watch = &viewer->watches[viewer->watchpoints[i].watch];
+            int change = watch_change_at(watch, step > 0 ? seq : seq - 1);
+            if (step > 0) {
+                change++;
+            }
+            if (change < 0 || change >= watch->change_count) {
+                continue;
+            }
+            long candidate = watch->changes[change].seq;
+            if (best < 0 || (step > 0 ? candidate < best : candidate > best)) {
+                best = candidate;
+                *watchpoint = i;
+            }
+        }
+        if (best < 0) {
+            return -1;
+        }
+        // A change on a line that was dropped is skipped
+        int index = find_entry_by_exec(viewer, best);
+        if (index >= 0) {
+            return index;
+        }
+        seq = best;
+    }
+}
+
+static void print_watch_hit(TraceViewer *viewer, const char *title, const char *expression) {
+    printf("\n\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("\033[1;35m%s\033[0m\n", title);
+    printf("\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    for (int i = 0; i < viewer->watchpoint_count; i++) {
+        Watchpoint *wp = &viewer->watchpoints[i];
+        if (strcmp(wp->variable, expression) == 0) {
+            const char *value = watch_value_at(viewer, wp->watch, viewer->current_entry);
+            printf("\033[1;36mWatch '%s' changed to %s\033[0m\n", expression, value ? value : "?");
+        }
+    }
+    print_current_entry(viewer);
+}
+
 // Continue to next breakpoint or watchpoint (forward)
 void continue_to_breakpoint(TraceViewer *viewer) {
     if (viewer->breakpoint_count == 0 && viewer->watchpoint_count == 0) {
@@ -266,11 +859,29 @@ void continue_to_breakpoint(TraceViewer *viewer) {
         return;
     }
     
+    if (watch_channel_only(viewer)) {
+        int watchpoint;
+        int index = next_watch_change(viewer, viewer->current_entry, 1, &watchpoint);
+        if (index >= 0) {
+            viewer->current_entry = index;
+            print_watch_hit(viewer, "👁 WATCHPOINT HIT", viewer->watchpoints[watchpoint].variable);
+            return;
+        }
+        printf("\033[1;33m⚠ No more breakpoints or watchpoints ahead. Jumping to end of trace.\033[0m\n");
+        viewer->current_entry = viewer->entry_count - 1;
+        print_current_entry(viewer);
+        return;
+    }
+
     // Initialize previous state to current entry before searching
     update_variable_state(viewer, viewer->current_entry);
     
     // Search forward from current position
     for (int i = viewer->current_entry + 1; i < viewer->entry_count; i++) {
+        if (!entry_in_filter(viewer, i)) {
+            continue;
+        }
+
         // Check watchpoints first (compares prev_vars with entry i)
         char triggered_var[256];
         char trigger_type[64];
@@ -280,6 +891,10 @@ void continue_to_breakpoint(TraceViewer *viewer) {
             // it at entry i (where we see the new value). We stop at entry i.
             // This means line number will be one past the write, but variables will show new value.
             viewer->current_entry = i;
+            if (wp_type == WATCHPOINT_VALUE) {
+                print_watch_hit(viewer, "👁 WATCHPOINT HIT", triggered_var);
+                return;
+            }
             printf("\n\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
             printf("\033[1;35m👁 WATCHPOINT HIT\033[0m\n");
             printf("\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
@@ -318,12 +933,31 @@ void reverse_continue_to_breakpoint(TraceViewer *viewer) {
         return;
     }
     
+    if (watch_channel_only(viewer)) {
+        int watchpoint;
+        int index = next_watch_change(viewer, viewer->current_entry, -1, &watchpoint);
+        if (index >= 0) {
+            viewer->current_entry = index;
+            print_watch_hit(viewer, "⟲ WATCHPOINT HIT (REVERSE)", viewer->watchpoints[watchpoint].variable);
+            return;
+        }
+        printf("\033[1;33m⚠ No more breakpoints or watchpoints behind. Jumping to beginning of trace.\033[0m\n");
+        viewer->current_entry = 0;
+        print_current_entry(viewer);
+        return;
+    }
+
     // Search backward from current position
     // For reverse, we need to check each position with the previous position as context
     for (int i = viewer->current_entry - 1; i >= 0; i--) {
-        // Initialize previous state to one before i (or empty if i is 0)
-        if (i > 0) {
-            update_variable_state(viewer, i - 1);
+        if (!entry_in_filter(viewer, i)) {
+            continue;
+        }
+
+        // Initialize previous state to the entry before i (or empty if there is none)
+        int previous = step_entry(viewer, i, -1);
+        if (previous >= 0) {
+            update_variable_state(viewer, previous);
         } else {
             viewer->prev_var_count = 0;  // No previous state for first entry
         }
@@ -335,6 +969,10 @@ void reverse_continue_to_breakpoint(TraceViewer *viewer) {
         if (check_watchpoint_triggered(viewer, i, triggered_var, trigger_type, &wp_type)) {
             // Stop at entry i where we detected the change
             viewer->current_entry = i;
+            if (wp_type == WATCHPOINT_VALUE) {
+                print_watch_hit(viewer, "⟲ WATCHPOINT HIT (REVERSE)", triggered_var);
+                return;
+            }
             printf("\n\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
             printf("\033[1;35m⟲ WATCHPOINT HIT (REVERSE)\033[0m\n");
             printf("\033[1;33m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
@@ -515,14 +1153,31 @@ void add_watchpoint(TraceViewer *viewer, const char *variable, WatchpointType ty
         }
     }
     
+    // Expressions the recorder evaluated are followed through the watch
+    // channel; anything else must be a variable name
+    load_watches(viewer);
+    int watch = -1;
+    for (int i = 0; i < viewer->watch_count; i++) {
+        if (strcmp(watch_expression(viewer, i), variable) == 0) {
+            watch = i;
+            type = WATCHPOINT_VALUE;
+        }
+    }
+    if (watch < 0 && !is_python_identifier(variable)) {
+        printf("\033[1;31m✗ '%s' was not recorded as a watch expression\033[0m\n", variable);
+        return;
+    }
+
     Watchpoint *wp = &viewer->watchpoints[viewer->watchpoint_count];
     strncpy(wp->variable, variable, sizeof(wp->variable) - 1);
     wp->variable[sizeof(wp->variable) - 1] = '\0';
     wp->type = type;
+    wp->watch = watch;
     viewer->watchpoint_count++;
     
     const char *type_str = (type == WATCHPOINT_READ) ? "read" : 
-                          (type == WATCHPOINT_WRITE) ? "write" : "read/write";
+                          (type == WATCHPOINT_WRITE) ? "write" :
+                          (type == WATCHPOINT_VALUE) ? "recorded value" : "read/write";
     printf("\033[1;32m✓ Watchpoint set on '%s' (type: %s)\033[0m\n", variable, type_str);
 }
 
@@ -538,9 +1193,16 @@ void list_watchpoints(TraceViewer *viewer) {
     printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n\n");
     
     for (int i = 0; i < viewer->watchpoint_count; i++) {
-        const char *type_str = (viewer->watchpoints[i].type == WATCHPOINT_READ) ? "read" :
-                              (viewer->watchpoints[i].type == WATCHPOINT_WRITE) ? "write" : "read/write";
-        printf("  %d. \033[1;32m%s\033[0m (%s)\n", i + 1, viewer->watchpoints[i].variable, type_str);
+        Watchpoint *wp = &viewer->watchpoints[i];
+        if (wp->type == WATCHPOINT_VALUE) {
+            const char *value = watch_value_at(viewer, wp->watch, viewer->current_entry);
+            printf("  %d. \033[1;32m%s\033[0m = %s (%d changes)\n", i + 1, wp->variable,
+                   value ? value : "(no value yet)", viewer->watches[wp->watch].change_count);
+            continue;
+        }
+        const char *type_str = (wp->type == WATCHPOINT_READ) ? "read" :
+                              (wp->type == WATCHPOINT_WRITE) ? "write" : "read/write";
+        printf("  %d. \033[1;32m%s\033[0m (%s)\n", i + 1, wp->variable, type_str);
     }
     
     printf("\nTotal: \033[1;32m%d\033[0m watchpoint(s)\n\n", viewer->watchpoint_count);
@@ -573,18 +1235,31 @@ int check_watchpoint_triggered(TraceViewer *viewer, int entry_index, char *trigg
         return 0;
     }
     
-    TraceEntry *entry = &viewer->entries[entry_index];
+    TraceEntry *entry = get_entry(viewer, entry_index);
     
     // Parse current variables
     VarState curr_vars[MAX_VARS];
     int curr_count = 0;
-    parse_variables(entry->variables, curr_vars, &curr_count, MAX_VARS);
+    parse_variables(entry_variables(viewer, entry_index), curr_vars, &curr_count, MAX_VARS);
     
     // Check each watchpoint
     for (int i = 0; i < viewer->watchpoint_count; i++) {
         Watchpoint *wp = &viewer->watchpoints[i];
         int read_triggered = 0;
         int write_triggered = 0;
+
+        if (wp->type == WATCHPOINT_VALUE) {
+            TraceWatch *watch = &viewer->watches[wp->watch];
+            int change = watch_change_at(watch, entry->exec_order);
+            if (change >= 0 && watch->changes[change].seq == entry->exec_order) {
+                strncpy(triggered_var, wp->variable, 255);
+                triggered_var[255] = '\0';
+                strcpy(trigger_type, "changed");
+                *wp_type = wp->type;
+                return 1;
+            }
+            continue;
+        }
         
         // Check for write
         if (wp->type == WATCHPOINT_WRITE || wp->type == WATCHPOINT_BOTH) {
@@ -623,36 +1298,42 @@ int check_watchpoint_triggered(TraceViewer *viewer, int entry_index, char *trigg
 
 // Update variable state tracking
 void update_variable_state(TraceViewer *viewer, int entry_index) {
-    TraceEntry *entry = &viewer->entries[entry_index];
-    parse_variables(entry->variables, viewer->prev_vars, &viewer->prev_var_count, MAX_VARS);
+    parse_variables(entry_variables(viewer, entry_index), viewer->prev_vars, &viewer->prev_var_count, MAX_VARS);
 }
 
-// Read trace file into memory
-int read_trace_file(const char *filename, TraceViewer *viewer) {
-    FILE *file = fopen(filename, "r");
-    if (!file) {
-        perror("Error opening trace file");
-        return 0;
+// Make room for one more entry, and its frame id if frames is not NULL
+static int reserve_entry(TraceViewer *viewer, int *capacity, uint64_t **frames) {
+    if (viewer->entry_count < *capacity) {
+        return 1;
     }
 
-    viewer->entries = malloc(MAX_LINES * sizeof(TraceEntry));
-    if (!viewer->entries) {
+    int grown_capacity = *capacity ? *capacity * 2 : INITIAL_ENTRIES;
+    TraceEntry *entries = realloc(viewer->entries, grown_capacity * sizeof(TraceEntry));
+    if (!entries) {
         fprintf(stderr, "Memory allocation failed\n");
-        fclose(file);
         return 0;
     }
+    viewer->entries = entries;
+    if (frames) {
+        uint64_t *grown = realloc(*frames, grown_capacity * sizeof(uint64_t));
+        if (!grown) {
+            fprintf(stderr, "Memory allocation failed\n");
+            return 0;
+        }
+        *frames = grown;
+    }
+    *capacity = grown_capacity;
+    return 1;
+}
 
-    viewer->entry_count = 0;
-    viewer->breakpoint_count = 0;  // Initialize breakpoint count
-    viewer->watchpoint_count = 0;  // Initialize watchpoint count
-    viewer->prev_var_count = 0;    // Initialize variable state count
-    viewer->eval_temp_file[0] = '\0';
-    viewer->eval_temp_file_ready = 0;
+// Read a legacy text trace (one "|||"-separated entry per line)
+static int read_text_trace(FILE *file, TraceViewer *viewer) {
     char *buffer = NULL;
     size_t buffer_size = 0;
     int first_line = 1;
+    int capacity = 0;
 
-    while (getline(&buffer, &buffer_size, file) != -1 && viewer->entry_count < MAX_LINES) {
+    while (getline(&buffer, &buffer_size, file) != -1) {
         // Skip header line
         if (first_line) {
             first_line = 0;
@@ -675,16 +1356,1289 @@ int read_trace_file(const char *filename, TraceViewer *viewer) {
         }
 
         TraceEntry entry;
-        if (parse_trace_line(buffer, &entry)) {
+        if (parse_trace_line(viewer, buffer, &entry)) {
+            if (!reserve_entry(viewer, &capacity, NULL)) {
+                free(buffer);
+                return 0;
+            }
             viewer->entries[viewer->entry_count] = entry;
             viewer->entry_count++;
         }
     }
 
-    free(buffer);
+    free(buffer);
+    return 1;
+}
+
+static int frame_cache_add(FrameCache *cache, uint64_t name, const unsigned char *value,
+                           size_t length, int index) {
+    if (cache->count == cache->capacity) {
+        int capacity = cache->capacity ? cache->capacity * 2 : 32;
+        VarValue *vars = realloc(cache->vars, capacity * sizeof(VarValue));
+        if (!vars) {
+            fprintf(stderr, "Memory allocation failed\n");
+            return 0;
+        }
+        cache->vars = vars;
+        cache->capacity = capacity;
+    }
+    if (index < 0 || index > cache->count) {
+        index = cache->count;
+    }
+    memmove(&cache->vars[index + 1], &cache->vars[index],
+            (cache->count - index) * sizeof(VarValue));
+    cache->vars[index].name = name;
+    cache->vars[index].value = value;
+    cache->vars[index].length = length;
+    cache->count++;
+    return 1;
+}
+
+static int frame_cache_find(FrameCache *cache, uint64_t name) {
+    for (int i = 0; i < cache->count; i++) {
+        if (cache->vars[i].name == name) {
+            return i;
+        }
+    }
+    return -1;
+}
+
+// Read "varint len, bytes" at *pos
+static int read_value(const unsigned char **pos, const unsigned char *end,
+                      const unsigned char **value, size_t *length) {
+    uint64_t value_length;
+    if (!trace_get_varint(pos, end, &value_length) || value_length > (uint64_t)(end - *pos)) {
+        return 0;
+    }
+    *value = *pos;
+    *length = value_length;
+    *pos += value_length;
+    return 1;
+}
+
+// Replace the cached variables with a full snapshot
+static int apply_snapshot(FrameCache *cache, const unsigned char *pos, const unsigned char *end) {
+    cache->count = 0;
+    while (pos < end) {
+        uint64_t name;
+        const unsigned char *value;
+        size_t length;
+        if (!trace_get_varint(&pos, end, &name) || !read_value(&pos, end, &value, &length) ||
+            !frame_cache_add(cache, name, value, length, -1)) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+// Apply the changes of a delta entry to the cached variables
+static int apply_delta(FrameCache *cache, const unsigned char *pos, const unsigned char *end) {
+    while (pos < end) {
+        uint64_t name, op, index;
+        const unsigned char *value;
+        size_t length;
+        if (!trace_get_varint(&pos, end, &name) || !trace_get_varint(&pos, end, &op)) {
+            return 0;
+        }
+
+        int found = frame_cache_find(cache, name);
+        if (op == VAR_DELETE) {
+            if (found >= 0) {
+                memmove(&cache->vars[found], &cache->vars[found + 1],
+                        (cache->count - found - 1) * sizeof(VarValue));
+                cache->count--;
+            }
+        } else if (op == VAR_SET) {
+            if (!read_value(&pos, end, &value, &length)) {
+                return 0;
+            }
+            if (found >= 0) {
+                cache->vars[found].value = value;
+                cache->vars[found].length = length;
+            } else if (!frame_cache_add(cache, name, value, length, -1)) {
+                return 0;
+            }
+        } else if (op == VAR_INSERT) {
+            if (!trace_get_varint(&pos, end, &index) || !read_value(&pos, end, &value, &length) ||
+                !frame_cache_add(cache, name, value, length, (int)index)) {
+                return 0;
+            }
+        } else {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+// Build the "name=value;..." variable list of the cached variables
+static char* format_variables(TraceViewer *viewer, FrameCache *cache) {
+    size_t total = 1;
+    for (int i = 0; i < cache->count; i++) {
+        uint64_t name = cache->vars[i].name;
+        const char *text = name < viewer->string_id_count && viewer->string_ids[name]
+                           ? viewer->string_ids[name] : "?";
+        total += strlen(text) + 2 + cache->vars[i].length;
+    }
+
+    char *variables = malloc(total);
+    if (!variables) {
+        fprintf(stderr, "Memory allocation failed\n");
+        return NULL;
+    }
+
+    char *out = variables;
+    for (int i = 0; i < cache->count; i++) {
+        uint64_t name = cache->vars[i].name;
+        const char *text = name < viewer->string_id_count && viewer->string_ids[name]
+                           ? viewer->string_ids[name] : "?";
+        size_t name_length = strlen(text);
+        if (i > 0) {
+            *out++ = ';';
+        }
+        memcpy(out, text, name_length);
+        out += name_length;
+        *out++ = '=';
+        memcpy(out, cache->vars[i].value, cache->vars[i].length);
+        out += cache->vars[i].length;
+    }
+    *out = '\0';
+    return variables;
+}
+
+// Variables of an entry as a "name=value;..." list. Binary traces store most
+// entries as changes since the previous entry of the same frame, so the list
+// is rebuilt from the frame's last keyframe (or a cached later state) and
+// kept for the VARIABLE_CACHE_SIZE most recently built entries.
+const char* entry_variables(TraceViewer *viewer, int index) {
+    TraceEntry *entry = get_entry(viewer, index);
+    if (entry->variables) {
+        return entry->variables;
+    }
+
+    // Walk back to a keyframe or to an entry whose state is cached
+    int *chain = NULL;
+    int chain_length = 0;
+    int chain_capacity = 0;
+    FrameCache *cache = NULL;
+    int node = index;
+
+    while (node >= 0) {
+        for (int i = 0; i < FRAME_CACHE_SIZE; i++) {
+            if (viewer->frame_cache[i].entry_index == node) {
+                cache = &viewer->frame_cache[i];
+                break;
+            }
+        }
+        if (cache) {
+            break;
+        }
+
+        if (chain_length == chain_capacity) {
+            chain_capacity = chain_capacity ? chain_capacity * 2 : 64;
+            int *grown = realloc(chain, chain_capacity * sizeof(int));
+            if (!grown) {
+                free(chain);
+                return "";
+            }
+            chain = grown;
+        }
+        chain[chain_length++] = node;
+
+        if (!(get_entry(viewer, node)->flags & LINE_DELTA)) {
+            break;
+        }
+        node = get_entry(viewer, node)->prev_in_frame;
+    }
+
+    if (!cache) {
+        cache = &viewer->frame_cache[0];
+        for (int i = 1; i < FRAME_CACHE_SIZE; i++) {
+            if (viewer->frame_cache[i].last_used < cache->last_used) {
+                cache = &viewer->frame_cache[i];
+            }
+        }
+        cache->count = 0;
+    }
+    cache->entry_index = -1;
+
+    int ok = 1;
+    for (int i = chain_length - 1; i >= 0 && ok; i--) {
+        TraceEntry *step = get_entry(viewer, chain[i]);
+        if (step->flags & LINE_DELTA) {
+            ok = apply_delta(cache, step->vars_start, step->vars_end);
+        } else {
+            ok = apply_snapshot(cache, step->vars_start, step->vars_end);
+        }
+    }
+    free(chain);
+
+    if (!ok) {
+        cache->count = 0;
+        entry->variables = xstrdup("");
+    } else {
+        cache->entry_index = index;
+        cache->last_used = ++viewer->frame_cache_clock;
+        entry->variables = format_variables(viewer, cache);
+    }
+    if (!entry->variables) {
+        return "";
+    }
+
+    // Drop the oldest built list
+    int *slot = &viewer->materialized[viewer->materialized_next];
+    if (*slot >= 0 && *slot != index) {
+        free(get_entry(viewer, *slot)->variables);
+        get_entry(viewer, *slot)->variables = NULL;
+    }
+    *slot = index;
+    viewer->materialized_next = (viewer->materialized_next + 1) % VARIABLE_CACHE_SIZE;
+
+    return entry->variables;
+}
+
+// Store a REC_STRING record in the string id table
+static int register_string(TraceViewer *viewer, const unsigned char *payload,
+                           const unsigned char *end) {
+    uint64_t id;
+    if (!trace_get_varint(&payload, end, &id) || payload >= end) {
+        return 0;
+    }
+    int kind = *payload++;
+
+    // Every segment of a segmented trace repeats the strings before it
+    if (id < viewer->string_id_count && viewer->string_ids[id]) {
+        return 1;
+    }
+    if (id >= viewer->string_id_count) {
+        uint64_t capacity = viewer->string_id_count ? viewer->string_id_count : 1024;
+        while (capacity <= id) {
+            capacity *= 2;
+        }
+        const char **grown = realloc(viewer->string_ids, capacity * sizeof(char *));
+        if (!grown) {
+            fprintf(stderr, "Memory allocation failed\n");
+            return 0;
+        }
+        memset(grown + viewer->string_id_count, 0,
+               (capacity - viewer->string_id_count) * sizeof(char *));
+        viewer->string_ids = grown;
+        viewer->string_id_count = capacity;
+    }
+
+    size_t text_length = end - payload;
+    char *text = malloc(text_length + 1);
+    if (text) {
+        memcpy(text, payload, text_length);
+        text[text_length] = '\0';
+    }
+    viewer->string_ids[id] = keep_string(viewer, text);
+    if (kind == STR_FILE && viewer->string_ids[id]) {
+        add_trace_file(viewer, viewer->string_ids[id], 0);
+    }
+    return viewer->string_ids[id] != NULL;
+}
+
+// Store a REC_WATCH record with the other changes of its expression, in seq
+// order: segments may be opened in any order. Blocks restate each value;
+// load_watches() drops the repeats once every block is in.
+static int register_watch(TraceViewer *viewer, const unsigned char *payload,
+                          const unsigned char *end) {
+    uint64_t seq, expression, length;
+    if (!trace_get_varint(&payload, end, &seq) || !trace_get_varint(&payload, end, &expression) ||
+        !trace_get_varint(&payload, end, &length) || length > (uint64_t)(end - payload)) {
+        return 0;
+    }
+
+    TraceWatch *watch = NULL;
+    for (int i = 0; i < viewer->watch_count; i++) {
+        if (viewer->watches[i].expression == expression) {
+            watch = &viewer->watches[i];
+        }
+    }
+    if (!watch) {
+        TraceWatch *grown = realloc(viewer->watches, (viewer->watch_count + 1) * sizeof(TraceWatch));
+        if (!grown) {
+            fprintf(stderr, "Memory allocation failed\n");
+            return 0;
+        }
+        viewer->watches = grown;
+        watch = &viewer->watches[viewer->watch_count++];
+        memset(watch, 0, sizeof(*watch));
+        watch->expression = expression;
+    }
+
+    int at = watch_change_at(watch, (long)seq) + 1;
+    if (at > 0 && watch->changes[at - 1].seq == (long)seq) {
+        return 1;
+    }
+
+    char *text = malloc(length + 1);
+    if (!text) {
+        fprintf(stderr, "Memory allocation failed\n");
+        return 0;
+    }
+    memcpy(text, payload, length);
+    text[length] = '\0';
+    const char *value = keep_string(viewer, text);
+    if (!value) {
+        return 0;
+    }
+    if (watch->change_count == watch->change_capacity) {
+        int capacity = watch->change_capacity ? watch->change_capacity * 2 : 64;
+        WatchChange *changes = realloc(watch->changes, capacity * sizeof(WatchChange));
+        if (!changes) {
+            fprintf(stderr, "Memory allocation failed\n");
+            return 0;
+        }
+        watch->changes = changes;
+        watch->change_capacity = capacity;
+    }
+    memmove(&watch->changes[at + 1], &watch->changes[at],
+            (watch->change_count - at) * sizeof(WatchChange));
+    watch->changes[at].seq = (long)seq;
+    watch->changes[at].value = value;
+    watch->change_count++;
+    return 1;
+}
+
+// Store a REC_THREAD record
+static int register_thread(TraceViewer *viewer, const unsigned char *payload,
+                           const unsigned char *end) {
+    uint64_t id, ident;
+    if (!trace_get_varint(&payload, end, &id) || !trace_get_varint(&payload, end, &ident)) {
+        return 0;
+    }
+    for (int i = 0; i < viewer->thread_count; i++) {
+        if (viewer->threads[i].id == (int)id) {
+            return 1;
+        }
+    }
+
+    TraceThread *threads = realloc(viewer->threads, (viewer->thread_count + 1) * sizeof(TraceThread));
+    if (!threads) {
+        fprintf(stderr, "Memory allocation failed\n");
+        return 0;
+    }
+    viewer->threads = threads;
+
+    size_t name_length = end - payload;
+    char *name = malloc(name_length + 1);
+    if (name) {
+        memcpy(name, payload, name_length);
+        name[name_length] = '\0';
+    }
+
+    TraceThread *thread = &viewer->threads[viewer->thread_count++];
+    thread->id = (int)id;
+    thread->ident = (unsigned long)ident;
+    thread->name = keep_string(viewer, name);
+    return 1;
+}
+
+// Store a REC_TASK record
+static int register_task(TraceViewer *viewer, const unsigned char *payload,
+                         const unsigned char *end) {
+    uint64_t id, thread;
+    if (!trace_get_varint(&payload, end, &id) || !trace_get_varint(&payload, end, &thread)) {
+        return 0;
+    }
+    if (find_task(viewer, (int)id)) {
+        return 1;
+    }
+
+    TraceTask *tasks = realloc(viewer->tasks, (viewer->task_count + 1) * sizeof(TraceTask));
+    if (!tasks) {
+        fprintf(stderr, "Memory allocation failed\n");
+        return 0;
+    }
+    viewer->tasks = tasks;
+
+    size_t name_length = end - payload;
+    char *name = malloc(name_length + 1);
+    if (name) {
+        memcpy(name, payload, name_length);
+        name[name_length] = '\0';
+    }
+
+    TraceTask *task = &viewer->tasks[viewer->task_count++];
+    memset(task, 0, sizeof(*task));
+    task->id = (int)id;
+    task->thread = (int)thread;
+    task->name = keep_string(viewer, name);
+    return 1;
+}
+
+// Decode a REC_LINE record. The entry keeps pointers into the payload.
+static int parse_line_record(TraceViewer *viewer, const unsigned char *payload,
+                             const unsigned char *end, TraceEntry *entry, uint64_t *frame) {
+    const char **strings = viewer->string_ids;
+    uint64_t seq, flags, file, line, code, thread = 0, task = 0, depth = 0, function = 0;
+    uint64_t elided = 0;
+
+    *frame = 0;
+    if (!trace_get_varint(&payload, end, &seq) ||
+        !trace_get_varint(&payload, end, &flags) ||
+        !trace_get_varint(&payload, end, &file) ||
+        !trace_get_varint(&payload, end, &line) ||
+        !trace_get_varint(&payload, end, &code) ||
+        ((flags & LINE_HAS_FRAME) && !trace_get_varint(&payload, end, frame)) ||
+        ((flags & LINE_HAS_THREAD) && !trace_get_varint(&payload, end, &thread)) ||
+        ((flags & LINE_HAS_TASK) && !trace_get_varint(&payload, end, &task)) ||
+        ((flags & LINE_HAS_CALL) && (!trace_get_varint(&payload, end, &depth) ||
+                                     !trace_get_varint(&payload, end, &function))) ||
+        ((flags & LINE_HAS_ELIDED) && !trace_get_varint(&payload, end, &elided)) ||
+        file >= viewer->string_id_count || code >= viewer->string_id_count ||
+        function >= viewer->string_id_count ||
+        !strings[file] || !strings[code]) {
+        return 0;
+    }
+
+    entry->exec_order = (long)seq;
+    entry->filename = strings[file];
+    entry->line_number = (int)line;
+    entry->code = strings[code];
+    entry->variables = NULL;
+    entry->flags = (int)flags;
+    entry->thread = (int)thread;
+    entry->task = (int)task;
+    entry->depth = (int)depth;
+    entry->function = (flags & LINE_HAS_CALL) ? strings[function] : NULL;
+    entry->elided = (long)elided;
+    entry->prev_in_frame = -1;
+    entry->vars_start = payload;
+    entry->vars_end = end;
+    return 1;
+}
+
+// Link entries[first..first+count) to the previous entry of their frame.
+// Frame ids grow as frames are created, so a table indexed from the smallest
+// id in the range is enough.
+static void link_frames(TraceEntry *entries, int first, int count, const uint64_t *frames) {
+    uint64_t low = UINT64_MAX, high = 0;
+    for (int i = 0; i < count; i++) {
+        if (entries[i].flags & LINE_HAS_FRAME) {
+            low = frames[i] < low ? frames[i] : low;
+            high = frames[i] > high ? frames[i] : high;
+        }
+    }
+
+    int *frame_last = low <= high ? malloc((high - low + 1) * sizeof(int)) : NULL;
+    if (frame_last) {
+        memset(frame_last, 0xff, (high - low + 1) * sizeof(int));
+    }
+
+    for (int i = 0; i < count; i++) {
+        TraceEntry *entry = &entries[i];
+        if (frame_last && (entry->flags & LINE_HAS_FRAME)) {
+            entry->prev_in_frame = frame_last[frames[i] - low];
+            frame_last[frames[i] - low] = first + i;
+        }
+
+        // A delta without an earlier entry of its frame cannot be decoded
+        if ((entry->flags & LINE_DELTA) && entry->prev_in_frame < 0) {
+            entry->variables = xstrdup("");
+        }
+    }
+    free(frame_last);
+}
+
+// Lines only carry their task when their thread's task changes, and every
+// thread starts a block outside of any task
+static void link_tasks(TraceEntry *entries, int count) {
+    int *current = NULL;
+    int thread_count = 0;
+
+    for (int i = 0; i < count; i++) {
+        TraceEntry *entry = &entries[i];
+        if (entry->thread >= thread_count) {
+            int grown_count = entry->thread + 16;
+            int *grown = realloc(current, grown_count * sizeof(int));
+            if (!grown) {
+                break;
+            }
+            memset(grown + thread_count, 0, (grown_count - thread_count) * sizeof(int));
+            current = grown;
+            thread_count = grown_count;
+        }
+
+        if (entry->flags & LINE_HAS_TASK) {
+            current[entry->thread] = entry->task;
+        } else {
+            entry->task = current[entry->thread];
+        }
+    }
+    free(current);
+}
+
+// Depth and function of each thread while decoding a block. Lines only carry
+// them when they differ from the thread's last REC_CALL or line that did.
+typedef struct {
+    int depth;
+    const char *function;
+    int called;             // A REC_CALL is waiting for the thread's next line
+} CallState;
+
+typedef struct {
+    CallState *threads;
+    int count;
+} CallTracker;
+
+static CallState* call_state(CallTracker *tracker, int thread) {
+    if (thread >= tracker->count) {
+        int count = thread + 16;
+        CallState *threads = realloc(tracker->threads, count * sizeof(CallState));
+        if (!threads) {
+            return NULL;
+        }
+        memset(threads + tracker->count, 0, (count - tracker->count) * sizeof(CallState));
+        tracker->threads = threads;
+        tracker->count = count;
+    }
+    return &tracker->threads[thread];
+}
+
+// Apply a REC_CALL or REC_RETURN record
+static void track_call_record(TraceViewer *viewer, CallTracker *tracker, int kind,
+                              const unsigned char *payload, const unsigned char *end) {
+    uint64_t thread, depth, function = 0;
+    if (!trace_get_varint(&payload, end, &thread) || !trace_get_varint(&payload, end, &depth) ||
+        (kind == REC_CALL && !trace_get_varint(&payload, end, &function))) {
+        return;
+    }
+    CallState *state = call_state(tracker, (int)thread);
+    if (!state) {
+        return;
+    }
+
+    if (kind == REC_CALL) {
+        state->depth = (int)depth;
+        state->function = function < viewer->string_id_count ? viewer->string_ids[function] : NULL;
+        state->called = 1;
+    } else {
+        // A call that returned without running a line leaves no trace
+        state->called = 0;
+    }
+}
+
+// Fill in the depth and function of a line that does not carry them
+static void track_line(CallTracker *tracker, TraceEntry *entry) {
+    CallState *state = call_state(tracker, entry->thread);
+    if (!state) {
+        return;
+    }
+
+    if (entry->flags & LINE_HAS_CALL) {
+        state->depth = entry->depth;
+        state->function = entry->function;
+    } else {
+        entry->depth = state->depth;
+        entry->function = state->function;
+    }
+    if (state->called) {
+        entry->flags |= ENTRY_CALL_START;
+        state->called = 0;
+    }
+}
+
+// Read a version 1 binary trace, where records follow the header directly.
+// Entries keep pointers into the mapping, which stays alive until cleanup.
+static int read_binary_trace(const unsigned char *data, size_t size, TraceViewer *viewer) {
+    uint64_t *frames = NULL;
+    int capacity = 0;
+    const unsigned char *pos = data + TRACE_HEADER_SIZE;
+    const unsigned char *end = data + size;
+    CallTracker calls = {0};
+
+    while (pos < end) {
+        int kind = *pos++;
+        uint64_t length;
+        if (!trace_get_varint(&pos, end, &length) || length > (uint64_t)(end - pos)) {
+            break;  // Truncated record, e.g. the recorder is still running
+        }
+        const unsigned char *payload = pos;
+        pos += length;
+
+        if (kind == REC_STRING) {
+            register_string(viewer, payload, pos);
+        } else if (kind == REC_THREAD) {
+            register_thread(viewer, payload, pos);
+        } else if (kind == REC_TASK) {
+            register_task(viewer, payload, pos);
+        } else if (kind == REC_CALL || kind == REC_RETURN) {
+            track_call_record(viewer, &calls, kind, payload, pos);
+        } else if (kind == REC_LINE) {
+            if (!reserve_entry(viewer, &capacity, &frames)) {
+                free(frames);
+                free(calls.threads);
+                return 0;
+            }
+            TraceEntry *entry = &viewer->entries[viewer->entry_count];
+            if (!parse_line_record(viewer, payload, pos, entry, &frames[viewer->entry_count])) {
+                continue;
+            }
+            track_line(&calls, entry);
+
+            // Sequence numbers are consecutive unless the recorder dropped lines
+            if (viewer->entry_count > 0 &&
+                entry->exec_order > viewer->entries[viewer->entry_count - 1].exec_order + 1) {
+                viewer->dropped_events += entry->exec_order - viewer->entries[viewer->entry_count - 1].exec_order - 1;
+            }
+            viewer->entry_count++;
+        }
+    }
+
+    link_frames(viewer->entries, 0, viewer->entry_count, frames);
+    link_tasks(viewer->entries, viewer->entry_count);
+    free(frames);
+    free(calls.threads);
+    return 1;
+}
+
+// Parse a block header at *pos. compressed_length is absent for index blocks.
+static int read_block_header(const unsigned char **pos, const unsigned char *end, int *type,
+                             uint64_t *compressed_length, uint64_t *raw_length,
+                             uint64_t *first_seq, uint64_t *event_count) {
+    if (*pos >= end) {
+        return 0;
+    }
+    *type = *(*pos)++;
+    if (!trace_get_varint(pos, end, compressed_length)) {
+        return 0;
+    }
+    if (*type == BLOCK_INDEX) {
+        return 1;
+    }
+    return trace_get_varint(pos, end, raw_length) && trace_get_varint(pos, end, first_seq) &&
+           trace_get_varint(pos, end, event_count) && *compressed_length <= (uint64_t)(end - *pos);
+}
+
+static unsigned char* inflate_block(const unsigned char *data, size_t compressed_length,
+                                    size_t raw_length) {
+    unsigned char *raw = malloc(raw_length ? raw_length : 1);
+    uLongf length = raw_length;
+    if (!raw) {
+        fprintf(stderr, "Memory allocation failed\n");
+        return NULL;
+    }
+    if (uncompress(raw, &length, data, compressed_length) != Z_OK || length != raw_length) {
+        fprintf(stderr, "Corrupt block in trace file\n");
+        free(raw);
+        return NULL;
+    }
+    return raw;
+}
+
+// Add a block found in the index or by walking the file. Strings and watch
+// changes are loaded right away; events blocks are loaded by get_entry().
+static int add_block(TraceViewer *viewer, const unsigned char *data, size_t size, size_t offset) {
+    const unsigned char *pos = data + offset;
+    const unsigned char *end = data + size;
+    int type;
+    uint64_t compressed_length, raw_length = 0, first_seq = 0, event_count = 0;
+
+    if (!read_block_header(&pos, end, &type, &compressed_length, &raw_length,
+                           &first_seq, &event_count) || type == BLOCK_INDEX) {
+        return 0;
+    }
+
+    if (type == BLOCK_STRINGS && !viewer->skip_strings) {
+        unsigned char *raw = inflate_block(pos, compressed_length, raw_length);
+        if (!raw) {
+            return 0;
+        }
+        const unsigned char *record = raw;
+        const unsigned char *raw_end = raw + raw_length;
+        while (record < raw_end) {
+            int kind = *record++;
+            uint64_t length;
+            if (!trace_get_varint(&record, raw_end, &length) || length > (uint64_t)(raw_end - record)) {
+                break;
+            }
+            if (kind == REC_STRING) {
+                register_string(viewer, record, record + length);
+            } else if (kind == REC_THREAD) {
+                register_thread(viewer, record, record + length);
+            } else if (kind == REC_TASK) {
+                register_task(viewer, record, record + length);
+            }
+            record += length;
+        }
+        free(raw);
+    } else if (type == BLOCK_WATCH) {
+        unsigned char *raw = inflate_block(pos, compressed_length, raw_length);
+        if (!raw) {
+            return 0;
+        }
+        const unsigned char *record = raw;
+        const unsigned char *raw_end = raw + raw_length;
+        while (record < raw_end) {
+            int kind = *record++;
+            uint64_t length;
+            if (!trace_get_varint(&record, raw_end, &length) || length > (uint64_t)(raw_end - record)) {
+                break;
+            }
+            if (kind == REC_WATCH) {
+                register_watch(viewer, record, record + length);
+            }
+            record += length;
+        }
+        free(raw);
+    } else if (type == BLOCK_EVENTS && event_count > 0) {
+        if (viewer->block_count % 256 == 0) {
+            TraceBlock *blocks = realloc(viewer->blocks, (viewer->block_count + 256) * sizeof(TraceBlock));
+            if (!blocks) {
+                fprintf(stderr, "Memory allocation failed\n");
+                return 0;
+            }
+            viewer->blocks = blocks;
+        }
+
+        TraceBlock *block = &viewer->blocks[viewer->block_count++];
+        memset(block, 0, sizeof(*block));
+        block->map = data;
+        block->data_offset = pos - data;
+        block->compressed_length = compressed_length;
+        block->raw_length = raw_length;
+        block->first_seq = (long)first_seq;
+        block->event_count = (int)event_count;
+        block->first_index = viewer->entry_count;
+
+        // Blocks are dropped whole, so gaps only appear between blocks
+        if (viewer->block_count > 1) {
+            TraceBlock *prev = &viewer->blocks[viewer->block_count - 2];
+            long expected = prev->first_seq + prev->event_count;
+            if (block->first_seq > expected) {
+                viewer->dropped_events += block->first_seq - expected;
+            }
+        }
+        viewer->entry_count += block->event_count;
+    }
+    return (pos - data) + compressed_length;
+}
+
+// Read a version 2 (block compressed) trace: find the blocks through the
+// index at the end of the file, or by walking them if the index is missing
+static int read_block_trace(const unsigned char *data, size_t size, TraceViewer *viewer) {
+    const unsigned char *end = data + size;
+
+    if (size >= TRACE_HEADER_SIZE + TRACE_TRAILER_SIZE &&
+        memcmp(end - 4, TRACE_TRAILER_MAGIC, 4) == 0) {
+        uint64_t index_offset = 0;
+        for (int i = 0; i < 8; i++) {
+            index_offset |= (uint64_t)end[-TRACE_TRAILER_SIZE + i] << (8 * i);
+        }
+
+        const unsigned char *pos = data + index_offset;
+        const unsigned char *index_end = end - TRACE_TRAILER_SIZE;
+        uint64_t payload_length, count;
+        if (index_offset < size && *pos++ == BLOCK_INDEX &&
+            trace_get_varint(&pos, index_end, &payload_length) &&
+            trace_get_varint(&pos, index_end, &count)) {
+            for (uint64_t i = 0; i < count; i++) {
+                uint64_t offset, compressed_length, raw_length, first_seq, event_count;
+                if (!trace_get_varint(&pos, index_end, &offset) || pos >= index_end) {
+                    break;
+                }
+                pos++;  // Type, also in the block header
+                if (!trace_get_varint(&pos, index_end, &compressed_length) ||
+                    !trace_get_varint(&pos, index_end, &raw_length) ||
+                    !trace_get_varint(&pos, index_end, &first_seq) ||
+                    !trace_get_varint(&pos, index_end, &event_count) ||
+                    offset >= index_offset) {
+                    break;
+                }
+                add_block(viewer, data, index_offset, offset);
+            }
+            return 1;
+        }
+    }
+
+    // No usable index: walk the blocks up to the first truncated one
+    size_t offset = TRACE_HEADER_SIZE;
+    while (offset < size) {
+        int next = add_block(viewer, data, size, offset);
+        if (next <= 0) {
+            break;
+        }
+        offset = next;
+    }
+    return 1;
+}
+
+// Free a loaded block and forget cached state that points into it
+static void unload_block(TraceViewer *viewer, TraceBlock *block) {
+    int first = block->first_index;
+    int last = block->first_index + block->event_count;
+
+    for (int i = 0; i < block->event_count; i++) {
+        free(block->entries[i].variables);
+    }
+    for (int i = 0; i < VARIABLE_CACHE_SIZE; i++) {
+        if (viewer->materialized[i] >= first && viewer->materialized[i] < last) {
+            viewer->materialized[i] = -1;
+        }
+    }
+    for (int i = 0; i < FRAME_CACHE_SIZE; i++) {
+        FrameCache *cache = &viewer->frame_cache[i];
+        if (cache->entry_index >= first && cache->entry_index < last) {
+            cache->entry_index = -1;
+            cache->count = 0;
+        }
+    }
+
+    free(block->entries);
+    free(block->raw);
+    block->entries = NULL;
+    block->raw = NULL;
+    viewer->loaded_blocks--;
+}
+
+static int load_block(TraceViewer *viewer, TraceBlock *block) {
+    if (viewer->loaded_blocks >= BLOCK_CACHE_SIZE) {
+        TraceBlock *oldest = NULL;
+        for (int i = 0; i < viewer->block_count; i++) {
+            TraceBlock *candidate = &viewer->blocks[i];
+            if (candidate->entries && (!oldest || candidate->last_used < oldest->last_used)) {
+                oldest = candidate;
+            }
+        }
+        if (oldest) {
+            unload_block(viewer, oldest);
+        }
+    }
+
+    unsigned char *raw = inflate_block(block->map + block->data_offset, block->compressed_length,
+                                       block->raw_length);
+    TraceEntry *entries = calloc(block->event_count, sizeof(TraceEntry));
+    uint64_t *frames = calloc(block->event_count, sizeof(uint64_t));
+    if (!raw || !entries || !frames) {
+        free(raw);
+        free(entries);
+        free(frames);
+        return 0;
+    }
+
+    int count = 0;
+    const unsigned char *pos = raw;
+    const unsigned char *end = raw + block->raw_length;
+    CallTracker calls = {0};
+    while (pos < end && count < block->event_count) {
+        int kind = *pos++;
+        uint64_t length;
+        if (!trace_get_varint(&pos, end, &length) || length > (uint64_t)(end - pos)) {
+            break;
+        }
+        if (kind == REC_LINE && parse_line_record(viewer, pos, pos + length, &entries[count], &frames[count])) {
+            track_line(&calls, &entries[count]);
+            count++;
+        } else if (kind == REC_CALL || kind == REC_RETURN) {
+            track_call_record(viewer, &calls, kind, pos, pos + length);
+        }
+        pos += length;
+    }
+    free(calls.threads);
+
+    // Keep the index stable if the block holds fewer lines than it claims
+    for (int i = count; i < block->event_count; i++) {
+        entries[i].exec_order = block->first_seq + i;
+        entries[i].filename = "<unavailable>";
+        entries[i].code = "";
+        entries[i].prev_in_frame = -1;
+        entries[i].variables = xstrdup("");
+    }
+
+    link_frames(entries, block->first_index, count, frames);
+    link_tasks(entries, count);
+    free(frames);
+
+    block->raw = raw;
+    block->entries = entries;
+    viewer->loaded_blocks++;
+    return 1;
+}
+
+// Map a segment and add its events blocks at the segment's entry indexes.
+// Its strings are only read if read_strings is set: the last segment holds
+// every strings block of the trace.
+static int open_trace_segment(TraceViewer *viewer, TraceSegment *segment, int read_strings) {
+    segment->state = -1;
+    int fd = open(segment->path, O_RDONLY | O_CLOEXEC);
+    struct stat st;
+    if (fd < 0 || fstat(fd, &st) != 0 || st.st_size < TRACE_HEADER_SIZE) {
+        fprintf(stderr, "Cannot open trace segment %s\n", segment->path);
+        if (fd >= 0) {
+            close(fd);
+        }
+        return 0;
+    }
+    void *map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (map == MAP_FAILED) {
+        perror("Error mapping trace segment");
+        return 0;
+    }
+    const unsigned char *data = map;
+    if (memcmp(data, TRACE_MAGIC, TRACE_MAGIC_SIZE) != 0 ||
+        data[TRACE_MAGIC_SIZE] != TRACE_FORMAT_VERSION) {
+        fprintf(stderr, "Not a version %d trace: %s\n", TRACE_FORMAT_VERSION, segment->path);
+        munmap(map, st.st_size);
+        return 0;
+    }
+    segment->map = map;
+    segment->size = st.st_size;
+    segment->state = 1;
+
+    // Read the segment's blocks on their own, then splice them in
+    TraceBlock *blocks = viewer->blocks;
+    int block_count = viewer->block_count;
+    int entry_count = viewer->entry_count;
+    long dropped_events = viewer->dropped_events;
+    viewer->blocks = NULL;
+    viewer->block_count = 0;
+    viewer->entry_count = segment->first_index;
+    viewer->skip_strings = !read_strings;
+    read_block_trace(data, st.st_size, viewer);
+    TraceBlock *added = viewer->blocks;
+    int added_count = viewer->block_count;
+    int added_events = viewer->entry_count - segment->first_index;
+    viewer->skip_strings = 0;
+    viewer->blocks = blocks;
+    viewer->block_count = block_count;
+    viewer->entry_count = entry_count;
+
+    // The manifest's counts fix the entry indexes of later segments, and
+    // its sequence numbers already account for dropped lines
+    if (segment->event_count < 0) {
+        segment->event_count = added_events;
+        if (added_count > 0) {
+            segment->first_seq = added[0].first_seq;
+        }
+    } else {
+        viewer->dropped_events = dropped_events;
+        int end = segment->first_index + segment->event_count;
+        while (added_count > 0 && added[added_count - 1].first_index >= end) {
+            added_count--;
+        }
+        if (added_count > 0 && added[added_count - 1].first_index + added[added_count - 1].event_count > end) {
+            added[added_count - 1].event_count = end - added[added_count - 1].first_index;
+        }
+    }
+
+    int before = 0;
+    while (before < block_count && blocks[before].first_index < segment->first_index) {
+        before++;
+    }
+    int total = block_count + added_count;
+    TraceBlock *merged = malloc(((total + 255) / 256 * 256 + 1) * sizeof(TraceBlock));
+    if (!merged) {
+        fprintf(stderr, "Memory allocation failed\n");
+        free(added);
+        return 0;
+    }
+    memcpy(merged, blocks, before * sizeof(TraceBlock));
+    memcpy(merged + before, added, added_count * sizeof(TraceBlock));
+    memcpy(merged + before + added_count, blocks + before, (block_count - before) * sizeof(TraceBlock));
+    free(added);
+    free(blocks);
+    viewer->blocks = merged;
+    viewer->block_count = total;
+    return 1;
+}
+
+// Segment holding the entry at index
+static TraceSegment* find_segment(TraceViewer *viewer, int index) {
+    int low = 0, high = viewer->segment_count - 1;
+    while (low < high) {
+        int mid = (low + high + 1) / 2;
+        if (viewer->segments[mid].first_index <= index) {
+            low = mid;
+        } else {
+            high = mid - 1;
+        }
+    }
+    return &viewer->segments[low];
+}
+
+// Entry at index. For compressed traces this decompresses the entry's block
+// if needed; the pointer stays valid until BLOCK_CACHE_SIZE other blocks
+// have been used. Segments are opened the first time one of their entries
+// is asked for.
+TraceEntry* get_entry(TraceViewer *viewer, int index) {
+    static TraceEntry unavailable = {
+        .exec_order = -1, .filename = "<unavailable>", .code = "", .variables = "",
+        .prev_in_frame = -1,
+    };
+
+    if (viewer->segments) {
+        TraceSegment *segment = find_segment(viewer, index);
+        if (segment->state == 0) {
+            open_trace_segment(viewer, segment, 0);
+        }
+        if (segment->state < 0 || viewer->block_count == 0) {
+            return &unavailable;
+        }
+    } else if (!viewer->blocks) {
+        return &viewer->entries[index];
+    }
+
+    int low = 0, high = viewer->block_count - 1;
+    while (low < high) {
+        int mid = (low + high + 1) / 2;
+        if (viewer->blocks[mid].first_index <= index) {
+            low = mid;
+        } else {
+            high = mid - 1;
+        }
+    }
+
+    TraceBlock *block = &viewer->blocks[low];
+    if (index - block->first_index >= block->event_count) {
+        return &unavailable;  // In a segment that could not be read
+    }
+    if (!block->entries && !load_block(viewer, block)) {
+        return &unavailable;
+    }
+    block->last_used = ++viewer->block_clock;
+    return &block->entries[index - block->first_index];
+}
+
+// Index of the entry with the given execution number, or -1
+static int find_entry_by_exec(TraceViewer *viewer, long exec_num) {
+    int low = 0, high = viewer->entry_count - 1;
+
+    // Execution numbers increase through the trace
+    while (low <= high) {
+        int mid = low + (high - low) / 2;
+        long order = get_entry(viewer, mid)->exec_order;
+        if (order == exec_num) {
+            return mid;
+        }
+        if (order < exec_num) {
+            low = mid + 1;
+        } else {
+            high = mid - 1;
+        }
+    }
+    return -1;
+}
+
+// Read the watch changes of every segment, then drop the values each block
+// restated without a change
+static void load_watches(TraceViewer *viewer) {
+    if (viewer->watches_loaded) {
+        return;
+    }
+    for (int i = 0; i < viewer->segment_count; i++) {
+        if (viewer->segments[i].state == 0) {
+            open_trace_segment(viewer, &viewer->segments[i], 0);
+        }
+    }
+    for (int i = 0; i < viewer->watch_count; i++) {
+        TraceWatch *watch = &viewer->watches[i];
+        int kept = 0;
+        for (int j = 0; j < watch->change_count; j++) {
+            if (kept == 0 || strcmp(watch->changes[kept - 1].value, watch->changes[j].value) != 0) {
+                watch->changes[kept++] = watch->changes[j];
+            }
+        }
+        watch->change_count = kept;
+    }
+    viewer->watches_loaded = 1;
+}
+
+// Read the manifest of a segmented trace (see traceformat.h). Segments with
+// a known event count are opened by get_entry(); the others, and the last
+// one for the strings of the whole trace, are opened now.
+static int read_manifest(FILE *file, const char *filename, TraceViewer *viewer) {
+    char *line = NULL;
+    size_t line_size = 0;
+    const char *slash = strrchr(filename, '/');
+    int directory_length = slash ? (int)(slash - filename) + 1 : 0;
+    int capacity = 0;
+    int ok = 1;
+
+    if (getline(&line, &line_size, file) == -1 ||
+        strncmp(line, TRACE_MANIFEST_MAGIC " ", strlen(TRACE_MANIFEST_MAGIC) + 1) != 0 ||
+        atoi(line + strlen(TRACE_MANIFEST_MAGIC) + 1) > TRACE_MANIFEST_VERSION) {
+        fprintf(stderr, "Unsupported trace manifest\n");
+        free(line);
+        return 0;
+    }
+
+    while (getline(&line, &line_size, file) != -1) {
+        long first_seq;
+        char count[32];
+        int name_start = 0;
+        if (sscanf(line, "%ld %31s %n", &first_seq, count, &name_start) != 2 || name_start == 0) {
+            continue;
+        }
+        char *name = line + name_start;
+        name[strcspn(name, "\r\n")] = '\0';
+        if (*name == '\0') {
+            continue;
+        }
+
+        if (viewer->segment_count == capacity) {
+            capacity = capacity ? capacity * 2 : 16;
+            TraceSegment *segments = realloc(viewer->segments, capacity * sizeof(TraceSegment));
+            if (!segments) {
+                fprintf(stderr, "Memory allocation failed\n");
+                ok = 0;
+                break;
+            }
+            viewer->segments = segments;
+        }
+        TraceSegment *segment = &viewer->segments[viewer->segment_count++];
+        memset(segment, 0, sizeof(*segment));
+        segment->path = malloc(directory_length + strlen(name) + 1);
+        if (!segment->path) {
+            fprintf(stderr, "Memory allocation failed\n");
+            viewer->segment_count--;
+            ok = 0;
+            break;
+        }
+        int relative = name[0] != '/';
+        sprintf(segment->path, "%.*s%s", relative ? directory_length : 0, filename, name);
+        segment->first_seq = first_seq;
+        segment->event_count = strcmp(count, "-") == 0 ? -1 : atoi(count);
+    }
+    free(line);
+
+    for (int i = 0; i < viewer->segment_count && ok; i++) {
+        TraceSegment *segment = &viewer->segments[i];
+        segment->first_index = viewer->entry_count;
+        if (segment->event_count < 0 || i == viewer->segment_count - 1) {
+            open_trace_segment(viewer, segment, i == viewer->segment_count - 1);
+        }
+        if (segment->event_count < 0) {
+            segment->event_count = 0;
+        }
+
+        // Lines dropped inside a segment show as a gap before the next one
+        if (i > 0) {
+            TraceSegment *prev = &viewer->segments[i - 1];
+            long expected = prev->first_seq + prev->event_count;
+            if (segment->first_seq > expected) {
+                viewer->dropped_events += segment->first_seq - expected;
+            }
+        }
+        viewer->entry_count += segment->event_count;
+    }
+    return ok;
+}
+
+// Read trace file into memory
+int read_trace_file(const char *filename, TraceViewer *viewer) {
+    FILE *file = fopen(filename, "r");
+    if (!file) {
+        perror("Error opening trace file");
+        return 0;
+    }
+
+    viewer->entries = NULL;
+    viewer->entry_count = 0;
+    viewer->breakpoint_count = 0;  // Initialize breakpoint count
+    viewer->watchpoint_count = 0;  // Initialize watchpoint count
+    viewer->prev_var_count = 0;    // Initialize variable state count
+    viewer->eval_temp_file[0] = '\0';
+    viewer->eval_temp_file_ready = 0;
+    viewer->strings = NULL;
+    viewer->string_count = 0;
+    viewer->string_capacity = 0;
+    viewer->string_ids = NULL;
+    viewer->string_id_count = 0;
+    viewer->map_data = NULL;
+    viewer->map_size = 0;
+    for (int i = 0; i < VARIABLE_CACHE_SIZE; i++) {
+        viewer->materialized[i] = -1;
+    }
+    viewer->materialized_next = 0;
+    memset(viewer->frame_cache, 0, sizeof(viewer->frame_cache));
+    for (int i = 0; i < FRAME_CACHE_SIZE; i++) {
+        viewer->frame_cache[i].entry_index = -1;
+    }
+    viewer->frame_cache_clock = 0;
+    viewer->dropped_events = 0;
+    viewer->blocks = NULL;
+    viewer->block_count = 0;
+    viewer->loaded_blocks = 0;
+    viewer->block_clock = 0;
+    viewer->watches = NULL;
+    viewer->watch_count = 0;
+    viewer->watches_loaded = 0;
+    viewer->segments = NULL;
+    viewer->segment_count = 0;
+    viewer->skip_strings = 0;
+    viewer->files = NULL;
+    viewer->file_count = 0;
+    viewer->file_capacity = 0;
+    viewer->threads = NULL;
+    viewer->thread_count = 0;
+    viewer->thread_filter = -1;
+    viewer->tasks = NULL;
+    viewer->task_count = 0;
+    viewer->task_filter = -1;
+    viewer->task_runs = NULL;
+    viewer->task_run_count = 0;
+    viewer->task_index_built = 0;
+    viewer->calls = NULL;
+    viewer->call_count = 0;
+    viewer->entry_call = NULL;
+    viewer->next_in_call = NULL;
+    viewer->call_index_built = 0;
+    viewer->trace_path = xstrdup(filename);
+    viewer->live_fd = -1;
+    viewer->live_seq = -1;
+
+    int ok;
+    struct stat st;
+    unsigned char header[TRACE_HEADER_SIZE] = {0};
+    if (fstat(fileno(file), &st) == 0 && st.st_size >= TRACE_HEADER_SIZE &&
+        fread(header, 1, sizeof(header), file) == sizeof(header) &&
+        memcmp(header, TRACE_MAGIC, TRACE_MAGIC_SIZE) == 0) {
+        int version = header[TRACE_MAGIC_SIZE];
+        void *data = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fileno(file), 0);
+        if (version > TRACE_FORMAT_VERSION) {
+            fprintf(stderr, "Unsupported trace format version %d\n", version);
+            ok = 0;
+        } else if (data == MAP_FAILED) {
+            perror("Error mapping trace file");
+            ok = 0;
+        } else {
+            viewer->map_data = data;
+            viewer->map_size = st.st_size;
+            if (version == 1) {
+                ok = read_binary_trace(data, st.st_size, viewer);
+            } else {
+                ok = read_block_trace(data, st.st_size, viewer);
+            }
+        }
+        if (data != MAP_FAILED && !viewer->map_data) {
+            munmap(data, st.st_size);
+        }
+    } else if (memcmp(header, TRACE_MANIFEST_MAGIC, TRACE_MAGIC_SIZE) == 0) {
+        rewind(file);
+        ok = read_manifest(file, filename, viewer);
+    } else if (memcmp(header, TRACE_PROCESS_LIST_MAGIC, TRACE_MAGIC_SIZE) == 0) {
+        ok = report_process_list(filename);
+    } else {
+        rewind(file);
+        ok = read_text_trace(file, viewer);
+    }
+
     fclose(file);
     viewer->current_entry = 0;
-    return 1;
+    return ok;
+}
+
+// Write the loaded trace in the legacy text format
+static void dump_trace_text(TraceViewer *viewer, FILE *out) {
+    fprintf(out, "EXECUTION_ORDER|||FILENAME|||LINE_NUMBER|||CODE|||VARIABLES\n");
+    for (int i = 0; i < viewer->entry_count; i++) {
+        TraceEntry *entry = get_entry(viewer, i);
+        fprintf(out, "%ld|||%s|||%d|||%s|||%s\n", entry->exec_order, entry->filename,
+                entry->line_number, entry->code, entry_variables(viewer, i));
+    }
 }
 
 // Print the current trace entry
@@ -694,17 +2648,31 @@ void print_current_entry(TraceViewer *viewer) {
     }
 
     if (viewer->current_entry >= 0 && viewer->current_entry < viewer->entry_count) {
-        TraceEntry *entry = &viewer->entries[viewer->current_entry];
+        TraceEntry *entry = get_entry(viewer, viewer->current_entry);
         printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
         printf("\033[1;33m[Execution #%ld]\033[0m\n", entry->exec_order);
+        if (entry->elided > 0) {
+            printf("\033[2m…%ld iterations elided\033[0m\n", entry->elided);
+        }
+        if (viewer->thread_count > 1) {
+            printf("\033[1;32mThread:\033[0m %s #%d\n", thread_label(viewer, entry->thread), entry->thread);
+        }
+        if (entry->task > 0) {
+            TraceTask *task = find_task(viewer, entry->task);
+            printf("\033[1;32mTask:\033[0m %s #%d\n", task && task->name[0] ? task->name : "task", entry->task);
+        }
+        if (entry->function) {
+            printf("\033[1;32mFunction:\033[0m %s (depth %d)\n", entry->function, entry->depth);
+        }
         printf("\033[1;32mFile:\033[0m %s \033[1;32mLine:\033[0m %d\n", entry->filename, entry->line_number);
         printf("\033[1;35mCode:\033[0m %s\n", entry->code);
         
-        if (strlen(entry->variables) > 0) {
+        const char *variables = entry_variables(viewer, viewer->current_entry);
+        if (strlen(variables) > 0) {
             printf("\033[1;34mVariables:\033[0m\n");
             
             // Parse and display variables nicely
-            char *vars_copy = xstrdup(entry->variables);
+            char *vars_copy = xstrdup(variables);
             if (!vars_copy) {
                 return;
             }
@@ -726,6 +2694,330 @@ void print_current_entry(TraceViewer *viewer) {
     }
 }
 
+// List the recorded threads
+void list_threads(TraceViewer *viewer) {
+    printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("\033[1;33mThreads\033[0m\n");
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    if (viewer->thread_count == 0) {
+        printf("No thread information in this trace\n");
+    }
+    for (int i = 0; i < viewer->thread_count; i++) {
+        TraceThread *thread = &viewer->threads[i];
+        printf("%c #%d %s (ident %lu)\n",
+               thread->id == viewer->thread_filter ? '*' : ' ',
+               thread->id, thread->name[0] ? thread->name : "thread", thread->ident);
+    }
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("Following: %s\n\n", viewer->thread_filter < 0 ? "all threads" : "one thread (*)");
+}
+
+// "thread <n>" makes navigation follow one thread; "thread all" follows all
+void select_thread(TraceViewer *viewer, const char *arg) {
+    while (isspace((unsigned char)*arg)) arg++;
+
+    if (*arg == '\0') {
+        if (viewer->thread_filter < 0) {
+            printf("Following all threads\n");
+        } else {
+            printf("Following thread #%d (%s)\n", viewer->thread_filter,
+                   thread_label(viewer, viewer->thread_filter));
+        }
+        return;
+    }
+    if (strcmp(arg, "all") == 0) {
+        viewer->thread_filter = -1;
+        printf("\033[1;32m✓ Following all threads\033[0m\n");
+        return;
+    }
+
+    char *end;
+    long id = strtol(arg, &end, 10);
+    int known = viewer->thread_count == 0 && id == 0;
+    for (int i = 0; i < viewer->thread_count; i++) {
+        known |= viewer->threads[i].id == id;
+    }
+    if (*end != '\0' || id < 0 || !known) {
+        printf("\033[1;31m✗ Unknown thread '%s' (see 'threads')\033[0m\n", arg);
+        return;
+    }
+
+    viewer->thread_filter = (int)id;
+    printf("\033[1;32m✓ Following thread #%ld (%s)\033[0m\n", id, thread_label(viewer, (int)id));
+
+    // Move to the nearest step of that thread
+    if (!entry_in_filter(viewer, viewer->current_entry)) {
+        int index = step_entry(viewer, viewer->current_entry, 1);
+        if (index < 0) {
+            index = step_entry(viewer, viewer->current_entry, -1);
+        }
+        if (index >= 0) {
+            viewer->current_entry = index;
+            print_current_entry(viewer);
+        }
+    }
+}
+
+// List the recorded asyncio tasks
+void list_tasks(TraceViewer *viewer) {
+    printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("\033[1;33mTasks\033[0m\n");
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    if (viewer->task_count == 0) {
+        printf("No asyncio tasks in this trace\n");
+    } else if (!build_task_index(viewer)) {
+        return;
+    }
+    for (int i = 0; i < viewer->task_count; i++) {
+        TraceTask *task = &viewer->tasks[i];
+        int steps = 0;
+        for (int r = 0; r < task->run_count; r++) {
+            TaskRun *run = &viewer->task_runs[task->runs[r]];
+            steps += run->last - run->first + 1;
+        }
+        printf("%c #%d %s (thread #%d, %d steps)\n",
+               task->id == viewer->task_filter ? '*' : ' ',
+               task->id, task->name[0] ? task->name : "task", task->thread, steps);
+    }
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("Following: %s\n\n", viewer->task_filter < 0 ? "all tasks" : "one task (*)");
+}
+
+// "task <n>" makes navigation follow one asyncio task; "task all" follows all
+void select_task(TraceViewer *viewer, const char *arg) {
+    while (isspace((unsigned char)*arg)) arg++;
+
+    if (*arg == '\0') {
+        if (viewer->task_filter < 0) {
+            printf("Following all tasks\n");
+        } else {
+            printf("Following task #%d\n", viewer->task_filter);
+        }
+        return;
+    }
+    if (strcmp(arg, "all") == 0) {
+        viewer->task_filter = -1;
+        printf("\033[1;32m✓ Following all tasks\033[0m\n");
+        return;
+    }
+
+    char *end;
+    long id = strtol(arg, &end, 10);
+    TraceTask *task = *end == '\0' && id > 0 ? find_task(viewer, (int)id) : NULL;
+    if (!task) {
+        printf("\033[1;31m✗ Unknown task '%s' (see 'tasks')\033[0m\n", arg);
+        return;
+    }
+    if (!build_task_index(viewer)) {
+        return;
+    }
+
+    viewer->task_filter = task->id;
+    printf("\033[1;32m✓ Following task #%d (%s)\033[0m\n", task->id,
+           task->name[0] ? task->name : "task");
+
+    // Move to the nearest step of that task
+    if (get_entry(viewer, viewer->current_entry)->task != task->id) {
+        int index = step_in_task(viewer, task, viewer->current_entry, 1);
+        if (index < 0) {
+            index = step_in_task(viewer, task, viewer->current_entry, -1);
+        }
+        if (index >= 0) {
+            viewer->current_entry = index;
+            print_current_entry(viewer);
+        }
+    }
+}
+
+// A process from a process list (see traceformat.h)
+typedef struct {
+    long pid;
+    long parent;
+    long fork_seq;
+    char path[PATH_MAX];
+} TraceProcess;
+
+// Read the process list of the trace at path into processes. The list is
+// named after the first process's trace, so a child's trace.log.p<pid>
+// strips its suffix first. Returns the number of processes, 0 if there is
+// no list, or -1 if it cannot be read.
+static int read_process_list(const char *path, TraceProcess **processes) {
+    char root[PATH_MAX];
+    snprintf(root, sizeof(root), "%s", path);
+    char *suffix = strrchr(root, '.');
+    if (suffix && suffix[1] == 'p' && isdigit((unsigned char)suffix[2]) &&
+        strspn(suffix + 2, "0123456789") == strlen(suffix + 2) &&
+        (!strrchr(root, '/') || suffix > strrchr(root, '/'))) {
+        *suffix = '\0';
+    }
+
+    char list[PATH_MAX + 8];
+    snprintf(list, sizeof(list), "%s.procs", root);
+    *processes = NULL;
+    FILE *file = fopen(list, "r");
+    if (!file) {
+        return errno == ENOENT ? 0 : -1;
+    }
+
+    const char *slash = strrchr(root, '/');
+    int directory_length = slash ? (int)(slash - root) + 1 : 0;
+    char line[PATH_MAX + 96];
+    char magic[8];
+    int version;
+    int count = 0, capacity = 0;
+    if (!fgets(line, sizeof(line), file) ||
+        sscanf(line, "%7s %d", magic, &version) != 2 ||
+        strcmp(magic, TRACE_PROCESS_LIST_MAGIC) != 0 || version > TRACE_PROCESS_LIST_VERSION) {
+        fclose(file);
+        return -1;
+    }
+    while (fgets(line, sizeof(line), file)) {
+        TraceProcess process;
+        int name = 0;
+        rstrip(line);
+        if (sscanf(line, "%ld %ld %ld %n", &process.pid, &process.parent, &process.fork_seq, &name) != 3 ||
+            line[name] == '\0') {
+            continue;
+        }
+        // Names are relative to the list's directory
+        snprintf(process.path, sizeof(process.path), "%.*s%s",
+                 line[name] == '/' ? 0 : directory_length, root, line + name);
+        if (count == capacity) {
+            capacity = capacity ? capacity * 2 : 8;
+            TraceProcess *grown = realloc(*processes, capacity * sizeof(TraceProcess));
+            if (!grown) {
+                break;
+            }
+            *processes = grown;
+        }
+        (*processes)[count++] = process;
+    }
+    fclose(file);
+    return count;
+}
+
+// A process list was opened instead of a trace: name the traces it lists.
+// Returns 0, since there is nothing to load.
+static int report_process_list(const char *filename) {
+    char root[PATH_MAX];
+    snprintf(root, sizeof(root), "%s", filename);
+    size_t length = strlen(root);
+    if (length > strlen(".procs") && strcmp(root + length - strlen(".procs"), ".procs") == 0) {
+        root[length - strlen(".procs")] = '\0';
+    }
+
+    TraceProcess *processes;
+    int count = read_process_list(root, &processes);
+    fprintf(stderr, "%s is a process list, not a trace\n", filename);
+    if (count < 0) {
+        fprintf(stderr, "Could not read the process list\n");
+    } else if (count > 0) {
+        fprintf(stderr, "Open the trace of one of its processes:\n");
+    }
+    for (int i = 0; i < count; i++) {
+        fprintf(stderr, "  pid %ld  %s\n", processes[i].pid, processes[i].path);
+    }
+    free(processes);
+    return 0;
+}
+
+// List the processes of a traced program that forked
+void list_processes(TraceViewer *viewer) {
+    TraceProcess *processes;
+    int count = read_process_list(viewer->trace_path, &processes);
+
+    printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("\033[1;33mProcesses\033[0m\n");
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    if (count < 0) {
+        printf("Could not read the process list of this trace\n");
+    } else if (count == 0) {
+        printf("The traced program did not fork\n");
+    }
+    for (int i = 0; i < count; i++) {
+        TraceProcess *process = &processes[i];
+        char current = strcmp(get_basename(process->path), get_basename(viewer->trace_path)) == 0 ? '*' : ' ';
+        if (process->parent == 0) {
+            printf("%c pid %ld  %s\n", current, process->pid, get_basename(process->path));
+        } else {
+            printf("%c pid %ld  %s (forked by %ld at [%ld])\n", current, process->pid,
+                   get_basename(process->path), process->parent, process->fork_seq + 1);
+        }
+    }
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    if (count > 0) {
+        printf("Viewing: this process (*); 'proc <pid>' opens another\n\n");
+    }
+    free(processes);
+}
+
+// "proc <pid>" opens the trace of another process of the program. The
+// breakpoints and watchpoints carry over.
+void select_process(TraceViewer *viewer, const char *arg) {
+    while (isspace((unsigned char)*arg)) arg++;
+
+    TraceProcess *processes;
+    int count = read_process_list(viewer->trace_path, &processes);
+    char *end;
+    long pid = strtol(arg, &end, 10);
+    TraceProcess *process = NULL;
+    for (int i = 0; i < count && *arg != '\0' && *end == '\0'; i++) {
+        if (processes[i].pid == pid) {
+            process = &processes[i];
+        }
+    }
+    if (!process) {
+        printf("\033[1;31m✗ Unknown process '%s' (see 'procs')\033[0m\n", arg);
+        free(processes);
+        return;
+    }
+
+    TraceViewer *next = malloc(sizeof(TraceViewer));
+    if (!next || !read_trace_file(process->path, next)) {
+        printf("\033[1;31m✗ Could not open %s\033[0m\n", process->path);
+        free(next);
+        free(processes);
+        return;
+    }
+    if (next->entry_count == 0) {
+        printf("\033[1;31m✗ Process %ld recorded no steps\033[0m\n", pid);
+        cleanup(next);
+        free(next);
+        free(processes);
+        return;
+    }
+
+    memcpy(next->breakpoints, viewer->breakpoints, sizeof(viewer->breakpoints));
+    next->breakpoint_count = viewer->breakpoint_count;
+    // Recorded watch expressions are numbered per trace
+    load_watches(next);
+    for (int i = 0; i < viewer->watchpoint_count; i++) {
+        Watchpoint wp = viewer->watchpoints[i];
+        if (wp.type == WATCHPOINT_VALUE) {
+            wp.watch = -1;
+            for (int j = 0; j < next->watch_count; j++) {
+                if (strcmp(watch_expression(next, j), wp.variable) == 0) {
+                    wp.watch = j;
+                }
+            }
+            if (wp.watch < 0) {
+                printf("\033[1;33m⚠ '%s' was not recorded in process %ld; watchpoint dropped\033[0m\n",
+                       wp.variable, pid);
+                continue;
+            }
+        }
+        next->watchpoints[next->watchpoint_count++] = wp;
+    }
+
+    cleanup(viewer);
+    *viewer = *next;
+    free(next);
+    printf("\033[1;32m✓ Process %ld: %d execution steps from %s\033[0m\n",
+           pid, viewer->entry_count, get_basename(process->path));
+    free(processes);
+    print_current_entry(viewer);
+}
+
 // Print summary statistics
 void print_summary(TraceViewer *viewer) {
     printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
@@ -735,15 +3027,15 @@ void print_summary(TraceViewer *viewer) {
     
     if (viewer->entry_count > 0) {
         printf("First Entry: [%ld] %s:%d\n", 
-               viewer->entries[0].exec_order,
-               viewer->entries[0].filename,
-               viewer->entries[0].line_number);
+               get_entry(viewer, 0)->exec_order,
+               get_entry(viewer, 0)->filename,
+               get_entry(viewer, 0)->line_number);
         printf("Last Entry:  [%ld] %s:%d\n", 
-               viewer->entries[viewer->entry_count - 1].exec_order,
-               viewer->entries[viewer->entry_count - 1].filename,
-               viewer->entries[viewer->entry_count - 1].line_number);
+               get_entry(viewer, viewer->entry_count - 1)->exec_order,
+               get_entry(viewer, viewer->entry_count - 1)->filename,
+               get_entry(viewer, viewer->entry_count - 1)->line_number);
         printf("\nCurrent Position: [%ld] (Entry %d of %d)\n",
-               viewer->entries[viewer->current_entry].exec_order,
+               get_entry(viewer, viewer->current_entry)->exec_order,
                viewer->current_entry + 1,
                viewer->entry_count);
     }
@@ -756,12 +3048,13 @@ void search_variable(TraceViewer *viewer, const char *var_name) {
     printf("\n\033[1;33mSearching for variable '%s'...\033[0m\n\n", var_name);
     
     for (int i = 0; i < viewer->entry_count; i++) {
-        TraceEntry *entry = &viewer->entries[i];
-        if (strstr(entry->variables, var_name)) {
+        TraceEntry *entry = get_entry(viewer, i);
+        const char *variables = entry_variables(viewer, i);
+        if (strstr(variables, var_name)) {
             printf("[%ld] %s:%d\n", entry->exec_order, entry->filename, entry->line_number);
             
             // Parse and find the specific variable
-            char *vars_copy = xstrdup(entry->variables);
+            char *vars_copy = xstrdup(variables);
             if (!vars_copy) {
                 return;
             }
@@ -805,8 +3098,8 @@ static FILE* try_open_with_trace_dir(const char *basename, TraceViewer *viewer,
     }
     
     // Strategy 2: Extract directory from trace entries and try there
-    for (int i = 0; i < viewer->entry_count; i++) {
-        const char *trace_file = viewer->entries[i].filename;
+    for (int i = 0; i < viewer->file_count; i++) {
+        const char *trace_file = viewer->files[i];
         
         // If this entry has a directory path, extract it
         const char *last_slash = strrchr(trace_file, '/');
@@ -838,7 +3131,7 @@ void show_file(TraceViewer *viewer, const char *requested_file) {
         return;
     }
     
-    TraceEntry *current = &viewer->entries[viewer->current_entry];
+    TraceEntry *current = get_entry(viewer, viewer->current_entry);
     const char *filename = NULL;
     int highlight_line = -1;
     char resolved_path[1026] = {0};
@@ -849,9 +3142,9 @@ void show_file(TraceViewer *viewer, const char *requested_file) {
         
         // Search trace for matching file
         const char *found_in_trace = NULL;
-        for (int i = 0; i < viewer->entry_count; i++) {
-            if (filenames_match(requested_file, viewer->entries[i].filename)) {
-                found_in_trace = viewer->entries[i].filename;
+        for (int i = 0; i < viewer->file_count; i++) {
+            if (filenames_match(requested_file, viewer->files[i])) {
+                found_in_trace = viewer->files[i];
                 break;
             }
         }
@@ -916,17 +3209,17 @@ void show_file(TraceViewer *viewer, const char *requested_file) {
         if (requested_file && strlen(requested_file) > 0) {
             printf("\033[1;33mTip: File not found in trace or on disk.\033[0m\n");
             printf("\033[1;33mFiles in trace:\033[0m\n");
-            for (int i = 0; i < viewer->entry_count; i++) {
+            for (int i = 0; i < viewer->file_count; i++) {
                 int already_shown = 0;
                 for (int j = 0; j < i; j++) {
-                    if (strcmp(get_basename(viewer->entries[i].filename), 
-                               get_basename(viewer->entries[j].filename)) == 0) {
+                    if (strcmp(get_basename(viewer->files[i]), 
+                               get_basename(viewer->files[j])) == 0) {
                         already_shown = 1;
                         break;
                     }
                 }
                 if (!already_shown) {
-                    printf("  - %s\n", get_basename(viewer->entries[i].filename));
+                    printf("  - %s\n", get_basename(viewer->files[i]));
                 }
             }
         }
@@ -994,11 +3287,53 @@ void cleanup(TraceViewer *viewer) {
         viewer->eval_temp_file_ready = 0;
     }
 
-    for (int i = 0; i < viewer->entry_count; i++) {
-        free(viewer->entries[i].code);
-        free(viewer->entries[i].variables);
+    if (viewer->blocks) {
+        for (int i = 0; i < viewer->block_count; i++) {
+            if (viewer->blocks[i].entries) {
+                unload_block(viewer, &viewer->blocks[i]);
+            }
+        }
+        free(viewer->blocks);
+    } else if (viewer->entries) {
+        for (int i = 0; i < viewer->entry_count; i++) {
+            free(viewer->entries[i].variables);
+        }
     }
     free(viewer->entries);
+    free(viewer->files);
+    free(viewer->threads);
+    for (int i = 0; i < viewer->task_count; i++) {
+        free(viewer->tasks[i].runs);
+    }
+    free(viewer->tasks);
+    free(viewer->task_runs);
+    for (int i = 0; i < viewer->watch_count; i++) {
+        free(viewer->watches[i].changes);
+    }
+    free(viewer->watches);
+    free(viewer->calls);
+    free(viewer->entry_call);
+    free(viewer->next_in_call);
+    for (int i = 0; i < viewer->string_count; i++) {
+        free(viewer->strings[i]);
+    }
+    free(viewer->strings);
+    free(viewer->string_ids);
+    for (int i = 0; i < FRAME_CACHE_SIZE; i++) {
+        free(viewer->frame_cache[i].vars);
+    }
+    if (viewer->map_data) {
+        munmap(viewer->map_data, viewer->map_size);
+    }
+    for (int i = 0; i < viewer->segment_count; i++) {
+        if (viewer->segments[i].map) {
+            munmap(viewer->segments[i].map, viewer->segments[i].size);
+        }
+        free(viewer->segments[i].path);
+    }
+    free(viewer->segments);
+    free(viewer->trace_path);
+    live_close(viewer);
 }
 
 // Print help
@@ -1009,7 +3344,16 @@ void print_help() {
     printf("\n\033[1;35mNavigation:\033[0m\n");
     printf("  \033[1;32mn\033[0m              - Next execution step\n");
     printf("  \033[1;32mback\033[0m           - Previous execution step\n");
+    printf("  \033[1;32mover\033[0m           - Next line of this call, stepping over calls\n");
+    printf("  \033[1;32mout\033[0m            - Line after this call returns, in the caller\n");
+    printf("  \033[1;32mreverse-out\033[0m    - Line that made this call\n");
     printf("  \033[1;32m:<number>\033[0m      - Jump to execution (e.g., :5 jumps to [5/50])\n");
+    printf("  \033[1;32mthreads\033[0m        - List recorded threads\n");
+    printf("  \033[1;32mthread <n|all>\033[0m - Follow one thread with n/back/c/rc, or all threads\n");
+    printf("  \033[1;32mtasks\033[0m          - List recorded asyncio tasks\n");
+    printf("  \033[1;32mtask <n|all>\033[0m   - Follow one asyncio task, or all tasks\n");
+    printf("  \033[1;32mprocs\033[0m          - List the processes of a program that forked\n");
+    printf("  \033[1;32mproc <pid>\033[0m     - Open the trace of another process\n");
     printf("\n\033[1;35mBreakpoints:\033[0m\n");
     printf("  \033[1;32mb <file> <line>\033[0m - Set breakpoint (e.g., b test.py 25)\n");
     printf("  \033[1;32mlist\033[0m           - List all breakpoints\n");
@@ -1017,6 +3361,7 @@ void print_help() {
     printf("  \033[1;32mrc\033[0m             - Reverse continue to previous breakpoint/watchpoint\n");
     printf("\n\033[1;35mWatchpoints:\033[0m\n");
     printf("  \033[1;32mw <var>\033[0m        - Set watchpoint on variable (read/write)\n");
+    printf("  \033[1;32mw <expr>\033[0m       - Stop where a recorded watch expression changes\n");
     printf("  \033[1;32mrw <var>\033[0m       - Set read watchpoint on variable\n");
     printf("  \033[1;32mww <var>\033[0m       - Set write watchpoint on variable\n");
     printf("  \033[1;32mlistw\033[0m          - List all watchpoints\n");
@@ -1027,6 +3372,8 @@ void print_help() {
     printf("  \033[1;32mfind <var>\033[0m    - Search for variable usage\n");
     printf("  \033[1;32mjump <line>\033[0m   - Jump to first occurrence of source line\n");
     printf("  \033[1;32meval <expression>\033[0m   - Evaluates a python command and prints the result\n");
+    printf("  \033[1;32mcheckpoints\033[0m    - List the recorder's checkpoints of the program\n");
+    printf("  \033[1;32mlive <expression>\033[0m   - Evaluate in the live program, re-run to this step\n");
     printf("\n\033[1;35mOther:\033[0m\n");
     printf("  \033[1;32mhelp\033[0m           - Show this help\n");
     printf("  \033[1;32mquit\033[0m or \033[1;32mq\033[0m     - Exit debugger\n");
@@ -1083,11 +3430,11 @@ static char* lookup_variable_repr(const char *vars_str, const char *name) {
     return NULL;
 }
 
-static char* lookup_direct_captured_identifier(TraceEntry *entry, const char *expression) {
+static char* lookup_direct_captured_identifier(const char *variables, const char *expression) {
     if (!is_python_identifier(expression)) {
         return NULL;
     }
-    return lookup_variable_repr(entry->variables, expression);
+    return lookup_variable_repr(variables, expression);
 }
 
 static void write_python_string(FILE *f, const char *value) {
@@ -1222,7 +3569,6 @@ void eval_expression(TraceViewer *viewer, const char *expression) {
         return;
     }
 
-    TraceEntry *entry = &viewer->entries[viewer->current_entry];
 
     // is an import, just add it to the file and return
     if(strncmp(expression, "import ", 7) == 0 || strncmp(expression, "from ", 5) == 0){
@@ -1263,7 +3609,8 @@ void eval_expression(TraceViewer *viewer, const char *expression) {
     }
 
     // Eval and print
-    char *direct_captured_value = lookup_direct_captured_identifier(entry, expression);
+    char *direct_captured_value = lookup_direct_captured_identifier(
+        entry_variables(viewer, viewer->current_entry), expression);
 
     if (!ensure_eval_temp_file(viewer)) {
         if (direct_captured_value) {
@@ -1295,7 +3642,7 @@ void eval_expression(TraceViewer *viewer, const char *expression) {
 
     long pos_before = ftell(f);
 
-    write_literal_loads(f, entry->variables);
+    write_literal_loads(f, entry_variables(viewer, viewer->current_entry));
 
     if (direct_captured_value) {
         fprintf(f, "if ");
@@ -1366,6 +3713,258 @@ cleanup_eval:
     free(direct_captured_value);
 }
 
+// A checkpoint from a checkpoint list (see traceformat.h)
+typedef struct {
+    long seq;
+    long pid;
+} TraceCheckpoint;
+
+// Read the checkpoint list of the trace at path. Returns the number of
+// checkpoints, oldest first, 0 if there is no list, or -1 if it cannot be
+// read.
+static int read_checkpoint_list(const char *path, TraceCheckpoint **checkpoints) {
+    char list[PATH_MAX + 8];
+    snprintf(list, sizeof(list), "%s.ckpt", path);
+    *checkpoints = NULL;
+    FILE *file = fopen(list, "r");
+    if (!file) {
+        return errno == ENOENT ? 0 : -1;
+    }
+
+    char line[128];
+    char magic[8];
+    int version;
+    int count = 0, capacity = 0;
+    if (!fgets(line, sizeof(line), file) ||
+        sscanf(line, "%7s %d", magic, &version) != 2 ||
+        strcmp(magic, TRACE_CHECKPOINT_LIST_MAGIC) != 0 || version > TRACE_CHECKPOINT_LIST_VERSION) {
+        fclose(file);
+        return -1;
+    }
+    while (fgets(line, sizeof(line), file)) {
+        TraceCheckpoint checkpoint;
+        if (sscanf(line, "%ld %ld", &checkpoint.seq, &checkpoint.pid) != 2) {
+            continue;
+        }
+        if (count == capacity) {
+            capacity = capacity ? capacity * 2 : 8;
+            TraceCheckpoint *grown = realloc(*checkpoints, capacity * sizeof(TraceCheckpoint));
+            if (!grown) {
+                break;
+            }
+            *checkpoints = grown;
+        }
+        (*checkpoints)[count++] = checkpoint;
+    }
+    fclose(file);
+    return count;
+}
+
+static int checkpoint_alive(long pid) {
+    return kill((pid_t)pid, 0) == 0 || errno == EPERM;
+}
+
+// List the checkpoints the recorder took of the traced program
+void list_checkpoints(TraceViewer *viewer) {
+    TraceCheckpoint *checkpoints;
+    int count = read_checkpoint_list(viewer->trace_path, &checkpoints);
+
+    printf("\n\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    printf("\033[1;33mCheckpoints\033[0m\n");
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    if (count < 0) {
+        printf("Could not read the checkpoint list of this trace\n");
+    } else if (count == 0) {
+        printf("No checkpoints (record with checkpoint_every=N to take some)\n");
+    }
+    for (int i = 0; i < count; i++) {
+        printf("  [%ld]  pid %ld  %s\n", checkpoints[i].seq + 1, checkpoints[i].pid,
+               checkpoint_alive(checkpoints[i].pid) ? "\033[1;32mlive\033[0m" : "\033[1;31mgone\033[0m");
+    }
+    printf("\033[1;36m━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\033[0m\n");
+    if (count > 0) {
+        printf("'live <expr>' re-runs the program from the nearest earlier checkpoint\n\n");
+    }
+    free(checkpoints);
+}
+
+static int send_request(int fd, const char *request) {
+    size_t length = strlen(request);
+    while (length > 0) {
+        ssize_t n = send(fd, request, length, MSG_NOSIGNAL);
+        if (n < 0 && errno == EINTR) {
+            continue;
+        }
+        if (n <= 0) {
+            return 0;
+        }
+        request += n;
+        length -= n;
+    }
+    return 1;
+}
+
+// Read a checkpoint's reply into a new string. Returns 1 for "ok", 0 for
+// "error" and -1 if the connection failed.
+static int read_reply(int fd, char **text) {
+    char header[32];
+    size_t header_length = 0;
+    *text = NULL;
+    while (header_length < sizeof(header) - 1) {
+        ssize_t n = read(fd, header + header_length, 1);
+        if (n < 0 && errno == EINTR) {
+            continue;
+        }
+        if (n <= 0) {
+            return -1;
+        }
+        if (header[header_length] == '\n') {
+            break;
+        }
+        header_length++;
+    }
+    header[header_length] = '\0';
+
+    char kind[8];
+    size_t length;
+    if (sscanf(header, "%7s %zu", kind, &length) != 2 || !(*text = malloc(length + 1))) {
+        return -1;
+    }
+    size_t done = 0;
+    while (done < length) {
+        ssize_t n = read(fd, *text + done, length - done);
+        if (n < 0 && errno == EINTR) {
+            continue;
+        }
+        if (n <= 0) {
+            free(*text);
+            *text = NULL;
+            return -1;
+        }
+        done += n;
+    }
+    (*text)[length] = '\0';
+    return strcmp(kind, "ok") == 0;
+}
+
+// End the re-run serving 'live', if any
+static void live_close(TraceViewer *viewer) {
+    if (viewer->live_fd >= 0) {
+        send_request(viewer->live_fd, "quit\n");
+        close(viewer->live_fd);
+        viewer->live_fd = -1;
+        viewer->live_seq = -1;
+    }
+}
+
+// Connect to a re-run of the program stopped at the current entry, started
+// from the nearest earlier checkpoint. Returns 0 or -1 with a message
+// printed.
+static int live_connect(TraceViewer *viewer) {
+    TraceEntry *entry = get_entry(viewer, viewer->current_entry);
+    if (viewer->live_fd >= 0 && viewer->live_seq == entry->exec_order) {
+        return 0;
+    }
+    live_close(viewer);
+
+    TraceCheckpoint *checkpoints;
+    int count = read_checkpoint_list(viewer->trace_path, &checkpoints);
+    TraceCheckpoint *nearest = NULL;
+    for (int i = 0; i < count; i++) {
+        if (checkpoints[i].seq <= entry->exec_order && checkpoint_alive(checkpoints[i].pid) &&
+            (!nearest || checkpoints[i].seq > nearest->seq)) {
+            nearest = &checkpoints[i];
+        }
+    }
+    if (!nearest) {
+        printf("\033[1;31m✗ No live checkpoint at or before this step (see 'checkpoints')\033[0m\n");
+        free(checkpoints);
+        return -1;
+    }
+
+    struct sockaddr_un address;
+    memset(&address, 0, sizeof(address));
+    address.sun_family = AF_UNIX;
+    int name_length = snprintf(address.sun_path + 1, sizeof(address.sun_path) - 1,
+                               TRACE_CHECKPOINT_SOCKET, nearest->pid);
+    socklen_t address_length = offsetof(struct sockaddr_un, sun_path) + 1 + name_length;
+    char request[64];
+    snprintf(request, sizeof(request), "run %ld\n", entry->exec_order);
+    int fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    char *reply = NULL;
+    int status = -1;
+    if (fd >= 0 && connect(fd, (struct sockaddr *)&address, address_length) == 0 &&
+        send_request(fd, request)) {
+        printf("Re-running from the checkpoint at [%ld]...\n", nearest->seq + 1);
+        fflush(stdout);
+        status = read_reply(fd, &reply);
+    }
+    if (status != 1) {
+        if (status == 0) {
+            printf("\033[1;31m✗ The re-run did not reach this step: %s\033[0m\n", reply);
+        } else {
+            printf("\033[1;31m✗ Could not re-run from the checkpoint of pid %ld\033[0m\n", nearest->pid);
+        }
+        if (fd >= 0) {
+            close(fd);
+        }
+        free(reply);
+        free(checkpoints);
+        return -1;
+    }
+
+    // The re-run stops at the same seq; a different line means the program
+    // did not run the same way again
+    char expected[PATH_MAX + 32];
+    snprintf(expected, sizeof(expected), "%s:%d", entry->filename, entry->line_number);
+    if (strcmp(reply, expected) != 0) {
+        printf("\033[1;33m⚠ The re-run reached %s instead of %s; it did not retrace the recording\033[0m\n",
+               reply, expected);
+    }
+    viewer->live_fd = fd;
+    viewer->live_seq = entry->exec_order;
+    free(reply);
+    free(checkpoints);
+    return 0;
+}
+
+// "live <expr>" evaluates expr in the program itself, re-run from a
+// checkpoint up to the current entry, so it sees the real objects rather
+// than their recorded reprs. Calls it makes run for real in the re-run.
+void live_eval(TraceViewer *viewer, const char *expression) {
+    if (viewer->current_entry < 0 || viewer->current_entry >= viewer->entry_count) {
+        printf("\033[1;31m✗ No current entry\033[0m\n");
+        return;
+    }
+    if (live_connect(viewer) < 0) {
+        return;
+    }
+
+    size_t length = strlen(expression) + 7;
+    char *request = malloc(length);
+    if (!request) {
+        return;
+    }
+    snprintf(request, length, "eval %s\n", expression);
+    char *reply = NULL;
+    int status = send_request(viewer->live_fd, request) ? read_reply(viewer->live_fd, &reply) : -1;
+    free(request);
+    if (status < 0) {
+        printf("\033[1;31m✗ The re-run went away\033[0m\n");
+        live_close(viewer);
+        return;
+    }
+    print_eval_header(expression);
+    if (status == 1) {
+        printf("Result: %s\n", reply);
+    } else {
+        printf("%s\n", reply);
+        printf("\033[1;31m✗ Evaluation failed\033[0m\n");
+    }
+    print_eval_footer();
+    free(reply);
+}
+
 // Filename completion support - shows .py files from trace and current directory
 static char* filename_generator(const char* text, int state) {
     static DIR *dir = NULL;
@@ -1387,9 +3986,9 @@ static char* filename_generator(const char* text, int state) {
     }
     
     // Phase 1: Suggest files from trace (most relevant)
-    if (g_viewer && trace_index < g_viewer->entry_count) {
-        while (trace_index < g_viewer->entry_count) {
-            const char *trace_file = g_viewer->entries[trace_index].filename;
+    if (g_viewer && trace_index < g_viewer->file_count) {
+        while (trace_index < g_viewer->file_count) {
+            const char *trace_file = g_viewer->files[trace_index];
             trace_index++;
             
             // Get basename
@@ -1562,8 +4161,9 @@ static int execute_command(TraceViewer *viewer, const char *raw_cmd) {
 
     // Handle 'n' command (next)
     if (strcmp(cmd, "n") == 0 || strcmp(cmd, "next") == 0) {
-        if (viewer->current_entry < viewer->entry_count - 1) {
-            viewer->current_entry++;
+        int next = step_entry(viewer, viewer->current_entry, 1);
+        if (next >= 0) {
+            viewer->current_entry = next;
             print_current_entry(viewer);
         } else {
             printf("\033[1;31m✗ Already at last execution step\033[0m\n");
@@ -1571,13 +4171,61 @@ static int execute_command(TraceViewer *viewer, const char *raw_cmd) {
     }
     // Handle 'back' command (previous)
     else if (strcmp(cmd, "back") == 0 || strcmp(cmd, "prev") == 0) {
-        if (viewer->current_entry > 0) {
-            viewer->current_entry--;
+        int previous = step_entry(viewer, viewer->current_entry, -1);
+        if (previous >= 0) {
+            viewer->current_entry = previous;
             print_current_entry(viewer);
         } else {
             printf("\033[1;31m✗ Already at first execution step\033[0m\n");
         }
     }
+    // Handle 'over', 'out' and 'reverse-out' (move through the call tree)
+    else if (strcmp(cmd, "over") == 0 || strcmp(cmd, "out") == 0 ||
+             strcmp(cmd, "reverse-out") == 0) {
+        if (viewer->entry_count > 0 && build_call_index(viewer)) {
+            int index;
+            if (strcmp(cmd, "over") == 0) {
+                index = step_over(viewer, viewer->current_entry);
+            } else if (strcmp(cmd, "out") == 0) {
+                index = step_out(viewer, viewer->current_entry);
+            } else {
+                index = reverse_step_out(viewer, viewer->current_entry);
+            }
+
+            if (index >= 0) {
+                viewer->current_entry = index;
+                print_current_entry(viewer);
+            } else if (strcmp(cmd, "reverse-out") == 0) {
+                printf("\033[1;31m✗ The caller of this call was not recorded\033[0m\n");
+            } else {
+                printf("\033[1;31m✗ No later line in this call or its callers\033[0m\n");
+            }
+        }
+    }
+    // Handle 'threads' command
+    else if (strcmp(cmd, "threads") == 0) {
+        list_threads(viewer);
+    }
+    // Handle 'thread' command (follow one thread, or all)
+    else if (strcmp(cmd, "thread") == 0 || strncmp(cmd, "thread ", 7) == 0) {
+        select_thread(viewer, cmd + 6);
+    }
+    // Handle 'tasks' command
+    else if (strcmp(cmd, "tasks") == 0) {
+        list_tasks(viewer);
+    }
+    // Handle 'task' command (follow one asyncio task, or all)
+    else if (strcmp(cmd, "task") == 0 || strncmp(cmd, "task ", 5) == 0) {
+        select_task(viewer, cmd + 4);
+    }
+    // Handle 'procs' command
+    else if (strcmp(cmd, "procs") == 0) {
+        list_processes(viewer);
+    }
+    // Handle 'proc' command (open another process's trace)
+    else if (strcmp(cmd, "proc") == 0 || strncmp(cmd, "proc ", 5) == 0) {
+        select_process(viewer, cmd + 4);
+    }
     // Handle 'summary' command
     else if (strcmp(cmd, "summary") == 0) {
         print_summary(viewer);
@@ -1612,18 +4260,20 @@ static int execute_command(TraceViewer *viewer, const char *raw_cmd) {
         long exec_num = user_num - 1;
         int found = 0;
 
-        // Validate range (user sees 1 to N, we search for 0 to N-1)
-        if (user_num < 1 || user_num > viewer->entry_count) {
-            printf("\033[1;31m✗ Execution #%ld out of range. Valid range: 1-%d\033[0m\n",
-                   user_num, viewer->entry_count);
+        // Validate range (user sees first+1 to last+1). A forked process's
+        // trace starts at the seq it was forked at.
+        long first = viewer->entry_count > 0 ? get_entry(viewer, 0)->exec_order + 1 : 1;
+        long last = viewer->entry_count > 0 ?
+            get_entry(viewer, viewer->entry_count - 1)->exec_order + 1 : 0;
+        if (user_num < first || user_num > last) {
+            printf("\033[1;31m✗ Execution #%ld out of range. Valid range: %ld-%ld\033[0m\n",
+                   user_num, first, last);
         } else {
-            for (int i = 0; i < viewer->entry_count; i++) {
-                if (viewer->entries[i].exec_order == exec_num) {
-                    viewer->current_entry = i;
-                    print_current_entry(viewer);
-                    found = 1;
-                    break;
-                }
+            int index = find_entry_by_exec(viewer, exec_num);
+            if (index >= 0) {
+                viewer->current_entry = index;
+                print_current_entry(viewer);
+                found = 1;
             }
 
             if (!found) {
@@ -1681,7 +4331,7 @@ static int execute_command(TraceViewer *viewer, const char *raw_cmd) {
 
         printf("\nSearching for line %d...\n\n", line_num);
         for (int i = 0; i < viewer->entry_count; i++) {
-            if (viewer->entries[i].line_number == line_num) {
+            if (get_entry(viewer, i)->line_number == line_num) {
                 viewer->current_entry = i;
                 print_current_entry(viewer);
                 found = 1;
@@ -1701,7 +4351,7 @@ static int execute_command(TraceViewer *viewer, const char *raw_cmd) {
         printf("\n\033[1;33mNote: 'break <line>' is deprecated. Use 'jump <line>' or 'b <file> <line>'\033[0m\n");
         printf("Searching for line %d...\n\n", line_num);
         for (int i = 0; i < viewer->entry_count; i++) {
-            if (viewer->entries[i].line_number == line_num) {
+            if (get_entry(viewer, i)->line_number == line_num) {
                 viewer->current_entry = i;
                 print_current_entry(viewer);
                 found = 1;
@@ -1716,7 +4366,7 @@ static int execute_command(TraceViewer *viewer, const char *raw_cmd) {
     // Handle 'w <var>' command (set watchpoint - both read and write)
     else if (cmd[0] == 'w' && (cmd[1] == ' ' || cmd[1] == '\0')) {
         if (cmd[1] == '\0') {
-            printf("\033[1;31m✗ Usage: w <variable>\033[0m\n");
+            printf("\033[1;31m✗ Usage: w <variable|expression>\033[0m\n");
             printf("Example: w counter\n");
         } else {
             char *var_name = cmd + 2;
@@ -1773,6 +4423,21 @@ static int execute_command(TraceViewer *viewer, const char *raw_cmd) {
     else if (strcmp(cmd, "q") == 0 || strcmp(cmd, "quit") == 0) {
         return 1;
     }
+    // Handle 'checkpoints' command
+    else if (strcmp(cmd, "checkpoints") == 0) {
+        list_checkpoints(viewer);
+    }
+    // Handle 'live' command (evaluate in a re-run of the program)
+    else if (strcmp(cmd, "live") == 0 || strncmp(cmd, "live ", 5) == 0) {
+        char *expression = cmd + 4;
+        while (isspace((unsigned char)*expression)) expression++;
+        if (strlen(expression) > 0) {
+            live_eval(viewer, expression);
+        } else {
+            printf("\033[1;31m✗ Usage: live <expression>\033[0m\n");
+            printf("Example: live my_object.cache.keys()\n");
+        }
+    }
     // Eval
     else if (strncmp(cmd, "eval ", 5) == 0) {
         char *expression = cmd + 5;
@@ -1889,15 +4554,25 @@ static const char* g_tui_help_lines[] = {
     "Navigation",
     "  n, next              step to next execution",
     "  back, prev           step to previous execution",
+    "  over                 next line of this call, stepping over calls",
+    "  out                  line after this call returns, in the caller",
+    "  reverse-out          line that made this call",
     "  :<number>            jump to execution number",
     "  c, continue          continue to next breakpoint or watchpoint",
     "  rc                   reverse-continue to previous breakpoint or watchpoint",
     "  jump <line>          jump to first trace entry for a source line",
+    "  threads              list recorded threads",
+    "  thread <n|all>       follow one thread with n/back/c/rc, or all threads",
+    "  tasks                list recorded asyncio tasks",
+    "  task <n|all>         follow one asyncio task, or all tasks",
+    "  procs                list the processes of a program that forked",
+    "  proc <pid>           open the trace of another process",
     "",
     "Breakpoints and Watchpoints",
     "  b <file> <line>      set a breakpoint",
     "  b, list              list breakpoints",
     "  w <var>              watch variable reads and writes",
+    "  w <expr>             watch a recorded expression's changes",
     "  rw <var>             watch variable reads",
     "  ww <var>             watch variable writes",
     "  listw                list watchpoints",
@@ -1908,6 +4583,8 @@ static const char* g_tui_help_lines[] = {
     "  summary              print trace summary in the log",
     "  find <var>           search captured variables",
     "  eval <expr>          evaluate a Python expression from captured values",
+    "  checkpoints          list the recorder's checkpoints of the program",
+    "  live <expr>          evaluate in the live program, re-run to this step",
     "",
     "TUI",
     "  help                 open this help view",
@@ -2181,7 +4858,7 @@ static int tui_line_has_breakpoint(TraceViewer *viewer, const char *filename, in
 }
 
 static FILE* tui_open_current_source(TraceViewer *viewer, char *resolved_path, size_t resolved_size) {
-    TraceEntry *entry = &viewer->entries[viewer->current_entry];
+    TraceEntry *entry = get_entry(viewer, viewer->current_entry);
     FILE *file = fopen(entry->filename, "r");
 
     if (file) {
@@ -2200,7 +4877,7 @@ static FILE* tui_open_current_source(TraceViewer *viewer, char *resolved_path, s
 
 static void tui_render_header(TuiState *state, int cols) {
     TraceViewer *viewer = state->viewer;
-    TraceEntry *entry = &viewer->entries[viewer->current_entry];
+    TraceEntry *entry = get_entry(viewer, viewer->current_entry);
     const char *stop_reason = is_at_breakpoint(viewer, viewer->current_entry) ? "breakpoint" : "line";
 
     tui_draw_box(1, 1, 3, cols, "");
@@ -2216,7 +4893,7 @@ static void tui_render_header(TuiState *state, int cols) {
 
 static void tui_render_source(TuiState *state, int row, int col, int height, int width) {
     TraceViewer *viewer = state->viewer;
-    TraceEntry *entry = &viewer->entries[viewer->current_entry];
+    TraceEntry *entry = get_entry(viewer, viewer->current_entry);
     char resolved_path[1026] = {0};
     FILE *file;
     int inner_rows = height - 2;
@@ -2293,6 +4970,9 @@ static const char* tui_watchpoint_type_name(WatchpointType type) {
     if (type == WATCHPOINT_WRITE) {
         return "write";
     }
+    if (type == WATCHPOINT_VALUE) {
+        return "value";
+    }
     return "read/write";
 }
 
@@ -2360,7 +5040,6 @@ static void tui_append_text(char *dest, size_t dest_size, size_t *dest_len, cons
 
 static void tui_render_locals(TuiState *state, int row, int col, int height, int width) {
     TraceViewer *viewer = state->viewer;
-    TraceEntry *entry = &viewer->entries[viewer->current_entry];
     VarState curr_vars[MAX_VARS];
     VarState prev_vars[MAX_VARS];
     int curr_count = 0;
@@ -2370,10 +5049,10 @@ static void tui_render_locals(TuiState *state, int row, int col, int height, int
 
     tui_draw_box(row, col, height, width, "locals / watches / diff-highlighted");
 
-    parse_variables(entry->variables, curr_vars, &curr_count, MAX_VARS);
-    if (viewer->current_entry > 0) {
-        parse_variables(viewer->entries[viewer->current_entry - 1].variables,
-                        prev_vars, &prev_count, MAX_VARS);
+    parse_variables(entry_variables(viewer, viewer->current_entry), curr_vars, &curr_count, MAX_VARS);
+    int previous = step_entry(viewer, viewer->current_entry, -1);
+    if (previous >= 0) {
+        parse_variables(entry_variables(viewer, previous), prev_vars, &prev_count, MAX_VARS);
     }
 
     tui_printf_clipped(out_row++, col + 2, width - 4,
@@ -2412,8 +5091,10 @@ static void tui_render_locals(TuiState *state, int row, int col, int height, int
         tui_draw_horizontal(out_row++, col + 1, width - 2);
         tui_printf_clipped(out_row++, col + 2, width - 4, "watches");
         for (int i = 0; i < viewer->watchpoint_count && out_row < last_row; i++) {
-            const char *value = tui_find_var_value(curr_vars, curr_count,
-                                                   viewer->watchpoints[i].variable);
+            Watchpoint *wp = &viewer->watchpoints[i];
+            const char *value = wp->type == WATCHPOINT_VALUE
+                ? watch_value_at(viewer, wp->watch, viewer->current_entry)
+                : tui_find_var_value(curr_vars, curr_count, wp->variable);
             tui_printf_clipped(out_row++, col + 2, width - 4,
                                "%s (%s) = %s",
                                viewer->watchpoints[i].variable,
@@ -2439,13 +5120,17 @@ static void tui_render_lower_trace(TuiState *state, int row, int col, int rows,
 
     for (int i = 0; i < rows && start + i < viewer->entry_count; i++) {
         int index = start + i;
-        TraceEntry *entry = &viewer->entries[index];
+        TraceEntry *entry = get_entry(viewer, index);
         char rendered[MAX_LINE_LENGTH + 128];
         char marker = index == viewer->current_entry ? '>' : ' ';
 
-        snprintf(rendered, sizeof(rendered), "%c [%ld] %s:%d  %s",
-                 marker, entry->exec_order, get_basename(entry->filename),
-                 entry->line_number, entry->code);
+        int length = snprintf(rendered, sizeof(rendered), "%c [%ld] %s:%d  %s",
+                              marker, entry->exec_order, get_basename(entry->filename),
+                              entry->line_number, entry->code);
+        if (entry->elided > 0 && length >= 0 && (size_t)length < sizeof(rendered)) {
+            snprintf(rendered + length, sizeof(rendered) - length, "  (…%ld iterations elided)",
+                     entry->elided);
+        }
         if (index == viewer->current_entry) {
             printf("\033[7m");
             tui_write_clipped(row + i, col, width, rendered);
@@ -3110,14 +5795,24 @@ static void run_tui_viewer(TraceViewer *viewer) {
 }
 
 int main(int argc, char *argv[]) {
+    TraceViewer viewer;
+
+    if (argc == 3 && strcmp(argv[1], "--text") == 0) {
+        if (!read_trace_file(argv[2], &viewer)) {
+            return 1;
+        }
+        dump_trace_text(&viewer, stdout);
+        cleanup(&viewer);
+        return 0;
+    }
+
     if (argc != 2) {
         fprintf(stderr, "Usage: %s <trace_file>\n", argv[0]);
+        fprintf(stderr, "       %s --text <trace_file>\n", argv[0]);
         fprintf(stderr, "Example: %s trace.log\n", argv[0]);
         return 1;
     }
 
-    TraceViewer viewer;
-
     printf("\033[1;36m╔════════════════════════════════════════════════════════╗\033[0m\n");
     printf("\033[1;36m║         Python Time-Traveling Debugger v1.0          ║\033[0m\n");
     printf("\033[1;36m╚════════════════════════════════════════════════════════╝\033[0m\n\n");
@@ -3134,7 +5829,15 @@ int main(int argc, char *argv[]) {
         return 0;
     }
 
-    printf("✓ Loaded %d execution steps\n", viewer.entry_count);
+    if (viewer.segment_count > 0) {
+        printf("✓ Loaded %d execution steps in %d segments\n", viewer.entry_count, viewer.segment_count);
+    } else {
+        printf("✓ Loaded %d execution steps\n", viewer.entry_count);
+    }
+    if (viewer.dropped_events > 0) {
+        printf("\033[1;33m⚠ %ld steps were dropped while recording (backpressure=drop)\033[0m\n",
+               viewer.dropped_events);
+    }
     
     // Set global pointer for autocomplete access
     g_viewer = &viewer;